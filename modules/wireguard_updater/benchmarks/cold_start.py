@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures the cold start of each updater handler: how long importing main takes and how long the first invocation
+# takes in a fresh interpreter. AWS calls are answered by botocore stubs, so the numbers cover client construction
+# and handler work but not network latency.
+#
+#   python modules/wireguard_updater/benchmarks/cold_start.py --runs 10 --output cold_start.json
+
+PYTHON_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_code')
+HANDLERS = ['get_client_config_file', 'add_new_client', 'handle_stream_updates']
+ENVIRONMENT = {
+    'AWS_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'DYNAMODB_TABLE_NAME': 'wireguard-updater',
+    'STATE_TABLE_NAME': 'wireguard-updater-state',
+}
+REGISTRY_ITEM = {
+    'PK': {'S': 'REGISTRY'},
+    'SK': {'S': 'ENVIRONMENT#dev'},
+    'Environment': {'S': 'dev'},
+    'PublicKey': {'S': 'server_public_key'},
+    'WireguardEndpoint': {'S': '203.0.113.10:51820'},
+    'VpcCidr': {'S': '10.50.0.0/16'},
+    'InstanceId': {'S': 'i-0123456789abcdef0'},
+}
+CLIENT_ITEM = {
+    'ClientIP': {'S': '192.168.2.5/32'},
+    'PublicKey': {'S': 'client_public_key'},
+    'Environments': {'L': [{'S': 'dev'}]},
+}
+
+
+def stub_registry(stubber):
+    # The first read of the environment registry: its version, then its environments.
+    stubber.add_response('get_item', {'Item': {'PK': {'S': 'REGISTRY'}, 'SK': {'S': 'VERSION'}, 'Version': {'S': '1'}}})
+    stubber.add_response('query', {'Items': [REGISTRY_ITEM], 'Count': 1, 'ScannedCount': 1})
+
+
+def stub_client_table(stubber, handler):
+    if handler == 'handle_stream_updates':
+        stub_registry(stubber)
+    if handler == 'add_new_client':
+        stubber.add_response('query', {'Items': [], 'Count': 0, 'ScannedCount': 0})
+        # The ip pool block doesn't exist yet, so it is seeded from a scan of the client table and created.
+        stubber.add_response('get_item', {})
+        stubber.add_response('scan', {'Items': [], 'Count': 0, 'ScannedCount': 0})
+        stubber.add_response('put_item', {})
+        stubber.add_response('update_item', {})
+    if handler in ('get_client_config_file', 'add_new_client'):
+        # No pre-rendered config yet, so the config is rendered from the client item.
+        stubber.add_response('get_item', {})
+        stubber.add_response('get_item', {'Item': CLIENT_ITEM})
+        stub_registry(stubber)
+    if handler == 'handle_stream_updates':
+        # The client's config is pre-rendered and its key guarded.
+        stubber.add_response('update_item', {})
+        stubber.add_response('put_item', {})
+
+
+def stub_state_client(stubber, handler):
+    if handler == 'add_new_client':
+        # The client and the guard of its public key are written together.
+        stubber.add_response('transact_write_items', {})
+    if handler == 'handle_stream_updates':
+        # No hashes recorded yet, so the new config is claimed under the next sequence number, written with its delta,
+        # the claim completed and the applied hash recorded.
+        stubber.add_response('batch_get_item', {'Responses': {'wireguard-updater-state': []}, 'UnprocessedKeys': {}})
+        stubber.add_response('update_item', {'Attributes': {'Sequence': {'N': '1'}}})
+        stubber.add_response('update_item', {})
+        stubber.add_response('update_item', {})
+
+
+def stub_ssm(stubber, handler):
+    if handler != 'handle_stream_updates':
+        return
+    stubber.add_response('get_parameter', {'Parameter': {'Value': '[Interface]\nAddress = 192.168.2.2/32'}})
+    stubber.add_response('put_parameter', {'Version': 2})
+    stubber.add_response('put_parameter', {'Version': 1})
+    stubber.add_response('send_command', {'Command': {'CommandId': '00000000-0000-0000-0000-000000000000'}})
+    stubber.add_response('list_command_invocations', {
+        'CommandInvocations': [{
+            'InstanceId': 'i-0123456789abcdef0',
+            'Status': 'Success',
+            'CommandPlugins': [{'Output': 'environment=dev\napplied_sequence=1\n'}],
+        }]
+    })
+
+
+def get_event(handler):
+    if handler == 'handle_stream_updates':
+        return {'Records': [{'eventName': 'INSERT', 'dynamodb': {'SequenceNumber': '1', 'NewImage': CLIENT_ITEM}}]}
+    if handler == 'add_new_client':
+        return {'public_key': 'client_public_key', 'environments': ['dev']}
+    return {'client_ip': '192.168.2.5/32'}
+
+
+def run_child(handler):
+    sys.path.insert(0, PYTHON_CODE_DIR)
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+
+    from botocore.stub import Stubber
+    import helpers
+    # Patch client construction so the stubs are attached the moment a handler first builds a client.
+    get_ssm_client = helpers.get_ssm_client.__wrapped__
+    get_dynamodb_resource = helpers.get_dynamodb_resource.__wrapped__
+    get_dynamodb_client = helpers.get_dynamodb_client.__wrapped__
+    stubbers = []
+    clients_built = []
+
+    def stubbed_ssm_client():
+        client = get_ssm_client()
+        stubber = Stubber(client)
+        stub_ssm(stubber, handler)
+        stubber.activate()
+        stubbers.append(stubber)
+        clients_built.append('ssm')
+        return client
+
+    def stubbed_dynamodb_resource():
+        resource = get_dynamodb_resource()
+        stubber = Stubber(resource.meta.client)
+        stub_client_table(stubber, handler)
+        stubber.activate()
+        stubbers.append(stubber)
+        clients_built.append('dynamodb')
+        return resource
+
+    def stubbed_dynamodb_client():
+        client = get_dynamodb_client()
+        stubber = Stubber(client)
+        stub_state_client(stubber, handler)
+        stubber.activate()
+        stubbers.append(stubber)
+        clients_built.append('dynamodb_client')
+        return client
+
+    helpers.get_ssm_client = helpers.functools.lru_cache(maxsize=None)(stubbed_ssm_client)
+    helpers.get_dynamodb_resource = helpers.functools.lru_cache(maxsize=None)(stubbed_dynamodb_resource)
+    helpers.get_dynamodb_client = helpers.functools.lru_cache(maxsize=None)(stubbed_dynamodb_client)
+
+    invoke_started = time.perf_counter()
+    response = getattr(main, handler)(get_event(handler), {})
+    invoked = time.perf_counter()
+    for stubber in stubbers:
+        stubber.assert_no_pending_responses()
+    # A failed record is reported back rather than raised, which would hide stubs that no longer match the handler.
+    if isinstance(response, dict) and response.get('batchItemFailures'):
+        raise Exception(f"{handler} reported failed records: {response['batchItemFailures']}")
+
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'first_invoke_ms': (invoked - invoke_started) * 1000,
+        'clients_built': clients_built,
+    }))
+
+
+def measure(handler, runs):
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', handler],
+            env=dict(os.environ, **ENVIRONMENT),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # The handlers print progress; the measurement is the last line.
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return {
+        'import_ms': statistics.median(s['import_ms'] for s in samples),
+        'first_invoke_ms': statistics.median(s['first_invoke_ms'] for s in samples),
+        'clients_built': samples[0]['clients_built'],
+        'runs': runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold start latency of the wireguard updater handlers.')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to start per handler')
+    parser.add_argument('--handler', choices=HANDLERS, action='append', help='only measure these handlers')
+    parser.add_argument('--output', help='write the results as JSON to this file so they can be tracked over releases')
+    parser.add_argument('--child', choices=HANDLERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return
+
+    results = {handler: measure(handler, args.runs) for handler in (args.handler or HANDLERS)}
+    print(f"{'handler':<26}{'import (ms)':>14}{'first invoke (ms)':>20}  clients built")
+    for handler, result in results.items():
+        print(f"{handler:<26}{result['import_ms']:>14.1f}{result['first_invoke_ms']:>20.1f}  {', '.join(result['clients_built'])}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+import unittest
+
+import cold_start
+
+
+class TestColdStart(unittest.TestCase):
+
+    def test_every_handler_runs_against_its_stubs(self):
+        for handler in cold_start.HANDLERS:
+            with self.subTest(handler=handler):
+                result = subprocess.run(
+                    [sys.executable, os.path.abspath(cold_start.__file__), '--child', handler],
+                    env=dict(os.environ, **cold_start.ENVIRONMENT),
+                    capture_output=True,
+                    text=True,
+                )
+                self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_measure_reports_every_client_built(self):
+        result = cold_start.measure('handle_stream_updates', 1)
+
+        self.assertEqual(sorted(result['clients_built']), ['dynamodb', 'dynamodb_client', 'ssm'])
+        self.assertEqual(result['runs'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
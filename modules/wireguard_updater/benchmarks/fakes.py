@@ -0,0 +1,363 @@
+import copy
+import io
+import re
+import threading
+import time
+import uuid
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+# In-process stand-ins for the SSM client and the DynamoDB resource the updater uses. Each call can be slowed down by
+# a fixed latency and rate limited per API, which is where the real services hurt at scale. A throttled call either
+# waits out the limit, the way botocore's retries would, or raises ThrottlingException when raise_on_throttle is set.
+
+
+class CallRecorder:
+    def __init__(self, latency=0.0, rate_limits=None, raise_on_throttle=False):
+        self.latency = latency
+        self.rate_limits = rate_limits or {}
+        self.raise_on_throttle = raise_on_throttle
+        self.calls = {}
+        self.throttled = {}
+        self.lock = threading.Lock()
+        # When the next call of each rate limited API may go through.
+        self.windows = {}
+
+    def record(self, api):
+        with self.lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+            wait = self._throttle(api)
+        if wait > 0:
+            if self.raise_on_throttle:
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, api)
+            time.sleep(wait)
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _throttle(self, api):
+        # Allows bursts of up to the limit within a second and spaces out the calls beyond that.
+        limit = self.rate_limits.get(api)
+        if limit is None:
+            return 0
+        now = time.monotonic()
+        interval = 1 / limit
+        theoretical_arrival = max(self.windows.get(api, now), now)
+        wait = max(0, theoretical_arrival - now - 1 + interval)
+        self.windows[api] = theoretical_arrival + interval
+        if wait > 0:
+            self.throttled[api] = self.throttled.get(api, 0) + 1
+        return wait
+
+
+class FakeSsmClient:
+    def __init__(self, recorder=None, parameters=None):
+        self.recorder = recorder or CallRecorder()
+        self.parameters = {name: (value, 1) for name, value in (parameters or {}).items()}
+        self.commands = {}
+        # The config target of each instance, so its command can report the config the latest delta produces.
+        self.instance_targets = {}
+        self.lock = threading.Lock()
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self.recorder.record('GetParameter')
+        with self.lock:
+            if Name not in self.parameters:
+                raise ClientError({'Error': {'Code': 'ParameterNotFound', 'Message': ''}}, 'GetParameter')
+            value, version = self.parameters[Name]
+        return {'Parameter': {'Name': Name, 'Value': value, 'Version': version}}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        self.recorder.record('GetParameters')
+        with self.lock:
+            return {
+                'Parameters': [{'Name': n, 'Value': self.parameters[n][0]} for n in Names if n in self.parameters],
+                'InvalidParameters': [n for n in Names if n not in self.parameters],
+            }
+
+    def put_parameter(self, Name, Value, Tier='Standard', **kwargs):
+        self.recorder.record('PutParameter')
+        if len(Value) > {'Standard': 4096, 'Advanced': 8192}[Tier]:
+            raise ClientError({'Error': {'Code': 'ValidationException', 'Message': 'value too large'}}, 'PutParameter')
+        with self.lock:
+            version = self.parameters.get(Name, ('', 0))[1] + 1
+            self.parameters[Name] = (Value, version)
+        return {'Version': version, 'Tier': Tier}
+
+    def delete_parameters(self, Names):
+        self.recorder.record('DeleteParameters')
+        with self.lock:
+            for name in Names:
+                self.parameters.pop(name, None)
+        return {'DeletedParameters': Names, 'InvalidParameters': []}
+
+    def send_command(self, DocumentName, Parameters, InstanceIds=None, Targets=None, **kwargs):
+        self.recorder.record('SendCommand')
+        command_id = str(uuid.uuid4())
+        instance_ids = list(InstanceIds or [])
+        for target in Targets or []:
+            if target['Key'] != 'InstanceIds':
+                raise NotImplementedError(target['Key'])
+            instance_ids += target['Values']
+        with self.lock:
+            self.commands[command_id] = instance_ids
+        return {'Command': {'CommandId': command_id}}
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_command_invocations':
+            raise NotImplementedError(operation_name)
+        return FakeCommandInvocationPaginator(self)
+
+
+class FakeCommandInvocationPaginator:
+    def __init__(self, ssm_client):
+        self.ssm_client = ssm_client
+
+    def paginate(self, CommandId, Details=False):
+        self.ssm_client.recorder.record('ListCommandInvocations')
+        instance_ids = self.ssm_client.commands[CommandId]
+        return [{'CommandInvocations': [self.get_invocation(i) for i in instance_ids]}]
+
+    def get_invocation(self, instance_id):
+        # Like the apply document, reports the sequence and hash of the config the server ends up at.
+        target = self.ssm_client.instance_targets.get(instance_id)
+        delta, _ = self.ssm_client.parameters.get(f'/{target}/wireguard/config_delta', ('', 0))
+        header = delta.split('\n', 1)[0].split()
+        output = f'applied_sequence={header[2]}\napplied_hash={header[4]}\n' if len(header) == 5 else ''
+        return {'InstanceId': instance_id, 'Status': 'Success', 'CommandPlugins': [{'Output': output}]}
+
+
+class ExpressionEvaluator:
+    # Understands the handful of update and condition expressions the updater writes, not DynamoDB's full grammar.
+
+    def __init__(self, names=None, values=None):
+        self.names = names or {}
+        self.values = values or {}
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    def operand(self, item, token):
+        token = token.strip()
+        match = re.fullmatch(r'if_not_exists\((.+?),\s*(.+)\)', token)
+        if match:
+            name = self.name(match.group(1).strip())
+            return item[name] if name in item else self.operand(item, match.group(2))
+        for operator in [' + ', ' - ']:
+            if operator in token:
+                left, right = token.rsplit(operator, 1)
+                a, b = self.operand(item, left), self.operand(item, right)
+                return a + b if operator == ' + ' else a - b
+        if token.startswith(':'):
+            return self.values[token]
+        return item.get(self.name(token))
+
+    def condition(self, item, expression):
+        if expression is None:
+            return True
+        return any(all(self.atom(item, atom) for atom in clause.split(' AND ')) for clause in expression.split(' OR '))
+
+    def atom(self, item, atom):
+        atom = atom.strip()
+        match = re.fullmatch(r'attribute_(not_)?exists\((.+)\)', atom)
+        if match:
+            exists = self.name(match.group(2).strip()) in item
+            return not exists if match.group(1) else exists
+        for operator in ['<>', '<', '=']:
+            if operator in atom:
+                left, right = atom.split(operator, 1)
+                left, right = self.operand(item, left), self.operand(item, right)
+                if operator == '<':
+                    return left is not None and left < right
+                return (left != right) if operator == '<>' else left == right
+        raise NotImplementedError(atom)
+
+    def update(self, item, expression):
+        updated = []
+        for clause, body in re.findall(r'(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)', expression):
+            for action in self.split(body):
+                if clause == 'SET':
+                    name, value = action.split('=', 1)
+                    name = self.name(name.strip())
+                    item[name] = self.operand(item, value)
+                elif clause == 'ADD':
+                    name, value = action.split()
+                    name = self.name(name)
+                    item[name] = item.get(name, 0) + self.operand(item, value)
+                else:
+                    name = self.name(action.strip())
+                    item.pop(name, None)
+                updated.append(name)
+        return updated
+
+    @staticmethod
+    def split(body):
+        # Splits on the commas between actions, not the ones inside function calls.
+        parts, depth, current = [], 0, ''
+        for char in body:
+            depth += char == '('
+            depth -= char == ')'
+            if char == ',' and depth == 0:
+                parts.append(current)
+                current = ''
+            else:
+                current += char
+        return parts + [current]
+
+
+def key_matches(item, condition):
+    expression = condition.get_expression()
+    operator, values = expression['operator'], expression['values']
+    if operator == 'AND':
+        return all(key_matches(item, value) for value in values)
+    value = item.get(values[0].name)
+    if operator == '=':
+        return value == values[1]
+    if operator == 'begins_with':
+        return isinstance(value, str) and value.startswith(values[1])
+    raise Exception(f"key_matches: unsupported key condition {operator}")
+
+
+def serialize_item(item):
+    return {k: TypeSerializer().serialize(v) for k, v in item.items()}
+
+
+def deserialize_item(item):
+    return {k: TypeDeserializer().deserialize(v) for k, v in item.items()}
+
+
+def conditional_check_failed(operation, item=None):
+    error = {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}}
+    if item is not None:
+        error['Item'] = serialize_item(item)
+    return ClientError(error, operation)
+
+
+class FakeTable:
+    def __init__(self, name, key_names, recorder):
+        self.name = name
+        self.key_names = key_names
+        self.recorder = recorder
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def _key(self, key):
+        return tuple(key[k] for k in self.key_names)
+
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        self.recorder.record('GetItem')
+        with self.lock:
+            item = self.items.get(self._key(Key))
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        self.recorder.record('PutItem')
+        evaluator = ExpressionEvaluator(ExpressionAttributeNames, ExpressionAttributeValues)
+        with self.lock:
+            key = self._key(Item)
+            if not evaluator.condition(self.items.get(key, {}), ConditionExpression):
+                raise conditional_check_failed('PutItem')
+            self.items[key] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', ReturnValuesOnConditionCheckFailure='NONE'):
+        self.recorder.record('UpdateItem')
+        evaluator = ExpressionEvaluator(ExpressionAttributeNames, ExpressionAttributeValues)
+        with self.lock:
+            key = self._key(Key)
+            item = copy.deepcopy(self.items.get(key, {}))
+            if not evaluator.condition(item, ConditionExpression):
+                old_item = item if ReturnValuesOnConditionCheckFailure == 'ALL_OLD' else None
+                raise conditional_check_failed('UpdateItem', old_item)
+            item.update(Key)
+            updated = evaluator.update(item, UpdateExpression)
+            self.items[key] = item
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': {name: item[name] for name in updated if name in item}}
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        self.recorder.record('DeleteItem')
+        evaluator = ExpressionEvaluator(ExpressionAttributeNames, ExpressionAttributeValues)
+        with self.lock:
+            key = self._key(Key)
+            if not evaluator.condition(self.items.get(key, {}), ConditionExpression):
+                raise conditional_check_failed('DeleteItem')
+            self.items.pop(key, None)
+        return {}
+
+    def query(self, KeyConditionExpression, ExclusiveStartKey=None, **kwargs):
+        # Key conditions are the boto3 condition objects, so they are matched directly instead of parsed.
+        self.recorder.record('Query')
+        with self.lock:
+            return {'Items': [copy.deepcopy(item) for item in self.items.values() if key_matches(item, KeyConditionExpression)]}
+
+    def scan(self, ExclusiveStartKey=None, **kwargs):
+        self.recorder.record('Scan')
+        with self.lock:
+            return {'Items': [copy.deepcopy(item) for item in self.items.values()]}
+
+
+class FakeDynamoDbResource:
+    def __init__(self, recorder=None, tables=None):
+        self.recorder = recorder or CallRecorder()
+        self.tables = {name: FakeTable(name, key_names, self.recorder) for name, key_names in (tables or {}).items()}
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        self.recorder.record('BatchGetItem')
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.tables[table_name]
+            with table.lock:
+                items = [table.items.get(table._key(key)) for key in request['Keys']]
+            responses[table_name] = [copy.deepcopy(item) for item in items if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class FakeDynamoDbClient:
+    # The plain client over the resource's tables, which takes and returns typed attribute values.
+    def __init__(self, resource):
+        self.resource = resource
+
+    def update_item(self, TableName, Key, ExpressionAttributeValues=None, **kwargs):
+        values = deserialize_item(ExpressionAttributeValues) if ExpressionAttributeValues is not None else None
+        response = self.resource.tables[TableName].update_item(
+            Key=deserialize_item(Key), ExpressionAttributeValues=values, **kwargs
+        )
+        if 'Attributes' in response:
+            response['Attributes'] = serialize_item(response['Attributes'])
+        return response
+
+    def batch_get_item(self, RequestItems):
+        request_items = {
+            table_name: dict(request, Keys=[deserialize_item(key) for key in request['Keys']])
+            for table_name, request in RequestItems.items()
+        }
+        response = self.resource.batch_get_item(request_items)
+        response['Responses'] = {
+            table_name: [serialize_item(item) for item in items] for table_name, items in response['Responses'].items()
+        }
+        return response
+
+
+class FakeS3Client:
+    def __init__(self, recorder=None):
+        self.recorder = recorder or CallRecorder()
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.recorder.record('PutObject')
+        with self.lock:
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {'ETag': f'"{uuid.uuid4().hex}"'}
+
+    def get_object(self, Bucket, Key):
+        self.recorder.record('GetObject')
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': ''}}, 'GetObject')
+            return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
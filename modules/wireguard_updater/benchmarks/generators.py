@@ -0,0 +1,98 @@
+import base64
+import ipaddress
+import random
+
+# Synthetic WireGuard configs and DynamoDB stream events. Everything is derived from a seeded random.Random so runs
+# with the same arguments produce the same data.
+
+CLIENT_NETWORK = ipaddress.ip_network('10.64.0.0/10')
+
+
+def make_public_key(rng):
+    return base64.b64encode(rng.randbytes(32)).decode('ascii')
+
+
+def make_client_ip(index):
+    return f'{CLIENT_NETWORK.network_address + 16 + index}/32'
+
+
+def make_clients(count, environments, rng, start=0):
+    # Every client gets a key and one to all of the environments.
+    return [
+        {
+            'client_ip': make_client_ip(start + i),
+            'public_key': make_public_key(rng),
+            'environments': sorted(rng.sample(environments, rng.randint(1, len(environments)))),
+        }
+        for i in range(count)
+    ]
+
+
+def make_server_config(env_index, peers):
+    lines = [
+        '[Interface]',
+        f'Address = 192.168.2.{2 + env_index}/32',
+        f'ListenPort = {51820 + env_index}',
+        'PrivateKey = ' + base64.b64encode(bytes([env_index % 256]) * 32).decode('ascii'),
+    ]
+    for public_key, client_ip in peers:
+        lines += ['', '[Peer]', f'PublicKey = {public_key}', f'AllowedIPs = {client_ip}']
+    return '\n'.join(lines)
+
+
+def make_server_configs(environments, clients):
+    peers = {env: [] for env in environments}
+    for client in clients:
+        for env in client['environments']:
+            peers[env].append((client['public_key'], client['client_ip']))
+    return {env: make_server_config(i, peers[env]) for i, env in enumerate(environments)}
+
+
+def make_image(client):
+    return {
+        'ClientIP': {'S': client['client_ip']},
+        'PublicKey': {'S': client['public_key']},
+        'Environments': {'L': [{'S': env} for env in client['environments']]},
+    }
+
+
+def make_stream_records(clients, environments, count, rng, start=0):
+    # A mix of new clients, rekeyed or moved clients and removed clients, the way a busy day looks on the stream.
+    records = []
+    new_clients = make_clients(count, environments, rng, start=start)
+    existing = list(clients)
+    rng.shuffle(existing)
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.5 or len(existing) == 0:
+            records.append({'eventName': 'INSERT', 'dynamodb': {'NewImage': make_image(new_clients[i])}})
+        elif kind < 0.8:
+            old = existing.pop()
+            new = dict(old, public_key=make_public_key(rng), environments=sorted(rng.sample(environments, rng.randint(1, len(environments)))))
+            records.append({'eventName': 'MODIFY', 'dynamodb': {'OldImage': make_image(old), 'NewImage': make_image(new)}})
+        else:
+            old = existing.pop()
+            records.append({'eventName': 'REMOVE', 'dynamodb': {'OldImage': make_image(old)}})
+    for i, record in enumerate(records):
+        record['dynamodb']['SequenceNumber'] = str(start + i + 1).zfill(21)
+    return records
+
+
+def get_environment_map(environments):
+    return {
+        env: {
+            'public_key': base64.b64encode(bytes([i % 256]) * 32).decode('ascii'),
+            'wireguard_endpoint': f'203.0.113.{10 + i}:{51820 + i}',
+            'vpc_cidr': f'10.{i % 64}.0.0/16',
+            'instance_id': f'i-{i:017x}',
+        }
+        for i, env in enumerate(environments)
+    }
+
+
+def get_environments(count):
+    return [f'env{i:03d}' for i in range(count)]
+
+
+def get_rng(seed):
+    return random.Random(seed)
@@ -0,0 +1,385 @@
+import argparse
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Load tests the updater against in-process stand-ins for SSM, S3 and DynamoDB (see fakes.py) with synthetic configs
+# and stream batches (see generators.py). Reports how long each phase takes, how much memory it peaks at and how many
+# calls it makes per AWS API, and compares the results with a baseline so regressions fail the run.
+#
+# The committed baselines.json holds what is the same on every machine for a seed: the AWS call counts, the traced
+# memory peaks, which only change with the code and the Python version, and the total time of a stream batch against
+# fakes that answer every call after GATED_LATENCY, which is mostly spent waiting on them. The default run includes
+# that batch and --update-baseline refreshes all three. Every other timing depends on the machine, so it is only
+# compared against a run saved with --output on the same machine, e.g. before and after a change:
+#
+#   python modules/wireguard_updater/benchmarks/load_test.py
+#   python modules/wireguard_updater/benchmarks/load_test.py --peers 50000 --environments 20 --latency 0.02 \
+#       --rate-limit PutParameter=3 --rate-limit SendCommand=5
+#   python modules/wireguard_updater/benchmarks/load_test.py --update-baseline
+#   python modules/wireguard_updater/benchmarks/load_test.py --output /tmp/before.json
+#   python modules/wireguard_updater/benchmarks/load_test.py --baseline /tmp/before.json
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PYTHON_CODE_DIR = os.path.join(BENCHMARKS_DIR, '..', 'python_code')
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baselines.json')
+ENVIRONMENT = {
+    'AWS_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'DYNAMODB_TABLE_NAME': 'wireguard-updater',
+    'STATE_TABLE_NAME': 'wireguard-updater-state',
+    'CONFIG_BUCKET_NAME': 'wireguard-updater-config',
+    'CLIENT_CIDR': '10.64.0.0/10',
+}
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, PYTHON_CODE_DIR)
+os.environ.update({k: v for k, v in ENVIRONMENT.items() if k not in os.environ})
+
+import fakes  # noqa: E402
+import generators  # noqa: E402
+import helpers  # noqa: E402
+import main as handlers  # noqa: E402
+
+# The helpers handle_stream_updates goes through, timed individually.
+STREAM_PHASES = [
+    'coalesce_stream_records',
+    'get_config_files',
+    'get_environment_states',
+    'get_dirty_config_files',
+    'get_config_files_to_apply',
+    'update_config_file_parameters',
+    'record_config_hashes',
+    'publish_config_deltas',
+    'send_commands',
+    'check_status_of_commands',
+    'materialize_client_configs',
+    'release_client_ips',
+    'sync_public_key_guards',
+]
+# Timings below this many milliseconds are too noisy to call a regression.
+MIN_REGRESSION_MS = 5
+# Memory peaks below this many KiB are too noisy to call a regression.
+MIN_REGRESSION_KIB = 256
+# The fixed latency and size of the stream batch whose total time is kept in the committed baseline.
+GATED_LATENCY = 0.02
+GATED_PEERS = 1000
+
+
+class PhaseTimer:
+    # Wraps the helpers a handler calls and adds up the time and peak traced memory of each one.
+
+    def __init__(self, phases, trace_memory=False):
+        self.phases = phases
+        self.trace_memory = trace_memory
+        self.results = {phase: {'ms': 0.0, 'peak_kib': 0.0, 'calls': 0} for phase in phases}
+        # Each phase resets the traced peak, so the handler's overall peak is kept here.
+        self.peak = 0
+
+    def wrap(self, phase, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if self.trace_memory:
+                self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                result = self.results[phase]
+                result['ms'] += (time.perf_counter() - started) * 1000
+                result['calls'] += 1
+                if self.trace_memory:
+                    self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                    peak = (tracemalloc.get_traced_memory()[1] - before) / 1024
+                    result['peak_kib'] = max(result['peak_kib'], peak)
+        return timed
+
+    @contextlib.contextmanager
+    def patched(self):
+        originals = {phase: getattr(helpers, phase) for phase in self.phases}
+        for phase, function in originals.items():
+            setattr(helpers, phase, self.wrap(phase, function))
+        try:
+            yield self
+        finally:
+            for phase, function in originals.items():
+                setattr(helpers, phase, function)
+
+
+@contextlib.contextmanager
+def fake_aws(recorder, config_store):
+    # Points the helpers' lazily built clients at the fakes for the duration of a scenario.
+    ssm_client = fakes.FakeSsmClient(recorder)
+    s3_client = fakes.FakeS3Client(recorder)
+    dynamodb_resource = fakes.FakeDynamoDbResource(recorder, {
+        ENVIRONMENT['DYNAMODB_TABLE_NAME']: ['ClientIP'],
+        ENVIRONMENT['STATE_TABLE_NAME']: ['PK', 'SK'],
+    })
+    dynamodb_client = fakes.FakeDynamoDbClient(dynamodb_resource)
+    client_table = dynamodb_resource.Table(ENVIRONMENT['DYNAMODB_TABLE_NAME'])
+    state_table = dynamodb_resource.Table(ENVIRONMENT['STATE_TABLE_NAME'])
+    ip_allocator = helpers.IpAllocator(state_table, ENVIRONMENT['CLIENT_CIDR'])
+    getters = {
+        'get_ssm_client': lambda: ssm_client,
+        'get_s3_client': lambda: s3_client,
+        'get_dynamodb_resource': lambda: dynamodb_resource,
+        'get_dynamodb_client': lambda: dynamodb_client,
+        'get_table_client': lambda: client_table,
+        'get_state_table_client': lambda: state_table,
+        'get_ip_allocator': lambda: ip_allocator,
+        'get_config_store': functools.partial(helpers.get_config_store, config_store),
+    }
+    originals = {name: getattr(helpers, name) for name in getters}
+    for name, getter in getters.items():
+        setattr(helpers, name, getter)
+    # The cached registry holds on to the state table it was built with.
+    helpers.get_environment_registry.cache_clear()
+    try:
+        yield ssm_client, dynamodb_resource
+    finally:
+        for name, getter in originals.items():
+            setattr(helpers, name, getter)
+        helpers.get_environment_registry.cache_clear()
+
+
+@contextlib.contextmanager
+def quiet():
+    # The handlers print every step and the whole event; keep that out of the report.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def measure(function, repeat, trace_memory):
+    samples = []
+    peak_kib = 0.0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    if trace_memory:
+        tracemalloc.start()
+        function()
+        peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return {'ms': min(samples), 'peak_kib': peak_kib, 'calls': {}}
+
+
+def run_peer_ops(peers, args):
+    # The config edits a single stream record causes, on a config that already holds the given number of peers.
+    rng = generators.get_rng(args.seed)
+    [env] = generators.get_environments(1)
+    clients = generators.make_clients(peers, [env], rng)
+    config_str = generators.make_server_configs([env], clients)[env]
+    existing = clients[len(clients) // 2]
+    new = generators.make_clients(1, [env], rng, start=peers)[0]
+
+    def edit(peer_changes):
+        return helpers.get_dirty_config_files({env: config_str}, {env: peer_changes})
+
+    with quiet():
+        new_config_str = edit({new['public_key']: new['client_ip']})[env]
+    operations = {
+        'add_peer': lambda: edit({new['public_key']: new['client_ip']}),
+        'remove_peer': lambda: edit({existing['public_key']: None}),
+        'rekey_peer': lambda: edit({existing['public_key']: None, new['public_key']: existing['client_ip']}),
+        'get_config_delta': lambda: helpers.get_config_delta(config_str, new_config_str),
+        'get_config_hash': lambda: helpers.get_config_hash(config_str),
+    }
+    with quiet():
+        return {name: measure(operation, args.repeat, not args.no_memory) for name, operation in operations.items()}
+
+
+def seed_stream_scenario(ssm_client, dynamodb_resource, environments, clients):
+    # Registers the environments, puts the clients in the client table, claims their ips and stores every server's
+    # current config.
+    registry = helpers.get_environment_registry()
+    for env, metadata in generators.get_environment_map(environments).items():
+        registry.put_environment(env, metadata)
+        ssm_client.instance_targets[metadata['instance_id']] = env
+    client_table = dynamodb_resource.Table(ENVIRONMENT['DYNAMODB_TABLE_NAME'])
+    for client in clients:
+        client_table.items[(client['client_ip'],)] = {
+            'ClientIP': client['client_ip'],
+            'PublicKey': client['public_key'],
+            'Environments': client['environments'],
+        }
+    helpers.get_ip_allocator().allocate_many(len(clients), helpers.get_all_taken_client_ips)
+    for env, config_str in generators.make_server_configs(environments, clients).items():
+        helpers.get_config_store().write(env, config_str)
+
+
+def run_stream(peers, args):
+    # One batch of stream records against environments that each already hold the given number of peers.
+    rng = generators.get_rng(args.seed)
+    environments = generators.get_environments(args.environments)
+    clients = [dict(client, environments=environments) for client in generators.make_clients(peers, environments, rng)]
+    records = generators.make_stream_records(clients, environments, args.records, rng, start=peers)
+
+    recorder = fakes.CallRecorder()
+    with quiet(), fake_aws(recorder, args.config_store) as (ssm_client, dynamodb_resource):
+        seed_stream_scenario(ssm_client, dynamodb_resource, environments, clients)
+        # Only the handler's own calls count; latency and rate limits apply from here on.
+        recorder.calls, recorder.throttled = {}, {}
+        recorder.latency, recorder.rate_limits = args.latency, args.rate_limits
+        trace_memory = not args.no_memory
+        timer = PhaseTimer(STREAM_PHASES, trace_memory)
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        with timer.patched():
+            handlers.handle_stream_updates({'Records': records}, {})
+        total_ms = (time.perf_counter() - started) * 1000
+        total_peak_kib = 0.0
+        if trace_memory:
+            total_peak_kib = max(timer.peak, tracemalloc.get_traced_memory()[1]) / 1024
+            tracemalloc.stop()
+
+    results = {phase: dict(result, calls={}) for phase, result in timer.results.items() if result['calls'] > 0}
+    results['total'] = {
+        'ms': total_ms,
+        'peak_kib': total_peak_kib,
+        'calls': dict(sorted(recorder.calls.items())),
+        'throttled': dict(sorted(recorder.throttled.items())),
+    }
+    return results
+
+
+SCENARIOS = {'peer_ops': run_peer_ops, 'stream': run_stream}
+
+
+def get_scenario_name(scenario, peers, args):
+    if scenario != 'stream':
+        return f'{scenario}/{peers}'
+    # Runs against slower or throttled fakes are only ever compared with baselines taken the same way.
+    name = f'stream/{args.config_store}/{peers}x{args.environments}/{args.records}'
+    if args.latency > 0:
+        name += f'/latency={args.latency}'
+    for api, limit in sorted(args.rate_limits.items()):
+        name += f'/{api}={limit}'
+    return name
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for scenario, phases in results.items():
+        for phase, result in phases.items():
+            expected = baseline.get(scenario, {}).get(phase)
+            if expected is None:
+                continue
+            name = f'{scenario} {phase}'
+            # Only what the baseline has is checked, see get_baseline_entry for what the committed one keeps.
+            if ('ms' in expected and result['ms'] > expected['ms'] * (1 + tolerance)
+                    and result['ms'] - expected['ms'] > MIN_REGRESSION_MS):
+                regressions.append(f"{name} took {result['ms']:.1f} ms, the baseline is {expected['ms']:.1f} ms")
+            if ('peak_kib' in expected and result['peak_kib'] > expected['peak_kib'] * (1 + tolerance)
+                    and result['peak_kib'] - expected['peak_kib'] > MIN_REGRESSION_KIB):
+                regressions.append(
+                    f"{name} peaked at {result['peak_kib']:.0f} KiB, the baseline is {expected['peak_kib']:.0f} KiB")
+            # Call counts are deterministic for a seed, so any increase is a regression.
+            expected_calls = expected.get('calls', {})
+            for api, count in result['calls'].items():
+                if count > expected_calls.get(api, 0):
+                    regressions.append(f"{name} made {count} {api} calls, the baseline is {expected_calls.get(api, 0)}")
+    return regressions
+
+
+def get_baseline_entry(scenario, phase, result, trace_memory):
+    entry = {'calls': result['calls']}
+    if trace_memory:
+        entry['peak_kib'] = round(result['peak_kib'])
+    if phase == 'total' and '/latency=' in scenario:
+        entry['ms'] = round(result['ms'], 1)
+    return entry
+
+
+def print_results(results):
+    print(f"{'scenario':<40}{'phase':<32}{'ms':>12}{'peak KiB':>12}  calls")
+    for scenario, phases in results.items():
+        for phase, result in phases.items():
+            calls = ', '.join(f'{api}={count}' for api, count in result['calls'].items())
+            if result.get('throttled'):
+                calls += ' (throttled ' + ', '.join(f'{api}={n}' for api, n in result['throttled'].items()) + ')'
+            print(f"{scenario:<40}{phase:<32}{result['ms']:>12.1f}{result['peak_kib']:>12.0f}  {calls}")
+
+
+def parse_rate_limit(value):
+    api, _, limit = value.partition('=')
+    if api == '' or limit == '':
+        raise argparse.ArgumentTypeError(f"expected API=CALLS_PER_SECOND, got {value}")
+    return api, float(limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the wireguard updater against local AWS stand-ins.')
+    parser.add_argument('--scenario', choices=list(SCENARIOS), action='append', help='only run these scenarios')
+    parser.add_argument('--peers', type=int, action='append', help='peers per server config (default 1000, 10000, 50000)')
+    parser.add_argument('--environments', type=int, default=5, help='environments in the stream scenario')
+    parser.add_argument('--records', type=int, default=100, help='stream records per batch in the stream scenario')
+    parser.add_argument('--config-store', default='s3', choices=['sharded_parameter', 's3'],
+                        help='where the stream scenario keeps server configs')
+    parser.add_argument('--latency', type=float,
+                        help='seconds added to every AWS call (default 0, plus the GATED_LATENCY stream batch)')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], dest='rate_limits',
+                        help='calls per second an AWS API allows before throttling, e.g. PutParameter=3')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per peer operation, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the generated clients and records')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory, which slows the runs down")
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown or memory growth, 0.5 is 50%%')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args()
+    args.rate_limits = dict(args.rate_limits)
+    gated = args.latency is None and args.peers is None
+    args.latency = args.latency or 0.0
+
+    scenarios = args.scenario or list(SCENARIOS)
+    runs = [(scenario, peers, args) for scenario in scenarios for peers in args.peers or [1000, 10000, 50000]]
+    if gated and 'stream' in scenarios:
+        runs.append(('stream', GATED_PEERS, argparse.Namespace(**dict(vars(args), latency=GATED_LATENCY))))
+    results = {}
+    for scenario, peers, run_args in runs:
+        results[get_scenario_name(scenario, peers, run_args)] = SCENARIOS[scenario](peers, run_args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update({
+            scenario: {
+                phase: get_baseline_entry(scenario, phase, r, not args.no_memory) for phase, r in phases.items()
+                if len(r['calls']) > 0 or not args.no_memory
+            }
+            for scenario, phases in results.items()
+        })
+        baseline = {scenario: phases for scenario, phases in baseline.items() if len(phases) > 0}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nUpdated the baseline in {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline} to compare with")
+        return
+    with open(args.baseline) as f:
+        regressions = find_regressions(results, json.load(f), args.tolerance)
+    if len(regressions) > 0:
+        print('\nRegressions against the baseline:\n' + '\n'.join(regressions))
+        sys.exit(1)
+    print('\nNo regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
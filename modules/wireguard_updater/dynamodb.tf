@@ -9,6 +9,19 @@ module "wireguard_updater_table" {
     {
       name = "ClientIP"
       type = "S"
+    },
+    {
+      name = "PublicKey"
+      type = "S"
+    }
+  ]
+
+  # Lets add_new_client check whether a public key is taken with a single query instead of a table scan.
+  global_secondary_indexes = [
+    {
+      name            = "PublicKeyIndex"
+      hash_key        = "PublicKey"
+      projection_type = "KEYS_ONLY"
     }
   ]
   billing_mode     = "PAY_PER_REQUEST"
@@ -43,4 +56,91 @@ module "wireguard_updater_table" {
 #     ]
 # }
 # EOF
-# }
\ No newline at end of file
+# }
+module "wireguard_updater_state_table" {
+  # Bookkeeping for the updater itself, such as the client ip pool. Kept apart from the client table so these
+  # writes never show up in its stream.
+  source  = "terraform-aws-modules/dynamodb-table/aws"
+  version = "4.1.0"
+  name    = "wireguard-updater-state"
+
+  hash_key  = "PK"
+  range_key = "SK"
+
+  attributes = [
+    {
+      name = "PK"
+      type = "S"
+    },
+    {
+      name = "SK"
+      type = "S"
+    }
+  ]
+  billing_mode = "PAY_PER_REQUEST"
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater-state"
+  }
+}
+
+locals {
+  vpn_environment_map = {
+    for env in var.vpn_environments :
+    env.environment => {
+      public_key         = env.public_key
+      wireguard_endpoint = env.wireguard_endpoint
+      vpc_cidr           = env.vpc_cidr
+      instance_id        = env.instance_id
+      servers            = env.servers
+    }
+  }
+}
+
+# The environment registry the lambdas read the servers from, one item per environment. An environment can also be
+# added at runtime with EnvironmentRegistry.put_environment, as long as it bumps the version item below.
+resource "aws_dynamodb_table_item" "environment_registry" {
+  for_each   = local.vpn_environment_map
+  table_name = module.wireguard_updater_state_table.dynamodb_table_id
+  hash_key   = "PK"
+  range_key  = "SK"
+
+  # Attributes of a single server environment are left out when it lists its servers instead.
+  item = jsonencode(merge(
+    {
+      PK          = { S = "REGISTRY" }
+      SK          = { S = "ENVIRONMENT#${each.key}" }
+      Environment = { S = each.key }
+      VpcCidr     = { S = each.value.vpc_cidr }
+    },
+    length(each.value.servers) > 0 ? {
+      Servers = { L = [
+        for server in each.value.servers : { M = {
+          ServerId          = { S = server.server_id }
+          InstanceId        = { S = server.instance_id }
+          PublicKey         = { S = server.public_key }
+          WireguardEndpoint = { S = server.wireguard_endpoint }
+        } }
+      ] }
+      } : {
+      PublicKey         = { S = each.value.public_key }
+      WireguardEndpoint = { S = each.value.wireguard_endpoint }
+      InstanceId        = { S = each.value.instance_id }
+    }
+  ))
+}
+
+# Lambdas with a cached registry only read the environments again once this version changes.
+resource "aws_dynamodb_table_item" "environment_registry_version" {
+  table_name = module.wireguard_updater_state_table.dynamodb_table_id
+  hash_key   = "PK"
+  range_key  = "SK"
+
+  item = jsonencode({
+    PK      = { S = "REGISTRY" }
+    SK      = { S = "VERSION" }
+    Version = { S = md5(jsonencode(local.vpn_environment_map)) }
+  })
+
+  depends_on = [aws_dynamodb_table_item.environment_registry]
+}
@@ -1,21 +1,3 @@
-locals {
-  # Transform the list of maps into the desired map format
-  vpn_environment_map = {
-    for env in var.vpn_environments :
-    env.environment => {
-      public_key         = env.public_key
-      wireguard_endpoint = env.wireguard_endpoint
-      vpc_cidr           = env.vpc_cidr
-      instance_id        = env.instance_id
-      status             = ""
-      command_id         = ""
-    }
-  }
-
-  # Optional: Convert the map to JSON string if needed
-  vpn_environment_map_json = jsonencode(local.vpn_environment_map)
-}
-
 module "handle_stream_updates_lambda" {
   source = "terraform-aws-modules/lambda/aws"
 
@@ -23,6 +5,7 @@ module "handle_stream_updates_lambda" {
   description   = "Lambda that listens for changes in the wireguard-updater DynamoDB table and makes appropriates updates to the WiregUrard VPN servers."
   handler       = "main.handle_stream_updates"
   runtime       = "python3.12"
+  timeout       = var.handle_stream_updates_timeout
 
   publish = true
 
@@ -34,7 +17,7 @@ module "handle_stream_updates_lambda" {
   }
 
   attach_policy_statements = true
-  policy_statements = {
+  policy_statements = merge({
     dynamodb_stream = {
       effect = "Allow",
       actions = [
@@ -45,22 +28,185 @@ module "handle_stream_updates_lambda" {
       ],
       resources = [module.wireguard_updater_table.dynamodb_table_stream_arn]
     },
+    stream_dead_letter = {
+      effect    = "Allow",
+      actions   = ["sqs:SendMessage"],
+      resources = [aws_sqs_queue.stream_dead_letter.arn]
+    },
+    dynamodb_state = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:BatchGetItem",
+        "dynamodb:PutItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:DeleteItem",
+        "dynamodb:Query"
+      ],
+      resources = [module.wireguard_updater_state_table.dynamodb_table_arn]
+    },
     ssm_access = {
       effect = "Allow",
       actions = [
         "ssm:SendCommand",
         "ssm:PutParameter",
         "ssm:GetParameter",
+        "ssm:GetParameters",
+        "ssm:DeleteParameters",
         "ssm:GetCommandInvocation",
+        "ssm:ListCommandInvocations",
         "ssm:AddTagsToResource"
       ],
       resources = ["*"]
     }
+    }, {
+    for k, v in {
+      config_bucket = {
+        effect    = "Allow",
+        actions   = ["s3:GetObject", "s3:PutObject"],
+        resources = ["${local.config_bucket_arn}/*"]
+      }
+      # Without it S3 answers 403 instead of 404 for a config object that wasn't written yet.
+      config_bucket_list = {
+        effect    = "Allow",
+        actions   = ["s3:ListBucket"],
+        resources = [local.config_bucket_arn]
+      }
+    } : k => v if var.config_store == "s3"
+    }, {
+    for k, v in {
+      config_kms_key = {
+        effect    = "Allow",
+        actions   = ["kms:Decrypt", "kms:GenerateDataKey"],
+        resources = [local.config_kms_key_arn]
+      }
+    } : k => v if var.config_store == "s3" && var.config_kms_key_id != ""
+  })
+
+  environment_variables = {
+    REGISTRY_CACHE_TTL_SECONDS     = var.registry_cache_ttl_seconds
+    DYNAMODB_TABLE_NAME            = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    SSM_MAX_CONCURRENCY            = var.ssm_max_concurrency
+    COMMAND_WAIT_TIMEOUT_SECONDS   = var.command_wait_timeout_seconds
+    WIREGUARD_APPLY_MODE           = var.wireguard_apply_mode
+    APPLY_DOCUMENT_NAME            = aws_ssm_document.apply_config.name
+    APPLY_DOCUMENT_VERSION         = aws_ssm_document.apply_config.latest_version
+    APPLY_MAX_CONCURRENCY          = var.apply_max_concurrency
+    APPLY_MAX_ERRORS               = var.apply_max_errors
+    STATE_TABLE_NAME               = module.wireguard_updater_state_table.dynamodb_table_id
+    CLIENT_CIDR                    = var.client_cidr
+    CLIENT_IP_RESERVED_COUNT       = var.client_ip_reserved_count
+    CONFIG_STORE                   = var.config_store
+    CONFIG_SHARD_TIER              = var.config_shard_tier
+    CONFIG_BUCKET_NAME             = local.config_bucket_name
+    CONFIG_KMS_KEY_ID              = var.config_kms_key_id
+    METRICS_NAMESPACE              = var.metrics_namespace
+    ENVIRONMENT_RETRY_BASE_SECONDS = var.environment_retry_base_seconds
+    ENVIRONMENT_RETRY_MAX_SECONDS  = var.environment_retry_max_seconds
   }
 
+  source_path = "./modules/wireguard_updater/python_code"
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+module "reconcile_lambda" {
+  source = "terraform-aws-modules/lambda/aws"
+
+  function_name = "reconcile_wireguard_configs"
+  description   = "Lambda that rebuilds every WireGuard server's peers from the wireguard-updater DynamoDB table and applies any drift."
+  handler       = "main.reconcile"
+  runtime       = "python3.12"
+  timeout       = var.reconcile_timeout
+  memory_size   = var.reconcile_memory_size
+
+  publish = true
+
+  allowed_triggers = {
+    Schedule = {
+      principal  = "events.amazonaws.com"
+      source_arn = aws_cloudwatch_event_rule.reconcile.arn
+    }
+  }
+
+  attach_policy_statements = true
+  policy_statements = merge({
+    dynamodb_scan = {
+      effect    = "Allow",
+      actions   = ["dynamodb:Scan"],
+      resources = [module.wireguard_updater_table.dynamodb_table_arn]
+    },
+    dynamodb_state = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:BatchGetItem",
+        "dynamodb:PutItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:Query"
+      ],
+      resources = [module.wireguard_updater_state_table.dynamodb_table_arn]
+    },
+    ssm_access = {
+      effect = "Allow",
+      actions = [
+        "ssm:SendCommand",
+        "ssm:PutParameter",
+        "ssm:GetParameter",
+        "ssm:GetParameters",
+        "ssm:DeleteParameters",
+        "ssm:GetCommandInvocation",
+        "ssm:ListCommandInvocations",
+        "ssm:AddTagsToResource"
+      ],
+      resources = ["*"]
+    }
+    }, {
+    for k, v in {
+      config_bucket = {
+        effect    = "Allow",
+        actions   = ["s3:GetObject", "s3:PutObject"],
+        resources = ["${local.config_bucket_arn}/*"]
+      }
+      # Without it S3 answers 403 instead of 404 for a config object that wasn't written yet.
+      config_bucket_list = {
+        effect    = "Allow",
+        actions   = ["s3:ListBucket"],
+        resources = [local.config_bucket_arn]
+      }
+    } : k => v if var.config_store == "s3"
+    }, {
+    for k, v in {
+      config_kms_key = {
+        effect    = "Allow",
+        actions   = ["kms:Decrypt", "kms:GenerateDataKey"],
+        resources = [local.config_kms_key_arn]
+      }
+    } : k => v if var.config_store == "s3" && var.config_kms_key_id != ""
+  })
+
   environment_variables = {
-    ENVIRONMENT_MAP     = local.vpn_environment_map_json
-    DYNAMODB_TABLE_NAME = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    REGISTRY_CACHE_TTL_SECONDS     = var.registry_cache_ttl_seconds
+    DYNAMODB_TABLE_NAME            = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    SSM_MAX_CONCURRENCY            = var.ssm_max_concurrency
+    COMMAND_WAIT_TIMEOUT_SECONDS   = var.command_wait_timeout_seconds
+    WIREGUARD_APPLY_MODE           = var.wireguard_apply_mode
+    APPLY_DOCUMENT_NAME            = aws_ssm_document.apply_config.name
+    APPLY_DOCUMENT_VERSION         = aws_ssm_document.apply_config.latest_version
+    APPLY_MAX_CONCURRENCY          = var.apply_max_concurrency
+    APPLY_MAX_ERRORS               = var.apply_max_errors
+    STATE_TABLE_NAME               = module.wireguard_updater_state_table.dynamodb_table_id
+    CONFIG_STORE                   = var.config_store
+    CONFIG_SHARD_TIER              = var.config_shard_tier
+    CONFIG_BUCKET_NAME             = local.config_bucket_name
+    CONFIG_KMS_KEY_ID              = var.config_kms_key_id
+    RECONCILE_SCAN_SEGMENTS        = var.reconcile_scan_segments
+    METRICS_NAMESPACE              = var.metrics_namespace
+    ENVIRONMENT_RETRY_BASE_SECONDS = var.environment_retry_base_seconds
+    ENVIRONMENT_RETRY_MAX_SECONDS  = var.environment_retry_max_seconds
   }
 
   source_path = "./modules/wireguard_updater/python_code"
@@ -71,6 +217,17 @@ module "handle_stream_updates_lambda" {
   }
 }
 
+resource "aws_cloudwatch_event_rule" "reconcile" {
+  name                = "reconcile-wireguard-configs"
+  description         = "Periodically rebuilds the WireGuard server configs from the wireguard-updater table."
+  schedule_expression = var.reconcile_schedule_expression
+}
+
+resource "aws_cloudwatch_event_target" "reconcile" {
+  rule = aws_cloudwatch_event_rule.reconcile.name
+  arn  = module.reconcile_lambda.lambda_function_arn
+}
+
 module "add_new_client_lambda" {
   source = "terraform-aws-modules/lambda/aws"
 
@@ -88,9 +245,23 @@ module "add_new_client_lambda" {
       actions = [
         "dynamodb:GetItem",
         "dynamodb:PutItem",
+        "dynamodb:Query",
         "dynamodb:Scan"
       ],
-      resources = [module.wireguard_updater_table.dynamodb_table_arn]
+      resources = [
+        module.wireguard_updater_table.dynamodb_table_arn,
+        "${module.wireguard_updater_table.dynamodb_table_arn}/index/*"
+      ]
+    },
+    dynamodb_state = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:Query"
+      ],
+      resources = [module.wireguard_updater_state_table.dynamodb_table_arn]
     },
     ssm_access = {
       effect = "Allow",
@@ -107,8 +278,11 @@ module "add_new_client_lambda" {
 
 
   environment_variables = {
-    ENVIRONMENT_MAP     = local.vpn_environment_map_json
-    DYNAMODB_TABLE_NAME = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    REGISTRY_CACHE_TTL_SECONDS = var.registry_cache_ttl_seconds
+    DYNAMODB_TABLE_NAME        = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    STATE_TABLE_NAME           = module.wireguard_updater_state_table.dynamodb_table_id
+    CLIENT_CIDR                = var.client_cidr
+    CLIENT_IP_RESERVED_COUNT   = var.client_ip_reserved_count
   }
 
   tags = {
@@ -129,8 +303,9 @@ module "get_client_config_file_lambda" {
   source_path = "./modules/wireguard_updater/python_code"
 
   environment_variables = {
-    ENVIRONMENT_MAP     = local.vpn_environment_map_json
-    DYNAMODB_TABLE_NAME = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    REGISTRY_CACHE_TTL_SECONDS = var.registry_cache_ttl_seconds
+    DYNAMODB_TABLE_NAME        = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    STATE_TABLE_NAME           = module.wireguard_updater_state_table.dynamodb_table_id
   }
 
   attach_policy_statements = true
@@ -144,6 +319,15 @@ module "get_client_config_file_lambda" {
       ],
       resources = [module.wireguard_updater_table.dynamodb_table_arn]
     },
+    dynamodb_state = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:Query",
+        "dynamodb:UpdateItem"
+      ],
+      resources = [module.wireguard_updater_state_table.dynamodb_table_arn]
+    },
     ssm_access = {
       effect = "Allow",
       actions = [
@@ -164,5 +348,338 @@ module "get_client_config_file_lambda" {
 
 }
 
-# TODO need remove client
-# TODO need update client
\ No newline at end of file
+module "revoke_clients_lambda" {
+  source = "terraform-aws-modules/lambda/aws"
+
+  function_name = "revoke_clients"
+  description   = "Lambda that removes one or many clients from every WireGuard server with one config update per server, then deletes them."
+  handler       = "main.revoke_clients"
+  runtime       = "python3.12"
+  timeout       = var.revoke_clients_timeout
+
+  source_path = "./modules/wireguard_updater/python_code"
+
+  attach_policy_statements = true
+  policy_statements = merge({
+    dynamodb_item = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:BatchGetItem",
+        "dynamodb:BatchWriteItem",
+        "dynamodb:DeleteItem",
+        "dynamodb:Query"
+      ],
+      resources = [
+        module.wireguard_updater_table.dynamodb_table_arn,
+        "${module.wireguard_updater_table.dynamodb_table_arn}/index/*"
+      ]
+    },
+    dynamodb_state = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:BatchGetItem",
+        "dynamodb:PutItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:Query"
+      ],
+      resources = [module.wireguard_updater_state_table.dynamodb_table_arn]
+    },
+    ssm_access = {
+      effect = "Allow",
+      actions = [
+        "ssm:SendCommand",
+        "ssm:PutParameter",
+        "ssm:GetParameter",
+        "ssm:GetParameters",
+        "ssm:DeleteParameters",
+        "ssm:GetCommandInvocation",
+        "ssm:ListCommandInvocations",
+        "ssm:AddTagsToResource"
+      ],
+      resources = ["*"]
+    }
+    }, {
+    for k, v in {
+      config_bucket = {
+        effect    = "Allow",
+        actions   = ["s3:GetObject", "s3:PutObject"],
+        resources = ["${local.config_bucket_arn}/*"]
+      }
+      # Without it S3 answers 403 instead of 404 for a config object that wasn't written yet.
+      config_bucket_list = {
+        effect    = "Allow",
+        actions   = ["s3:ListBucket"],
+        resources = [local.config_bucket_arn]
+      }
+    } : k => v if var.config_store == "s3"
+    }, {
+    for k, v in {
+      config_kms_key = {
+        effect    = "Allow",
+        actions   = ["kms:Decrypt", "kms:GenerateDataKey"],
+        resources = [local.config_kms_key_arn]
+      }
+    } : k => v if var.config_store == "s3" && var.config_kms_key_id != ""
+  })
+
+  environment_variables = {
+    REGISTRY_CACHE_TTL_SECONDS     = var.registry_cache_ttl_seconds
+    DYNAMODB_TABLE_NAME            = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    SSM_MAX_CONCURRENCY            = var.ssm_max_concurrency
+    COMMAND_WAIT_TIMEOUT_SECONDS   = var.command_wait_timeout_seconds
+    WIREGUARD_APPLY_MODE           = var.wireguard_apply_mode
+    APPLY_DOCUMENT_NAME            = aws_ssm_document.apply_config.name
+    APPLY_DOCUMENT_VERSION         = aws_ssm_document.apply_config.latest_version
+    APPLY_MAX_CONCURRENCY          = var.apply_max_concurrency
+    APPLY_MAX_ERRORS               = var.apply_max_errors
+    STATE_TABLE_NAME               = module.wireguard_updater_state_table.dynamodb_table_id
+    CONFIG_STORE                   = var.config_store
+    CONFIG_SHARD_TIER              = var.config_shard_tier
+    CONFIG_BUCKET_NAME             = local.config_bucket_name
+    CONFIG_KMS_KEY_ID              = var.config_kms_key_id
+    METRICS_NAMESPACE              = var.metrics_namespace
+    ENVIRONMENT_RETRY_BASE_SECONDS = var.environment_retry_base_seconds
+    ENVIRONMENT_RETRY_MAX_SECONDS  = var.environment_retry_max_seconds
+  }
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+module "add_new_clients_lambda" {
+  source = "terraform-aws-modules/lambda/aws"
+
+  function_name = "add_new_clients"
+  description   = "Lambda that adds many clients at once and grants them access to the networks specified."
+  handler       = "main.add_new_clients"
+  runtime       = "python3.12"
+  timeout       = var.add_new_clients_timeout
+
+  source_path = "./modules/wireguard_updater/python_code"
+
+  attach_policy_statements = true
+  policy_statements = {
+    dynamodb_item = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:PutItem",
+        "dynamodb:BatchWriteItem",
+        "dynamodb:Query",
+        "dynamodb:Scan"
+      ],
+      resources = [
+        module.wireguard_updater_table.dynamodb_table_arn,
+        "${module.wireguard_updater_table.dynamodb_table_arn}/index/*"
+      ]
+    },
+    dynamodb_state = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:Query"
+      ],
+      resources = [module.wireguard_updater_state_table.dynamodb_table_arn]
+    }
+  }
+
+  environment_variables = {
+    REGISTRY_CACHE_TTL_SECONDS = var.registry_cache_ttl_seconds
+    DYNAMODB_TABLE_NAME        = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    STATE_TABLE_NAME           = module.wireguard_updater_state_table.dynamodb_table_id
+    CLIENT_CIDR                = var.client_cidr
+    CLIENT_IP_RESERVED_COUNT   = var.client_ip_reserved_count
+  }
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+module "export_client_configs_lambda" {
+  source = "terraform-aws-modules/lambda/aws"
+
+  function_name = "export_client_configs"
+  description   = "Exports the client configs of many clients as one zip archive and returns a presigned url to it."
+  handler       = "main.export_client_configs"
+  runtime       = "python3.12"
+  timeout       = 300
+
+  source_path = "./modules/wireguard_updater/python_code"
+
+  attach_policy_statements = true
+  policy_statements = {
+    dynamodb_item = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:Scan"
+      ],
+      resources = [module.wireguard_updater_table.dynamodb_table_arn]
+    },
+    dynamodb_state = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:BatchGetItem",
+        "dynamodb:GetItem",
+        "dynamodb:Query",
+        "dynamodb:UpdateItem"
+      ],
+      resources = [module.wireguard_updater_state_table.dynamodb_table_arn]
+    },
+    export_bucket = {
+      effect    = "Allow",
+      actions   = ["s3:PutObject", "s3:GetObject"],
+      resources = ["${aws_s3_bucket.client_config_exports.arn}/*"]
+    }
+  }
+
+  environment_variables = {
+    REGISTRY_CACHE_TTL_SECONDS = var.registry_cache_ttl_seconds
+    DYNAMODB_TABLE_NAME        = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    STATE_TABLE_NAME           = module.wireguard_updater_state_table.dynamodb_table_id
+    EXPORT_BUCKET_NAME         = aws_s3_bucket.client_config_exports.id
+    EXPORT_URL_EXPIRY_SECONDS  = var.export_url_expiry_seconds
+  }
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+module "collect_peer_liveness_lambda" {
+  source = "terraform-aws-modules/lambda/aws"
+
+  function_name = "collect_peer_liveness"
+  description   = "Collects the WireGuard servers' peer handshakes and removes the peers that have been idle for too long."
+  handler       = "main.collect_peer_liveness"
+  runtime       = "python3.12"
+  timeout       = var.collect_peer_liveness_timeout
+  memory_size   = var.reconcile_memory_size
+
+  publish = true
+
+  allowed_triggers = {
+    Schedule = {
+      principal  = "events.amazonaws.com"
+      source_arn = aws_cloudwatch_event_rule.collect_peer_liveness.arn
+    }
+  }
+
+  attach_policy_statements = true
+  policy_statements = merge({
+    dynamodb_item = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:Scan",
+        "dynamodb:UpdateItem",
+        "dynamodb:DeleteItem"
+      ],
+      resources = [module.wireguard_updater_table.dynamodb_table_arn]
+    },
+    dynamodb_state = {
+      effect = "Allow",
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:BatchGetItem",
+        "dynamodb:PutItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:Query"
+      ],
+      resources = [module.wireguard_updater_state_table.dynamodb_table_arn]
+    },
+    ssm_access = {
+      effect = "Allow",
+      actions = [
+        "ssm:SendCommand",
+        "ssm:PutParameter",
+        "ssm:GetParameter",
+        "ssm:GetParameters",
+        "ssm:DeleteParameters",
+        "ssm:GetCommandInvocation",
+        "ssm:ListCommandInvocations",
+        "ssm:AddTagsToResource"
+      ],
+      resources = ["*"]
+    },
+    liveness_bucket = {
+      effect    = "Allow",
+      actions   = ["s3:GetObject", "s3:PutObject"],
+      resources = ["${aws_s3_bucket.peer_liveness.arn}/*"]
+    },
+    liveness_bucket_list = {
+      effect    = "Allow",
+      actions   = ["s3:ListBucket"],
+      resources = [aws_s3_bucket.peer_liveness.arn]
+    }
+    }, {
+    for k, v in {
+      config_bucket = {
+        effect    = "Allow",
+        actions   = ["s3:GetObject", "s3:PutObject"],
+        resources = ["${local.config_bucket_arn}/*"]
+      }
+      # Without it S3 answers 403 instead of 404 for a config object that wasn't written yet.
+      config_bucket_list = {
+        effect    = "Allow",
+        actions   = ["s3:ListBucket"],
+        resources = [local.config_bucket_arn]
+      }
+    } : k => v if var.config_store == "s3"
+    }, {
+    for k, v in {
+      config_kms_key = {
+        effect    = "Allow",
+        actions   = ["kms:Decrypt", "kms:GenerateDataKey"],
+        resources = [local.config_kms_key_arn]
+      }
+    } : k => v if var.config_store == "s3" && var.config_kms_key_id != ""
+  })
+
+  environment_variables = {
+    REGISTRY_CACHE_TTL_SECONDS     = var.registry_cache_ttl_seconds
+    DYNAMODB_TABLE_NAME            = split("/", module.wireguard_updater_table.dynamodb_table_arn)[1]
+    SSM_MAX_CONCURRENCY            = var.ssm_max_concurrency
+    COMMAND_WAIT_TIMEOUT_SECONDS   = var.command_wait_timeout_seconds
+    WIREGUARD_APPLY_MODE           = var.wireguard_apply_mode
+    APPLY_DOCUMENT_NAME            = aws_ssm_document.apply_config.name
+    APPLY_DOCUMENT_VERSION         = aws_ssm_document.apply_config.latest_version
+    APPLY_MAX_CONCURRENCY          = var.apply_max_concurrency
+    APPLY_MAX_ERRORS               = var.apply_max_errors
+    STATE_TABLE_NAME               = module.wireguard_updater_state_table.dynamodb_table_id
+    CONFIG_STORE                   = var.config_store
+    CONFIG_SHARD_TIER              = var.config_shard_tier
+    CONFIG_BUCKET_NAME             = local.config_bucket_name
+    CONFIG_KMS_KEY_ID              = var.config_kms_key_id
+    RECONCILE_SCAN_SEGMENTS        = var.reconcile_scan_segments
+    METRICS_NAMESPACE              = var.metrics_namespace
+    ENVIRONMENT_RETRY_BASE_SECONDS = var.environment_retry_base_seconds
+    ENVIRONMENT_RETRY_MAX_SECONDS  = var.environment_retry_max_seconds
+    LIVENESS_BUCKET_NAME           = aws_s3_bucket.peer_liveness.id
+    PEER_EXPIRY_DAYS               = var.peer_expiry_days
+  }
+
+  source_path = "./modules/wireguard_updater/python_code"
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+resource "aws_cloudwatch_event_rule" "collect_peer_liveness" {
+  name                = "collect-wireguard-peer-liveness"
+  description         = "Periodically collects the WireGuard peers' handshakes and expires the idle ones."
+  schedule_expression = var.liveness_schedule_expression
+}
+
+resource "aws_cloudwatch_event_target" "collect_peer_liveness" {
+  rule = aws_cloudwatch_event_rule.collect_peer_liveness.name
+  arn  = module.collect_peer_liveness_lambda.lambda_function_arn
+}
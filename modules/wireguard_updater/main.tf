@@ -2,4 +2,52 @@ resource "aws_lambda_event_source_mapping" "dynamodb_lambda_trigger" {
   event_source_arn  = module.wireguard_updater_table.dynamodb_table_stream_arn
   function_name     = module.handle_stream_updates_lambda.lambda_function_arn
   starting_position = "LATEST"
+
+  # Records are coalesced into one config update per environment, so larger batches converge faster.
+  batch_size                         = var.stream_batch_size
+  maximum_batching_window_in_seconds = var.stream_batching_window_in_seconds
+  # Batches of one shard processed at the same time. Records of the same client stay in order, and concurrent
+  # writes of the same config are retried against each other's result, see helpers.claim_config_hash.
+  parallelization_factor = var.stream_parallelization_factor
+
+  # The handler reports the records it couldn't process, so only those and the records after them are retried.
+  # A failed invocation is split in half until the failing record is isolated, and records that still fail after
+  # the retries are handed to the dead letter queue so they don't block the shard.
+  function_response_types        = ["ReportBatchItemFailures"]
+  bisect_batch_on_function_error = true
+  maximum_retry_attempts         = var.stream_maximum_retry_attempts
+  maximum_record_age_in_seconds  = var.stream_maximum_record_age_in_seconds
+
+  destination_config {
+    on_failure {
+      destination_arn = aws_sqs_queue.stream_dead_letter.arn
+    }
+  }
+}
+
+# Receives the shard, sequence number range and error of every batch of stream records that kept failing. The
+# records themselves stay in the stream for 24 hours and can be replayed from there.
+resource "aws_sqs_queue" "stream_dead_letter" {
+  name                      = "wireguard-updater-stream-dead-letter"
+  message_retention_seconds = 1209600
+  sqs_managed_sse_enabled   = true
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+# The script every server runs to apply its config, generated by python_code/apply_document.py. Each change publishes
+# a new document version, and the lambdas send the version they were deployed with.
+resource "aws_ssm_document" "apply_config" {
+  name            = "wireguard-updater-apply-config"
+  document_type   = "Command"
+  document_format = "JSON"
+  content         = file("${path.module}/apply_document.json")
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
 }
@@ -0,0 +1,14 @@
+output "config_bucket_arn" {
+  # Pass to the wireguard_vpn_server modules when config_store is "s3" so the servers can read their configs.
+  value = local.config_bucket_arn
+}
+
+output "stream_dead_letter_queue_arn" {
+  # Batches of stream records handle_stream_updates gave up on; alarm on its depth.
+  value = aws_sqs_queue.stream_dead_letter.arn
+}
+
+output "liveness_bucket_arn" {
+  # Pass to the wireguard_vpn_server modules so the servers can upload their peer dumps.
+  value = aws_s3_bucket.peer_liveness.arn
+}
@@ -0,0 +1,150 @@
+import json
+import os
+from config_store import ParameterConfigStore, S3ConfigStore, ShardedParameterConfigStore
+
+# Builds the SSM document the updater sends to the servers to apply their configs. Terraform registers it from
+# apply_document.json next to the module's .tf files, so run `python apply_document.py` after changing the script here
+# to regenerate that file; a new document version is published on the next apply.
+DOCUMENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apply_document.json')
+METADATA_URL = 'http://169.254.169.254/latest'
+CONFIG_STORES = ['parameter', 'advanced_parameter', 'sharded_parameter', 's3']
+APPLY_MODES = ['syncconf', 'restart']
+
+
+def get_fetch_commands():
+    # The script doesn't know the environment or region until it runs, so the stores build their fetch commands
+    # around the shell variables it sets.
+    parameter_store = ParameterConfigStore(None, region='$region')
+    sharded_store = ShardedParameterConfigStore(None, region='$region')
+    s3_store = S3ConfigStore(None, None, '{{ configBucket }}', region='$region')
+    return [
+        'fetch_config() {',
+        '  case "$config_store" in',
+        f'    s3) {s3_store.get_fetch_command("$environment")} ;;',
+        f'    sharded_parameter) {sharded_store.get_fetch_command("$environment")} ;;',
+        f'    *) {parameter_store.get_fetch_command("$environment")} ;;',
+        '  esac',
+        '}',
+    ]
+
+
+def get_apply_commands():
+    metadata_token = '-H "X-aws-ec2-metadata-token: $token"'
+    # The full config is streamed into a temporary file and only moved into place once it was fetched completely.
+    full_sync_commands = [
+        'fetch_config | sudo tee /etc/wireguard/wg0.conf.new > /dev/null',
+        'sudo chmod 600 /etc/wireguard/wg0.conf.new',
+        'sudo mv /etc/wireguard/wg0.conf.new /etc/wireguard/wg0.conf',
+        # syncconf swaps the peer set on the running interface so existing tunnels are not dropped. The interface is
+        # only started when it is not up yet.
+        'if [ "$apply_mode" = restart ]; then sudo systemctl restart wg-quick@wg0; '
+        "elif sudo wg show wg0 > /dev/null 2>&1; then sudo bash -c 'wg syncconf wg0 <(wg-quick strip wg0)'; "
+        'else sudo systemctl start wg-quick@wg0; fi',
+        "state=\"$to $(sudo sha256sum /etc/wireguard/wg0.conf | cut -d ' ' -f 1)\"",
+    ]
+    delta_fetch_command = ParameterConfigStore(None, region='$region').get_parameter_fetch_command(
+        '/$environment/wireguard/config_delta'
+    )
+    return [
+        'set -eo pipefail',
+        "environment='{{ environment }}'",
+        "region='{{ region }}'",
+        "config_store='{{ configStore }}'",
+        "apply_mode='{{ applyMode }}'",
+        # One command is sent to every server, so each works out its own environment from its Environment tag.
+        'if [ -z "$environment" ] || [ -z "$region" ]; then',
+        f"  token=$(curl -sf -X PUT -H 'X-aws-ec2-metadata-token-ttl-seconds: 60' {METADATA_URL}/api/token)",
+        f'  [ -n "$environment" ] || environment=$(curl -sf {metadata_token} {METADATA_URL}/meta-data/tags/instance/Environment || true)',
+        f'  [ -n "$region" ] || region=$(curl -sf {metadata_token} {METADATA_URL}/meta-data/placement/region)',
+        # A server of an environment with several servers is also tagged with its id and applies its own share of
+        # the peers, stored under <environment>/<server id>.
+        f'  server=$(curl -sf {metadata_token} {METADATA_URL}/meta-data/tags/instance/WireguardServer || true)',
+        '  if [ -n "$environment" ] && [ -n "$server" ] && [ "${environment#*/}" = "$environment" ]; then environment="$environment/$server"; fi',
+        'fi',
+        'if [ -z "$environment" ]; then echo "no environment parameter and no Environment instance tag" >&2; exit 1; fi',
+        # Lets the updater check the server applied the environment it expected.
+        'echo "environment=$environment"',
+    ] + get_fetch_commands() + [
+        # The server keeps the sequence and hash of the config it is at, and the delta names the sequence and hash
+        # of the config it starts from and the one it produces.
+        "state=$(sudo cat /etc/wireguard/wg0.seq 2> /dev/null || true)",
+        f"delta=$({delta_fetch_command} 2> /dev/null || true)",
+        "set -- $(printf '%s\\n' \"$delta\" | sed -n 1p)",
+        'kind=${1:-}; from=${2:-}; to=${3:-}; from_hash=${4:-}; to_hash=${5:-}',
+        # With syncconf a server at exactly the delta's starting config only applies the peer changes, so the cost of
+        # an update doesn't grow with the number of peers. The running config is saved so it survives a reboot. Any
+        # other config, and every update with restart, falls back to a full sync.
+        'if [ "$apply_mode" = syncconf ] && [ "$kind" = delta ] && [ -n "$from_hash" ] && [ "$state" = "$from $from_hash" ] && sudo wg show wg0 > /dev/null 2>&1; then',
+        "  printf '%s\\n' \"$delta\" | sed 1d | while read -r op key allowed_ips; do",
+        '    if [ "$op" = remove ]; then sudo wg set wg0 peer "$key" remove; '
+        'else sudo wg set wg0 peer "$key" allowed-ips "$allowed_ips"; fi',
+        '  done',
+        '  sudo wg-quick save wg0',
+        '  state="$to $to_hash"',
+        'elif [ "$apply_mode" = syncconf ] && [ -n "$to_hash" ] && [ "$state" = "$to $to_hash" ] && sudo wg show wg0 > /dev/null 2>&1; then',
+        '  echo "already at sequence $to"',
+        'else',
+    ] + [f'  {c}' for c in full_sync_commands] + [
+        'fi',
+        'echo "$state" | sudo tee /etc/wireguard/wg0.seq > /dev/null',
+        # Reported back to check_status_of_commands so the updater knows which config the server is running.
+        'echo "applied_sequence=${state% *}"',
+        'echo "applied_hash=${state#* }"',
+        # Only add the firewall rules when they are missing so repeated applies don't keep growing the chains.
+        "sudo iptables -t nat -C POSTROUTING -o ens5 -j MASQUERADE 2> /dev/null || sudo iptables -t nat -A POSTROUTING -o ens5 -j MASQUERADE",
+        "sudo iptables -C FORWARD -i wg0 -j ACCEPT 2> /dev/null || sudo iptables -A FORWARD -i wg0 -j ACCEPT",
+    ]
+
+
+def get_apply_document():
+    return {
+        'schemaVersion': '2.2',
+        'description': 'Brings a WireGuard server up to date with the config the wireguard updater stored for its environment.',
+        'parameters': {
+            'environment': {
+                'type': 'String',
+                'description': "The environment, or environment/server id, whose config to apply. Defaults to the instance's Environment and WireguardServer tags.",
+                'default': '',
+                'allowedPattern': '^[A-Za-z0-9_.-]*(/[A-Za-z0-9_.-]+)?$',
+            },
+            'region': {
+                'type': 'String',
+                'description': "The region the config is stored in. Defaults to the instance's region.",
+                'default': '',
+                'allowedPattern': '^[a-z0-9-]*$',
+            },
+            'configStore': {
+                'type': 'String',
+                'description': 'Where the updater stores the configs.',
+                'default': 'parameter',
+                'allowedValues': CONFIG_STORES,
+            },
+            'configBucket': {
+                'type': 'String',
+                'description': 'The bucket the configs are stored in when configStore is s3.',
+                'default': '',
+                'allowedPattern': '^[a-z0-9.-]*$',
+            },
+            'applyMode': {
+                'type': 'String',
+                'description': 'syncconf hot-applies peer changes, restart restarts wg-quick@wg0.',
+                'default': 'syncconf',
+                'allowedValues': APPLY_MODES,
+            },
+        },
+        'mainSteps': [{
+            'action': 'aws:runShellScript',
+            'name': 'applyConfig',
+            'inputs': {'runCommand': get_apply_commands()},
+        }],
+    }
+
+
+def render_apply_document():
+    return json.dumps(get_apply_document(), indent=2) + '\n'
+
+
+if __name__ == '__main__':
+    with open(DOCUMENT_PATH, 'w') as f:
+        f.write(render_apply_document())
+    print(f"Wrote {os.path.normpath(DOCUMENT_PATH)}")
@@ -0,0 +1,215 @@
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+import unittest
+import apply_document
+from config_store import compress_config
+
+SEED_CONFIG = '[Interface]\nAddress = 192.168.2.2/32\nListenPort = 64731\nPrivateKey = server_private_key'
+PEER_CONFIG = SEED_CONFIG + '\n\n[Peer]\nPublicKey = client_key\nAllowedIPs = 192.168.2.5/32'
+PEER_HASH = hashlib.sha256(PEER_CONFIG.encode('utf-8')).hexdigest()
+
+# Stand-ins for the tools the script calls on a server. sudo just runs the command, the instance metadata says the
+# server is tagged with the dev environment, aws answers from files and wg, wg-quick, systemctl and iptables log
+# their arguments.
+FAKE_TOOLS = {
+    'sudo': 'exec "$@"\n',
+    'curl': (
+        'case "$*" in\n'
+        '  *api/token*) echo token ;;\n'
+        '  *tags/instance/Environment*) [ -f "$ROOT/tag" ] && cat "$ROOT/tag" || exit 22 ;;\n'
+        '  *tags/instance/WireguardServer*) [ -f "$ROOT/server" ] && cat "$ROOT/server" || exit 22 ;;\n'
+        '  *placement/region*) echo us-west-2 ;;\n'
+        'esac\n'
+    ),
+    'aws': (
+        'echo "aws $*" >> "$ROOT/log"\n'
+        'if [ "$1" = ssm ]; then cat "$ROOT/ssm$4"; echo; '
+        'elif [ "$1" = s3api ]; then [ -f "$ROOT/s3/$4/$6" ] || { echo "(404) Not Found" >&2; exit 254; }; '
+        'else cat "$ROOT/s3/${3#s3://}"; fi\n'
+    ),
+    'wg': (
+        'echo "wg $*" >> "$ROOT/log"\n'
+        'if [ "$1" = show ]; then [ -f "$ROOT/up" ]; fi\n'
+    ),
+    'wg-quick': 'echo "wg-quick $*" >> "$ROOT/log"\nif [ "$1" = strip ]; then cat "$ROOT/etc/wg0.conf"; fi\n',
+    'systemctl': 'echo "systemctl $*" >> "$ROOT/log"\ntouch "$ROOT/up"\n',
+    'iptables': 'echo "iptables $*" >> "$ROOT/log"\n',
+}
+
+
+class TestApplyDocument(unittest.TestCase):
+    def test_document_is_up_to_date(self):
+        with open(apply_document.DOCUMENT_PATH) as f:
+            self.assertEqual(f.read(), apply_document.render_apply_document(), 'run python apply_document.py')
+
+    def test_commands_do_not_name_an_environment_or_region(self):
+        script = '\n'.join(apply_document.get_apply_commands())
+
+        self.assertNotIn('us-east-1', script)
+        self.assertNotIn('/dev/wireguard', script)
+        parameters = set(re.findall(r'{{ (\w+) }}', script))
+        self.assertEqual(parameters, set(apply_document.get_apply_document()['parameters']))
+
+    def test_idempotent_firewall_rules(self):
+        for command in [c for c in apply_document.get_apply_commands() if 'iptables' in c]:
+            check, append = command.split(' || ')
+            self.assertIn(' -C ', check)
+            self.assertEqual(check.replace(' -C ', ' -A ').replace(' 2> /dev/null', ''), append)
+
+
+class TestApplyScript(unittest.TestCase):
+    # Runs the document's script against the fake tools, with /etc/wireguard moved into a temporary directory.
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        os.makedirs(os.path.join(self.root, 'bin'))
+        os.makedirs(os.path.join(self.root, 'etc'))
+        for name, body in FAKE_TOOLS.items():
+            path = os.path.join(self.root, 'bin', name)
+            with open(path, 'w') as f:
+                f.write('#!/bin/bash\n' + body)
+            os.chmod(path, 0o755)
+        self.write('tag', 'dev')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, value):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(value)
+
+    def read(self, name):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            return ''
+        with open(path) as f:
+            return f.read()
+
+    def run_script(self, **parameters):
+        parameters = dict({'environment': '', 'region': '', 'configStore': 'parameter', 'configBucket': '', 'applyMode': 'syncconf'}, **parameters)
+        script = '\n'.join(apply_document.get_apply_commands()).replace('/etc/wireguard', os.path.join(self.root, 'etc'))
+        for name, value in parameters.items():
+            script = script.replace(f'{{{{ {name} }}}}', value)
+        return subprocess.run(
+            ['bash', '-c', script],
+            env=dict(os.environ, ROOT=self.root, PATH=f"{self.root}/bin:{os.environ['PATH']}"),
+            capture_output=True,
+            text=True,
+        )
+
+    def test_full_sync_discovers_environment(self):
+        self.write('ssm/dev/wireguard/config_file', PEER_CONFIG)
+        self.write('ssm/dev/wireguard/config_delta', f'full 0 1 seed_hash {PEER_HASH}')
+
+        result = self.run_script()
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('environment=dev', result.stdout)
+        self.assertIn('applied_sequence=1', result.stdout)
+        self.assertIn(f'applied_hash={PEER_HASH}', result.stdout)
+        self.assertEqual(self.read('etc/wg0.conf'), PEER_CONFIG)
+        self.assertEqual(self.read('etc/wg0.seq').strip(), f'1 {PEER_HASH}')
+        self.assertIn('--region us-west-2', self.read('log'))
+        self.assertIn('systemctl start wg-quick@wg0', self.read('log'))
+
+    def test_server_tag_selects_its_share(self):
+        self.write('server', 'b')
+        self.write('ssm/dev/b/wireguard/config_file', PEER_CONFIG)
+        self.write('ssm/dev/b/wireguard/config_delta', f'full 0 1 seed_hash {PEER_HASH}')
+
+        result = self.run_script()
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('environment=dev/b', result.stdout)
+        self.assertEqual(self.read('etc/wg0.conf'), PEER_CONFIG)
+
+    def test_applies_delta(self):
+        self.write('up', '')
+        self.write('etc/wg0.seq', '3 hash3\n')
+        self.write('ssm/prod/wireguard/config_delta', 'delta 3 4 hash3 hash4\nadd client_key 192.168.2.5/32\nremove old_key')
+
+        result = self.run_script(environment='prod', region='eu-west-1')
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('environment=prod', result.stdout)
+        log = self.read('log')
+        self.assertIn('wg set wg0 peer client_key allowed-ips 192.168.2.5/32', log)
+        self.assertIn('wg set wg0 peer old_key remove', log)
+        self.assertIn('wg-quick save wg0', log)
+        self.assertNotIn('config_file', log)
+        self.assertEqual(self.read('etc/wg0.seq').strip(), '4 hash4')
+        self.assertIn('applied_hash=hash4', result.stdout)
+
+    def test_delta_from_another_config_syncs_fully(self):
+        # Arrange: the server is at the delta's starting sequence, but with some other config.
+        self.write('up', '')
+        self.write('etc/wg0.seq', '3 other_hash\n')
+        self.write('ssm/dev/wireguard/config_file', PEER_CONFIG)
+        self.write('ssm/dev/wireguard/config_delta', f'delta 3 4 hash3 {PEER_HASH}\nadd client_key 192.168.2.5/32')
+
+        # Act
+        result = self.run_script()
+
+        # Assert
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNotIn('wg set', self.read('log'))
+        self.assertEqual(self.read('etc/wg0.conf'), PEER_CONFIG)
+        self.assertEqual(self.read('etc/wg0.seq').strip(), f'4 {PEER_HASH}')
+
+    def test_skips_only_the_config_it_is_at(self):
+        self.write('up', '')
+        self.write('etc/wg0.seq', '4 hash4\n')
+        self.write('ssm/dev/wireguard/config_file', PEER_CONFIG)
+
+        # The delta it already applied is skipped, one for a config stored since isn't.
+        self.write('ssm/dev/wireguard/config_delta', 'delta 3 4 hash3 hash4\nadd client_key 192.168.2.5/32')
+        skipped = self.run_script()
+        self.write('ssm/dev/wireguard/config_delta', f'delta 4 5 hash3 {PEER_HASH}')
+        synced = self.run_script()
+
+        self.assertIn('already at sequence 4', skipped.stdout)
+        self.assertIn('applied_hash=hash4', skipped.stdout)
+        self.assertEqual(synced.returncode, 0, synced.stderr)
+        self.assertEqual(self.read('etc/wg0.conf'), PEER_CONFIG)
+        self.assertIn(f'applied_hash={PEER_HASH}', synced.stdout)
+
+    def test_restart_always_syncs_fully(self):
+        self.write('up', '')
+        self.write('etc/wg0.seq', '3 hash3\n')
+        self.write('ssm/dev/wireguard/config_file', PEER_CONFIG)
+        self.write('ssm/dev/wireguard/config_delta', 'delta 3 4 hash3 hash4\nadd client_key 192.168.2.5/32')
+
+        result = self.run_script(applyMode='restart')
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNotIn('wg set', self.read('log'))
+        self.assertIn('systemctl restart wg-quick@wg0', self.read('log'))
+        self.assertEqual(self.read('etc/wg0.conf'), PEER_CONFIG)
+
+    def test_s3_store(self):
+        os.makedirs(os.path.join(self.root, 's3/bucket/dev/wireguard'))
+        with open(os.path.join(self.root, 's3/bucket/dev/wireguard/wg0.conf.gz'), 'wb') as f:
+            f.write(compress_config(PEER_CONFIG))
+
+        result = self.run_script(configStore='s3', configBucket='bucket')
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(self.read('etc/wg0.conf'), PEER_CONFIG)
+
+    def test_fails_without_environment(self):
+        os.remove(os.path.join(self.root, 'tag'))
+
+        result = self.run_script()
+
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('no Environment instance tag', result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
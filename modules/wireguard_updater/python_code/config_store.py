@@ -0,0 +1,233 @@
+import abc
+import base64
+import gzip
+import hashlib
+from botocore.exceptions import ClientError
+
+# SecureString value limits per parameter tier.
+TIER_LIMITS = {'Standard': 4096, 'Advanced': 8192}
+# SSM GetParameters and DeleteParameters take at most this many names per call.
+PARAMETER_BATCH_SIZE = 10
+
+
+def get_config_parameter_name(env):
+    return f'/{env}/wireguard/config_file'
+
+
+def compress_config(config_str):
+    # mtime is fixed so the same config always compresses to the same bytes.
+    return gzip.compress(config_str.encode('utf-8'), mtime=0)
+
+
+class ConfigStore(abc.ABC):
+    # Where the server configs live. read and write are used by the updater, get_fetch_command is the shell pipeline
+    # a server runs to stream its config to stdout. Until a store has written a config for an environment, the seed
+    # config terraform put in the environment's config_file parameter is read instead.
+
+    def __init__(self, ssm_client, region='us-east-1'):
+        self.ssm_client = ssm_client
+        self.region = region
+
+    def read(self, env):
+        config_str = self._read(env)
+        if config_str is None:
+            print(f"read: No stored config for {env} yet, reading the seed config...")
+            config_str = self._read_parameter(get_config_parameter_name(env))
+        return config_str
+
+    @abc.abstractmethod
+    def write(self, env, config_str):
+        pass
+
+    @abc.abstractmethod
+    def get_fetch_command(self, env):
+        pass
+
+    @abc.abstractmethod
+    def _read(self, env):
+        # The stored config, or None when the store hasn't written one for the environment yet.
+        pass
+
+    def _read_parameter(self, name):
+        return self.ssm_client.get_parameter(Name=name, WithDecryption=True)['Parameter']['Value']
+
+    def get_parameter_fetch_command(self, name, decrypt=True):
+        decryption = ' --with-decryption' if decrypt else ''
+        return f'aws ssm get-parameter --name {name}{decryption} --query Parameter.Value --output text --region {self.region}'
+
+    def get_seed_fetch_command(self, env):
+        # The CLI appends a newline to text output; the command substitution drops it again.
+        return f'printf \'%s\' "$({self.get_parameter_fetch_command(get_config_parameter_name(env))})"'
+
+
+class ParameterConfigStore(ConfigStore):
+    # The whole config as one SecureString parameter. Standard tier holds about 40 peers, Advanced about twice that.
+
+    def __init__(self, ssm_client, tier='Standard', region='us-east-1'):
+        super().__init__(ssm_client, region)
+        self.tier = tier
+
+    def write(self, env, config_str):
+        size = len(config_str.encode('utf-8'))
+        if size > TIER_LIMITS[self.tier]:
+            raise Exception(
+                f"the {env} config is {size} bytes which is over the {TIER_LIMITS[self.tier]} byte limit of "
+                f"{self.tier} tier parameters. use the sharded_parameter or s3 config store instead"
+            )
+        return self.ssm_client.put_parameter(
+            Name=get_config_parameter_name(env),
+            Description=f'The config file for wireguard in the {env} network.',
+            Value=config_str,
+            Type='SecureString',
+            Overwrite=True,
+            Tier=self.tier,
+            DataType='text'
+        )['Version']
+
+    def get_fetch_command(self, env):
+        return self.get_seed_fetch_command(env)
+
+    def _read(self, env):
+        return self._read_parameter(get_config_parameter_name(env))
+
+
+class ShardedParameterConfigStore(ConfigStore):
+    # The gzipped config split base64 encoded over as many SecureString parameters as it needs. Shards are written
+    # under a generation named after the config's hash and the manifest parameter is switched to the new generation
+    # last, so a server never reads a half written config. The previous generation is kept for servers that are still
+    # reading it and anything older is deleted.
+
+    def __init__(self, ssm_client, tier='Standard', region='us-east-1'):
+        super().__init__(ssm_client, region)
+        self.tier = tier
+        self.shard_size = TIER_LIMITS[tier]
+
+    @staticmethod
+    def get_manifest_name(env):
+        return f'/{env}/wireguard/config_manifest'
+
+    @staticmethod
+    def get_shard_names(env, generation, shard_count):
+        return [f'/{env}/wireguard/config_shards/{generation}/{i}' for i in range(shard_count)]
+
+    def write(self, env, config_str):
+        encoded = base64.b64encode(compress_config(config_str)).decode('ascii')
+        generation = hashlib.sha256(config_str.encode('utf-8')).hexdigest()[:16]
+        shards = [encoded[i:i + self.shard_size] for i in range(0, len(encoded), self.shard_size)]
+        manifest = self._read_manifest(env)
+        if manifest is not None and manifest[0] == (generation, len(shards)):
+            return manifest[2]
+
+        for name, shard in zip(self.get_shard_names(env, generation, len(shards)), shards):
+            self.ssm_client.put_parameter(
+                Name=name,
+                Value=shard,
+                Type='SecureString',
+                Overwrite=True,
+                Tier=self.tier,
+                DataType='text'
+            )
+        # The first line is the generation servers fetch, the second the one it replaced.
+        previous = manifest[0] if manifest is not None else ('', 0)
+        lines = [f'{g} {n}' for g, n in [(generation, len(shards)), previous] if g != '']
+        version = self.ssm_client.put_parameter(
+            Name=self.get_manifest_name(env),
+            Description=f'The config file shards for wireguard in the {env} network.',
+            Value='\n'.join(lines),
+            Type='String',
+            Overwrite=True,
+            Tier='Standard',
+            DataType='text'
+        )['Version']
+
+        if manifest is not None and manifest[1][0] not in ('', generation, previous[0]):
+            self._delete_parameters(self.get_shard_names(env, *manifest[1]))
+        return version
+
+    def get_fetch_command(self, env):
+        manifest = self.get_parameter_fetch_command(self.get_manifest_name(env), decrypt=False)
+        shard = self.get_parameter_fetch_command(f'/{env}/wireguard/config_shards/$generation/$i')
+        # Each shard is decoded and decompressed as it arrives instead of assembling the whole config first.
+        return (
+            f'manifest=$({manifest} | head -n 1) && generation=${{manifest% *}} && shards=${{manifest#* }} && '
+            f'for i in $(seq 0 $((shards - 1))); do {shard} | tr -d \'\\n\'; done | base64 -d | gunzip'
+        )
+
+    def _read(self, env):
+        manifest = self._read_manifest(env)
+        if manifest is None:
+            return None
+        names = self.get_shard_names(env, *manifest[0])
+        values = {}
+        for i in range(0, len(names), PARAMETER_BATCH_SIZE):
+            response = self.ssm_client.get_parameters(Names=names[i:i + PARAMETER_BATCH_SIZE], WithDecryption=True)
+            if len(response.get('InvalidParameters', [])) > 0:
+                raise Exception(f"config shards {response['InvalidParameters']} for {env} are missing")
+            values.update({p['Name']: p['Value'] for p in response['Parameters']})
+        return gzip.decompress(base64.b64decode(''.join(values[name] for name in names))).decode('utf-8')
+
+    def _read_manifest(self, env):
+        try:
+            response = self.ssm_client.get_parameter(Name=self.get_manifest_name(env))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ParameterNotFound':
+                raise e
+            return None
+        generations = []
+        for line in response['Parameter']['Value'].splitlines()[:2]:
+            generation, _, shard_count = line.strip().partition(' ')
+            generations.append((generation, int(shard_count)))
+        current, previous = (generations + [('', 0)])[:2]
+        return current, previous, response['Parameter']['Version']
+
+    def _delete_parameters(self, names):
+        for i in range(0, len(names), PARAMETER_BATCH_SIZE):
+            self.ssm_client.delete_parameters(Names=names[i:i + PARAMETER_BATCH_SIZE])
+
+
+class S3ConfigStore(ConfigStore):
+    # The gzipped config as one KMS encrypted object, for environments with thousands of peers.
+
+    def __init__(self, ssm_client, s3_client, bucket, kms_key_id='', region='us-east-1'):
+        super().__init__(ssm_client, region)
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.kms_key_id = kms_key_id
+
+    @staticmethod
+    def get_object_key(env):
+        return f'{env}/wireguard/wg0.conf.gz'
+
+    def write(self, env, config_str):
+        encryption = {'ServerSideEncryption': 'aws:kms'}
+        if self.kms_key_id != '':
+            encryption['SSEKMSKeyId'] = self.kms_key_id
+        response = self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.get_object_key(env),
+            Body=compress_config(config_str),
+            ContentType='application/gzip',
+            **encryption
+        )
+        return response.get('VersionId', response['ETag'].strip('"'))
+
+    def get_fetch_command(self, env):
+        key = self.get_object_key(env)
+        # Like read, a server falls back to the seed config until the first config object was written. S3 only
+        # answers 404 for a missing key when the caller may list the bucket, any other error fails the fetch.
+        return (
+            f'if err=$(aws s3api head-object --bucket {self.bucket} --key {key} --region {self.region} '
+            '2>&1 > /dev/null); '
+            f'then aws s3 cp s3://{self.bucket}/{key} - --region {self.region} | gunzip; '
+            f'elif [[ "$err" == *"(404)"* ]]; then {self.get_seed_fetch_command(env)}; '
+            'else echo "$err" >&2; false; fi'
+        )
+
+    def _read(self, env):
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket, Key=self.get_object_key(env))['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise e
+            return None
+        return gzip.decompress(body).decode('utf-8')
@@ -0,0 +1,208 @@
+import gzip
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+from config_store import ParameterConfigStore, S3ConfigStore, ShardedParameterConfigStore
+from wireguard_config import WireGuardConfig
+
+SEED_CONFIG = '[Interface]\nAddress = 192.168.2.2/32\nListenPort = 64731\nPrivateKey = server_private_key'
+
+
+def get_large_config(peer_count):
+    config = WireGuardConfig.parse(SEED_CONFIG)
+    for i in range(peer_count):
+        config.add_peer(os.urandom(32).hex(), f'192.168.{i // 250}.{i % 250}/32')
+    return config.serialize()
+
+
+class FakeParameterStore:
+    # Just enough of the SSM client to exercise the parameter backed stores.
+
+    def __init__(self, parameters=None):
+        self.parameters = {name: (value, 1) for name, value in (parameters or {}).items()}
+        self.put_count = 0
+
+    def get_parameter(self, Name, WithDecryption=False):
+        if Name not in self.parameters:
+            raise ClientError({'Error': {'Code': 'ParameterNotFound', 'Message': ''}}, 'GetParameter')
+        value, version = self.parameters[Name]
+        return {'Parameter': {'Name': Name, 'Value': value, 'Version': version}}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        assert len(Names) <= 10
+        return {
+            'Parameters': [{'Name': n, 'Value': self.parameters[n][0]} for n in Names if n in self.parameters],
+            'InvalidParameters': [n for n in Names if n not in self.parameters],
+        }
+
+    def put_parameter(self, Name, Value, Tier='Standard', **kwargs):
+        assert len(Value) <= {'Standard': 4096, 'Advanced': 8192}[Tier]
+        self.put_count += 1
+        version = self.parameters.get(Name, ('', 0))[1] + 1
+        self.parameters[Name] = (Value, version)
+        return {'Version': version}
+
+    def delete_parameters(self, Names):
+        assert len(Names) <= 10
+        for name in Names:
+            self.parameters.pop(name, None)
+        return {'DeletedParameters': Names}
+
+
+class TestParameterConfigStore(unittest.TestCase):
+    def test_write_standard(self):
+        mock_ssm_client = MagicMock()
+        mock_ssm_client.put_parameter.return_value = {'Version': 2}
+
+        result = ParameterConfigStore(mock_ssm_client).write('dev', SEED_CONFIG)
+
+        self.assertEqual(result, 2)
+        mock_ssm_client.put_parameter.assert_called_once_with(
+            Name='/dev/wireguard/config_file',
+            Description='The config file for wireguard in the dev network.',
+            Value=SEED_CONFIG,
+            Type='SecureString',
+            Overwrite=True,
+            Tier='Standard',
+            DataType='text'
+        )
+
+    def test_write_over_tier_limit(self):
+        mock_ssm_client = MagicMock()
+
+        with self.assertRaises(Exception) as context:
+            ParameterConfigStore(mock_ssm_client, 'Advanced').write('dev', get_large_config(100))
+
+        self.assertIn('8192 byte limit', str(context.exception))
+        mock_ssm_client.put_parameter.assert_not_called()
+
+
+class TestShardedParameterConfigStore(unittest.TestCase):
+    def setUp(self):
+        self.ssm_client = FakeParameterStore({'/dev/wireguard/config_file': SEED_CONFIG})
+        self.store = ShardedParameterConfigStore(self.ssm_client)
+
+    def test_read_seed_config_before_first_write(self):
+        self.assertEqual(self.store.read('dev'), SEED_CONFIG)
+
+    def test_write_and_read_thousands_of_peers(self):
+        config_str = get_large_config(2000)
+
+        self.store.write('dev', config_str)
+
+        shards = [n for n in self.ssm_client.parameters if n.startswith('/dev/wireguard/config_shards/')]
+        self.assertGreater(len(shards), 10)
+        self.assertEqual(self.store.read('dev'), config_str)
+        # The seed parameter is left alone.
+        self.assertEqual(self.ssm_client.parameters['/dev/wireguard/config_file'][0], SEED_CONFIG)
+
+    def test_write_unchanged_config(self):
+        config_str = get_large_config(50)
+        version = self.store.write('dev', config_str)
+        put_count = self.ssm_client.put_count
+
+        self.assertEqual(self.store.write('dev', config_str), version)
+        self.assertEqual(self.ssm_client.put_count, put_count)
+
+    def test_write_keeps_previous_generation_only(self):
+        configs = [get_large_config(50) for _ in range(3)]
+        generations = []
+        for config_str in configs:
+            self.store.write('dev', config_str)
+            generations.append(self.ssm_client.parameters['/dev/wireguard/config_manifest'][0].splitlines()[0].split()[0])
+
+        shard_generations = {n.split('/')[4] for n in self.ssm_client.parameters if '/config_shards/' in n}
+        self.assertEqual(shard_generations, set(generations[1:]))
+        self.assertEqual(self.store.read('dev'), configs[2])
+
+
+class TestS3ConfigStore(unittest.TestCase):
+    def test_write_encrypts_with_kms(self):
+        mock_s3_client = MagicMock()
+        mock_s3_client.put_object.return_value = {'ETag': '"etag1"', 'VersionId': 'v1'}
+
+        result = S3ConfigStore(MagicMock(), mock_s3_client, 'bucket', 'key-id').write('dev', SEED_CONFIG)
+
+        self.assertEqual(result, 'v1')
+        kwargs = mock_s3_client.put_object.call_args.kwargs
+        self.assertEqual(kwargs['Key'], 'dev/wireguard/wg0.conf.gz')
+        self.assertEqual(kwargs['ServerSideEncryption'], 'aws:kms')
+        self.assertEqual(kwargs['SSEKMSKeyId'], 'key-id')
+        self.assertEqual(gzip.decompress(kwargs['Body']).decode('utf-8'), SEED_CONFIG)
+
+    def test_read_seed_config_before_first_write(self):
+        mock_s3_client = MagicMock()
+        mock_s3_client.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey', 'Message': ''}}, 'GetObject')
+        ssm_client = FakeParameterStore({'/dev/wireguard/config_file': SEED_CONFIG})
+
+        self.assertEqual(S3ConfigStore(ssm_client, mock_s3_client, 'bucket').read('dev'), SEED_CONFIG)
+
+
+class TestFetchCommands(unittest.TestCase):
+    # Runs each store's fetch command against a fake aws cli that answers from what the store wrote.
+
+    def run_fetch_command(self, store, ssm_client, objects=None):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, (value, _) in ssm_client.parameters.items():
+                path = os.path.join(directory, 'ssm' + name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(value)
+            for key, body in (objects or {}).items():
+                path = os.path.join(directory, 's3', key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(body)
+            aws = os.path.join(directory, 'aws')
+            with open(aws, 'w') as f:
+                f.write(
+                    '#!/bin/bash\n'
+                    f'if [ "$1" = ssm ]; then cat "{directory}/ssm$4"; echo; '
+                    f'elif [ "$1" = s3api ]; then [ -f "{directory}/s3/$6" ] || '
+                    '{ echo "An error occurred (404) when calling the HeadObject operation" >&2; exit 254; }; '
+                    f'else cat "{directory}/s3/${{3#s3://*/}}"; fi\n'
+                )
+            os.chmod(aws, 0o755)
+            result = subprocess.run(
+                ['bash', '-c', 'set -eo pipefail; ' + store.get_fetch_command('dev')],
+                env=dict(os.environ, PATH=f"{directory}:{os.environ['PATH']}"),
+                capture_output=True,
+                check=True,
+            )
+            return result.stdout.decode('utf-8')
+
+    def test_parameter_fetch_command(self):
+        ssm_client = FakeParameterStore({'/dev/wireguard/config_file': SEED_CONFIG})
+
+        self.assertEqual(self.run_fetch_command(ParameterConfigStore(ssm_client), ssm_client), SEED_CONFIG)
+
+    def test_sharded_parameter_fetch_command(self):
+        ssm_client = FakeParameterStore()
+        store = ShardedParameterConfigStore(ssm_client)
+        config_str = get_large_config(300)
+        store.write('dev', config_str)
+
+        self.assertEqual(self.run_fetch_command(store, ssm_client), config_str)
+
+    def test_s3_fetch_command(self):
+        mock_s3_client = MagicMock()
+        mock_s3_client.put_object.return_value = {'ETag': '"etag1"'}
+        store = S3ConfigStore(FakeParameterStore(), mock_s3_client, 'bucket')
+        config_str = get_large_config(300)
+        store.write('dev', config_str)
+        body = mock_s3_client.put_object.call_args.kwargs['Body']
+
+        self.assertEqual(self.run_fetch_command(store, FakeParameterStore(), {'dev/wireguard/wg0.conf.gz': body}), config_str)
+
+    def test_s3_fetch_command_before_first_write(self):
+        ssm_client = FakeParameterStore({'/dev/wireguard/config_file': SEED_CONFIG})
+        store = S3ConfigStore(ssm_client, MagicMock(), 'bucket')
+
+        self.assertEqual(self.run_fetch_command(store, ssm_client), SEED_CONFIG)
+
+
+if __name__ == '__main__':
+    unittest.main()
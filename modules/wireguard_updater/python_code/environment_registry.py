@@ -0,0 +1,123 @@
+import threading
+import time
+import uuid
+from boto3.dynamodb.conditions import Key
+
+REGISTRY_PARTITION = 'REGISTRY'
+VERSION_KEY = {'PK': REGISTRY_PARTITION, 'SK': 'VERSION'}
+# How the static metadata of an environment is stored on its registry item.
+METADATA_ATTRIBUTES = {
+    'public_key': 'PublicKey',
+    'wireguard_endpoint': 'WireguardEndpoint',
+    'vpc_cidr': 'VpcCidr',
+    'instance_id': 'InstanceId',
+}
+# An environment with several servers lists them instead of the single server's public key, endpoint and instance.
+SERVER_ATTRIBUTES = {
+    'server_id': 'ServerId',
+    'public_key': 'PublicKey',
+    'wireguard_endpoint': 'WireguardEndpoint',
+    'instance_id': 'InstanceId',
+}
+SERVER_ID_CHARACTERS = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.-')
+
+
+def get_environment_key(env):
+    return {'PK': REGISTRY_PARTITION, 'SK': f'ENVIRONMENT#{env}'}
+
+
+class EnvironmentRegistry:
+    # The environments the updater manages and the static metadata of their servers, one item per environment in a
+    # single partition of the state table, plus a version item that every change to the registry bumps. The
+    # environments are cached for ttl_seconds; after that a single read of the version item tells whether they have
+    # to be read again. Listeners added with subscribe are told which environments were added, changed or removed
+    # whenever a refresh finds the registry changed. The returned environments are shared and must not be modified.
+
+    def __init__(self, table, ttl_seconds=60, clock=time.monotonic):
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.environments = None
+        self.version = None
+        self.expires_at = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def get_environments(self):
+        with self.lock:
+            if self.environments is None or self.clock() >= self.expires_at:
+                self._refresh()
+            return self.environments
+
+    def put_environment(self, env, metadata):
+        servers = metadata.get('servers') or []
+        required = ['vpc_cidr'] if len(servers) > 0 else list(METADATA_ATTRIBUTES)
+        missing = [name for name in required if metadata.get(name, '') == '']
+        missing += [f'servers[{i}].{name}' for i, server in enumerate(servers) for name in SERVER_ATTRIBUTES if server.get(name, '') == '']
+        if len(missing) > 0:
+            raise Exception(f"environment {env} is missing {missing}")
+        server_ids = [server['server_id'] for server in servers]
+        if len(set(server_ids)) != len(server_ids) or any(set(server_id) - SERVER_ID_CHARACTERS for server_id in server_ids):
+            raise Exception(f"environment {env} needs unique server ids made of letters, digits, '_', '.' and '-': {server_ids}")
+        item = dict(get_environment_key(env), Environment=env)
+        item.update({attribute: metadata[name] for name, attribute in METADATA_ATTRIBUTES.items() if metadata.get(name, '') != ''})
+        if len(servers) > 0:
+            item['Servers'] = [{attribute: server[name] for name, attribute in SERVER_ATTRIBUTES.items()} for server in servers]
+        self.table.put_item(Item=item)
+        self._bump_version()
+
+    def delete_environment(self, env):
+        self.table.delete_item(Key=get_environment_key(env))
+        self._bump_version()
+
+    def invalidate(self):
+        with self.lock:
+            self.expires_at = 0
+
+    def _bump_version(self):
+        self.table.put_item(Item=dict(VERSION_KEY, Version=uuid.uuid4().hex))
+        self.invalidate()
+
+    def _refresh(self):
+        version = self.table.get_item(Key=VERSION_KEY, ConsistentRead=True).get('Item', {}).get('Version')
+        # Without a version item there is nothing to compare against, so the environments are read every time.
+        if self.environments is None or version is None or version != self.version:
+            environments = self._read_environments()
+            if self.environments is not None:
+                self._notify(self.environments, environments)
+            self.environments = environments
+            self.version = version
+        self.expires_at = self.clock() + self.ttl_seconds
+
+    def _read_environments(self):
+        print("_read_environments: Reading the environment registry...")
+        environments = {}
+        kwargs = {'KeyConditionExpression': Key('PK').eq(REGISTRY_PARTITION) & Key('SK').begins_with('ENVIRONMENT#')}
+        while True:
+            response = self.table.query(**kwargs)
+            for item in response['Items']:
+                metadata = {name: item.get(attribute, '') for name, attribute in METADATA_ATTRIBUTES.items()}
+                if len(item.get('Servers', [])) > 0:
+                    metadata['servers'] = [
+                        {name: server.get(attribute, '') for name, attribute in SERVER_ATTRIBUTES.items()}
+                        for server in item['Servers']
+                    ]
+                environments[item['Environment']] = metadata
+            if 'LastEvaluatedKey' not in response:
+                return environments
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _notify(self, old_environments, new_environments):
+        added = sorted(env for env in new_environments if env not in old_environments)
+        removed = sorted(env for env in old_environments if env not in new_environments)
+        changed = sorted(
+            env for env in new_environments if env in old_environments and new_environments[env] != old_environments[env]
+        )
+        if len(added) + len(removed) + len(changed) == 0:
+            return
+        print(f"_notify: The registry changed, added {added}, changed {changed}, removed {removed}")
+        for listener in self.listeners:
+            listener(old_environments, new_environments, added, changed, removed)
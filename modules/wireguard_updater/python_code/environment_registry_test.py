@@ -0,0 +1,135 @@
+import unittest
+from environment_registry import EnvironmentRegistry, REGISTRY_PARTITION
+
+DEV = {'public_key': 'dev_key', 'wireguard_endpoint': '203.0.113.10:64731', 'vpc_cidr': '10.50.0.0/16', 'instance_id': 'i-1'}
+
+
+class FakeRegistryTable:
+    # Just enough of the state table for the registry: keyed items and a query over one partition, a page at a time.
+
+    def __init__(self, page_size=2):
+        self.items = {}
+        self.page_size = page_size
+        self.calls = {}
+
+    def record(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.record('get_item')
+        item = self.items.get((Key['PK'], Key['SK']))
+        return {'Item': dict(item)} if item is not None else {}
+
+    def put_item(self, Item):
+        self.record('put_item')
+        self.items[(Item['PK'], Item['SK'])] = dict(Item)
+
+    def delete_item(self, Key):
+        self.record('delete_item')
+        self.items.pop((Key['PK'], Key['SK']), None)
+
+    def query(self, KeyConditionExpression, ExclusiveStartKey=None):
+        self.record('query')
+        keys = sorted(k for k in self.items if k[0] == REGISTRY_PARTITION and k[1].startswith('ENVIRONMENT#'))
+        start = keys.index((ExclusiveStartKey['PK'], ExclusiveStartKey['SK'])) + 1 if ExclusiveStartKey else 0
+        page = keys[start:start + self.page_size]
+        response = {'Items': [dict(self.items[k]) for k in page]}
+        if start + self.page_size < len(keys):
+            response['LastEvaluatedKey'] = {'PK': page[-1][0], 'SK': page[-1][1]}
+        return response
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestEnvironmentRegistry(unittest.TestCase):
+    def setUp(self):
+        self.table = FakeRegistryTable()
+        self.clock = Clock()
+        self.registry = EnvironmentRegistry(self.table, ttl_seconds=60, clock=self.clock)
+
+    def test_reads_every_page(self):
+        for i in range(5):
+            self.registry.put_environment(f'env{i}', dict(DEV, instance_id=f'i-{i}'))
+
+        environments = self.registry.get_environments()
+
+        self.assertEqual(sorted(environments), [f'env{i}' for i in range(5)])
+        self.assertEqual(environments['env3'], dict(DEV, instance_id='i-3'))
+        self.assertEqual(self.table.calls['query'], 3)
+
+    def test_cached_until_the_ttl_expires(self):
+        self.registry.put_environment('dev', DEV)
+        self.registry.get_environments()
+        # Written behind the registry's back, e.g. by terraform, without bumping the version.
+        self.table.put_item(Item={'PK': REGISTRY_PARTITION, 'SK': 'ENVIRONMENT#prod', 'Environment': 'prod'})
+
+        self.clock.now = 59
+        self.assertEqual(sorted(self.registry.get_environments()), ['dev'])
+        self.assertEqual(self.table.calls['query'], 1)
+
+    def test_unchanged_version_skips_the_query(self):
+        self.registry.put_environment('dev', DEV)
+        self.registry.get_environments()
+
+        self.clock.now = 61
+        self.registry.get_environments()
+
+        self.assertEqual(self.table.calls['query'], 1)
+        self.assertEqual(self.table.calls['get_item'], 2)
+
+    def test_changes_are_picked_up_and_announced(self):
+        writer = EnvironmentRegistry(self.table)
+        writer.put_environment('dev', DEV)
+        writer.put_environment('stage', dict(DEV, instance_id='i-2'))
+        notifications = []
+        self.registry.subscribe(lambda old, new, added, changed, removed: notifications.append((added, changed, removed)))
+        self.registry.get_environments()
+
+        writer.put_environment('prod', dict(DEV, instance_id='i-3'))
+        writer.put_environment('dev', dict(DEV, instance_id='i-4'))
+        writer.delete_environment('stage')
+        self.clock.now = 61
+        environments = self.registry.get_environments()
+
+        self.assertEqual(sorted(environments), ['dev', 'prod'])
+        self.assertEqual(environments['dev']['instance_id'], 'i-4')
+        self.assertEqual(notifications, [(['prod'], ['dev'], ['stage'])])
+
+    def test_own_writes_are_visible_immediately(self):
+        self.registry.get_environments()
+
+        self.registry.put_environment('dev', DEV)
+
+        self.assertIn('dev', self.registry.get_environments())
+
+    def test_put_environment_requires_metadata(self):
+        with self.assertRaises(Exception):
+            self.registry.put_environment('dev', dict(DEV, instance_id=''))
+
+
+    def test_environment_with_several_servers(self):
+        servers = [
+            {'server_id': 'a', 'public_key': 'key_a', 'wireguard_endpoint': '203.0.113.10:64731', 'instance_id': 'i-1'},
+            {'server_id': 'b', 'public_key': 'key_b', 'wireguard_endpoint': '203.0.113.11:64731', 'instance_id': 'i-2'},
+        ]
+
+        self.registry.put_environment('dev', {'vpc_cidr': '10.50.0.0/16', 'servers': servers})
+
+        self.assertEqual(self.registry.get_environments()['dev'], {
+            'public_key': '', 'wireguard_endpoint': '', 'vpc_cidr': '10.50.0.0/16', 'instance_id': '', 'servers': servers,
+        })
+
+    def test_put_environment_validates_servers(self):
+        server = {'server_id': 'a', 'public_key': 'key_a', 'wireguard_endpoint': '203.0.113.10:64731', 'instance_id': 'i-1'}
+        for servers in [[server, server], [dict(server, server_id='a/b')], [dict(server, instance_id='')]]:
+            with self.assertRaises(Exception):
+                self.registry.put_environment('dev', {'vpc_cidr': '10.50.0.0/16', 'servers': servers})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,310 @@
-import json
+import base64
+import binascii
+import functools
+import hashlib
+import math
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 import boto3
-import re
 import time
 import os
-ssm_client = boto3.client('ssm', os.getenv('AWS_REGION', 'us-east-1'))
-table_client = boto3.resource('dynamodb', os.getenv('AWS_REGION', 'us-east-1')).Table(os.getenv("DYNAMODB_TABLE_NAME", "test"))
+from config_store import ParameterConfigStore, S3ConfigStore, ShardedParameterConfigStore
+from environment_registry import EnvironmentRegistry
+from ip_allocator import IpAllocator
+from peer_liveness import DUMP_COMMAND, PeerLivenessStore, get_idle_peers, merge_peer_liveness, parse_peer_dump
+from placement import HashRing
+import metrics
+from wireguard_config import WireGuardConfig
+# Upper bound on how many environments are read, written or sent a command at the same time.
+SSM_MAX_CONCURRENCY = int(os.getenv('SSM_MAX_CONCURRENCY', '10'))
+# How long check_status_of_commands waits for the servers to finish applying a config.
+COMMAND_WAIT_TIMEOUT_SECONDS = int(os.getenv('COMMAND_WAIT_TIMEOUT_SECONDS', '120'))
+PENDING_COMMAND_STATUSES = ['Pending', 'InProgress', 'Delayed']
+# 'syncconf' hot-applies peer changes to the running interface, 'restart' restarts wg-quick@wg0.
+WIREGUARD_APPLY_MODE = os.getenv('WIREGUARD_APPLY_MODE', 'syncconf')
+# The SSM document the servers apply their configs with, see apply_document.py, and the version of it to send.
+APPLY_DOCUMENT_NAME = os.getenv('APPLY_DOCUMENT_NAME', 'wireguard-updater-apply-config')
+APPLY_DOCUMENT_VERSION = os.getenv('APPLY_DOCUMENT_VERSION', '$DEFAULT')
+# How many servers apply a config at the same time, and how many may fail before SSM stops sending to the rest.
+APPLY_MAX_CONCURRENCY = os.getenv('APPLY_MAX_CONCURRENCY', '50')
+APPLY_MAX_ERRORS = os.getenv('APPLY_MAX_ERRORS', '100%')
+# SendCommand accepts at most this many instance ids in a target.
+SEND_COMMAND_MAX_TARGETS = 50
+type_serializer = TypeSerializer()
+type_deserializer = TypeDeserializer()
+PUBLIC_KEY_INDEX_NAME = os.getenv('PUBLIC_KEY_INDEX_NAME', 'PublicKeyIndex')
+# Deltas larger than a Standard tier parameter are replaced by a marker that makes the servers do a full sync.
+CONFIG_DELTA_MAX_BYTES = 4096
+# Number of parallel scan segments the reconcile handler reads the client table with.
+RECONCILE_SCAN_SEGMENTS = int(os.getenv('RECONCILE_SCAN_SEGMENTS', '8'))
+# How long the presigned url of a client config export stays valid.
+EXPORT_URL_EXPIRY_SECONDS = int(os.getenv('EXPORT_URL_EXPIRY_SECONDS', '900'))
+# Where the server configs are stored: 'parameter', 'advanced_parameter', 'sharded_parameter' or 's3'.
+CONFIG_STORE = os.getenv('CONFIG_STORE', 'parameter')
+# How long an environment whose server failed to apply its config is skipped, doubling with every failure in a row.
+ENVIRONMENT_RETRY_BASE_SECONDS = int(os.getenv('ENVIRONMENT_RETRY_BASE_SECONDS', '30'))
+ENVIRONMENT_RETRY_MAX_SECONDS = int(os.getenv('ENVIRONMENT_RETRY_MAX_SECONDS', '900'))
+# How long the lambdas use the environments they read from the registry before checking it for changes again.
+REGISTRY_CACHE_TTL_SECONDS = int(os.getenv('REGISTRY_CACHE_TTL_SECONDS', '60'))
+# Where the servers upload their peer dumps and the collected peer liveness is kept.
+LIVENESS_BUCKET_NAME = os.getenv('LIVENESS_BUCKET_NAME', '')
+# Peers without a handshake for this many days are expired; 0 only collects their liveness.
+PEER_EXPIRY_DAYS = int(os.getenv('PEER_EXPIRY_DAYS', '90'))
+# How often a config write that lost a race with another writer is retried against the fresh config.
+CONFIG_WRITE_MAX_ATTEMPTS = int(os.getenv('CONFIG_WRITE_MAX_ATTEMPTS', '5'))
+# How long a claimed config write may take before another writer can take the claim over, when the writer doesn't
+# know how long it has left. No invocation runs longer than the lambda limit.
+CONFIG_CLAIM_TIMEOUT_SECONDS = int(os.getenv('CONFIG_CLAIM_TIMEOUT_SECONDS', '900'))
+# How often a writer checks whether another writer's claim on a config has been finished.
+CONFIG_CLAIM_POLL_SECONDS = float(os.getenv('CONFIG_CLAIM_POLL_SECONDS', '1'))
+# At most this many client ips are named in a log summary; the rest are only counted.
+LOG_SUMMARY_MAX_ITEMS = int(os.getenv('LOG_SUMMARY_MAX_ITEMS', '10'))
 
 
-def get_config_files(environments):
-    print("get_config_files: Retrieving config files for each environment...")
-    config_files = {}
-    for env in environments:
+# The AWS clients are only built the first time a handler needs them, so e.g. get_client_config_file never pays
+# for an SSM client during its cold start.
+@functools.lru_cache(maxsize=None)
+def get_ssm_client():
+    return metrics.instrument_client(boto3.client(
+        'ssm',
+        os.getenv('AWS_REGION', 'us-east-1'),
+        config=Config(max_pool_connections=SSM_MAX_CONCURRENCY),
+    ), 'Ssm')
+
+
+@functools.lru_cache(maxsize=None)
+def get_dynamodb_resource():
+    return boto3.resource('dynamodb', os.getenv('AWS_REGION', 'us-east-1'))
+
+
+# A plain client with typed attribute values, which is thread safe. The resource's own meta.client isn't plain: the
+# resource hooks into it to convert attribute values.
+@functools.lru_cache(maxsize=None)
+def get_dynamodb_client():
+    return boto3.client(
+        'dynamodb',
+        os.getenv('AWS_REGION', 'us-east-1'),
+        config=Config(max_pool_connections=SSM_MAX_CONCURRENCY),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    return boto3.client(
+        's3',
+        os.getenv('AWS_REGION', 'us-east-1'),
+        config=Config(max_pool_connections=SSM_MAX_CONCURRENCY),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_table_client():
+    return get_dynamodb_resource().Table(os.getenv("DYNAMODB_TABLE_NAME", "test"))
+
+
+# Holds the updater's own bookkeeping, such as the client ip pool, so it never shows up in the client table's stream.
+@functools.lru_cache(maxsize=None)
+def get_state_table_client():
+    return get_dynamodb_resource().Table(os.getenv("STATE_TABLE_NAME", "test-state"))
+
+
+@functools.lru_cache(maxsize=None)
+def get_ip_allocator():
+    return IpAllocator(
+        get_state_table_client(),
+        os.getenv('CLIENT_CIDR', '192.168.2.0/24'),
+        int(os.getenv('CLIENT_IP_RESERVED_COUNT', '5')),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_environment_registry():
+    registry = EnvironmentRegistry(get_state_table_client(), REGISTRY_CACHE_TTL_SECONDS)
+    registry.subscribe(reset_replaced_servers)
+    return registry
+
+
+def get_environment_map():
+    # The environments and their servers' metadata, shared by every caller. Command state is kept apart from it, see
+    # get_command_states.
+    return get_environment_registry().get_environments()
+
+
+def get_server_map(environment_map):
+    # Every config target and the metadata of its server. An environment with a single server is its own target; every
+    # server of an environment with several gets its own config, stored as the target <environment>/<server id>,
+    # holding the share of the environment's peers the hash ring places on it.
+    server_map = {}
+    for env, metadata in environment_map.items():
+        for server in metadata.get('servers', []):
+            server_map[f"{env}/{server['server_id']}"] = dict(server, vpc_cidr=metadata['vpc_cidr'])
+        if len(metadata.get('servers', [])) == 0:
+            server_map[env] = metadata
+    return server_map
+
+
+def get_target_environment(target):
+    return target.split('/', 1)[0]
+
+
+def get_failed_environments(failures):
+    # An environment failed when any of its targets did.
+    return {get_target_environment(target): e for target, e in failures.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def get_hash_ring(server_ids):
+    return HashRing(server_ids)
+
+
+def get_peer_target(env, public_key, environment_map):
+    servers = environment_map[env].get('servers', [])
+    if len(servers) == 0:
+        return env
+    server_id = get_hash_ring(tuple(sorted(server['server_id'] for server in servers))).get_server(public_key)
+    return f'{env}/{server_id}'
+
+
+def place_peer_changes(peer_changes, environment_map):
+    # Turns peer changes per environment into peer changes per target. A peer is added to the server the ring places
+    # it on, while removals go to every server of the environment, so a peer is also taken off a server it was placed
+    # on before the environment's servers changed and reconcile moved it. Every target of the environments in
+    # peer_changes is returned, with no changes when none of them are placed on it.
+    server_map = get_server_map({env: environment_map[env] for env in peer_changes if env in environment_map})
+    placed = {target: {} for target in server_map}
+    for env, changes in peer_changes.items():
+        if env not in environment_map:
+            continue
+        targets = [target for target in server_map if get_target_environment(target) == env]
+        for public_key, client_ip in changes.items():
+            if client_ip is None:
+                for target in targets:
+                    placed[target][public_key] = None
+            else:
+                placed[get_peer_target(env, public_key, environment_map)][public_key] = client_ip
+    return placed
+
+
+def reset_replaced_servers(old_environments, new_environments, added, changed, removed):
+    # A server that was replaced starts from its seed config, so what the old one applied or how often it failed no
+    # longer says anything. Forgetting it makes the next update or reconcile send the new server its full config.
+    old_servers = get_server_map({env: old_environments[env] for env in changed})
+    new_servers = get_server_map({env: new_environments[env] for env in changed})
+    replaced = [
+        target for target in new_servers
+        if target in old_servers and old_servers[target]['instance_id'] != new_servers[target]['instance_id']
+    ]
+    for target in replaced:
+        print(f"reset_replaced_servers: {target} has a new server, forgetting the old one's applied config")
+        get_state_table_client().update_item(
+            Key=get_environment_state_key(target),
+            UpdateExpression='REMOVE AppliedHash, FailureCount, RetryAfter'
+        )
+
+
+def forget_replaced_servers(environment_states, server_map):
+    # reset_replaced_servers only runs in a container that sees the registry change. The applied hash is recorded with
+    # the server that reported it, so a server replaced while no container was around is recognised here instead, and
+    # what the old one applied or how often it failed is ignored the same way.
+    for target, state in environment_states.items():
+        instance_id = server_map.get(target, {}).get('instance_id')
+        if state.get('AppliedInstanceId', instance_id) != instance_id:
+            print(f"forget_replaced_servers: {target} has a new server, ignoring the old one's applied config")
+            for attribute_name in ['AppliedHash', 'FailureCount', 'RetryAfter']:
+                state.pop(attribute_name, None)
+    return environment_states
+
+
+def get_command_states(server_map, targets):
+    # What happened to the command sent to each target's server.
+    return {target: {'instance_id': server_map[target]['instance_id'], 'command_id': '', 'status': ''} for target in targets}
+
+
+@functools.lru_cache(maxsize=None)
+def get_peer_liveness_store():
+    return PeerLivenessStore(get_s3_client(), LIVENESS_BUCKET_NAME)
+
+
+def get_config_store(config_store=CONFIG_STORE):
+    region = os.getenv('AWS_REGION', 'us-east-1')
+    if config_store == 'parameter':
+        return ParameterConfigStore(get_ssm_client(), 'Standard', region)
+    if config_store == 'advanced_parameter':
+        return ParameterConfigStore(get_ssm_client(), 'Advanced', region)
+    if config_store == 'sharded_parameter':
+        return ShardedParameterConfigStore(get_ssm_client(), os.getenv('CONFIG_SHARD_TIER', 'Standard'), region)
+    if config_store == 's3':
+        return S3ConfigStore(
+            get_ssm_client(),
+            get_s3_client(),
+            os.getenv('CONFIG_BUCKET_NAME', ''),
+            os.getenv('CONFIG_KMS_KEY_ID', ''),
+            region,
+        )
+    raise Exception(f"unknown config store {config_store}")
+
+
+class PublicKeyExistsError(Exception):
+    pass
+
+
+class ClientNotFoundError(Exception):
+    pass
+
+
+class ConfigConflictError(Exception):
+    pass
+
+
+class ConfigClaimedError(ConfigConflictError):
+    def __init__(self, message, pending_until):
+        super().__init__(message)
+        self.pending_until = pending_until
+
+
+def run_for_each_environment(operation, environments, max_workers=SSM_MAX_CONCURRENCY):
+    # Runs operation(env) on a bounded thread pool and collects every result or failure instead of stopping at the
+    # first error.
+    results = {}
+    failures = {}
+    if len(environments) == 0:
+        return results, failures
+    if len(environments) == 1:
+        # Not worth a thread pool, and keeps nested calls from the per environment pipeline on the same thread.
+        env = environments[0]
         try:
-            config_files[env] = ssm_client.get_parameter(
-                Name=f'/{env}/wireguard/config_file',
-                WithDecryption=True,
-            )['Parameter']['Value']
+            results[env] = operation(env)
         except Exception as e:
-            raise e
-    return config_files
+            print(f"run_for_each_environment: {env} failed: {e}")
+            failures[env] = e
+        return results, failures
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(environments)))) as executor:
+        futures = {executor.submit(operation, env): env for env in environments}
+        for future in as_completed(futures):
+            env = futures[future]
+            try:
+                results[env] = future.result()
+            except Exception as e:
+                print(f"run_for_each_environment: {env} failed: {e}")
+                failures[env] = e
+    # Keep the caller's environment order regardless of completion order.
+    results = {env: results[env] for env in environments if env in results}
+    return results, failures
+
+
+def get_config_files(environments):
+    print("get_config_files: Retrieving config files for each environment...")
+    # Build the clients before fanning out; creating boto3 clients isn't thread safe.
+    config_store = get_config_store()
+    return run_for_each_environment(config_store.read, environments)
+
+
+def read_config_file(env):
+    return get_config_store().read(env)
 
 
 def compare_environments(old_image, new_image):
@@ -32,176 +316,973 @@ def compare_environments(old_image, new_image):
     return removed, added
 
 
-def update_public_key(old_image, new_image, config_files_map):
-    print("update_public_key: Updating client public key...")
+def get_peer_changes(old_image, new_image):
     old_public_key = old_image.get('PublicKey', {}).get('S', '')
     new_public_key = new_image.get('PublicKey', {}).get('S', '')
+    client_ip = new_image.get('ClientIP', {}).get('S', '')
+    new_environments = [obj['S'] for obj in new_image.get('Environments', {}).get('L', [])]
 
-    if old_public_key == '':
+    removed_envs, added_envs = compare_environments(old_image, new_image)
+    if len(removed_envs) == 0 and len(added_envs) == 0 and old_public_key == '':
         raise Exception("the public_key for this client is unexpectedly empty. please manually check the config")
-    if old_public_key != new_public_key:
-        for e in [obj['S'] for obj in new_image.get('Environments', {}).get('L', [])]:
-            config_files_map[e] = update_peer_public_key(config_files_map[e], old_public_key, new_public_key)
-    return config_files_map
 
+    # Each environment maps a public key to the client ip it should be allowed, or None if the peer must be removed.
+    peer_changes = {}
+    for env in removed_envs:
+        peer_changes.setdefault(env, {})[old_public_key] = None
+    for env in new_environments:
+        if env in added_envs:
+            peer_changes.setdefault(env, {})[new_public_key] = client_ip
+        elif old_public_key != new_public_key:
+            peer_changes.setdefault(env, {})[old_public_key] = None
+            peer_changes[env][new_public_key] = client_ip
+    return peer_changes
 
-def add_peer_section(config_str, new_image):
-    print("add_peer_section: Adding peer section to config...")
-    public_key = new_image.get('PublicKey', {}).get('S', '')
-    client_ip = new_image.get('ClientIP', {}).get('S', '')
 
-    # We don't want to add the peer section if public key or client_ip is an empty string
-    if public_key == '' or client_ip == '':
-        raise Exception("either no client_ip or public_key provided")
-    if f'PublicKey = {public_key}' not in config_str:
-        config_str += f'\n[Peer]\nPublicKey = {public_key}\nAllowedIPs = {client_ip}'
-    return config_str
+def coalesce_stream_records(records):
+    print(f"coalesce_stream_records: Folding {len(records)} stream records into one change per environment...")
+    # Records that can't be turned into peer changes are returned as failed instead of failing the whole batch.
+    peer_changes = {}
+    failed_records = []
+    for record in records:
+        old_image = record['dynamodb'].get('OldImage', {})
+        # A removed client has no new image; the peer leaves every environment it was in.
+        new_image = {} if record.get('eventName') == 'REMOVE' else record['dynamodb'].get('NewImage', {})
+        try:
+            record_changes = get_peer_changes(old_image, new_image)
+        except Exception as e:
+            print(f"coalesce_stream_records: Skipping record {record['dynamodb'].get('SequenceNumber')}: {e}")
+            failed_records.append(record)
+            continue
+        for env, changes in record_changes.items():
+            env_changes = peer_changes.setdefault(env, {})
+            for public_key, client_ip in changes.items():
+                # Later records win, so a key added and then removed in the same batch nets out to a removal.
+                env_changes.pop(public_key, None)
+                env_changes[public_key] = client_ip
+    return peer_changes, failed_records
+
+
+def get_failed_records(records, failed_envs, failed_records):
+    # Every record that touches an environment whose config couldn't be stored has to be retried, along with the
+    # records that failed on their own.
+    failed_ids = {id(record) for record in failed_records}
+    return [r for r in records if id(r) in failed_ids or len(get_record_environments(r) & set(failed_envs)) > 0]
+
+
+def get_batch_item_failures(failed_records):
+    # The stream checkpoints everything before the lowest reported sequence number and retries the rest.
+    return {'batchItemFailures': [{'itemIdentifier': r['dynamodb']['SequenceNumber']} for r in failed_records]}
+
+
+def get_record_environments(record):
+    old_image = record['dynamodb'].get('OldImage', {})
+    new_image = record['dynamodb'].get('NewImage', {})
+    return {obj['S'] for image in [old_image, new_image] for obj in image.get('Environments', {}).get('L', [])}
+
+
+def get_oldest_record_times(records):
+    # The creation time of the oldest record touching each environment, which is where its propagation latency starts.
+    oldest = {}
+    for record in records:
+        created_at = record['dynamodb'].get('ApproximateCreationDateTime')
+        if created_at is None:
+            continue
+        for env in get_record_environments(record):
+            oldest[env] = min(oldest.get(env, created_at), created_at)
+    return oldest
+
+
+def summarize_records(records):
+    # Stands in for logging the whole event: no keys and a bounded number of client ips however big the batch is.
+    event_names = {}
+    client_ips = []
+    for record in records:
+        event_names[record.get('eventName')] = event_names.get(record.get('eventName'), 0) + 1
+        image = record['dynamodb'].get('NewImage') or record['dynamodb'].get('OldImage') or {}
+        client_ips.append(image.get('ClientIP', {}).get('S', ''))
+    counts = ', '.join(f'{k}={v}' for k, v in sorted(event_names.items(), key=lambda kv: str(kv[0])))
+    named = ', '.join(client_ips[:LOG_SUMMARY_MAX_ITEMS])
+    more = f' and {len(client_ips) - LOG_SUMMARY_MAX_ITEMS} more' if len(client_ips) > LOG_SUMMARY_MAX_ITEMS else ''
+    return f"{len(records)} records ({counts}) for clients {named}{more}"
+
+
+def get_config_sizes(config_files_map):
+    return {env: (config_str.count('[Peer]'), len(config_str.encode('utf-8'))) for env, config_str in config_files_map.items()}
+
+
+def scan_clients(total_segments=RECONCILE_SCAN_SEGMENTS):
+    print(f"scan_clients: Scanning the client table in {total_segments} segments...")
+    # The plain client is thread safe, unlike the table resource, and returns items in the same format as the stream
+    # images. The resource's own client would return them untyped.
+    dynamodb_client = get_dynamodb_client()
+    table_name = get_table_client().name
+
+    def scan_segment(segment):
+        items = []
+        paginator = dynamodb_client.get_paginator('scan')
+        for page in paginator.paginate(
+            TableName=table_name,
+            Segment=segment,
+            TotalSegments=total_segments,
+            ProjectionExpression='ClientIP, PublicKey, Environments',
+            ConsistentRead=True,
+        ):
+            items.extend(page['Items'])
+        return items
+
+    segments, failures = run_for_each_environment(scan_segment, list(range(total_segments)), total_segments)
+    if len(failures) > 0:
+        raise Exception(f"failed to scan the client table: {failures}")
+    return [item for items in segments.values() for item in items]
+
 
+def get_desired_peers(clients, environments):
+    # Every environment's peer set as the client table says it should be: public key -> client ip.
+    desired_peers = {env: {} for env in environments}
+    for client in clients:
+        public_key = client.get('PublicKey', {}).get('S', '')
+        client_ip = client.get('ClientIP', {}).get('S', '')
+        if public_key == '' or client_ip == '':
+            print(f"get_desired_peers: Skipping client {client_ip} without a public key")
+            continue
+        for env in [obj['S'] for obj in client.get('Environments', {}).get('L', [])]:
+            if env in desired_peers:
+                desired_peers[env][public_key] = client_ip
+    return desired_peers
 
-def update_peer_public_key(config_str, old_public_key, new_public_key):
-    print("update_peer_public_key: Key needs updated. Updating peer public key...")
-    pattern = re.compile(r'PublicKey\s*=\s*' + re.escape(old_public_key))
-    updated_config_str = pattern.sub('PublicKey = ' + new_public_key, config_str)
-    return updated_config_str.strip()
 
+def get_reconcile_changes(config_files_map, desired_peers):
+    # The peer changes that turn each stored config into the desired peer set, in the same format as
+    # coalesce_stream_records so they go through the same update path.
+    peer_changes = {}
+    for env, config_str in config_files_map.items():
+        config = WireGuardConfig.parse(config_str)
+        desired = desired_peers.get(env, {})
+        changes = {public_key: None for public_key in config.peers if public_key not in desired}
+        changes.update({k: v for k, v in desired.items() if config.get_allowed_ips(k) != v})
+        if len(changes) > 0:
+            peer_changes[env] = changes
+    return peer_changes
 
-def remove_peer_section(config_str, old_image):
-    print("remove_peer_section: Removing peer section from config...")
-    public_key = old_image.get('PublicKey', {}).get('S', '')
-    pattern = re.compile(
-        r'\[Peer\](?:\n(?:[^\[]*\n)*?PublicKey\s*=\s*' + re.escape(public_key) + r'\n(?:.*\n)*?)(?=\[Peer\]|\Z)',
-        re.MULTILINE
+
+def apply_peer_changes(config, peer_changes):
+    print("apply_peer_changes: Applying net peer changes to config...")
+    changed = False
+    for public_key, client_ip in peer_changes.items():
+        if client_ip is None:
+            changed = config.remove_peer(public_key) or changed
+            continue
+        if public_key == '' or client_ip == '':
+            raise Exception("either no client_ip or public_key provided")
+        changed = config.set_peer(public_key, client_ip) or changed
+    return changed
+
+
+def get_dirty_config_files(config_files_map, peer_changes):
+    print("get_dirty_config_files: Applying peer changes and keeping only the configs that changed...")
+    dirty_config_files_map = {}
+    for env, config_str in config_files_map.items():
+        config = WireGuardConfig.parse(config_str)
+        if apply_peer_changes(config, peer_changes.get(env, {})):
+            dirty_config_files_map[env] = config.serialize()
+    return dirty_config_files_map
+
+
+def get_config_files_to_apply(config_files_map, dirty_config_files_map, environment_states):
+    print("get_config_files_to_apply: Finding the configs the servers haven't applied yet...")
+    # A config that is unchanged but whose hash the server never reported back (e.g. the apply failed and the batch
+    # is being retried) still has to be applied; everything else that is unchanged is skipped.
+    config_files_to_apply = {}
+    for env, config_str in config_files_map.items():
+        desired_config_str = dirty_config_files_map.get(env, config_str)
+        if env in dirty_config_files_map or environment_states.get(env, {}).get('AppliedHash') != get_config_hash(desired_config_str):
+            config_files_to_apply[env] = desired_config_str
+    return config_files_to_apply
+
+
+def get_config_delta(old_config_str, new_config_str):
+    # One line per peer operation, e.g. 'add <public key> 192.168.2.5/32' or 'remove <public key>'.
+    operations = WireGuardConfig.parse(old_config_str).diff(WireGuardConfig.parse(new_config_str))
+    return [f"{op} {public_key} {allowed_ips.replace(' ', '')}".strip() for op, public_key, allowed_ips in operations]
+
+
+def publish_config_deltas(config_deltas, sequences, config_hash_changes):
+    # config_hash_changes maps each environment to the hashes of the config its delta starts from and produces.
+    print(f"publish_config_deltas: Publishing peer deltas for {list(config_deltas)}...")
+    ssm_client = get_ssm_client()
+
+    def publish_config_delta(env):
+        # Every stored config gets the next sequence number of its environment when it is claimed, see
+        # claim_config_hash, and deltas are only published under the claim so the sequence never goes backwards. A
+        # server applies the delta only when it is at both the delta's starting sequence and hash, skips it when it is
+        # at the config the delta produces and otherwise syncs the full config.
+        sequence = sequences[env]
+        header = f'{sequence - 1} {sequence} {config_hash_changes[env][0]} {config_hash_changes[env][1]}'
+        delta = '\n'.join([f'delta {header}'] + config_deltas[env])
+        if len(delta.encode('utf-8')) > CONFIG_DELTA_MAX_BYTES:
+            delta = f'full {header}'
+        ssm_client.put_parameter(
+            Name=f'/{env}/wireguard/config_delta',
+            Description=f'The latest peer changes for wireguard in the {env} network.',
+            Value=delta,
+            Type='SecureString',
+            Overwrite=True,
+            Tier='Standard',
+            DataType='text'
+        )
+        return sequence
+
+    return run_for_each_environment(publish_config_delta, list(config_deltas))
+
+
+def get_applied_config_hashes(instance_id_map, config_hashes, sequences):
+    # A server reports the hash of the config it is at. One running an older apply document only reports the
+    # sequence after a delta, which stands for the config published with that sequence.
+    applied_hashes = {}
+    for env, config_hash in config_hashes.items():
+        instance = instance_id_map.get(env, {})
+        if instance.get('status') != 'Success':
+            continue
+        if 'applied_hash' in instance:
+            applied_hashes[env] = instance['applied_hash']
+        elif env in sequences and instance.get('applied_sequence') == str(sequences[env]):
+            applied_hashes[env] = config_hash
+    return applied_hashes
+
+
+def get_deferred_environments(environment_states, now=None):
+    # Environments whose server failed recently are left alone until their retry time, so one unhealthy server
+    # doesn't hold up every batch for the whole command wait.
+    now = now or time.time()
+    return [env for env, state in environment_states.items() if state.get('RetryAfter', 0) > now]
+
+
+def get_retry_delay(failure_count):
+    return min(ENVIRONMENT_RETRY_BASE_SECONDS * 2 ** (failure_count - 1), ENVIRONMENT_RETRY_MAX_SECONDS)
+
+
+def record_apply_results(environment_states, apply_results):
+    # apply_results maps each environment a command was sent to whether its server confirmed the config. Failures
+    # push the next attempt back exponentially; a success clears the retry state again.
+    print(f"record_apply_results: Recording apply results for {list(apply_results)}...")
+    now = time.time()
+    updates = {}
+    for env, succeeded in apply_results.items():
+        failure_count = int(environment_states.get(env, {}).get('FailureCount', 0))
+        if succeeded and failure_count > 0:
+            updates[env] = ('SET FailureCount = :zero REMOVE RetryAfter', {':zero': 0})
+        elif not succeeded:
+            retry_after = int(now + get_retry_delay(failure_count + 1))
+            updates[env] = (
+                'SET FailureCount = :count, RetryAfter = :retry_after',
+                {':count': failure_count + 1, ':retry_after': retry_after}
+            )
+
+    def record_apply_result(env):
+        update_expression, values = updates[env]
+        update_state_item(
+            Key=get_environment_state_key(env),
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=values
+        )
+
+    return run_for_each_environment(record_apply_result, list(updates))
+
+
+def get_environment_state_key(env):
+    return {'PK': f'ENVIRONMENT#{env}', 'SK': 'CONFIG'}
+
+
+def update_state_item(Key, **kwargs):
+    # update_item of the state table for the environment state, which is written from the thread pool. The table
+    # resource isn't thread safe, so this goes through the plain client and types the key and values itself.
+    if 'ExpressionAttributeValues' in kwargs:
+        kwargs['ExpressionAttributeValues'] = serialize_item(kwargs['ExpressionAttributeValues'])
+    response = get_dynamodb_client().update_item(
+        TableName=get_state_table_client().name, Key=serialize_item(Key), **kwargs
     )
-    modified_config = pattern.sub('', config_str)
-    return modified_config.strip()
+    if 'Attributes' in response:
+        response['Attributes'] = deserialize_item(response['Attributes'])
+    return response
+
+
+def get_environment_states(environments):
+    print("get_environment_states: Retrieving the recorded config hashes for each environment...")
+    # Also read again from the thread pool when a config write conflicts, so it uses the plain client too.
+    dynamodb_client = get_dynamodb_client()
+    states = {env: {} for env in environments}
+    table_name = get_state_table_client().name
+    keys = [serialize_item(get_environment_state_key(env)) for env in environments]
+    for i in range(0, len(keys), 100):
+        request_items = {table_name: {'Keys': keys[i:i + 100], 'ConsistentRead': True}}
+        while request_items:
+            response = dynamodb_client.batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(table_name, []):
+                item = deserialize_item(item)
+                states[item['PK'][len('ENVIRONMENT#'):]] = item
+            request_items = response.get('UnprocessedKeys')
+    return states
+
+
+def record_config_hashes(config_hashes, attribute_name, instance_ids=None):
+    # instance_ids maps each environment to the server that reported the hash, see forget_replaced_servers.
+    print(f"record_config_hashes: Recording {attribute_name} for {list(config_hashes)}...")
+
+    def record_config_hash(env):
+        if instance_ids is None:
+            update_state_item(
+                Key=get_environment_state_key(env),
+                UpdateExpression='SET #hash = :hash',
+                ExpressionAttributeNames={'#hash': attribute_name},
+                ExpressionAttributeValues={':hash': config_hashes[env]}
+            )
+            return
+        update_state_item(
+            Key=get_environment_state_key(env),
+            UpdateExpression='SET #hash = :hash, AppliedInstanceId = :instance_id',
+            ExpressionAttributeNames={'#hash': attribute_name},
+            ExpressionAttributeValues={':hash': config_hashes[env], ':instance_id': instance_ids[env]}
+        )
+
+    return run_for_each_environment(record_config_hash, list(config_hashes))
+
+
+def claim_config_hash(env, read_hash, config_hash, claim_seconds=CONFIG_CLAIM_TIMEOUT_SECONDS):
+    # The config stores overwrite unconditionally, so concurrent writers are kept apart through the environment's
+    # DesiredHash, the hash of the latest stored config. A writer swaps it from the hash of the config it read to the
+    # hash of the one it is about to store, and only writes when that succeeds. Anyone who read the config before
+    # then gets a ConfigConflictError and has to apply its changes to the fresh config instead. The claim stays
+    # pending until complete_config_claim or release_config_claim finishes it, or for claim_seconds at most, which
+    # callers set to the time their invocation has left. Only then can it be taken over, as its writer must have died,
+    # and until then a ConfigClaimedError tells when that will be. Every claim takes the environment's next sequence
+    # number, which its delta is published with and which finishing it needs.
+    claimed_at = int(time.time())
+    try:
+        response = update_state_item(
+            Key=get_environment_state_key(env),
+            UpdateExpression=(
+                'SET DesiredHash = :hash, PendingUntil = :pending_until REMOVE ReleasedHash ADD #sequence :one'
+            ),
+            ConditionExpression=(
+                'attribute_not_exists(DesiredHash) AND attribute_not_exists(PendingUntil) '
+                'OR DesiredHash = :read_hash AND attribute_not_exists(PendingUntil) '
+                'OR ReleasedHash = :read_hash AND attribute_not_exists(PendingUntil) '
+                'OR PendingUntil < :claimed_at'
+            ),
+            ExpressionAttributeNames={'#sequence': 'Sequence'},
+            ExpressionAttributeValues={
+                ':hash': config_hash,
+                ':read_hash': read_hash,
+                ':claimed_at': claimed_at,
+                ':pending_until': claimed_at + math.ceil(claim_seconds),
+                ':one': 1,
+            },
+            ReturnValues='UPDATED_NEW',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+        pending_until = e.response.get('Item', {}).get('PendingUntil', {}).get('N')
+        if pending_until is not None:
+            raise ConfigClaimedError(f"the {env} config is being stored by another writer", int(pending_until))
+        raise ConfigConflictError(f"the {env} config changed since it was read")
+    return int(response['Attributes']['Sequence'])
+
+
+def complete_config_claim(env, sequence, published_hash=None):
+    # Finishes the claim once its config is stored and its delta published, so the next writer can claim it.
+    # PublishedHash is the hash of the config the latest published delta produces. It is left alone when the delta
+    # couldn't be published, so the next update publishes one for the stored config before it is applied.
+    if published_hash is None:
+        finish_config_claim(env, sequence, 'REMOVE PendingUntil', {})
+    else:
+        update_expression = 'SET PublishedHash = :published_hash REMOVE PendingUntil'
+        finish_config_claim(env, sequence, update_expression, {':published_hash': published_hash})
+
+
+def release_config_claim(env, read_hash, config_hash, sequence):
+    # Hands the claim back after the config couldn't be written, so the next writer doesn't have to wait for it to
+    # go stale. The write may still have landed, so ReleasedHash keeps the claimed hash and a writer that read either
+    # config can claim it next.
+    print(f"release_config_claim: Releasing the claim on the {env} config...")
+    finish_config_claim(
+        env, sequence, 'SET DesiredHash = :read_hash, ReleasedHash = :hash REMOVE PendingUntil',
+        {':read_hash': read_hash, ':hash': config_hash}
+    )
+
+
+def finish_config_claim(env, sequence, update_expression, values):
+    # Does nothing when the claim went stale and someone else took it over.
+    try:
+        update_state_item(
+            Key=get_environment_state_key(env),
+            UpdateExpression=update_expression,
+            ConditionExpression='#sequence = :sequence AND attribute_exists(PendingUntil)',
+            ExpressionAttributeNames={'#sequence': 'Sequence'},
+            ExpressionAttributeValues={**values, ':sequence': sequence}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+        print(f"finish_config_claim: The claim on the {env} config was taken over")
+
+
+def get_conflict_delay(attempt):
+    return random.uniform(0, 0.1 * 2 ** attempt)
 
 
 def update_config_file_parameters(config_files_map):
     print("update_config_file_parameters: Updating confile file parameters with new clients...")
-    try:
-        print(config_files_map)
-        for k, v in config_files_map.items():
-            ssm_client.put_parameter(
-                Name=f'/{k}/wireguard/config_file',
-                Description=f'The config file for wireguard in the {k} network.',
-                Value=v,
-                Type='SecureString',
-                Overwrite=True,
-                Tier='Standard',
-                DataType='text'
-            )
-    except Exception as e:
-        raise e
+    config_store = get_config_store()
+
+    def update_config_file_parameter(env):
+        return config_store.write(env, config_files_map[env])
+
+    return run_for_each_environment(update_config_file_parameter, list(config_files_map))
+
 
+def get_apply_parameters():
+    # The same parameters go to every server; each works out its own environment from its Environment tag.
+    return {
+        'configStore': [CONFIG_STORE],
+        'configBucket': [os.getenv('CONFIG_BUCKET_NAME', '')],
+        'applyMode': [WIREGUARD_APPLY_MODE],
+        'region': [os.getenv('AWS_REGION', 'us-east-1')],
+    }
 
-def send_commands(config_files_map, instance_id_map):
+
+def get_apply_command():
+    return {'DocumentName': APPLY_DOCUMENT_NAME, 'DocumentVersion': APPLY_DOCUMENT_VERSION, 'Parameters': get_apply_parameters()}
+
+
+def send_commands(instance_id_map, command=None):
+    # One command covers up to SEND_COMMAND_MAX_TARGETS servers, and SSM rolls it out at APPLY_MAX_CONCURRENCY
+    # servers at a time, stopping once APPLY_MAX_ERRORS of them failed. The command is the apply document unless
+    # another is given.
     print("send_commands: Sending commands to instances...")
-    for k, v in config_files_map.items():
+    command = command or get_apply_command()
+    ssm_client = get_ssm_client()
+    environments = list(instance_id_map)
+    failures = {}
+    for i in range(0, len(environments), SEND_COMMAND_MAX_TARGETS):
+        batch = environments[i:i + SEND_COMMAND_MAX_TARGETS]
         try:
-            response = ssm_client.send_command(
-                InstanceIds=[
-                    instance_id_map[k]["instance_id"],
-                ],
-                DocumentName='AWS-RunShellScript',
-                Parameters={
-                    'commands': [
-                        f'config=$(aws ssm get-parameters --names /{k}/wireguard/config_file --with-decryption --query Parameters[0].Value --output text --region us-east-1)',
-                        f'echo -e "$config" | sudo tee /etc/wireguard/wg0.conf > /dev/null',
-                        "sudo systemctl reload wg-quick@wg0",
-                        "sudo systemctl restart wg-quick@wg0",
-                        "sudo iptables -t nat -A POSTROUTING -o ens5 -j MASQUERADE",
-                        "sudo iptables -A FORWARD -i wg0 -j ACCEPT"
-                    ]
-                }
-            )
+            command_id = ssm_client.send_command(
+                Targets=[{'Key': 'InstanceIds', 'Values': [instance_id_map[env]["instance_id"] for env in batch]}],
+                MaxConcurrency=APPLY_MAX_CONCURRENCY,
+                MaxErrors=APPLY_MAX_ERRORS,
+                **command
+            )['Command']['CommandId']
         except Exception as e:
-            raise e
-        instance_id_map[k]["command_id"] = response['Command']['CommandId']
-    return instance_id_map
+            print(f"send_commands: Sending to {batch} failed: {e}")
+            failures.update({env: e for env in batch})
+            continue
+        for env in batch:
+            instance_id_map[env]["command_id"] = command_id
+    return instance_id_map, failures
+
 
+def get_reported_value(invocation, name):
+    # The apply script reports e.g. applied_hash=<sha256> on its own line of output.
+    for plugin in invocation.get('CommandPlugins', []):
+        for line in plugin.get('Output', '').splitlines():
+            if line.startswith(f'{name}='):
+                return line[len(name) + 1:].strip()
+    return None
 
-def check_status_of_commands(instance_id_map, max_depth=5, current_depth=0):
+
+def check_status_of_commands(instance_id_map, timeout=COMMAND_WAIT_TIMEOUT_SECONDS, initial_delay=0.5, max_delay=8,
+                             on_complete=None):
+    # on_complete is called after every poll with the environments that finished in it, so callers can act on each
+    # server's result without waiting for the slowest one.
     print("check_status_of_commands: Checking command status...")
+    started_at = time.monotonic()
+    deadline = started_at + timeout
+    delay = initial_delay
 
-    if current_depth >= max_depth:
-        print(f"Maximum recursion depth of {max_depth} reached.")
-        raise Exception("too many calls to check the status")
+    pending = {k: v for k, v in instance_id_map.items() if "command_id" in v and v["command_id"] != ""}
+    while len(pending) > 0:
+        commands = {}
+        for k, v in pending.items():
+            commands.setdefault(v["command_id"], []).append(k)
 
-    for k, v in instance_id_map.items():
-        if "command_id" in v and v["command_id"] != "":
+        completed = {}
+        # One bulk call per command covers every instance it was sent to.
+        for command_id, envs in commands.items():
+            statuses = {}
             try:
-                response = ssm_client.get_command_invocation(
-                    CommandId=v["command_id"],
-                    InstanceId=v["instance_id"],
-                )
-            except Exception as e:
-                raise e
-            v['status'] = response['Status']
+                paginator = get_ssm_client().get_paginator('list_command_invocations')
+                for page in paginator.paginate(CommandId=command_id, Details=True):
+                    statuses.update({i['InstanceId']: i for i in page['CommandInvocations']})
+            except ClientError as e:
+                # The invocation is not visible yet right after send_command; treat it as still pending.
+                if e.response['Error']['Code'] != 'InvocationDoesNotExist':
+                    raise e
+            for k in envs:
+                invocation = statuses.get(pending[k]["instance_id"])
+                if invocation is None:
+                    continue
+                pending[k]['status'] = invocation['Status']
+                if invocation['Status'] not in PENDING_COMMAND_STATUSES:
+                    pending[k]['elapsed_seconds'] = round(time.monotonic() - started_at, 3)
+                    pending[k]['completed_at'] = time.time()
+                    for name in ['applied_hash', 'applied_sequence']:
+                        value = get_reported_value(invocation, name)
+                        if value:
+                            pending[k][name] = value
+                    # A server tagged with the wrong environment applied some other environment's config.
+                    environment = get_reported_value(invocation, 'environment')
+                    if environment is not None and environment != k:
+                        print(f"check_status_of_commands: {k} server {pending[k]['instance_id']} applied {environment}'s config")
+                        pending[k]['status'] = 'WrongEnvironment'
+                        pending[k].pop('applied_hash', None)
+                        pending[k].pop('applied_sequence', None)
+                    completed[k] = pending.pop(k)
 
-    while 'InProgress' in [v["status"] for k, v in instance_id_map.items() if "command_id" in v and v["command_id"] != ""]:
-        time.sleep(5)
-        check_status_of_commands(instance_id_map, max_depth, current_depth + 1)
+        remaining = deadline - time.monotonic()
+        if len(pending) > 0 and remaining <= 0:
+            print(f"check_status_of_commands: Deadline of {timeout}s reached with {list(pending)} still pending.")
+            for k, v in pending.items():
+                v['status'] = 'TimedOut'
+                v['elapsed_seconds'] = round(time.monotonic() - started_at, 3)
+            completed.update(pending)
+            pending = {}
+        if on_complete is not None and len(completed) > 0:
+            on_complete(completed)
+        if len(pending) > 0:
+            # Exponential backoff with jitter, never sleeping past the deadline.
+            time.sleep(min(remaining, delay / 2 + random.uniform(0, delay / 2)))
+            delay = min(delay * 2, max_delay)
     return instance_id_map
 
 
+def collect_peer_dumps(server_map, timeout=COMMAND_WAIT_TIMEOUT_SECONDS):
+    # Has every server upload its peer dump to the liveness bucket and returns each target's parsed dump, and the
+    # targets whose server couldn't be read. The dumps go through S3 because SSM only returns the first
+    # few thousand characters of a command's output.
+    print(f"collect_peer_dumps: Collecting the peer dumps of {len(server_map)} servers...")
+    command = {
+        'DocumentName': 'AWS-RunShellScript',
+        'Parameters': {'commands': [DUMP_COMMAND]},
+        'OutputS3BucketName': LIVENESS_BUCKET_NAME,
+        'OutputS3KeyPrefix': get_peer_liveness_store().output_prefix,
+    }
+    command_states, failures = send_commands(get_command_states(server_map, list(server_map)), command)
+    command_states = check_status_of_commands({k: v for k, v in command_states.items() if k not in failures}, timeout)
+    dumps = {}
+    for env, state in command_states.items():
+        if env in failures:
+            continue
+        if state.get('status') != 'Success':
+            failures[env] = Exception(f"the dump command ended with status {state.get('status')}")
+            continue
+        output = get_peer_liveness_store().read_command_output(state['command_id'], state['instance_id'])
+        dumps[env] = parse_peer_dump(output)
+    return dumps, failures
+
+
+def update_peer_liveness(dumps, now):
+    # Folds the dumps into the stored liveness of their environments. Returns the new liveness per environment and
+    # the environments it couldn't be stored for.
+    store = get_peer_liveness_store()
+
+    def update_environment_liveness(env):
+        liveness = merge_peer_liveness(store.read(env), dumps[env], now)
+        stored_bytes = store.write(env, liveness)
+        print(f"update_environment_liveness: {env} has {len(liveness)} peers, stored in {stored_bytes} bytes")
+        return liveness
+
+    return run_for_each_environment(update_environment_liveness, list(dumps))
+
+
+def get_expiry_changes(clients, liveness, now, max_idle_seconds):
+    # Which clients lose which environments because their peer there has been idle for too long, and the peer
+    # removals that takes, in the format of get_revocation_changes. Only peers the client table still grants are
+    # expired; peers it doesn't know about are left to reconcile. liveness is kept per target, and a peer that is
+    # active on any server of an environment isn't idle there.
+    idle_peers = {}
+    active_peers = {}
+    for target, peers in liveness.items():
+        idle = set(get_idle_peers(peers, now, max_idle_seconds))
+        idle_peers.setdefault(get_target_environment(target), set()).update(idle)
+        active_peers.setdefault(get_target_environment(target), set()).update(k for k in peers if k not in idle)
+    idle_peers = {env: peers - active_peers[env] for env, peers in idle_peers.items()}
+    peer_changes = {}
+    expirations = {}
+    for client in clients:
+        public_key = client.get('PublicKey', {}).get('S', '')
+        client_ip = client.get('ClientIP', {}).get('S', '')
+        environments = [obj['S'] for obj in client.get('Environments', {}).get('L', [])]
+        expired = [env for env in environments if public_key in idle_peers.get(env, ())]
+        if public_key == '' or client_ip == '' or len(expired) == 0:
+            continue
+        for env in expired:
+            peer_changes.setdefault(env, {})[public_key] = None
+        expirations[client_ip] = {'public_key': public_key, 'environments': environments, 'expired': expired}
+    return peer_changes, expirations
+
+
+def get_peer_section_size(public_key, allowed_ips):
+    # The bytes a peer takes up in a server config, including the blank line separating it from the section before.
+    return len(WireGuardConfig(peers={public_key: [('AllowedIPs', allowed_ips)]}).serialize().encode('utf-8')) + 2
+
+
+def expire_client_environments(expirations, failed_envs):
+    # Takes the expired environments off the clients, and deletes the clients left without any. A client's
+    # environments only lose those whose config was stored without its peer. Every write is conditional on the client
+    # being unchanged since it was read, so a client that was rekeyed or moved in the meantime keeps its access;
+    # reconcile puts its peer back. Returns the client ips that were updated, deleted and skipped.
+    print(f"expire_client_environments: Expiring the idle environments of {len(expirations)} clients...")
+    updated, deleted, skipped = [], [], []
+    for client_ip, expiration in expirations.items():
+        expired = [env for env in expiration['expired'] if env not in failed_envs]
+        if len(expired) == 0:
+            skipped.append(client_ip)
+            continue
+        remaining = [env for env in expiration['environments'] if env not in expired]
+        condition = {
+            'ConditionExpression': 'PublicKey = :public_key AND Environments = :environments',
+            'ExpressionAttributeValues': {':public_key': expiration['public_key'], ':environments': expiration['environments']},
+        }
+        try:
+            if len(remaining) == 0:
+                get_table_client().delete_item(Key={'ClientIP': client_ip}, **condition)
+                deleted.append(client_ip)
+            else:
+                condition['ExpressionAttributeValues'][':remaining'] = remaining
+                get_table_client().update_item(
+                    Key={'ClientIP': client_ip},
+                    UpdateExpression='SET Environments = :remaining',
+                    **condition
+                )
+                updated.append(client_ip)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            print(f"expire_client_environments: {client_ip} changed since it was read, skipping")
+            skipped.append(client_ip)
+    return updated, deleted, skipped
+
+
 def get_all_taken_client_ips():
-    response = table_client.scan()
+    response = get_table_client().scan()
     primary_keys = [item['ClientIP'] for item in response['Items']]
 
     while 'LastEvaluatedKey' in response:
-        response = table_client.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
+        response = get_table_client().scan(ExclusiveStartKey=response['LastEvaluatedKey'])
         primary_keys.extend([item['ClientIP'] for item in response['Items']])
 
     return primary_keys
 
 
-def get_available_ip(taken_ips):
-    client_ip_prefix = "192.168.2"
-    random_number = random.randint(5, 255)
-    ip = client_ip_prefix + f".{random_number}/32"
-    if is_ip_available(taken_ips, ip):
-        return ip
-    return get_available_ip(taken_ips)
+def get_available_ip():
+    return get_ip_allocator().allocate(get_all_taken_client_ips)
 
 
-def is_ip_available(taken_ips, ip):
-    if ip in taken_ips:
-        return False
-    else:
-        return True
+def release_client_ips(records):
+    print("release_client_ips: Returning the ips of removed clients to the pool...")
+    for record in records:
+        if record.get('eventName') != 'REMOVE':
+            continue
+        client_ip = record['dynamodb'].get('OldImage', {}).get('ClientIP', {}).get('S', '')
+        if client_ip != '':
+            get_ip_allocator().release(client_ip)
 
 
 def get_client_from_dynamodb(client_ip):
-    response = table_client.get_item(
+    response = get_table_client().get_item(
         Key={"ClientIP": client_ip}
     )
     item = response.get('Item')
     if not item:
-        raise Exception(f"The item with client ip {client_ip} was not found.")
+        raise ClientNotFoundError(f"The item with client ip {client_ip} was not found.")
     return item
 
 
+def render_client_config(client_ip, public_key, environments, environment_map):
+    # The client connects to the server of each environment its peer is placed on.
+    config = WireGuardConfig(interface=[('PrivateKey', 'ReplaceWithYourPrivateKey'), ('Address', client_ip)])
+    server_map = get_server_map({env: environment_map[env] for env in environments if env in environment_map})
+    for env in environments:
+        if env not in environment_map:
+            print(f'render_client_config: Environment {env} not found in the registry')
+            continue
+        server = server_map[get_peer_target(env, public_key, environment_map)]
+        config.peers[server['public_key']] = [
+            ('AllowedIPs', server['vpc_cidr']),
+            ('Endpoint', server['wireguard_endpoint']),
+            ('PersistentKeepalive', '90'),
+        ]
+    return config.serialize()
+
+
+def get_config_hash(config_str):
+    return hashlib.sha256(config_str.encode('utf-8')).hexdigest()
+
+
+def get_client_config_key(client_ip):
+    return {'PK': f'CLIENT#{client_ip}', 'SK': 'CONFIG'}
+
+
+def get_materialized_client_config(client_ip):
+    return get_state_table_client().get_item(Key=get_client_config_key(client_ip)).get('Item')
+
+
+def get_materialized_client_configs(client_ips):
+    # Batched version of get_materialized_client_config, 100 keys per request.
+    items = {}
+    table_name = get_state_table_client().name
+    keys = [get_client_config_key(client_ip) for client_ip in client_ips]
+    for i in range(0, len(keys), 100):
+        request_items = {table_name: {'Keys': keys[i:i + 100]}}
+        while request_items:
+            response = get_dynamodb_resource().batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(table_name, []):
+                items[item['PK'][len('CLIENT#'):]] = item
+            request_items = response.get('UnprocessedKeys')
+    return items
+
+
+def upload_client_config_archive(archive, key):
+    print(f"upload_client_config_archive: Uploading {key}...")
+    bucket = os.getenv('EXPORT_BUCKET_NAME', '')
+    get_s3_client().upload_fileobj(
+        archive,
+        bucket,
+        key,
+        ExtraArgs={'ContentType': 'application/zip', 'ServerSideEncryption': 'aws:kms'}
+    )
+    return get_s3_client().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=EXPORT_URL_EXPIRY_SECONDS
+    )
+
+
+def materialize_client_configs(records, environment_map):
+    print("materialize_client_configs: Pre-rendering the configs of changed clients...")
+    # Only the last image of each client in the batch matters.
+    latest_images = {}
+    for record in records:
+        old_image = record['dynamodb'].get('OldImage', {})
+        new_image = record['dynamodb'].get('NewImage', {})
+        client_ip = (new_image or old_image).get('ClientIP', {}).get('S', '')
+        if client_ip != '':
+            latest_images[client_ip] = new_image
+    write_client_configs(latest_images, environment_map)
+
+
+def write_client_configs(images, environment_map):
+    # Renders and stores the config of every client ip in images, or deletes it for an empty image.
+    for client_ip, new_image in images.items():
+        if len(new_image) == 0:
+            get_state_table_client().delete_item(Key=get_client_config_key(client_ip))
+            continue
+        environments = [obj['S'] for obj in new_image.get('Environments', {}).get('L', [])]
+        public_key = new_image.get('PublicKey', {}).get('S', '')
+        config_str = render_client_config(client_ip, public_key, environments, environment_map)
+        etag = get_config_hash(config_str)
+        try:
+            # The version only moves when the rendered config actually changes. The client's key and environments are
+            # kept with it, so it can be checked against the registry when it is read, see main.load_client_config.
+            get_state_table_client().update_item(
+                Key=get_client_config_key(client_ip),
+                UpdateExpression=(
+                    'SET Config = :config, ETag = :etag, PublicKey = :public_key, Environments = :environments, '
+                    'Version = if_not_exists(Version, :zero) + :one'
+                ),
+                ConditionExpression='attribute_not_exists(ETag) OR ETag <> :etag OR attribute_not_exists(PublicKey)',
+                ExpressionAttributeValues={
+                    ':config': config_str,
+                    ':etag': etag,
+                    ':public_key': public_key,
+                    ':environments': environments,
+                    ':zero': 0,
+                    ':one': 1,
+                }
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+
+
 def add_item_to_dynamodb(client_ip, public_key, environments):
+    # The client and a guard item keyed by its public key are written in one transaction, so a duplicate key is
+    # rejected atomically even when two clients are onboarded at the same time. The items are typed here, so they go
+    # through the plain client; the resource's client would type them again.
     try:
-        table_client.put_item(
-            Item={
-                'ClientIP': client_ip,
-                'PublicKey': public_key,
-                'Environments': environments
-            }
+        get_dynamodb_client().transact_write_items(
+            TransactItems=[
+                {
+                    'Put': {
+                        'TableName': get_state_table_client().name,
+                        'Item': serialize_item(get_public_key_guard_item(public_key, client_ip)),
+                        'ConditionExpression': 'attribute_not_exists(PK)'
+                    }
+                },
+                {
+                    'Put': {
+                        'TableName': get_table_client().name,
+                        'Item': serialize_item({
+                            'ClientIP': client_ip,
+                            'PublicKey': public_key,
+                            'Environments': environments
+                        }),
+                        'ConditionExpression': 'attribute_not_exists(ClientIP)'
+                    }
+                }
+            ]
         )
     except ClientError as e:
+        reasons = e.response.get('CancellationReasons', [])
+        if e.response['Error']['Code'] == 'TransactionCanceledException' and len(reasons) > 0 and reasons[0].get('Code') == 'ConditionalCheckFailed':
+            raise PublicKeyExistsError(f"The public key {public_key} is already used by another client.")
         raise e
 
 
+def is_valid_public_key(public_key):
+    # WireGuard public keys are 32 bytes, base64 encoded.
+    try:
+        return len(base64.b64decode(public_key, validate=True)) == 32
+    except (binascii.Error, TypeError, ValueError):
+        return False
+
+
+def claim_public_key_guards(client_ips_by_public_key):
+    # Claims the guard items of many public keys, up to 100 per transaction. Returns the keys that are already taken;
+    # the rest are claimed.
+    print(f"claim_public_key_guards: Claiming {len(client_ips_by_public_key)} public keys...")
+    # The guard items are typed here, so they go through the plain client.
+    dynamodb_client = get_dynamodb_client()
+    table_name = get_state_table_client().name
+    taken = []
+    public_keys = list(client_ips_by_public_key)
+    for i in range(0, len(public_keys), 100):
+        chunk = public_keys[i:i + 100]
+        while len(chunk) > 0:
+            try:
+                dynamodb_client.transact_write_items(TransactItems=[
+                    {
+                        'Put': {
+                            'TableName': table_name,
+                            'Item': serialize_item(get_public_key_guard_item(public_key, client_ips_by_public_key[public_key])),
+                            'ConditionExpression': 'attribute_not_exists(PK)'
+                        }
+                    } for public_key in chunk
+                ])
+                break
+            except ClientError as e:
+                reasons = e.response.get('CancellationReasons', [])
+                conflicts = [k for k, r in zip(chunk, reasons) if r.get('Code') == 'ConditionalCheckFailed']
+                if e.response['Error']['Code'] != 'TransactionCanceledException' or len(conflicts) == 0:
+                    raise e
+                # Drop the keys that are taken and claim the rest of the chunk again.
+                taken.extend(conflicts)
+                chunk = [k for k in chunk if k not in conflicts]
+    return taken
+
+
+def add_items_to_dynamodb(clients):
+    # Writes many clients through the batch writer, which sends 25 items per request and resends unprocessed ones.
+    print(f"add_items_to_dynamodb: Adding {len(clients)} clients...")
+    with get_table_client().batch_writer() as batch:
+        for client in clients:
+            batch.put_item(Item={
+                'ClientIP': client['client_ip'],
+                'PublicKey': client['public_key'],
+                'Environments': client['environments']
+            })
+
+
+def get_clients_from_dynamodb(client_ips):
+    # Batched version of get_client_from_dynamodb, 100 keys per request. Clients that don't exist are left out.
+    items = {}
+    table_name = get_table_client().name
+    keys = [{'ClientIP': client_ip} for client_ip in dict.fromkeys(client_ips)]
+    for i in range(0, len(keys), 100):
+        request_items = {table_name: {'Keys': keys[i:i + 100], 'ConsistentRead': True}}
+        while request_items:
+            response = get_dynamodb_resource().batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(table_name, []):
+                items[item['ClientIP']] = item
+            request_items = response.get('UnprocessedKeys')
+    return items
+
+
+def get_client_ip_by_public_key(public_key):
+    response = get_table_client().query(
+        IndexName=PUBLIC_KEY_INDEX_NAME,
+        KeyConditionExpression=Key('PublicKey').eq(public_key),
+        Limit=1
+    )
+    if response['Count'] == 0:
+        return None
+    return response['Items'][0]['ClientIP']
+
+
+def get_revocation_changes(clients):
+    # The peer removals revoking the given client items takes, folded into one change per environment.
+    peer_changes = {}
+    for client in clients:
+        for env in client.get('Environments', []):
+            peer_changes.setdefault(env, {})[client['PublicKey']] = None
+    return peer_changes
+
+
+def delete_items_from_dynamodb(client_ips):
+    print(f"delete_items_from_dynamodb: Deleting {len(client_ips)} clients...")
+    with get_table_client().batch_writer() as batch:
+        for client_ip in client_ips:
+            batch.delete_item(Key={'ClientIP': client_ip})
+
+
+def serialize_item(item):
+    return {k: type_serializer.serialize(v) for k, v in item.items()}
+
+
+def deserialize_item(item):
+    return {k: type_deserializer.deserialize(v) for k, v in item.items()}
+
+
+def get_public_key_guard_item(public_key, client_ip):
+    return {'PK': f'PUBLICKEY#{public_key}', 'SK': 'GUARD', 'ClientIP': client_ip}
+
+
 def does_public_key_exist_already(public_key):
-    response = table_client.scan()
-    public_keys = [item['PublicKey'] for item in response['Items']]
+    return get_client_ip_by_public_key(public_key) is not None
 
-    while 'LastEvaluatedKey' in response:
-        response = table_client.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        public_keys.extend([item['PublicKey'] for item in response['Items']])
 
-    if public_key in public_keys:
-        return True
-    return False
+def sync_public_key_guards(records):
+    print("sync_public_key_guards: Keeping public key guards in line with the client table...")
+    for record in records:
+        old_image = record['dynamodb'].get('OldImage', {})
+        new_image = record['dynamodb'].get('NewImage', {})
+        old_public_key = old_image.get('PublicKey', {}).get('S', '')
+        new_public_key = new_image.get('PublicKey', {}).get('S', '')
+        if old_public_key == new_public_key:
+            continue
+        if new_public_key != '':
+            client_ip = new_image.get('ClientIP', {}).get('S', '')
+            try:
+                get_state_table_client().put_item(
+                    Item=get_public_key_guard_item(new_public_key, client_ip),
+                    ConditionExpression='attribute_not_exists(PK) OR ClientIP = :client_ip',
+                    ExpressionAttributeValues={':client_ip': client_ip}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
+                print(f"sync_public_key_guards: The public key of {client_ip} is already used by another client.")
+        if old_public_key != '':
+            client_ip = old_image.get('ClientIP', {}).get('S', '')
+            try:
+                get_state_table_client().delete_item(
+                    Key={'PK': f'PUBLICKEY#{old_public_key}', 'SK': 'GUARD'},
+                    ConditionExpression='ClientIP = :client_ip',
+                    ExpressionAttributeValues={':client_ip': client_ip}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
@@ -1,11 +1,17 @@
+import re
+import threading
 import unittest
+from decimal import Decimal
+from botocore.exceptions import ClientError
 import helpers
+from wireguard_config import WireGuardConfig
 from unittest.mock import patch, MagicMock
 
 
 class TestGetConfigFiles(unittest.TestCase):
-    @patch('helpers.ssm_client')
-    def test_get_config_files_success(self, mock_ssm_client):
+    @patch('helpers.get_ssm_client')
+    def test_get_config_files_success(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
         # Arrange
         environments = ['dev', 'prod']
         expected_config_files = {
@@ -14,32 +20,53 @@ class TestGetConfigFiles(unittest.TestCase):
         }
 
         # Mock the return value of ssm_client.get_parameter for each environment
-        mock_ssm_client.get_parameter.side_effect = [
-            {'Parameter': {'Value': 'dev_config_content'}},
-            {'Parameter': {'Value': 'prod_config_content'}}
-        ]
+        mock_ssm_client.get_parameter.side_effect = lambda Name, WithDecryption: {
+            'Parameter': {'Value': f"{Name.split('/')[1]}_config_content"}
+        }
 
         # Act
-        result = helpers.get_config_files(environments)
+        result, failures = helpers.get_config_files(environments)
 
         # Assert
         self.assertEqual(result, expected_config_files)
+        self.assertEqual(failures, {})
         mock_ssm_client.get_parameter.assert_any_call(Name='/dev/wireguard/config_file', WithDecryption=True)
         mock_ssm_client.get_parameter.assert_any_call(Name='/prod/wireguard/config_file', WithDecryption=True)
         self.assertEqual(mock_ssm_client.get_parameter.call_count, 2)
 
-    @patch('helpers.ssm_client')
-    def test_get_config_files_failure(self, mock_ssm_client):
+    @patch('helpers.get_ssm_client')
+    def test_get_config_files_failure(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
         # Arrange
         environments = ['dev', 'prod']
         mock_ssm_client.get_parameter.side_effect = Exception("SSM Error")
 
-        # Act & Assert
-        with self.assertRaises(Exception) as context:
-            helpers.get_config_files(environments)
+        # Act
+        result, failures = helpers.get_config_files(environments)
+
+        # Assert: every environment is attempted and each failure is collected
+        self.assertEqual(result, {})
+        self.assertEqual(set(failures), {'dev', 'prod'})
+        self.assertEqual(str(failures['dev']), "SSM Error")
+        self.assertEqual(mock_ssm_client.get_parameter.call_count, 2)
+
+    @patch('helpers.get_ssm_client')
+    def test_get_config_files_partial_failure(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
+        # Arrange
+        def get_parameter(Name, WithDecryption):
+            if Name.startswith('/prod/'):
+                raise Exception("SSM Error")
+            return {'Parameter': {'Value': 'dev_config_content'}}
+
+        mock_ssm_client.get_parameter.side_effect = get_parameter
+
+        # Act
+        result, failures = helpers.get_config_files(['dev', 'prod'])
 
-        self.assertEqual(str(context.exception), "SSM Error")
-        mock_ssm_client.get_parameter.assert_called_once_with(Name='/dev/wireguard/config_file', WithDecryption=True)
+        # Assert
+        self.assertEqual(result, {'dev': 'dev_config_content'})
+        self.assertEqual(list(failures), ['prod'])
 
 
 class TestCompareEnvironments(unittest.TestCase):
@@ -98,393 +125,12 @@ class TestCompareEnvironments(unittest.TestCase):
         self.assertEqual(added, [])
 
 
-class TestUpdatePeerPublicKey(unittest.TestCase):
-    def test_update_peer_public_key_no_change(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-PostUp = wg set %i private-key /etc/wireguard/privatekey
-
-[Peer]
-PublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=
-AllowedIPs = 10.0.0.1/32
-
-[Peer]
-PublicKey = 1234/nr5ETQ/evj5fUk5huzk+qkvoJ1+=
-AllowedIPs = 10.0.0.2/32
-"""
-
-        expected_config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-PostUp = wg set %i private-key /etc/wireguard/privatekey
-
-[Peer]
-PublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=
-AllowedIPs = 10.0.0.1/32
-
-[Peer]
-PublicKey = 1234/nr5ETQ/evj5fUk5huzk+qkvoJ1+=
-AllowedIPs = 10.0.0.2/32
-"""
-        old_public_key = "1234/nr5ETQ/evj5fUk5huzk+qkvoJ1+="
-        new_public_key = "1234/nr5ETQ/evj5fUk5huzk+qkvoJ1+="  # No change
-        result = helpers.update_peer_public_key(config_str, old_public_key, new_public_key)
-
-        self.assertEqual(result.strip(), expected_config_str.strip())
-
-    def test_update_peer_public_key_single_peer(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-PostUp = wg set %i private-key /etc/wireguard/privatekey
-
-[Peer]
-PublicKey = 1234/nr5ETQ/evj5fUk5huzk+qkvoJ1+=
-AllowedIPs = 10.0.0.1/32
-"""
-        old_public_key = "1234/nr5ETQ/evj5fUk5huzk+qkvoJ1+="
-        new_public_key = "9876nr5ETQ/evj5fUk5huzk+qkvoJ1+="
-        expected_result = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-PostUp = wg set %i private-key /etc/wireguard/privatekey
-
-[Peer]
-PublicKey = 9876nr5ETQ/evj5fUk5huzk+qkvoJ1+=
-AllowedIPs = 10.0.0.1/32
-"""
-        result = helpers.update_peer_public_key(config_str, old_public_key, new_public_key)
-
-        self.assertEqual(result.strip(), expected_result.strip())
-
-    def test_update_peer_public_key_multiple_peers(self):
-        config_str = """
-[Peer]
-PublicKey = another_key
-AllowedIPs = 10.0.0.2/32
-
-[Peer]
-PublicKey = 9876nr5ETQ/evj5fUk5huzk+qkvoJ1+=
-AllowedIPs = 10.0.0.3/32
-"""
-        old_public_key = "9876nr5ETQ/evj5fUk5huzk+qkvoJ1+="
-        new_public_key = "1234/nr5ETQ/evj5fUk5huzk+qkvoJ1+="
-        expected_result = """
-[Peer]
-PublicKey = another_key
-AllowedIPs = 10.0.0.2/32
-
-[Peer]
-PublicKey = 1234/nr5ETQ/evj5fUk5huzk+qkvoJ1+=
-AllowedIPs = 10.0.0.3/32
-"""
-        result = helpers.update_peer_public_key(config_str, old_public_key, new_public_key)
-
-        self.assertEqual(result.strip(), expected_result.strip())
-
-    def test_update_peer_public_key_no_match(self):
-        config_str = """
-[Peer]
-PublicKey = another_key
-AllowedIPs = 10.0.0.1/32
-"""
-        old_public_key = "old_key"  # Key does not exist in the config
-        new_public_key = "new_key"
-        result = helpers.update_peer_public_key(config_str, old_public_key, new_public_key)
-
-        # The config should remain unchanged because the old_public_key wasn't found
-        self.assertEqual(result.strip(), config_str.strip())
-
-    def test_update_peer_public_key_partial_match(self):
-        config_str = """
-[Peer]
-PublicKey = old_key
-AllowedIPs = 10.0.0.1/32
-"""
-        old_public_key = "old_key_partial"
-        new_public_key = "new_key"
-        result = helpers.update_peer_public_key(config_str, old_public_key, new_public_key)
-
-        # The config should remain unchanged because the full old_public_key wasn't found
-        self.assertEqual(result.strip(), config_str.strip())
-
-
-class TestUpdatePublicKey(unittest.TestCase):
-    def test_update_public_key_no_change(self):
-        old_image = {'PublicKey': {'S': 'QzGaKVm6zB+Z0rusOiP+dEKdhyc+='}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
-        new_image = {'PublicKey': {'S': 'QzGaKVm6zB+Z0rusOiP+dEKdhyc+='}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
-        config_files_map = {
-            'dev': '[Interface]\nAddress = 192.168.0.1/24\nListenPort = 51820\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = QzGaKVm6zB+Z0rusOiP+dEKdhyc+=\nAllowedIPs = 192.168.0.4/32',
-            'prod': '[Interface]\nAddress = 192.168.0.2/24\nListenPort = 51821\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = QzGaKVm6zB+Z0rusOiP+dEKdhyc+=\nAllowedIPs = 192.168.0.4/32'
-        }
-
-        expected_result = {
-            'dev': '[Interface]\nAddress = 192.168.0.1/24\nListenPort = 51820\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = QzGaKVm6zB+Z0rusOiP+dEKdhyc+=\nAllowedIPs = 192.168.0.4/32',
-            'prod': '[Interface]\nAddress = 192.168.0.2/24\nListenPort = 51821\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = QzGaKVm6zB+Z0rusOiP+dEKdhyc+=\nAllowedIPs = 192.168.0.4/32'
-        }
-
-        result = helpers.update_public_key(old_image, new_image, config_files_map)
-
-        self.assertEqual(result, expected_result)
-
-    def test_update_public_key_changed_key(self):
-        old_image = {'PublicKey': {'S': 'QzGaKVm6zB+Z0rusOiP+dEKdhyc+dzOEWhD7ZowV3k4='}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
-        new_image = {'PublicKey': {'S': 'NaGaKVm6zB+Z0rusOiP+dEKdhyc+dzOEWhD7ZowV3k4='}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
-        config_files_map = {
-            'dev': '[Interface]\nAddress = 192.168.0.1/24\nListenPort = 51820\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = QzGaKVm6zB+Z0rusOiP+dEKdhyc+dzOEWhD7ZowV3k4=\nAllowedIPs = 192.168.0.4/32',
-            'prod': '[Interface]\nAddress = 192.168.0.2/24\nListenPort = 51821\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = NaGaKVm6zB+Z0rusOiP+dEKdhyc+dzOEWhD7ZowV3k4=\nAllowedIPs = 192.168.0.4/32'
-        }
-
-        expected_result = {
-            'dev': '[Interface]\nAddress = 192.168.0.1/24\nListenPort = 51820\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = NaGaKVm6zB+Z0rusOiP+dEKdhyc+dzOEWhD7ZowV3k4=\nAllowedIPs = 192.168.0.4/32',
-            'prod': '[Interface]\nAddress = 192.168.0.2/24\nListenPort = 51821\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = NaGaKVm6zB+Z0rusOiP+dEKdhyc+dzOEWhD7ZowV3k4=\nAllowedIPs = 192.168.0.4/32'
-        }
-
-        result = helpers.update_public_key(old_image, new_image, config_files_map)
-
-        self.assertEqual(result, expected_result)
-
-    def test_update_public_key_empty_old_key(self):
-        old_image = {'PublicKey': {'S': ''}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
-        new_image = {'PublicKey': {'S': 'new_key'}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
-        config_files_map = {
-            'dev': '[Interface]\nAddress = 192.168.0.1/24\nListenPort = 51820\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = \nAllowedIPs = 192.168.0.4/32',
-            'prod': '[Interface]\nAddress = 192.168.0.2/24\nListenPort = 51821\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = \nAllowedIPs = 192.168.0.4/32'
-        }
-
-        with self.assertRaises(Exception) as context:
-            helpers.update_public_key(old_image, new_image, config_files_map)
-
-    def test_update_public_key_empty_new_key(self):
-        old_image = {'PublicKey': {'S': 'old_key'}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
-        new_image = {'PublicKey': {'S': ''}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
-        config_files_map = {
-            'dev': '[Interface]\nAddress = 192.168.0.1/24\nListenPort = 51820\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = old_key\nAllowedIPs = 192.168.0.4/32',
-            'prod': '[Interface]\nAddress = 192.168.0.2/24\nListenPort = 51821\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = old_key\nAllowedIPs = 192.168.0.4/32'
-        }
-
-        expected_result = {
-            'dev': '[Interface]\nAddress = 192.168.0.1/24\nListenPort = 51820\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = \nAllowedIPs = 192.168.0.4/32',
-            'prod': '[Interface]\nAddress = 192.168.0.2/24\nListenPort = 51821\nPostUp = wg set %i private-key /etc/wireguard/privatekey\n[Peer]\nPublicKey = nr5ETQ/evj5fUk5huzk+qkvoJ1+=\nAllowedIPs = 192.168.0.3/32\n[Peer]\nPublicKey = \nAllowedIPs = 192.168.0.4/32'
-        }
-
-        result = helpers.update_public_key(old_image, new_image, config_files_map)
-
-        self.assertEqual(result, expected_result)
-
-
-class TestAddPeerSection(unittest.TestCase):
-    def test_add_peer_section_new_peer_no_existing_peers(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-"""
-        new_image = {
-            'PublicKey': {'S': 'new_public_key'},
-            'ClientIP': {'S': '10.0.0.3/32'}
-        }
-        expected_result = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = new_public_key
-AllowedIPs = 10.0.0.3/32
-"""
-        result = helpers.add_peer_section(config_str, new_image)
-        self.assertEqual(result.strip(), expected_result.strip())
-
-    def test_add_peer_section_existing_peer(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = other_existing_key
-AllowedIPs = 10.0.0.2/32
-"""
-        expected_result = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = other_existing_key
-AllowedIPs = 10.0.0.2/32
-
-[Peer]
-PublicKey = other_public_key
-AllowedIPs = 10.0.0.3/32
-"""
-        new_image = {
-            'PublicKey': {'S': 'other_public_key'},
-            'ClientIP': {'S': '10.0.0.3/32'}
-        }
-        result = helpers.add_peer_section(config_str, new_image)
-        self.assertEqual(result.strip(), expected_result.strip())
-
-    def test_add_peer_section_no_public_key(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-"""
-        new_image = {
-            'ClientIP': {'S': '10.0.0.3/32'}
-        }
-        # No PublicKey in new_image, so the config should remain unchanged
-        with self.assertRaises(Exception) as context:
-            helpers.add_peer_section(config_str, new_image)
-
-    def test_add_peer_section_no_client_ip(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-"""
-        new_image = {
-            'PublicKey': {'S': 'new_public_key'}
-        }
-        expected_result = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-
-[Peer]
-PublicKey = new_public_key
-AllowedIPs = 
-"""
-        with self.assertRaises(Exception) as context:
-            helpers.add_peer_section(config_str, new_image)
-
-
-class TestRemovePeerSection(unittest.TestCase):
-    def test_remove_peer_section_existing_peer(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = to_be_removed_key
-AllowedIPs = 10.0.0.1/32
-
-[Peer]
-PublicKey = another_key
-AllowedIPs = 10.0.0.2/32
-"""
-        old_image = {
-            'PublicKey': {'S': 'to_be_removed_key'}
-        }
-        expected_result = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = another_key
-AllowedIPs = 10.0.0.2/32
-"""
-        result = helpers.remove_peer_section(config_str, old_image)
-        self.assertEqual(result.strip(), expected_result.strip())
-
-    def test_remove_peer_section_non_existing_peer(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = another_key
-AllowedIPs = 10.0.0.2/32
-"""
-        old_image = {
-            'PublicKey': {'S': 'non_existing_key'}
-        }
-        # Since the PublicKey doesn't exist, the config should remain unchanged
-        result = helpers.remove_peer_section(config_str, old_image)
-        self.assertEqual(result.strip(), config_str.strip())
-
-    def test_remove_peer_section_empty_config(self):
-        config_str = """
-        [Interface]
-        Address = 192.168.0.1/24
-        ListenPort = 51820
-        """
-        old_image = {
-            'PublicKey': {'S': 'any_key'}
-        }
-        # Config is empty, so nothing to remove
-        result = helpers.remove_peer_section(config_str, old_image)
-        self.assertEqual(result.strip(), config_str.strip())
-
-    def test_remove_peer_section_no_public_key_in_old_image(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = some_key
-AllowedIPs = 10.0.0.1/32
-"""
-        old_image = {}  # No PublicKey in old_image
-        # Since no PublicKey is provided, the config should remain unchanged
-        result = helpers.remove_peer_section(config_str, old_image)
-        self.assertEqual(result.strip(), config_str.strip())
-
-    def test_remove_peer_section_multiple_peers_with_similar_keys(self):
-        config_str = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = to_be_removed_key_1
-AllowedIPs = 10.0.0.1/32
-
-[Peer]
-PublicKey = to_be_removed_key_2
-AllowedIPs = 10.0.0.2/32
-
-[Peer]
-PublicKey = another_key
-AllowedIPs = 10.0.0.3/32
-"""
-        old_image = {
-            'PublicKey': {'S': 'to_be_removed_key_2'}
-        }
-        expected_result = """
-[Interface]
-Address = 192.168.0.1/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = to_be_removed_key_1
-AllowedIPs = 10.0.0.1/32
-
-[Peer]
-PublicKey = another_key
-AllowedIPs = 10.0.0.3/32
-"""
-        result = helpers.remove_peer_section(config_str, old_image)
-        self.assertEqual(result.strip(), expected_result.strip())
-
-
 class TestUpdateConfigFileParameters(unittest.TestCase):
-    @patch('helpers.ssm_client')
-    def test_update_config_file_parameters_success(self, mock_ssm_client):
+    @patch('helpers.get_ssm_client')
+    def test_update_config_file_parameters_success(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
         # Arrange
-        mock_put_parameter = MagicMock()
+        mock_put_parameter = MagicMock(return_value={'Version': 2})
         mock_ssm_client.put_parameter = mock_put_parameter
 
         config_files_map = {
@@ -493,7 +139,7 @@ class TestUpdateConfigFileParameters(unittest.TestCase):
         }
 
         # Act
-        helpers.update_config_file_parameters(config_files_map)
+        versions, failures = helpers.update_config_file_parameters(config_files_map)
 
         # Assert
         calls = [
@@ -516,11 +162,14 @@ class TestUpdateConfigFileParameters(unittest.TestCase):
                 DataType='text'
             )
         ]
-        mock_put_parameter.assert_has_calls(calls)
+        mock_put_parameter.assert_has_calls(calls, any_order=True)
         self.assertEqual(mock_put_parameter.call_count, 2)
+        self.assertEqual(versions, {'dev': 2, 'prod': 2})
+        self.assertEqual(failures, {})
 
-    @patch('helpers.ssm_client')
-    def test_update_config_file_parameters_failure(self, mock_ssm_client):
+    @patch('helpers.get_ssm_client')
+    def test_update_config_file_parameters_failure(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
         # Arrange
         mock_ssm_client.put_parameter.side_effect = Exception("SSM update failed")
 
@@ -528,15 +177,18 @@ class TestUpdateConfigFileParameters(unittest.TestCase):
             'dev': 'config_data_for_dev'
         }
 
-        # Act & Assert
-        with self.assertRaises(Exception) as context:
-            helpers.update_config_file_parameters(config_files_map)
-        self.assertEqual(str(context.exception), "SSM update failed")
+        # Act
+        versions, failures = helpers.update_config_file_parameters(config_files_map)
+
+        # Assert
+        self.assertEqual(versions, {})
+        self.assertEqual(str(failures['dev']), "SSM update failed")
 
 
 class TestSendCommands(unittest.TestCase):
-    @patch('helpers.ssm_client')
-    def test_send_commands_success(self, mock_ssm_client):
+    @patch('helpers.get_ssm_client')
+    def test_send_commands_success(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
         # Arrange
         mock_send_command = MagicMock()
         mock_send_command.return_value = {
@@ -544,11 +196,6 @@ class TestSendCommands(unittest.TestCase):
         }
         mock_ssm_client.send_command = mock_send_command
 
-        config_files_map = {
-            'dev': 'config_data_for_dev',
-            'prod': 'config_data_for_prod',
-            'staging': 'config_data_for_staging'
-        }
         instance_id_map = {
             'dev': {'instance_id': 'i-1234567890abcdef'},
             'prod': {'instance_id': 'i-abcdef1234567890'},
@@ -556,93 +203,94 @@ class TestSendCommands(unittest.TestCase):
         }
 
         # Act
-        updated_instance_id_map = helpers.send_commands(config_files_map, instance_id_map)
+        updated_instance_id_map, failures = helpers.send_commands(instance_id_map)
 
         # Assert
         self.assertEqual(updated_instance_id_map['dev']['command_id'], 'command-id-123')
         self.assertEqual(updated_instance_id_map['prod']['command_id'], 'command-id-123')
         self.assertEqual(updated_instance_id_map['staging']['command_id'], 'command-id-123')
 
-        # Verify that send_command was called with the expected parameters
-        expected_calls = [
-            unittest.mock.call(
-                InstanceIds=['i-1234567890abcdef'],
-                DocumentName='AWS-RunShellScript',
-                Parameters={
-                    'commands': [
-                        'config=$(aws ssm get-parameters --names /dev/wireguard/config_file --with-decryption --query Parameters[0].Value --output text --region us-east-1)',
-                        'echo -e "$config" | sudo tee /etc/wireguard/wg0.conf > /dev/null',
-                        'sudo systemctl reload wg-quick@wg0',
-                        'sudo systemctl restart wg-quick@wg0'
-                    ]
-                }
-            ),
-            unittest.mock.call(
-                InstanceIds=['i-abcdef1234567890'],
-                DocumentName='AWS-RunShellScript',
-                Parameters={
-                    'commands': [
-                        'config=$(aws ssm get-parameters --names /prod/wireguard/config_file --with-decryption --query Parameters[0].Value --output text --region us-east-1)',
-                        'echo -e "$config" | sudo tee /etc/wireguard/wg0.conf > /dev/null',
-                        'sudo systemctl reload wg-quick@wg0',
-                        'sudo systemctl restart wg-quick@wg0'
-                    ]
-                }
-            ),
-            unittest.mock.call(
-                InstanceIds=['i-fedcba0987654321'],
-                DocumentName='AWS-RunShellScript',
-                Parameters={
-                    'commands': [
-                        'config=$(aws ssm get-parameters --names /staging/wireguard/config_file --with-decryption --query Parameters[0].Value --output text --region us-east-1)',
-                        'echo -e "$config" | sudo tee /etc/wireguard/wg0.conf > /dev/null',
-                        'sudo systemctl reload wg-quick@wg0',
-                        'sudo systemctl restart wg-quick@wg0'
-                    ]
-                }
-            )
-        ]
-        mock_send_command.assert_has_calls(expected_calls)
-        self.assertEqual(mock_send_command.call_count, 3)
-
-    @patch('helpers.ssm_client')
-    def test_send_commands_failure(self, mock_ssm_client):
+        # Verify that one command was sent to every server through the apply document
+        mock_send_command.assert_called_once_with(
+            Targets=[{'Key': 'InstanceIds', 'Values': ['i-1234567890abcdef', 'i-abcdef1234567890', 'i-fedcba0987654321']}],
+            DocumentName=helpers.APPLY_DOCUMENT_NAME,
+            DocumentVersion=helpers.APPLY_DOCUMENT_VERSION,
+            Parameters=helpers.get_apply_parameters(),
+            MaxConcurrency=helpers.APPLY_MAX_CONCURRENCY,
+            MaxErrors=helpers.APPLY_MAX_ERRORS
+        )
+        self.assertEqual(failures, {})
+
+    @patch('helpers.get_ssm_client')
+    def test_send_commands_batches_targets(self, mock_get_ssm_client):
+        mock_send_command = mock_get_ssm_client.return_value.send_command
+        mock_send_command.side_effect = [{'Command': {'CommandId': 'cmd1'}}, Exception('throttled')]
+        environments = [f'env{i}' for i in range(helpers.SEND_COMMAND_MAX_TARGETS + 1)]
+        instance_id_map = {env: {'instance_id': f'i-{i}'} for i, env in enumerate(environments)}
+
+        updated_instance_id_map, failures = helpers.send_commands(instance_id_map)
+
+        self.assertEqual(mock_send_command.call_count, 2)
+        self.assertEqual(len(mock_send_command.call_args_list[0].kwargs['Targets'][0]['Values']), helpers.SEND_COMMAND_MAX_TARGETS)
+        self.assertEqual(updated_instance_id_map['env0']['command_id'], 'cmd1')
+        self.assertEqual(list(failures), [environments[-1]])
+
+    @patch('helpers.get_ssm_client')
+    def test_send_commands_failure(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
         # Arrange
         mock_ssm_client.send_command.side_effect = Exception("SSM command failed")
 
-        config_files_map = {
-            'dev': 'config_data_for_dev'
-        }
         instance_id_map = {
             'dev': {'instance_id': 'i-1234567890abcdef'}
         }
 
-        # Act & Assert
-        with self.assertRaises(Exception) as context:
-            helpers.send_commands(config_files_map, instance_id_map)
-        self.assertEqual(str(context.exception), "SSM command failed")
+        # Act
+        updated_instance_id_map, failures = helpers.send_commands(instance_id_map)
+
+        # Assert
+        self.assertNotIn('command_id', updated_instance_id_map['dev'])
+        self.assertEqual(str(failures['dev']), "SSM command failed")
+
+
+def mock_command_invocations(mock_ssm_client, pages_per_poll):
+    # Each poll of a command returns the next list of (instance_id, status) or (instance_id, status, output) tuples
+    # for it.
+    polls = {}
+
+    def paginate(CommandId, Details=False):
+        responses = pages_per_poll[CommandId]
+        index = polls.get(CommandId, 0)
+        polls[CommandId] = index + 1
+        response = responses[min(index, len(responses) - 1)]
+        if isinstance(response, Exception):
+            raise response
+        invocations = []
+        for invocation in response:
+            instance_id, status = invocation[:2]
+            plugins = [{'Name': 'aws:runShellScript', 'Output': invocation[2]}] if len(invocation) > 2 else []
+            invocations.append({'InstanceId': instance_id, 'Status': status, 'CommandPlugins': plugins})
+        return [{'CommandInvocations': invocations}]
+
+    mock_ssm_client.get_paginator.return_value.paginate.side_effect = paginate
+    return polls
 
 
 class TestCheckStatusOfCommands(unittest.TestCase):
-    @patch('helpers.ssm_client')
-    def test_check_status_of_commands_failed(self, mock_ssm_client):
+    @patch('helpers.time.sleep')
+    @patch('helpers.get_ssm_client')
+    def test_check_status_of_commands_failed(self, mock_get_ssm_client, mock_sleep):
+        mock_ssm_client = mock_get_ssm_client.return_value
         # Arrange
-        mock_get_command_invocation = MagicMock()
-        # Simulate different statuses
-        mock_get_command_invocation.side_effect = [
-            {'Status': 'InProgress'},
-            {'Status': 'InProgress'},
-            {'Status': 'InProgress'},
-            {'Status': 'Success'},
-            {'Status': 'Failed'},
-            {'Status': 'Success'},
-        ]
-        mock_ssm_client.get_command_invocation = mock_get_command_invocation
-
+        mock_command_invocations(mock_ssm_client, {
+            'cmd1': [[('i-1', 'InProgress')], [('i-1', 'Success')]],
+            'cmd2': [[('i-2', 'Failed')]],
+            'cmd3': [[('i-3', 'InProgress')], [('i-3', 'InProgress')], [('i-3', 'Success')]],
+        })
         instance_id_map = {
-            'env1': {'instance_id': 'i-1234567890abcdef', 'command_id': 'cmd1'},
-            'env2': {'instance_id': 'i-abcdef1234567890', 'command_id': 'cmd2'},
-            'env3': {'instance_id': 'i-fedcba0987654321', 'command_id': 'cmd3'}
+            'env1': {'instance_id': 'i-1', 'command_id': 'cmd1'},
+            'env2': {'instance_id': 'i-2', 'command_id': 'cmd2'},
+            'env3': {'instance_id': 'i-3', 'command_id': 'cmd3'}
         }
 
         # Act
@@ -652,40 +300,58 @@ class TestCheckStatusOfCommands(unittest.TestCase):
         self.assertEqual(updated_instance_id_map['env1']['status'], 'Success')
         self.assertEqual(updated_instance_id_map['env2']['status'], 'Failed')
         self.assertEqual(updated_instance_id_map['env3']['status'], 'Success')
-
-    @patch('helpers.ssm_client')
-    def test_check_status_of_commands_success(self, mock_ssm_client):
-        # Arrange
-        mock_get_command_invocation = MagicMock()
-        # Simulate different statuses
-        mock_get_command_invocation.side_effect = [
-            {'Status': 'InProgress'},
-            {'Status': 'InProgress'},
-            {'Status': 'Success'},
-            {'Status': 'Success'},
-            {'Status': 'Success'},
-            {'Status': 'Success'},
-        ]
-        mock_ssm_client.get_command_invocation = mock_get_command_invocation
-
+        for v in updated_instance_id_map.values():
+            self.assertIn('elapsed_seconds', v)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('helpers.time.sleep')
+    @patch('helpers.get_ssm_client')
+    def test_check_status_of_commands_one_call_per_command(self, mock_get_ssm_client, mock_sleep):
+        mock_ssm_client = mock_get_ssm_client.return_value
+        # Arrange: one command sent to two instances
+        polls = mock_command_invocations(mock_ssm_client, {
+            'cmd1': [[('i-1', 'Success'), ('i-2', 'Success')]],
+        })
         instance_id_map = {
-            'env1': {'instance_id': 'i-1234567890abcdef', 'command_id': 'cmd1'},
-            'env2': {'instance_id': 'i-abcdef1234567890', 'command_id': 'cmd2'},
-            'env3': {'instance_id': 'i-fedcba0987654321', 'command_id': 'cmd3'}
+            'env1': {'instance_id': 'i-1', 'command_id': 'cmd1'},
+            'env2': {'instance_id': 'i-2', 'command_id': 'cmd1'},
+            'env3': {'instance_id': 'i-3', 'command_id': ''}
         }
 
         # Act
         updated_instance_id_map = helpers.check_status_of_commands(instance_id_map)
 
         # Assert
+        self.assertEqual(polls, {'cmd1': 1})
         self.assertEqual(updated_instance_id_map['env1']['status'], 'Success')
         self.assertEqual(updated_instance_id_map['env2']['status'], 'Success')
-        self.assertEqual(updated_instance_id_map['env3']['status'], 'Success')
+        self.assertNotIn('status', updated_instance_id_map['env3'])
+        mock_sleep.assert_not_called()
 
-    @patch('helpers.ssm_client')
-    def test_check_status_of_commands_failure(self, mock_ssm_client):
+    @patch('helpers.time.sleep')
+    @patch('helpers.get_ssm_client')
+    def test_check_status_of_commands_invocation_not_visible_yet(self, mock_get_ssm_client, mock_sleep):
+        mock_ssm_client = mock_get_ssm_client.return_value
         # Arrange
-        mock_ssm_client.get_command_invocation.side_effect = Exception("SSM command failed")
+        not_visible = helpers.ClientError({'Error': {'Code': 'InvocationDoesNotExist', 'Message': ''}}, 'ListCommandInvocations')
+        mock_command_invocations(mock_ssm_client, {
+            'cmd1': [not_visible, [], [('i-1', 'Success')]],
+        })
+        instance_id_map = {'env1': {'instance_id': 'i-1', 'command_id': 'cmd1'}}
+
+        # Act
+        updated_instance_id_map = helpers.check_status_of_commands(instance_id_map)
+
+        # Assert
+        self.assertEqual(updated_instance_id_map['env1']['status'], 'Success')
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('helpers.time.sleep')
+    @patch('helpers.get_ssm_client')
+    def test_check_status_of_commands_failure(self, mock_get_ssm_client, mock_sleep):
+        mock_ssm_client = mock_get_ssm_client.return_value
+        # Arrange
+        mock_ssm_client.get_paginator.return_value.paginate.side_effect = Exception("SSM command failed")
 
         instance_id_map = {
             'env1': {'instance_id': 'i-1234567890abcdef', 'command_id': 'cmd1'}
@@ -696,61 +362,1121 @@ class TestCheckStatusOfCommands(unittest.TestCase):
             helpers.check_status_of_commands(instance_id_map)
         self.assertEqual(str(context.exception), "SSM command failed")
 
-    @patch('helpers.ssm_client')
-    def test_check_status_of_commands_in_progress(self, mock_ssm_client):
+    @patch('helpers.get_ssm_client')
+    def test_check_status_of_commands_in_progress(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
+        # Arrange: the command never finishes
+        mock_command_invocations(mock_ssm_client, {'cmd1': [[('i-1', 'InProgress')]]})
+        instance_id_map = {
+            'env1': {'instance_id': 'i-1', 'command_id': 'cmd1'},
+        }
+
+        # Act
+        updated_instance_id_map = helpers.check_status_of_commands(instance_id_map, timeout=0.05, initial_delay=0.01)
+
+        # Assert
+        self.assertEqual(updated_instance_id_map['env1']['status'], 'TimedOut')
+
+
+class TestGetAvailableIP(unittest.TestCase):
+    @patch('helpers.get_ip_allocator')
+    def test_get_available_ip(self, mock_get_ip_allocator):
+        mock_ip_allocator = mock_get_ip_allocator.return_value
+        mock_ip_allocator.allocate.return_value = "192.168.2.5/32"
+
+        result = helpers.get_available_ip()
+
+        self.assertEqual(result, "192.168.2.5/32")
+        # Existing clients are only scanned if the allocator has to seed a new block.
+        mock_ip_allocator.allocate.assert_called_once_with(helpers.get_all_taken_client_ips)
+
+
+class TestReleaseClientIps(unittest.TestCase):
+    @patch('helpers.get_ip_allocator')
+    def test_release_client_ips_only_for_removed_clients(self, mock_get_ip_allocator):
+        mock_ip_allocator = mock_get_ip_allocator.return_value
+        records = [
+            {'eventName': 'INSERT', 'dynamodb': {'NewImage': {'ClientIP': {'S': '192.168.2.5/32'}}}},
+            {'eventName': 'MODIFY', 'dynamodb': {'OldImage': {'ClientIP': {'S': '192.168.2.6/32'}}, 'NewImage': {'ClientIP': {'S': '192.168.2.6/32'}}}},
+            {'eventName': 'REMOVE', 'dynamodb': {'OldImage': {'ClientIP': {'S': '192.168.2.7/32'}}}},
+        ]
+
+        helpers.release_client_ips(records)
+
+        mock_ip_allocator.release.assert_called_once_with('192.168.2.7/32')
+
+
+class TestGetPeerChanges(unittest.TestCase):
+    def test_get_peer_changes_new_client(self):
+        old_image = {}
+        new_image = {'PublicKey': {'S': 'key1'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}
+
+        result = helpers.get_peer_changes(old_image, new_image)
+
+        self.assertEqual(result, {'dev': {'key1': '10.0.0.3/32'}, 'prod': {'key1': '10.0.0.3/32'}})
+
+    def test_get_peer_changes_removed_client(self):
+        old_image = {'PublicKey': {'S': 'key1'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}]}}
+        new_image = {}
+
+        result = helpers.get_peer_changes(old_image, new_image)
+
+        self.assertEqual(result, {'dev': {'key1': None}})
+
+    def test_get_peer_changes_rotated_key(self):
+        old_image = {'PublicKey': {'S': 'old_key'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}]}}
+        new_image = {'PublicKey': {'S': 'new_key'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}]}}
+
+        result = helpers.get_peer_changes(old_image, new_image)
+
+        self.assertEqual(result, {'dev': {'old_key': None, 'new_key': '10.0.0.3/32'}})
+
+    def test_get_peer_changes_no_change(self):
+        image = {'PublicKey': {'S': 'key1'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}]}}
+
+        result = helpers.get_peer_changes(image, image)
+
+        self.assertEqual(result, {})
+
+    def test_get_peer_changes_empty_old_key(self):
+        old_image = {'PublicKey': {'S': ''}, 'Environments': {'L': [{'S': 'dev'}]}}
+        new_image = {'PublicKey': {'S': 'new_key'}, 'Environments': {'L': [{'S': 'dev'}]}}
+
+        with self.assertRaises(Exception):
+            helpers.get_peer_changes(old_image, new_image)
+
+
+class TestCoalesceStreamRecords(unittest.TestCase):
+    def test_coalesce_stream_records_folds_batch(self):
+        records = [
+            {'dynamodb': {'NewImage': {'PublicKey': {'S': 'key1'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}]}}}},
+            {'dynamodb': {'NewImage': {'PublicKey': {'S': 'key2'}, 'ClientIP': {'S': '10.0.0.4/32'}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}}}},
+            {'dynamodb': {
+                'OldImage': {'PublicKey': {'S': 'key1'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}]}},
+            }},
+        ]
+
+        result, failed_records = helpers.coalesce_stream_records(records)
+
+        self.assertEqual(result, {'dev': {'key1': None, 'key2': '10.0.0.4/32'}, 'prod': {'key2': '10.0.0.4/32'}})
+        self.assertEqual(list(result['dev']), ['key2', 'key1'])
+        self.assertEqual(failed_records, [])
+
+    def test_coalesce_stream_records_skips_poison_record(self):
+        poison_record = {'dynamodb': {'SequenceNumber': '2', 'NewImage': {'ClientIP': {'S': '10.0.0.5/32'}}}}
+        records = [
+            {'dynamodb': {'SequenceNumber': '1', 'NewImage': {'PublicKey': {'S': 'key1'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}]}}}},
+            poison_record,
+        ]
+
+        result, failed_records = helpers.coalesce_stream_records(records)
+
+        self.assertEqual(result, {'dev': {'key1': '10.0.0.3/32'}})
+        self.assertEqual(failed_records, [poison_record])
+
+    def test_coalesce_stream_records_empty_batch(self):
+        self.assertEqual(helpers.coalesce_stream_records([]), ({}, []))
+
+
+class TestBatchItemFailures(unittest.TestCase):
+    def get_record(self, sequence_number, environments):
+        return {'dynamodb': {'SequenceNumber': sequence_number, 'NewImage': {'Environments': {'L': [{'S': e} for e in environments]}}}}
+
+    def test_get_failed_records(self):
+        records = [self.get_record('1', ['dev']), self.get_record('2', ['prod']), self.get_record('3', ['dev', 'qa']), self.get_record('4', [])]
+
+        failed_records = helpers.get_failed_records(records, {'qa': Exception('boom')}, [records[3]])
+
+        self.assertEqual(helpers.get_batch_item_failures(failed_records), {'batchItemFailures': [{'itemIdentifier': '3'}, {'itemIdentifier': '4'}]})
+
+    def test_get_deferred_environments(self):
+        environment_states = {'dev': {'RetryAfter': 1100}, 'prod': {'RetryAfter': 900}, 'qa': {}}
+
+        self.assertEqual(helpers.get_deferred_environments(environment_states, now=1000), ['dev'])
+
+    @patch('time.time', return_value=1000)
+    @patch('helpers.update_state_item')
+    def test_record_apply_results(self, mock_update_state_item, mock_time):
+        environment_states = {'dev': {'FailureCount': Decimal(2)}, 'prod': {'FailureCount': Decimal(1)}, 'qa': {}}
+
+        helpers.record_apply_results(environment_states, {'dev': False, 'prod': True, 'qa': True})
+
+        calls = {c.kwargs['Key']['PK']: c.kwargs for c in mock_update_state_item.call_args_list}
+        self.assertEqual(sorted(calls), ['ENVIRONMENT#dev', 'ENVIRONMENT#prod'])
+        self.assertEqual(calls['ENVIRONMENT#dev']['ExpressionAttributeValues'], {':count': 3, ':retry_after': 1000 + 4 * helpers.ENVIRONMENT_RETRY_BASE_SECONDS})
+        self.assertEqual(calls['ENVIRONMENT#prod']['UpdateExpression'], 'SET FailureCount = :zero REMOVE RetryAfter')
+
+    def test_get_retry_delay_is_capped(self):
+        self.assertEqual(helpers.get_retry_delay(1), helpers.ENVIRONMENT_RETRY_BASE_SECONDS)
+        self.assertEqual(helpers.get_retry_delay(50), helpers.ENVIRONMENT_RETRY_MAX_SECONDS)
+
+
+class TestApplyPeerChanges(unittest.TestCase):
+    def test_apply_peer_changes(self):
+        config = WireGuardConfig.parse('[Interface]\nAddress = 192.168.0.1/24\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 10.0.0.1/32\n\n[Peer]\nPublicKey = key2\nAllowedIPs = 10.0.0.2/32')
+
+        changed = helpers.apply_peer_changes(config, {'key2': None, 'key3': '10.0.0.3/32'})
+
+        self.assertTrue(changed)
+        self.assertEqual(config.serialize(), '[Interface]\nAddress = 192.168.0.1/24\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 10.0.0.1/32\n\n[Peer]\nPublicKey = key3\nAllowedIPs = 10.0.0.3/32')
+
+    def test_apply_peer_changes_does_not_duplicate_existing_peer(self):
+        config = WireGuardConfig.parse('[Interface]\nAddress = 192.168.0.1/24\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 10.0.0.1/32')
+
+        changed = helpers.apply_peer_changes(config, {'key1': '10.0.0.1/32', 'missing_key': None})
+
+        self.assertFalse(changed)
+        self.assertEqual(len(config), 1)
+
+    def test_apply_peer_changes_missing_client_ip(self):
+        config = WireGuardConfig.parse('[Interface]\nAddress = 192.168.0.1/24')
+
+        with self.assertRaises(Exception):
+            helpers.apply_peer_changes(config, {'key1': ''})
+
+    def test_apply_peer_changes_missing_public_key(self):
+        config = WireGuardConfig.parse('[Interface]\nAddress = 192.168.0.1/24')
+
+        with self.assertRaises(Exception):
+            helpers.apply_peer_changes(config, {'': '10.0.0.3/32'})
+
+
+class TestGetDirtyConfigFiles(unittest.TestCase):
+    def test_get_dirty_config_files_only_changed_environments(self):
+        config_files_map = {
+            'dev': '[Interface]\nAddress = 192.168.0.1/24\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 10.0.0.1/32',
+            'prod': '[Interface]\nAddress = 192.168.0.2/24\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 10.0.0.1/32',
+        }
+        peer_changes = {
+            'dev': {'key2': '10.0.0.2/32'},
+            'prod': {'key1': '10.0.0.1/32'},
+        }
+
+        result = helpers.get_dirty_config_files(config_files_map, peer_changes)
+
+        self.assertEqual(list(result), ['dev'])
+        self.assertIn('PublicKey = key2\nAllowedIPs = 10.0.0.2/32', result['dev'])
+
+    def test_get_dirty_config_files_no_changes(self):
+        config_files_map = {'dev': '[Interface]\nAddress = 192.168.0.1/24\n'}
+
+        result = helpers.get_dirty_config_files(config_files_map, {'dev': {'missing_key': None}})
+
+        self.assertEqual(result, {})
+
+
+class TestRunForEachEnvironment(unittest.TestCase):
+    def test_run_for_each_environment_keeps_order_and_collects_failures(self):
+        def operation(env):
+            if env == 'bad':
+                raise Exception("boom")
+            return env.upper()
+
+        results, failures = helpers.run_for_each_environment(operation, ['dev', 'bad', 'prod'], max_workers=3)
+
+        self.assertEqual(list(results.items()), [('dev', 'DEV'), ('prod', 'PROD')])
+        self.assertEqual(list(failures), ['bad'])
+
+    def test_run_for_each_environment_runs_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        # Every call waits on the others, so this only completes if all three run at the same time.
+        results, failures = helpers.run_for_each_environment(lambda env: barrier.wait(), ['a', 'b', 'c'], max_workers=3)
+
+        self.assertEqual(failures, {})
+        self.assertEqual(len(results), 3)
+
+    def test_run_for_each_environment_no_environments(self):
+        self.assertEqual(helpers.run_for_each_environment(lambda env: env, []), ({}, {}))
+
+    def test_run_for_each_environment_single_environment_runs_inline(self):
+        thread = threading.current_thread()
+
+        results, failures = helpers.run_for_each_environment(lambda env: threading.current_thread() is thread, ['dev'])
+
+        self.assertEqual(results, {'dev': True})
+        self.assertEqual(failures, {})
+
+
+class TestAddItemToDynamodb(unittest.TestCase):
+    @patch('helpers.get_state_table_client')
+    @patch('helpers.get_table_client')
+    @patch('helpers.get_dynamodb_client')
+    def test_add_item_to_dynamodb_writes_guard_and_client_together(self, mock_get_dynamodb_client, mock_get_table_client, mock_get_state_table_client):
+        mock_dynamodb_client = mock_get_dynamodb_client.return_value
+        mock_table_client = mock_get_table_client.return_value
+        mock_state_table_client = mock_get_state_table_client.return_value
+        mock_table_client.name = 'wireguard-updater'
+        mock_state_table_client.name = 'wireguard-updater-state'
+
+        helpers.add_item_to_dynamodb('192.168.2.5/32', 'key1', ['dev'])
+
+        transact_items = mock_dynamodb_client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual(transact_items[0]['Put'], {
+            'TableName': 'wireguard-updater-state',
+            'Item': {'PK': {'S': 'PUBLICKEY#key1'}, 'SK': {'S': 'GUARD'}, 'ClientIP': {'S': '192.168.2.5/32'}},
+            'ConditionExpression': 'attribute_not_exists(PK)'
+        })
+        self.assertEqual(transact_items[1]['Put'], {
+            'TableName': 'wireguard-updater',
+            'Item': {'ClientIP': {'S': '192.168.2.5/32'}, 'PublicKey': {'S': 'key1'}, 'Environments': {'L': [{'S': 'dev'}]}},
+            'ConditionExpression': 'attribute_not_exists(ClientIP)'
+        })
+
+    @patch('helpers.get_dynamodb_client')
+    def test_add_item_to_dynamodb_duplicate_public_key(self, mock_get_dynamodb_client):
+        mock_dynamodb_client = mock_get_dynamodb_client.return_value
+        mock_dynamodb_client.transact_write_items.side_effect = helpers.ClientError(
+            {
+                'Error': {'Code': 'TransactionCanceledException', 'Message': ''},
+                'CancellationReasons': [{'Code': 'ConditionalCheckFailed'}, {'Code': 'None'}]
+            },
+            'TransactWriteItems'
+        )
+
+        with self.assertRaises(helpers.PublicKeyExistsError):
+            helpers.add_item_to_dynamodb('192.168.2.5/32', 'key1', ['dev'])
+
+    @patch('helpers.get_dynamodb_client')
+    def test_add_item_to_dynamodb_other_failure(self, mock_get_dynamodb_client):
+        mock_dynamodb_client = mock_get_dynamodb_client.return_value
+        mock_dynamodb_client.transact_write_items.side_effect = helpers.ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': ''}},
+            'TransactWriteItems'
+        )
+
+        with self.assertRaises(helpers.ClientError):
+            helpers.add_item_to_dynamodb('192.168.2.5/32', 'key1', ['dev'])
+
+
+class TestDoesPublicKeyExistAlready(unittest.TestCase):
+    @patch('helpers.get_table_client')
+    def test_does_public_key_exist_already(self, mock_get_table_client):
+        mock_table_client = mock_get_table_client.return_value
+        mock_table_client.query.return_value = {'Count': 1, 'Items': [{'ClientIP': '192.168.2.5/32', 'PublicKey': 'key1'}]}
+
+        self.assertTrue(helpers.does_public_key_exist_already('key1'))
+        self.assertEqual(mock_table_client.query.call_args.kwargs['IndexName'], 'PublicKeyIndex')
+        mock_table_client.scan.assert_not_called()
+
+    @patch('helpers.get_table_client')
+    def test_does_public_key_exist_already_missing(self, mock_get_table_client):
+        mock_table_client = mock_get_table_client.return_value
+        mock_table_client.query.return_value = {'Count': 0, 'Items': []}
+
+        self.assertFalse(helpers.does_public_key_exist_already('key1'))
+
+
+class TestSyncPublicKeyGuards(unittest.TestCase):
+    @patch('helpers.get_state_table_client')
+    def test_sync_public_key_guards(self, mock_get_state_table_client):
+        mock_state_table_client = mock_get_state_table_client.return_value
+        records = [
+            {'dynamodb': {'NewImage': {'ClientIP': {'S': '192.168.2.5/32'}, 'PublicKey': {'S': 'key1'}}}},
+            {'dynamodb': {
+                'OldImage': {'ClientIP': {'S': '192.168.2.6/32'}, 'PublicKey': {'S': 'old_key'}},
+                'NewImage': {'ClientIP': {'S': '192.168.2.6/32'}, 'PublicKey': {'S': 'new_key'}},
+            }},
+            {'dynamodb': {'OldImage': {'ClientIP': {'S': '192.168.2.7/32'}, 'PublicKey': {'S': 'key3'}}}},
+            {'dynamodb': {
+                'OldImage': {'ClientIP': {'S': '192.168.2.8/32'}, 'PublicKey': {'S': 'key4'}},
+                'NewImage': {'ClientIP': {'S': '192.168.2.8/32'}, 'PublicKey': {'S': 'key4'}},
+            }},
+        ]
+
+        helpers.sync_public_key_guards(records)
+
+        put_keys = [c.kwargs['Item']['PK'] for c in mock_state_table_client.put_item.call_args_list]
+        deleted_keys = [c.kwargs['Key']['PK'] for c in mock_state_table_client.delete_item.call_args_list]
+        self.assertEqual(put_keys, ['PUBLICKEY#key1', 'PUBLICKEY#new_key'])
+        self.assertEqual(deleted_keys, ['PUBLICKEY#old_key', 'PUBLICKEY#key3'])
+
+
+class TestLazyInitialization(unittest.TestCase):
+    def setUp(self):
+        helpers.get_ssm_client.cache_clear()
+        helpers.get_environment_registry.cache_clear()
+
+    def tearDown(self):
+        helpers.get_ssm_client.cache_clear()
+        helpers.get_environment_registry.cache_clear()
+
+    @patch('helpers.boto3')
+    def test_get_ssm_client_is_built_once(self, mock_boto3):
+        first = helpers.get_ssm_client()
+        second = helpers.get_ssm_client()
+
+        self.assertIs(first, second)
+        mock_boto3.client.assert_called_once()
+
+    @patch('helpers.get_state_table_client')
+    def test_get_environment_map_reads_the_registry_once(self, mock_get_state_table_client):
+        mock_table = mock_get_state_table_client.return_value
+        mock_table.get_item.return_value = {'Item': {'Version': 'v1'}}
+        mock_table.query.return_value = {'Items': [{'Environment': 'dev', 'InstanceId': 'i-1'}]}
+
+        first = helpers.get_environment_map()
+        second = helpers.get_environment_map()
+
+        self.assertIs(first, second)
+        self.assertEqual(first['dev']['instance_id'], 'i-1')
+        mock_table.query.assert_called_once()
+
+
+class TestEnvironmentRegistryListeners(unittest.TestCase):
+    @patch('helpers.get_state_table_client')
+    def test_reset_replaced_servers(self, mock_get_state_table_client):
+        old = {'dev': {'instance_id': 'i-1', 'public_key': 'key1'}, 'prod': {'instance_id': 'i-2', 'public_key': 'key2'}}
+        new = {'dev': {'instance_id': 'i-3', 'public_key': 'key1'}, 'prod': {'instance_id': 'i-2', 'public_key': 'key3'}}
+
+        helpers.reset_replaced_servers(old, new, [], ['dev', 'prod'], [])
+
+        mock_get_state_table_client.return_value.update_item.assert_called_once_with(
+            Key=helpers.get_environment_state_key('dev'),
+            UpdateExpression='REMOVE AppliedHash, FailureCount, RetryAfter'
+        )
+
+    def test_forget_replaced_servers(self):
+        server_map = {'dev': {'instance_id': 'i-3'}, 'prod': {'instance_id': 'i-2'}, 'stage': {'instance_id': 'i-4'}}
+        environment_states = {
+            'dev': {'AppliedHash': 'hash1', 'AppliedInstanceId': 'i-1', 'FailureCount': 2, 'RetryAfter': 100, 'Sequence': 3},
+            'prod': {'AppliedHash': 'hash2', 'AppliedInstanceId': 'i-2', 'FailureCount': 1},
+            # Recorded before the instance id was, so there is nothing to compare against.
+            'stage': {'AppliedHash': 'hash3'},
+        }
+
+        result = helpers.forget_replaced_servers(environment_states, server_map)
+
+        self.assertIs(result, environment_states)
+        self.assertEqual(result, {
+            'dev': {'AppliedInstanceId': 'i-1', 'Sequence': 3},
+            'prod': {'AppliedHash': 'hash2', 'AppliedInstanceId': 'i-2', 'FailureCount': 1},
+            'stage': {'AppliedHash': 'hash3'},
+        })
+
+    def test_get_command_states_leave_the_registry_alone(self):
+        environment_map = {'dev': {'instance_id': 'i-1', 'public_key': 'key1'}}
+
+        command_states = helpers.get_command_states(environment_map, ['dev'])
+        command_states['dev']['status'] = 'Success'
+
+        self.assertEqual(command_states, {'dev': {'instance_id': 'i-1', 'command_id': '', 'status': 'Success'}})
+        self.assertEqual(environment_map, {'dev': {'instance_id': 'i-1', 'public_key': 'key1'}})
+
+
+class TestPeerPlacement(unittest.TestCase):
+    SERVERS = [
+        {'server_id': s, 'instance_id': f'i-{s}', 'public_key': f'{s}_key', 'wireguard_endpoint': f'{s}.example.com:64731'}
+        for s in ['a', 'b']
+    ]
+    ENVIRONMENT_MAP = {
+        'dev': {'public_key': '', 'wireguard_endpoint': '', 'vpc_cidr': '10.50.0.0/16', 'instance_id': '', 'servers': SERVERS},
+        'prod': {'public_key': 'prod_key', 'wireguard_endpoint': 'prod.example.com:64731', 'vpc_cidr': '10.60.0.0/16', 'instance_id': 'i-1'},
+    }
+
+    def test_get_server_map(self):
+        server_map = helpers.get_server_map(self.ENVIRONMENT_MAP)
+
+        self.assertEqual(list(server_map), ['dev/a', 'dev/b', 'prod'])
+        self.assertEqual(server_map['dev/b'], dict(self.SERVERS[1], vpc_cidr='10.50.0.0/16'))
+        self.assertIs(server_map['prod'], self.ENVIRONMENT_MAP['prod'])
+        self.assertEqual(helpers.get_target_environment('dev/b'), 'dev')
+
+    def test_place_peer_changes(self):
+        ring = helpers.HashRing(['a', 'b'])
+
+        placed = helpers.place_peer_changes(
+            {'dev': {'key1': '192.168.2.5/32', 'key2': None}, 'prod': {'key1': '192.168.2.5/32'}, 'unknown': {'key3': None}},
+            self.ENVIRONMENT_MAP
+        )
+
+        # Additions go to the placed server only, removals to every server of the environment.
+        self.assertEqual(placed, {
+            'dev/a': dict({'key2': None}, **({'key1': '192.168.2.5/32'} if ring.get_server('key1') == 'a' else {})),
+            'dev/b': dict({'key2': None}, **({'key1': '192.168.2.5/32'} if ring.get_server('key1') == 'b' else {})),
+            'prod': {'key1': '192.168.2.5/32'},
+        })
+
+    @patch('helpers.get_state_table_client')
+    def test_reset_replaced_servers_of_an_environment(self, mock_get_state_table_client):
+        new_servers = [self.SERVERS[0], dict(self.SERVERS[1], instance_id='i-new')]
+        new = {'dev': dict(self.ENVIRONMENT_MAP['dev'], servers=new_servers)}
+
+        helpers.reset_replaced_servers(self.ENVIRONMENT_MAP, new, [], ['dev'], [])
+
+        mock_get_state_table_client.return_value.update_item.assert_called_once_with(
+            Key=helpers.get_environment_state_key('dev/b'),
+            UpdateExpression='REMOVE AppliedHash, FailureCount, RetryAfter'
+        )
+
+
+class TestRenderClientConfig(unittest.TestCase):
+    def test_render_client_config(self):
+        environment_map = {
+            'dev': {'public_key': 'dev_server_key', 'vpc_cidr': '10.50.0.0/16', 'wireguard_endpoint': '203.0.113.10:64731'},
+            'stage': {'public_key': 'stage_server_key', 'vpc_cidr': '10.30.0.0/16', 'wireguard_endpoint': '203.0.113.11:64729'},
+        }
+
+        result = helpers.render_client_config('192.168.2.5/32', 'key1', ['dev', 'stage', 'unknown'], environment_map)
+
+        self.assertEqual(result, """[Interface]
+PrivateKey = ReplaceWithYourPrivateKey
+Address = 192.168.2.5/32
+
+[Peer]
+PublicKey = dev_server_key
+AllowedIPs = 10.50.0.0/16
+Endpoint = 203.0.113.10:64731
+PersistentKeepalive = 90
+
+[Peer]
+PublicKey = stage_server_key
+AllowedIPs = 10.30.0.0/16
+Endpoint = 203.0.113.11:64729
+PersistentKeepalive = 90""")
+
+    def test_render_client_config_uses_the_placed_server(self):
+        servers = [
+            {'server_id': s, 'instance_id': f'i-{s}', 'public_key': f'{s}_key', 'wireguard_endpoint': f'{s}.example.com:64731'}
+            for s in ['a', 'b', 'c']
+        ]
+        environment_map = {'dev': {'public_key': '', 'wireguard_endpoint': '', 'vpc_cidr': '10.50.0.0/16', 'instance_id': '', 'servers': servers}}
+        server_id = helpers.HashRing(['a', 'b', 'c']).get_server('key1')
+
+        result = helpers.render_client_config('192.168.2.5/32', 'key1', ['dev'], environment_map)
+
+        self.assertIn(f'PublicKey = {server_id}_key\nAllowedIPs = 10.50.0.0/16\nEndpoint = {server_id}.example.com:64731', result)
+
+
+class TestMaterializeClientConfigs(unittest.TestCase):
+    @patch('helpers.get_state_table_client')
+    def test_materialize_client_configs(self, mock_get_state_table_client):
+        mock_state_table_client = mock_get_state_table_client.return_value
+        environment_map = {'dev': {'public_key': 'dev_server_key', 'vpc_cidr': '10.50.0.0/16', 'wireguard_endpoint': '203.0.113.10:64731'}}
+        records = [
+            {'dynamodb': {'NewImage': {'ClientIP': {'S': '192.168.2.5/32'}, 'Environments': {'L': []}}}},
+            {'dynamodb': {
+                'OldImage': {'ClientIP': {'S': '192.168.2.5/32'}, 'Environments': {'L': []}},
+                'NewImage': {'ClientIP': {'S': '192.168.2.5/32'}, 'PublicKey': {'S': 'key1'}, 'Environments': {'L': [{'S': 'dev'}]}},
+            }},
+            {'dynamodb': {'OldImage': {'ClientIP': {'S': '192.168.2.6/32'}, 'Environments': {'L': [{'S': 'dev'}]}}}},
+        ]
+
+        helpers.materialize_client_configs(records, environment_map)
+
+        # Only the latest image of each client is rendered.
+        mock_state_table_client.update_item.assert_called_once()
+        values = mock_state_table_client.update_item.call_args.kwargs['ExpressionAttributeValues']
+        self.assertEqual(values[':config'], helpers.render_client_config('192.168.2.5/32', 'key1', ['dev'], environment_map))
+        self.assertEqual(values[':etag'], helpers.get_config_hash(values[':config']))
+        self.assertEqual((values[':public_key'], values[':environments']), ('key1', ['dev']))
+        mock_state_table_client.delete_item.assert_called_once_with(Key={'PK': 'CLIENT#192.168.2.6/32', 'SK': 'CONFIG'})
+
+    @patch('helpers.get_state_table_client')
+    def test_materialize_client_configs_unchanged(self, mock_get_state_table_client):
+        mock_state_table_client = mock_get_state_table_client.return_value
+        mock_state_table_client.update_item.side_effect = helpers.ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}}, 'UpdateItem'
+        )
+        records = [{'dynamodb': {'NewImage': {'ClientIP': {'S': '192.168.2.5/32'}, 'Environments': {'L': []}}}}]
+
+        # A config that is already stored with the same etag is left alone.
+        helpers.materialize_client_configs(records, {})
+
+
+class FakeStateTable:
+    # Just enough of update_state_item to evaluate the config claim expressions against one item.
+
+    def __init__(self, item=None):
+        self.item = item or {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames=None,
+                    ConditionExpression=None, ReturnValues=None, ReturnValuesOnConditionCheckFailure=None):
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues
+        if ConditionExpression and not any(
+            all(self.check(atom.strip(), names, values) for atom in clause.split(' AND '))
+            for clause in ConditionExpression.split(' OR ')
+        ):
+            error = {'Error': {'Code': 'ConditionalCheckFailedException'}}
+            if ReturnValuesOnConditionCheckFailure == 'ALL_OLD':
+                error['Item'] = helpers.serialize_item(self.item)
+            raise ClientError(error, 'UpdateItem')
+        for clause, actions in re.findall(r'(SET|REMOVE|ADD) (.*?)(?= SET | REMOVE | ADD |$)', UpdateExpression):
+            for action in actions.split(', '):
+                name, _, value = action.replace(' = ', ' ').partition(' ')
+                name = names.get(name, name)
+                if clause == 'SET':
+                    self.item[name] = values[value]
+                elif clause == 'ADD':
+                    self.item[name] = self.item.get(name, 0) + values[value]
+                else:
+                    self.item.pop(name, None)
+        return {'Attributes': {'Sequence': self.item.get('Sequence')}}
+
+    def check(self, atom, names, values):
+        function = re.fullmatch(r'attribute_(not_)?exists\((\w+)\)', atom)
+        if function:
+            return (function.group(2) in self.item) != bool(function.group(1))
+        name, operator, value = atom.split(' ')
+        name = names.get(name, name)
+        if name not in self.item:
+            return False
+        return self.item[name] < values[value] if operator == '<' else self.item[name] == values[value]
+
+
+class TestConfigClaims(unittest.TestCase):
+    @patch('helpers.time.time', return_value=1700000000.5)
+    @patch('helpers.update_state_item')
+    def test_claim_config_hash(self, mock_update_state_item, mock_time):
+        mock_update_state_item.return_value = {'Attributes': {'Sequence': Decimal(4)}}
+
+        sequence = helpers.claim_config_hash('dev/a', 'read_hash', 'new_hash', 299.2)
+
+        self.assertEqual(sequence, 4)
+        kwargs = mock_update_state_item.call_args.kwargs
+        self.assertEqual(kwargs['Key'], helpers.get_environment_state_key('dev/a'))
+        self.assertIn('DesiredHash = :read_hash', kwargs['ConditionExpression'])
+        self.assertEqual(kwargs['ExpressionAttributeValues'], {
+            ':hash': 'new_hash', ':read_hash': 'read_hash', ':claimed_at': 1700000000, ':pending_until': 1700000300,
+            ':one': 1,
+        })
+
+    @patch('helpers.update_state_item')
+    def test_claim_config_hash_conflict(self, mock_update_state_item):
+        mock_update_state_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem'
+        )
+
+        with self.assertRaises(helpers.ConfigConflictError) as context:
+            helpers.claim_config_hash('dev', 'read_hash', 'new_hash')
+
+        self.assertNotIsInstance(context.exception, helpers.ConfigClaimedError)
+
+    @patch('helpers.update_state_item')
+    def test_release_config_claim_taken_over(self, mock_update_state_item):
+        mock_update_state_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem'
+        )
+
+        # Someone else claimed the config since, so there is nothing to give back.
+        helpers.release_config_claim('dev', 'read_hash', 'new_hash', 4)
+
+        self.assertEqual(
+            mock_update_state_item.call_args.kwargs['ExpressionAttributeValues'],
+            {':read_hash': 'read_hash', ':hash': 'new_hash', ':sequence': 4}
+        )
+
+    @patch('helpers.time.time')
+    @patch('helpers.update_state_item')
+    def test_two_writers_after_the_timeout(self, mock_update_state_item, mock_time):
+        table = FakeStateTable()
+        mock_update_state_item.side_effect = table.update_item
+        mock_time.return_value = 1700000000
+        helpers.complete_config_claim('dev', helpers.claim_config_hash('dev', None, 'hash0'))
+        mock_time.return_value = 1700000000 + helpers.CONFIG_CLAIM_TIMEOUT_SECONDS + 60
+
+        # Both writers read hash0 long after the last write finished, only the first one gets to store its config.
+        sequence = helpers.claim_config_hash('dev', 'hash0', 'hash_a')
+        with self.assertRaises(helpers.ConfigConflictError):
+            helpers.claim_config_hash('dev', 'hash0', 'hash_b')
+        # Re-reading doesn't help while the first write is still pending.
+        with self.assertRaises(helpers.ConfigClaimedError) as context:
+            helpers.claim_config_hash('dev', 'hash_a', 'hash_b')
+        self.assertEqual(context.exception.pending_until, mock_time.return_value + helpers.CONFIG_CLAIM_TIMEOUT_SECONDS)
+        helpers.complete_config_claim('dev', sequence)
+
+        self.assertEqual(helpers.claim_config_hash('dev', 'hash_a', 'hash_b'), 3)
+        self.assertEqual(table.item['DesiredHash'], 'hash_b')
+
+    @patch('helpers.time.time')
+    @patch('helpers.update_state_item')
+    def test_stale_pending_claim_is_taken_over(self, mock_update_state_item, mock_time):
+        table = FakeStateTable({'DesiredHash': 'hash0', 'Sequence': 1})
+        mock_update_state_item.side_effect = table.update_item
+        mock_time.return_value = 1700000000
+        # The claim lasts as long as its invocation had left, not the longest any invocation could run.
+        crashed_sequence = helpers.claim_config_hash('dev', 'hash0', 'hash_a', 60)
+        with self.assertRaises(helpers.ConfigClaimedError):
+            helpers.claim_config_hash('dev', 'hash0', 'hash_b')
+        mock_time.return_value = 1700000000 + 61
+
+        helpers.claim_config_hash('dev', 'hash0', 'hash_b', 60)
+        # The crashed writer can't finish the claim it lost.
+        helpers.complete_config_claim('dev', crashed_sequence)
+
+        self.assertEqual(table.item, {'DesiredHash': 'hash_b', 'PendingUntil': 1700000000 + 121, 'Sequence': 3})
+
+    @patch('helpers.time.time', return_value=1700000000)
+    @patch('helpers.update_state_item')
+    def test_completed_claim_records_published_hash(self, mock_update_state_item, mock_time):
+        table = FakeStateTable({'DesiredHash': 'hash0', 'PublishedHash': 'hash0'})
+        mock_update_state_item.side_effect = table.update_item
+
+        helpers.complete_config_claim('dev', helpers.claim_config_hash('dev', 'hash0', 'hash_a'))
+        self.assertEqual(table.item['PublishedHash'], 'hash0')
+        helpers.complete_config_claim('dev', helpers.claim_config_hash('dev', 'hash_a', 'hash_b'), 'hash_b')
+
+        self.assertEqual(table.item, {'DesiredHash': 'hash_b', 'PublishedHash': 'hash_b', 'Sequence': 2})
+
+    @patch('helpers.time.time', return_value=1700000000)
+    @patch('helpers.update_state_item')
+    def test_released_claim_accepts_either_config(self, mock_update_state_item, mock_time):
+        table = FakeStateTable({'DesiredHash': 'hash0', 'Sequence': 1})
+        mock_update_state_item.side_effect = table.update_item
+
+        helpers.release_config_claim('dev', 'hash0', 'hash_a', helpers.claim_config_hash('dev', 'hash0', 'hash_a'))
+
+        # The failed write may or may not have landed, so a writer that read either config may claim it.
+        self.assertEqual(table.item, {'DesiredHash': 'hash0', 'ReleasedHash': 'hash_a', 'Sequence': 2})
+        helpers.claim_config_hash('dev', 'hash_a', 'hash_b')
+        self.assertNotIn('ReleasedHash', table.item)
+
+
+class TestConfigHashes(unittest.TestCase):
+    def test_get_config_files_to_apply_skips_applied_configs(self):
         # Arrange
-        mock_get_command_invocation = MagicMock()
-        # Simulate a case where commands are stuck in 'InProgress'
-        mock_get_command_invocation.side_effect = [
-            {'Status': 'InProgress'},
-            {'Status': 'InProgress'},
-            {'Status': 'InProgress'},
-            {'Status': 'InProgress'},
-            {'Status': 'InProgress'}
+        config_files_map = {'dev': 'dev_config', 'prod': 'prod_config', 'stage': 'stage_config'}
+        dirty_config_files_map = {'dev': 'new_dev_config'}
+        environment_states = {
+            'dev': {'AppliedHash': helpers.get_config_hash('dev_config')},
+            'prod': {'AppliedHash': helpers.get_config_hash('prod_config')},
+            'stage': {'AppliedHash': helpers.get_config_hash('old_stage_config')},
+        }
+
+        # Act
+        result = helpers.get_config_files_to_apply(config_files_map, dirty_config_files_map, environment_states)
+
+        # Assert
+        self.assertEqual(result, {'dev': 'new_dev_config', 'stage': 'stage_config'})
+
+    def test_get_config_files_to_apply_no_recorded_state(self):
+        result = helpers.get_config_files_to_apply({'dev': 'dev_config'}, {}, {'dev': {}})
+
+        self.assertEqual(result, {'dev': 'dev_config'})
+
+    @patch('helpers.get_dynamodb_client')
+    @patch('helpers.get_state_table_client')
+    def test_get_environment_states(self, mock_get_state_table_client, mock_get_dynamodb_client):
+        # Arrange: the plain client is used, so keys and items are typed.
+        mock_get_state_table_client.return_value.name = 'state'
+        mock_batch_get_item = mock_get_dynamodb_client.return_value.batch_get_item
+        mock_batch_get_item.side_effect = [
+            {
+                'Responses': {'state': [{'PK': {'S': 'ENVIRONMENT#dev'}, 'SK': {'S': 'CONFIG'}, 'Sequence': {'N': '3'}}]},
+                'UnprocessedKeys': {'state': {'Keys': [{'PK': {'S': 'ENVIRONMENT#prod'}, 'SK': {'S': 'CONFIG'}}], 'ConsistentRead': True}},
+            },
+            {'Responses': {'state': []}, 'UnprocessedKeys': {}},
         ]
-        mock_ssm_client.get_command_invocation = mock_get_command_invocation
 
+        # Act
+        result = helpers.get_environment_states(['dev', 'prod'])
+
+        # Assert
+        self.assertEqual(result, {'dev': {'PK': 'ENVIRONMENT#dev', 'SK': 'CONFIG', 'Sequence': Decimal(3)}, 'prod': {}})
+        self.assertEqual(mock_batch_get_item.call_count, 2)
+        self.assertEqual(
+            mock_batch_get_item.call_args_list[0].kwargs['RequestItems']['state']['Keys'],
+            [{'PK': {'S': 'ENVIRONMENT#dev'}, 'SK': {'S': 'CONFIG'}}, {'PK': {'S': 'ENVIRONMENT#prod'}, 'SK': {'S': 'CONFIG'}}]
+        )
+
+    @patch('helpers.get_dynamodb_client')
+    @patch('helpers.get_state_table_client')
+    def test_update_state_item(self, mock_get_state_table_client, mock_get_dynamodb_client):
+        mock_get_state_table_client.return_value.name = 'state'
+        mock_update_item = mock_get_dynamodb_client.return_value.update_item
+        mock_update_item.return_value = {'Attributes': {'Sequence': {'N': '4'}}}
+
+        response = helpers.update_state_item(
+            Key={'PK': 'ENVIRONMENT#dev', 'SK': 'CONFIG'}, UpdateExpression='ADD #sequence :one',
+            ExpressionAttributeNames={'#sequence': 'Sequence'}, ExpressionAttributeValues={':one': 1}, ReturnValues='UPDATED_NEW'
+        )
+
+        # The shared table resource isn't touched from the thread pool, only its name.
+        mock_get_state_table_client.return_value.update_item.assert_not_called()
+        mock_update_item.assert_called_once_with(
+            TableName='state', Key={'PK': {'S': 'ENVIRONMENT#dev'}, 'SK': {'S': 'CONFIG'}}, UpdateExpression='ADD #sequence :one',
+            ExpressionAttributeNames={'#sequence': 'Sequence'}, ExpressionAttributeValues={':one': {'N': '1'}}, ReturnValues='UPDATED_NEW'
+        )
+        self.assertEqual(response, {'Attributes': {'Sequence': Decimal(4)}})
+
+    @patch('helpers.update_state_item')
+    def test_record_config_hashes(self, mock_update_state_item):
+        _, failures = helpers.record_config_hashes({'dev': 'hash1'}, 'AppliedHash')
+
+        self.assertEqual(failures, {})
+        mock_update_state_item.assert_called_once_with(
+            Key={'PK': 'ENVIRONMENT#dev', 'SK': 'CONFIG'},
+            UpdateExpression='SET #hash = :hash',
+            ExpressionAttributeNames={'#hash': 'AppliedHash'},
+            ExpressionAttributeValues={':hash': 'hash1'}
+        )
+
+    @patch('helpers.update_state_item')
+    def test_record_config_hashes_with_instance_ids(self, mock_update_state_item):
+        helpers.record_config_hashes({'dev': 'hash1'}, 'AppliedHash', {'dev': 'i-1'})
+
+        mock_update_state_item.assert_called_once_with(
+            Key={'PK': 'ENVIRONMENT#dev', 'SK': 'CONFIG'},
+            UpdateExpression='SET #hash = :hash, AppliedInstanceId = :instance_id',
+            ExpressionAttributeNames={'#hash': 'AppliedHash'},
+            ExpressionAttributeValues={':hash': 'hash1', ':instance_id': 'i-1'}
+        )
+
+    def test_get_reported_value(self):
+        invocation = {'CommandPlugins': [{'Name': 'aws:runShellScript', 'Output': 'Warning: something\napplied_hash=abc123\n'}]}
+
+        self.assertEqual(helpers.get_reported_value(invocation, 'applied_hash'), 'abc123')
+        self.assertIsNone(helpers.get_reported_value({'CommandPlugins': [{'Output': ''}]}, 'applied_hash'))
+
+    @patch('helpers.time.sleep')
+    @patch('helpers.get_ssm_client')
+    def test_check_status_of_commands_records_applied_hash(self, mock_get_ssm_client, mock_sleep):
+        mock_command_invocations(mock_get_ssm_client.return_value, {'cmd1': [[('i-1', 'Success', 'applied_hash=abc123\n')]]})
+
+        result = helpers.check_status_of_commands({'dev': {'instance_id': 'i-1', 'command_id': 'cmd1', 'status': ''}}, timeout=10)
+
+        self.assertEqual(result['dev']['applied_hash'], 'abc123')
+
+    @patch('helpers.time.sleep')
+    @patch('helpers.get_ssm_client')
+    def test_check_status_of_commands_reports_each_poll(self, mock_get_ssm_client, mock_sleep):
+        mock_command_invocations(mock_get_ssm_client.return_value, {
+            'cmd1': [[('i-1', 'Success'), ('i-2', 'InProgress')], [('i-1', 'Success'), ('i-2', 'Failed')]],
+        })
+        instance_id_map = {'dev': {'instance_id': 'i-1', 'command_id': 'cmd1'}, 'prod': {'instance_id': 'i-2', 'command_id': 'cmd1'}}
+        completed = []
+
+        helpers.check_status_of_commands(instance_id_map, on_complete=lambda m: completed.append({k: v['status'] for k, v in m.items()}))
+
+        self.assertEqual(completed, [{'dev': 'Success'}, {'prod': 'Failed'}])
+
+    @patch('helpers.time.sleep')
+    @patch('helpers.get_ssm_client')
+    def test_check_status_of_commands_wrong_environment(self, mock_get_ssm_client, mock_sleep):
+        mock_command_invocations(mock_get_ssm_client.return_value, {
+            'cmd1': [[('i-1', 'Success', 'environment=prod\napplied_hash=abc123\n')]],
+        })
+
+        result = helpers.check_status_of_commands({'dev': {'instance_id': 'i-1', 'command_id': 'cmd1', 'status': ''}}, timeout=10)
+
+        self.assertEqual(result['dev']['status'], 'WrongEnvironment')
+        self.assertNotIn('applied_hash', result['dev'])
+
+
+class TestGetConfigStore(unittest.TestCase):
+    @patch('helpers.get_s3_client')
+    @patch('helpers.get_ssm_client')
+    def test_get_config_store(self, mock_get_ssm_client, mock_get_s3_client):
+        self.assertEqual(helpers.get_config_store('parameter').tier, 'Standard')
+        self.assertEqual(helpers.get_config_store('advanced_parameter').tier, 'Advanced')
+        self.assertIsInstance(helpers.get_config_store('sharded_parameter'), helpers.ShardedParameterConfigStore)
+        self.assertIs(helpers.get_config_store('s3').s3_client, mock_get_s3_client.return_value)
+        with self.assertRaises(Exception):
+            helpers.get_config_store('dynamodb')
+
+
+class TestConfigDeltas(unittest.TestCase):
+    def test_get_config_delta(self):
+        old_config = '[Interface]\nAddress = 192.168.2.2/32\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 192.168.2.5/32'
+        new_config = '[Interface]\nAddress = 192.168.2.2/32\n\n[Peer]\nPublicKey = key2\nAllowedIPs = 192.168.2.5/32, 10.0.0.0/24'
+
+        self.assertEqual(helpers.get_config_delta(old_config, new_config), ['remove key1', 'add key2 192.168.2.5/32,10.0.0.0/24'])
+
+    @patch('helpers.get_ssm_client')
+    def test_publish_config_deltas(self, mock_get_ssm_client):
+        mock_ssm_client = mock_get_ssm_client.return_value
+
+        sequences, failures = helpers.publish_config_deltas(
+            {'dev': ['remove key1', 'add key2 192.168.2.5/32']}, {'dev': 4}, {'dev': ('hash3', 'hash4')}
+        )
+
+        self.assertEqual((sequences, failures), ({'dev': 4}, {}))
+        put_kwargs = mock_ssm_client.put_parameter.call_args.kwargs
+        self.assertEqual(put_kwargs['Name'], '/dev/wireguard/config_delta')
+        self.assertEqual(put_kwargs['Value'], 'delta 3 4 hash3 hash4\nremove key1\nadd key2 192.168.2.5/32')
+
+    @patch('helpers.get_ssm_client')
+    def test_publish_config_deltas_too_large(self, mock_get_ssm_client):
+        helpers.publish_config_deltas(
+            {'dev': [f'add key{i} 192.168.2.5/32' for i in range(500)]}, {'dev': 4}, {'dev': ('hash3', 'hash4')}
+        )
+
+        self.assertEqual(mock_get_ssm_client.return_value.put_parameter.call_args.kwargs['Value'], 'full 3 4 hash3 hash4')
+
+    def test_get_applied_config_hashes(self):
         instance_id_map = {
-            'env1': {'instance_id': 'i-1234567890abcdef', 'command_id': 'cmd1'},
+            'dev': {'status': 'Success', 'applied_sequence': '4'},
+            'stage': {'status': 'Success', 'applied_sequence': '4', 'applied_hash': 'installed_hash'},
+            'prod': {'status': 'Success', 'applied_sequence': '2'},
+            'test': {'status': 'Failed'},
         }
+        config_hashes = {'dev': 'dev_hash', 'stage': 'stage_hash', 'prod': 'prod_hash', 'test': 'test_hash'}
 
-        # Assert
-        with self.assertRaises(Exception) as context:
-            helpers.check_status_of_commands(instance_id_map)
+        result = helpers.get_applied_config_hashes(instance_id_map, config_hashes, {'dev': 4, 'stage': 4, 'prod': 3, 'test': 1})
 
+        self.assertEqual(result, {'dev': 'dev_hash', 'stage': 'installed_hash'})
 
-class TestGetAvailableIP(unittest.TestCase):
-    @patch('helpers.is_ip_available')
-    @patch('random.randint')
-    def test_get_available_ip(self, mock_randint, mock_is_ip_available):
-        # Mock the random number to control the IP generation
-        mock_randint.return_value = 10
 
-        # Case where the IP is available
-        mock_is_ip_available.side_effect = [True]  # First call returns True
+class TestReconcile(unittest.TestCase):
+    @patch('helpers.get_table_client')
+    @patch('helpers.get_dynamodb_client')
+    def test_scan_clients_reads_every_segment(self, mock_get_dynamodb_client, mock_get_table_client):
+        mock_get_table_client.return_value.name = 'wireguard-updater'
+        mock_paginate = mock_get_dynamodb_client.return_value.get_paginator.return_value.paginate
+        mock_paginate.side_effect = lambda Segment, **kwargs: [
+            {'Items': [{'ClientIP': {'S': f'192.168.{Segment}.{i}/32'}} for i in range(2)]},
+            {'Items': [{'ClientIP': {'S': f'192.168.{Segment}.9/32'}}]},
+        ]
+
+        result = helpers.scan_clients(4)
+
+        self.assertEqual(len(result), 12)
+        self.assertEqual(sorted(c.kwargs['Segment'] for c in mock_paginate.call_args_list), [0, 1, 2, 3])
+        self.assertTrue(all(c.kwargs['TotalSegments'] == 4 for c in mock_paginate.call_args_list))
+
+    def test_get_desired_peers(self):
+        clients = [
+            {'ClientIP': {'S': '192.168.2.5/32'}, 'PublicKey': {'S': 'key1'}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}},
+            {'ClientIP': {'S': '192.168.2.6/32'}, 'PublicKey': {'S': 'key2'}, 'Environments': {'L': [{'S': 'unknown'}]}},
+            {'ClientIP': {'S': '192.168.2.7/32'}, 'Environments': {'L': [{'S': 'dev'}]}},
+        ]
+
+        result = helpers.get_desired_peers(clients, ['dev', 'prod', 'stage'])
+
+        self.assertEqual(result, {'dev': {'key1': '192.168.2.5/32'}, 'prod': {'key1': '192.168.2.5/32'}, 'stage': {}})
+
+    def test_get_reconcile_changes(self):
+        config_files_map = {
+            'dev': '[Interface]\nAddress = 192.168.2.2/32\n\n[Peer]\nPublicKey = stale\nAllowedIPs = 192.168.2.9/32\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 192.168.2.5/32',
+            'prod': '[Interface]\nAddress = 192.168.2.3/32\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 192.168.2.5/32',
+        }
+        desired_peers = {'dev': {'key1': '192.168.2.5/32', 'key2': '192.168.2.6/32'}, 'prod': {'key1': '192.168.2.5/32'}}
+
+        result = helpers.get_reconcile_changes(config_files_map, desired_peers)
+
+        self.assertEqual(result, {'dev': {'stale': None, 'key2': '192.168.2.6/32'}})
+
+    def test_get_reconcile_changes_many_clients(self):
+        clients = [
+            {'ClientIP': {'S': f'10.{i // 65536}.{i // 256 % 256}.{i % 256}/32'}, 'PublicKey': {'S': f'key{i}'}, 'Environments': {'L': [{'S': 'dev'}]}}
+            for i in range(100000)
+        ]
+        desired_peers = helpers.get_desired_peers(clients, ['dev'])
+        config = WireGuardConfig.parse('[Interface]\nAddress = 192.168.2.2/32')
+        for public_key, client_ip in list(desired_peers['dev'].items())[1:]:
+            config.add_peer(public_key, client_ip)
+
+        result = helpers.get_reconcile_changes({'dev': config.serialize()}, desired_peers)
+
+        self.assertEqual(result, {'dev': {'key0': '10.0.0.0/32'}})
+
+
+class TestBulkClients(unittest.TestCase):
+    def test_is_valid_public_key(self):
+        self.assertTrue(helpers.is_valid_public_key('xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg='))
+        self.assertFalse(helpers.is_valid_public_key('key1'))
+        self.assertFalse(helpers.is_valid_public_key('not base64!'))
+        self.assertFalse(helpers.is_valid_public_key(None))
+
+    @patch('helpers.get_state_table_client')
+    @patch('helpers.get_dynamodb_client')
+    def test_claim_public_key_guards_drops_taken_keys(self, mock_get_dynamodb_client, mock_get_state_table_client):
+        mock_get_state_table_client.return_value.name = 'state'
+        mock_transact_write_items = mock_get_dynamodb_client.return_value.transact_write_items
+        mock_transact_write_items.side_effect = [
+            helpers.ClientError({
+                'Error': {'Code': 'TransactionCanceledException', 'Message': ''},
+                'CancellationReasons': [{'Code': 'None'}, {'Code': 'ConditionalCheckFailed'}, {'Code': 'None'}]
+            }, 'TransactWriteItems'),
+            {},
+        ]
+
+        taken = helpers.claim_public_key_guards({'key1': '192.168.2.5/32', 'key2': '192.168.2.6/32', 'key3': '192.168.2.7/32'})
+
+        self.assertEqual(taken, ['key2'])
+        retried = mock_transact_write_items.call_args_list[1].kwargs['TransactItems']
+        self.assertEqual([i['Put']['Item']['PK']['S'] for i in retried], ['PUBLICKEY#key1', 'PUBLICKEY#key3'])
+
+    @patch('helpers.get_state_table_client')
+    @patch('helpers.get_dynamodb_client')
+    def test_claim_public_key_guards_chunks(self, mock_get_dynamodb_client, mock_get_state_table_client):
+        mock_transact_write_items = mock_get_dynamodb_client.return_value.transact_write_items
+
+        taken = helpers.claim_public_key_guards({f'key{i}': f'10.0.0.{i}/32' for i in range(250)})
+
+        self.assertEqual(taken, [])
+        self.assertEqual([len(c.kwargs['TransactItems']) for c in mock_transact_write_items.call_args_list], [100, 100, 50])
+
+    @patch('helpers.get_table_client')
+    def test_add_items_to_dynamodb(self, mock_get_table_client):
+        mock_batch = mock_get_table_client.return_value.batch_writer.return_value.__enter__.return_value
+
+        helpers.add_items_to_dynamodb([{'client_ip': '192.168.2.5/32', 'public_key': 'key1', 'environments': ['dev']}])
+
+        mock_batch.put_item.assert_called_once_with(Item={'ClientIP': '192.168.2.5/32', 'PublicKey': 'key1', 'Environments': ['dev']})
+
+    @patch('helpers.get_state_table_client')
+    @patch('helpers.get_dynamodb_resource')
+    def test_get_materialized_client_configs(self, mock_get_dynamodb_resource, mock_get_state_table_client):
+        mock_get_state_table_client.return_value.name = 'state'
+        mock_get_dynamodb_resource.return_value.batch_get_item.return_value = {
+            'Responses': {'state': [{'PK': 'CLIENT#192.168.2.5/32', 'SK': 'CONFIG', 'Config': 'config'}]}
+        }
+
+        result = helpers.get_materialized_client_configs(['192.168.2.5/32', '192.168.2.6/32'])
 
-        taken_ips = ["192.168.2.5/32", "192.168.2.6/32"]
-        result = helpers.get_available_ip(taken_ips)
-        self.assertEqual(result, "192.168.2.10/32")
+        self.assertEqual(list(result), ['192.168.2.5/32'])
 
-        # Case where the first IP is not available, but the second one is
-        mock_is_ip_available.side_effect = [False, True]  # First call False, second True
-        result = helpers.get_available_ip(taken_ips)
-        self.assertEqual(result, "192.168.2.10/32")
 
-    @patch('helpers.is_ip_available')
-    @patch('random.randint')
-    def test_get_available_ip_with_multiple_attempts(self, mock_randint, mock_is_ip_available):
-        # Mock the random number to control the IP generation
-        mock_randint.side_effect = [5, 10, 15]  # Sequence of numbers
+class TestStreamRecordSummaries(unittest.TestCase):
+    def get_record(self, event_name, client_ip, environments, created_at):
+        image = {'ClientIP': {'S': client_ip}, 'PublicKey': {'S': 'secret_key'}, 'Environments': {'L': [{'S': e} for e in environments]}}
+        return {'eventName': event_name, 'dynamodb': {'NewImage': image, 'ApproximateCreationDateTime': created_at}}
 
-        # Case where the first two IPs are not available, but the third is
-        mock_is_ip_available.side_effect = [False, False, True]
+    def test_summarize_records_is_redacted_and_bounded(self):
+        records = [self.get_record('INSERT', f'192.168.2.{i}/32', ['dev'], 100) for i in range(15)]
+        records.append(self.get_record('MODIFY', '192.168.3.1/32', ['dev'], 100))
 
-        taken_ips = ["192.168.2.5/32", "192.168.2.10/32"]
-        result = helpers.get_available_ip(taken_ips)
-        self.assertEqual(result, "192.168.2.15/32")
+        summary = helpers.summarize_records(records)
 
+        self.assertEqual(
+            summary,
+            '16 records (INSERT=15, MODIFY=1) for clients ' + ', '.join(f'192.168.2.{i}/32' for i in range(10)) + ' and 6 more'
+        )
+        self.assertNotIn('secret_key', summary)
+
+    def test_get_oldest_record_times(self):
+        records = [
+            self.get_record('INSERT', '192.168.2.5/32', ['dev', 'prod'], 200),
+            self.get_record('INSERT', '192.168.2.6/32', ['dev'], 100),
+            {'eventName': 'REMOVE', 'dynamodb': {'OldImage': {'Environments': {'L': [{'S': 'qa'}]}}}},
+        ]
+
+        self.assertEqual(helpers.get_oldest_record_times(records), {'dev': 100, 'prod': 200})
+
+    def test_get_config_sizes(self):
+        config_str = '[Interface]\nAddress = 192.168.2.1/32\n\n[Peer]\nPublicKey = key\nAllowedIPs = 192.168.2.5/32'
+
+        self.assertEqual(helpers.get_config_sizes({'dev': config_str}), {'dev': (1, len(config_str))})
+
+
+class TestRevocation(unittest.TestCase):
+    def test_get_revocation_changes(self):
+        clients = [
+            {'ClientIP': '192.168.2.5/32', 'PublicKey': 'key1', 'Environments': ['dev', 'prod']},
+            {'ClientIP': '192.168.2.6/32', 'PublicKey': 'key2', 'Environments': ['dev']},
+        ]
+
+        self.assertEqual(helpers.get_revocation_changes(clients), {'dev': {'key1': None, 'key2': None}, 'prod': {'key1': None}})
+
+    @patch('helpers.get_table_client')
+    @patch('helpers.get_dynamodb_resource')
+    def test_get_clients_from_dynamodb_batches(self, mock_get_dynamodb_resource, mock_get_table_client):
+        mock_get_table_client.return_value.name = 'clients'
+        client_ips = [f'192.168.{i // 250}.{i % 250}/32' for i in range(150)]
+        mock_get_dynamodb_resource.return_value.batch_get_item.side_effect = lambda RequestItems: {
+            'Responses': {'clients': [{'ClientIP': k['ClientIP']} for k in RequestItems['clients']['Keys'][:-1]]}
+        }
+
+        items = helpers.get_clients_from_dynamodb(client_ips + client_ips[:1])
+
+        self.assertEqual(mock_get_dynamodb_resource.return_value.batch_get_item.call_count, 2)
+        self.assertEqual(len(items), 148)
+
+    def test_coalesce_stream_records_remove_event(self):
+        # A REMOVE record only ever removes, even if it carries a new image.
+        image = {'PublicKey': {'S': 'key1'}, 'ClientIP': {'S': '10.0.0.3/32'}, 'Environments': {'L': [{'S': 'dev'}]}}
+        records = [{'eventName': 'REMOVE', 'dynamodb': {'OldImage': image, 'NewImage': image}}]
+
+        self.assertEqual(helpers.coalesce_stream_records(records), ({'dev': {'key1': None}}, []))
+
+
+
+class TestPeerExpiry(unittest.TestCase):
+    CLIENTS = [
+        {'ClientIP': {'S': '192.168.2.5/32'}, 'PublicKey': {'S': 'key1'}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}},
+        {'ClientIP': {'S': '192.168.2.6/32'}, 'PublicKey': {'S': 'key2'}, 'Environments': {'L': [{'S': 'dev'}]}},
+        {'ClientIP': {'S': '192.168.2.7/32'}, 'PublicKey': {'S': 'key3'}, 'Environments': {'L': [{'S': 'prod'}]}},
+    ]
+
+    def test_get_expiry_changes(self):
+        # key1 is idle in dev but active in prod, key2 is idle in dev and key3 is active. stray isn't a client.
+        liveness = {
+            'dev': {'key1': (100, 0, 0, 0), 'key2': (100, 200, 0, 0), 'stray': (100, 0, 0, 0)},
+            'prod': {'key1': (100, 950, 0, 0), 'key3': (100, 900, 0, 0)},
+        }
+
+        peer_changes, expirations = helpers.get_expiry_changes(self.CLIENTS, liveness, 1000, 500)
+
+        self.assertEqual(peer_changes, {'dev': {'key1': None, 'key2': None}})
+        self.assertEqual(expirations, {
+            '192.168.2.5/32': {'public_key': 'key1', 'environments': ['dev', 'prod'], 'expired': ['dev']},
+            '192.168.2.6/32': {'public_key': 'key2', 'environments': ['dev'], 'expired': ['dev']},
+        })
+
+    def test_get_expiry_changes_across_servers(self):
+        # key1 moved from dev/a to dev/b, where it is active, so it isn't idle in dev. key2 is idle on both.
+        liveness = {
+            'dev/a': {'key1': (100, 0, 0, 0), 'key2': (100, 200, 0, 0)},
+            'dev/b': {'key1': (900, 950, 0, 0), 'key2': (100, 0, 0, 0)},
+        }
+
+        peer_changes, expirations = helpers.get_expiry_changes(self.CLIENTS, liveness, 1000, 500)
+
+        self.assertEqual(peer_changes, {'dev': {'key2': None}})
+        self.assertEqual(list(expirations), ['192.168.2.6/32'])
+
+    def test_get_peer_section_size(self):
+        config = WireGuardConfig(interface=[('Address', '192.168.2.2/32')])
+        before = len(config.serialize())
+        config.add_peer('key1', '192.168.2.5/32')
+
+        self.assertEqual(helpers.get_peer_section_size('key1', '192.168.2.5/32'), len(config.serialize()) - before)
+
+    @patch('helpers.get_table_client')
+    def test_expire_client_environments(self, mock_get_table_client):
+        table = mock_get_table_client.return_value
+        table.update_item.side_effect = [None, ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem'), None]
+        expirations = {
+            '192.168.2.5/32': {'public_key': 'key1', 'environments': ['dev', 'prod'], 'expired': ['dev']},
+            '192.168.2.6/32': {'public_key': 'key2', 'environments': ['dev'], 'expired': ['dev']},
+            '192.168.2.7/32': {'public_key': 'key3', 'environments': ['prod'], 'expired': ['prod']},
+            '192.168.2.8/32': {'public_key': 'key4', 'environments': ['dev', 'stage'], 'expired': ['dev', 'stage']},
+            '192.168.2.9/32': {'public_key': 'key5', 'environments': ['dev', 'qa'], 'expired': ['dev']},
+        }
+
+        updated, deleted, skipped = helpers.expire_client_environments(expirations, {'stage': Exception('throttled'), 'prod': Exception('throttled')})
+
+        self.assertEqual((updated, deleted, skipped), (['192.168.2.5/32', '192.168.2.9/32'], ['192.168.2.6/32'], ['192.168.2.7/32', '192.168.2.8/32']))
+        table.delete_item.assert_called_once_with(
+            Key={'ClientIP': '192.168.2.6/32'},
+            ConditionExpression='PublicKey = :public_key AND Environments = :environments',
+            ExpressionAttributeValues={':public_key': 'key2', ':environments': ['dev']},
+        )
+        # A failed environment stays with the client.
+        self.assertEqual(table.update_item.call_args_list[0].kwargs['ExpressionAttributeValues'][':remaining'], ['prod'])
+        self.assertEqual(table.update_item.call_args_list[1].kwargs['ExpressionAttributeValues'][':remaining'], ['stage'])
+
+    @patch('helpers.get_peer_liveness_store')
+    @patch('helpers.check_status_of_commands')
+    @patch('helpers.get_ssm_client')
+    def test_collect_peer_dumps(self, mock_get_ssm_client, mock_check_status_of_commands, mock_get_peer_liveness_store):
+        mock_get_ssm_client.return_value.send_command.return_value = {'Command': {'CommandId': 'cmd'}}
+        mock_check_status_of_commands.side_effect = lambda states, timeout: {
+            'dev': dict(states['dev'], status='Success'), 'prod': dict(states['prod'], status='Failed')
+        }
+        mock_get_peer_liveness_store.return_value.output_prefix = 'output'
+        mock_get_peer_liveness_store.return_value.read_command_output.return_value = 'key1 1700000000 10 20\n'
+
+        dumps, failures = helpers.collect_peer_dumps({'dev': {'instance_id': 'i-1'}, 'prod': {'instance_id': 'i-2'}}, 30)
+
+        self.assertEqual(dumps, {'dev': {'key1': (1700000000, 10, 20)}})
+        self.assertEqual(list(failures), ['prod'])
+        kwargs = mock_get_ssm_client.return_value.send_command.call_args.kwargs
+        self.assertEqual(kwargs['DocumentName'], 'AWS-RunShellScript')
+        self.assertEqual(kwargs['Targets'], [{'Key': 'InstanceIds', 'Values': ['i-1', 'i-2']}])
+        self.assertEqual(kwargs['OutputS3KeyPrefix'], 'output')
+        mock_get_peer_liveness_store.return_value.read_command_output.assert_called_once_with('cmd', 'i-1')
 
 if __name__ == '__main__':
     unittest.main()
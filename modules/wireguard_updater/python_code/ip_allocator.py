@@ -0,0 +1,184 @@
+import ipaddress
+from botocore.exceptions import ClientError
+
+# Each block item tracks this many addresses in its bitmap (2 KB per item).
+BLOCK_SIZE = 16384
+MAX_ATTEMPTS = 10
+
+
+class IpAllocator:
+    # Hands out client addresses from a CIDR using bitmaps stored in DynamoDB. Every block of BLOCK_SIZE addresses is
+    # one item, a claim always takes the lowest free address, and each claim or release is a conditional write on
+    # the block's version so concurrent callers can never hand out the same address.
+
+    def __init__(self, table, cidr, reserved_count=5):
+        self.table = table
+        self.network = ipaddress.ip_network(cidr)
+        self.reserved_count = reserved_count
+        self.suffix = '/32' if self.network.version == 4 else '/128'
+        self.block_count = (self.network.num_addresses + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.pool_key = f'POOL#{self.network}'
+
+    def allocate(self, get_taken_ips=None):
+        print(f"allocate: Claiming the lowest free address in {self.network}...")
+        for block_index in range(self.block_count):
+            for attempt in range(MAX_ATTEMPTS):
+                block = self._get_block(block_index, get_taken_ips)
+                bitmap = self._read_bitmap(block)
+                # The lowest zero bit of the bitmap is the lowest free address in the block.
+                offset = (~bitmap & (bitmap + 1)).bit_length() - 1
+                if offset >= BLOCK_SIZE:
+                    break
+                if self._write_block(block_index, block, bitmap | (1 << offset), 1):
+                    return str(self.network.network_address + block_index * BLOCK_SIZE + offset) + self.suffix
+            else:
+                raise Exception(f"could not claim an address in {self.network} after {MAX_ATTEMPTS} attempts")
+        raise Exception(f"there are no free client ips left in {self.network}")
+
+    def allocate_many(self, count, get_taken_ips=None):
+        # Claims the lowest count free addresses with one conditional write per block instead of one per address.
+        print(f"allocate_many: Claiming {count} free addresses in {self.network}...")
+        client_ips = []
+        for block_index in range(self.block_count):
+            if len(client_ips) == count:
+                break
+            for attempt in range(MAX_ATTEMPTS):
+                block = self._get_block(block_index, get_taken_ips)
+                bitmap = self._read_bitmap(block)
+                free = ~bitmap & ((1 << BLOCK_SIZE) - 1)
+                offsets = []
+                while free and len(client_ips) + len(offsets) < count:
+                    lowest = free & -free
+                    offsets.append(lowest.bit_length() - 1)
+                    free ^= lowest
+                if len(offsets) == 0:
+                    break
+                claimed = bitmap
+                for offset in offsets:
+                    claimed |= 1 << offset
+                if self._write_block(block_index, block, claimed, len(offsets)):
+                    first = self.network.network_address + block_index * BLOCK_SIZE
+                    client_ips.extend(str(first + offset) + self.suffix for offset in offsets)
+                    break
+            else:
+                self.release_many(client_ips)
+                raise Exception(f"could not claim addresses in {self.network} after {MAX_ATTEMPTS} attempts")
+        if len(client_ips) < count:
+            self.release_many(client_ips)
+            raise Exception(f"there are not {count} free client ips left in {self.network}")
+        return client_ips
+
+    def release_many(self, client_ips):
+        # Returns addresses with one conditional write per block.
+        print(f"release_many: Returning {len(client_ips)} addresses to {self.network}...")
+        offsets_by_block = {}
+        for client_ip in client_ips:
+            address = ipaddress.ip_interface(client_ip).ip
+            if address.version != self.network.version or address not in self.network:
+                print(f"release_many: {client_ip} is not part of {self.network}, skipping")
+                continue
+            index = int(address) - int(self.network.network_address)
+            if not self._is_reserved(index):
+                block_index, offset = divmod(index, BLOCK_SIZE)
+                offsets_by_block.setdefault(block_index, []).append(offset)
+        for block_index, offsets in offsets_by_block.items():
+            for attempt in range(MAX_ATTEMPTS):
+                block = self._get_block(block_index)
+                bitmap = self._read_bitmap(block)
+                taken = [offset for offset in offsets if bitmap & (1 << offset)]
+                if len(taken) == 0:
+                    break
+                for offset in taken:
+                    bitmap &= ~(1 << offset)
+                if self._write_block(block_index, block, bitmap, -len(taken)):
+                    break
+            else:
+                raise Exception(f"could not release addresses in {self.network} after {MAX_ATTEMPTS} attempts")
+
+    def release(self, client_ip):
+        print(f"release: Returning {client_ip} to {self.network}...")
+        address = ipaddress.ip_interface(client_ip).ip
+        if address not in self.network:
+            print(f"release: {client_ip} is not part of {self.network}, skipping")
+            return False
+        index = int(address) - int(self.network.network_address)
+        block_index, offset = divmod(index, BLOCK_SIZE)
+        if self._is_reserved(index):
+            return False
+        for attempt in range(MAX_ATTEMPTS):
+            block = self._get_block(block_index)
+            bitmap = self._read_bitmap(block)
+            if not bitmap & (1 << offset):
+                return False
+            if self._write_block(block_index, block, bitmap & ~(1 << offset), -1):
+                return True
+        raise Exception(f"could not release {client_ip} after {MAX_ATTEMPTS} attempts")
+
+    @staticmethod
+    def _read_bitmap(block):
+        # The resource API wraps binary attributes in boto3.dynamodb.types.Binary.
+        bitmap = block['Bitmap']
+        return int.from_bytes(bitmap.value if hasattr(bitmap, 'value') else bitmap, 'little')
+
+    def _is_reserved(self, index):
+        if index < self.reserved_count:
+            return True
+        # The IPv4 broadcast address is never handed out.
+        return self.network.version == 4 and self.network.num_addresses > 2 and index == self.network.num_addresses - 1
+
+    def _block_key(self, block_index):
+        return {'PK': self.pool_key, 'SK': f'BLOCK#{block_index:08d}'}
+
+    def _get_block(self, block_index, get_taken_ips=None):
+        item = self.table.get_item(Key=self._block_key(block_index), ConsistentRead=True).get('Item')
+        if item is not None:
+            return item
+        return self._create_block(block_index, get_taken_ips)
+
+    def _create_block(self, block_index, get_taken_ips=None):
+        first = block_index * BLOCK_SIZE
+        # Addresses past the end of the network and reserved addresses are marked as taken up front.
+        remaining = self.network.num_addresses - first
+        bitmap = 0 if remaining >= BLOCK_SIZE else ((1 << BLOCK_SIZE) - 1) ^ ((1 << remaining) - 1)
+        reserved = list(range(self.reserved_count)) + [self.network.num_addresses - 1]
+        for index in reserved:
+            if first <= index < first + BLOCK_SIZE and self._is_reserved(index):
+                bitmap |= 1 << (index - first)
+        # Clients that were added before the pool existed are marked as taken when their block is first created.
+        used = 0
+        for client_ip in (get_taken_ips() if get_taken_ips is not None else []):
+            address = ipaddress.ip_interface(client_ip).ip
+            if address.version != self.network.version or address not in self.network:
+                continue
+            offset = int(address) - int(self.network.network_address) - first
+            if 0 <= offset < BLOCK_SIZE and not bitmap & (1 << offset):
+                bitmap |= 1 << offset
+                used += 1
+        item = dict(self._block_key(block_index), Bitmap=bitmap.to_bytes(BLOCK_SIZE // 8, 'little'), Used=used, Version=0)
+        try:
+            self.table.put_item(Item=item, ConditionExpression='attribute_not_exists(PK)')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            # Another caller created the block first; use theirs.
+            return self.table.get_item(Key=self._block_key(block_index), ConsistentRead=True)['Item']
+        return item
+
+    def _write_block(self, block_index, block, bitmap, used_delta):
+        try:
+            self.table.update_item(
+                Key=self._block_key(block_index),
+                UpdateExpression='SET Bitmap = :bitmap, Used = Used + :delta, Version = Version + :one',
+                ConditionExpression='Version = :version',
+                ExpressionAttributeValues={
+                    ':bitmap': bitmap.to_bytes(BLOCK_SIZE // 8, 'little'),
+                    ':delta': used_delta,
+                    ':one': 1,
+                    ':version': block['Version'],
+                },
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            return False
+        return True
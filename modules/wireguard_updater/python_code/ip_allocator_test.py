@@ -0,0 +1,192 @@
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+import ip_allocator
+from ip_allocator import IpAllocator
+
+
+def conditional_check_failed():
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}}, 'UpdateItem')
+
+
+class FakeBlockTable:
+    # Just enough of a DynamoDB Table to exercise the allocator's conditional writes.
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+        self.get_item_calls = 0
+
+    def get_item(self, Key, ConsistentRead=False):
+        with self.lock:
+            self.get_item_calls += 1
+            item = self.items.get((Key['PK'], Key['SK']))
+            return {'Item': dict(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None):
+        with self.lock:
+            key = (Item['PK'], Item['SK'])
+            if key in self.items:
+                raise conditional_check_failed()
+            self.items[key] = dict(Item)
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues):
+        with self.lock:
+            item = self.items[(Key['PK'], Key['SK'])]
+            if item['Version'] != ExpressionAttributeValues[':version']:
+                raise conditional_check_failed()
+            item['Bitmap'] = ExpressionAttributeValues[':bitmap']
+            item['Used'] += ExpressionAttributeValues[':delta']
+            item['Version'] += 1
+
+
+class TestAllocate(unittest.TestCase):
+    def test_allocate_lowest_free_address(self):
+        allocator = IpAllocator(FakeBlockTable(), '192.168.2.0/24', reserved_count=5)
+
+        self.assertEqual(allocator.allocate(), '192.168.2.5/32')
+        self.assertEqual(allocator.allocate(), '192.168.2.6/32')
+
+    def test_allocate_skips_existing_clients(self):
+        allocator = IpAllocator(FakeBlockTable(), '192.168.2.0/24', reserved_count=5)
+
+        result = allocator.allocate(lambda: ['192.168.2.5/32', '192.168.2.6/32', '10.0.0.1/32'])
+
+        self.assertEqual(result, '192.168.2.7/32')
+
+    def test_allocate_exhausted_pool(self):
+        allocator = IpAllocator(FakeBlockTable(), '192.168.2.0/29', reserved_count=5)
+
+        # .5 and .6 are the only usable addresses; .7 is the broadcast address.
+        self.assertEqual(allocator.allocate(), '192.168.2.5/32')
+        self.assertEqual(allocator.allocate(), '192.168.2.6/32')
+        with self.assertRaises(Exception):
+            allocator.allocate()
+
+    def test_allocate_ipv6(self):
+        allocator = IpAllocator(FakeBlockTable(), 'fd00::/64', reserved_count=2)
+
+        self.assertEqual(allocator.allocate(), 'fd00::2/128')
+
+    def test_allocate_spans_blocks(self):
+        table = FakeBlockTable()
+        allocator = IpAllocator(table, '10.0.0.0/16', reserved_count=0)
+        # Fill the first block.
+        table.put_item(Item=dict(allocator._block_key(0), Bitmap=b'\xff' * (ip_allocator.BLOCK_SIZE // 8), Used=ip_allocator.BLOCK_SIZE, Version=0))
+
+        self.assertEqual(allocator.allocate(), '10.0.64.0/32')
+
+    def test_allocate_thousands_of_clients(self):
+        allocator = IpAllocator(FakeBlockTable(), '10.0.0.0/16', reserved_count=5)
+
+        allocated = [allocator.allocate() for _ in range(3000)]
+
+        self.assertEqual(len(set(allocated)), 3000)
+        self.assertEqual(allocated[-1], '10.0.11.188/32')
+
+    def test_allocate_concurrently_never_collides(self):
+        allocator = IpAllocator(FakeBlockTable(), '192.168.2.0/24', reserved_count=5)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            allocated = list(executor.map(lambda _: allocator.allocate(), range(40)))
+
+        self.assertEqual(len(set(allocated)), 40)
+
+    def test_allocate_retries_on_conflict(self):
+        table = FakeBlockTable()
+        allocator = IpAllocator(table, '192.168.2.0/24', reserved_count=5)
+        allocator.allocate()
+        original_update_item = table.update_item
+        calls = []
+
+        def update_item(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                # Another caller claims an address between our read and our write.
+                original_update_item(**dict(kwargs, ExpressionAttributeValues=dict(kwargs['ExpressionAttributeValues'])))
+                raise conditional_check_failed()
+            return original_update_item(**kwargs)
+
+        table.update_item = update_item
+
+        self.assertEqual(allocator.allocate(), '192.168.2.7/32')
+        self.assertEqual(len(calls), 2)
+
+    def test_allocate_gives_up_after_max_attempts(self):
+        table = FakeBlockTable()
+        allocator = IpAllocator(table, '10.0.0.0/16', reserved_count=5)
+        table.update_item = MagicMock(side_effect=conditional_check_failed())
+
+        with self.assertRaisesRegex(Exception, 'after 10 attempts'):
+            allocator.allocate()
+        # The allocator never moves on to the next block while the first one still has free addresses.
+        self.assertEqual(table.update_item.call_count, ip_allocator.MAX_ATTEMPTS)
+        self.assertEqual({key[1] for key in table.items}, {'BLOCK#00000000'})
+
+
+class TestRelease(unittest.TestCase):
+    def test_release_returns_address_to_pool(self):
+        allocator = IpAllocator(FakeBlockTable(), '192.168.2.0/24', reserved_count=5)
+        first = allocator.allocate()
+        allocator.allocate()
+
+        self.assertTrue(allocator.release(first))
+        self.assertFalse(allocator.release(first))
+        self.assertEqual(allocator.allocate(), first)
+
+    def test_release_outside_pool(self):
+        allocator = IpAllocator(FakeBlockTable(), '192.168.2.0/24', reserved_count=5)
+
+        self.assertFalse(allocator.release('10.0.0.1/32'))
+
+    def test_release_reserved_address(self):
+        allocator = IpAllocator(FakeBlockTable(), '192.168.2.0/24', reserved_count=5)
+
+        self.assertFalse(allocator.release('192.168.2.2/32'))
+
+
+class TestAllocateMany(unittest.TestCase):
+    def test_allocate_many_one_write_per_block(self):
+        table = FakeBlockTable()
+        allocator = IpAllocator(table, '10.0.0.0/16', reserved_count=5)
+        table.update_item = MagicMock(side_effect=table.update_item)
+
+        result = allocator.allocate_many(200, lambda: ['10.0.0.6/32'])
+
+        self.assertEqual(len(set(result)), 200)
+        self.assertEqual(result[:2], ['10.0.0.5/32', '10.0.0.7/32'])
+        self.assertEqual(table.update_item.call_count, 1)
+        self.assertEqual(allocator.allocate(), '10.0.0.206/32')
+
+    def test_allocate_many_spans_blocks(self):
+        allocator = IpAllocator(FakeBlockTable(), '10.0.0.0/16', reserved_count=0)
+        allocator.allocate_many(ip_allocator.BLOCK_SIZE - 1)
+
+        result = allocator.allocate_many(3)
+
+        self.assertEqual(result, ['10.0.63.255/32', '10.0.64.0/32', '10.0.64.1/32'])
+
+    def test_allocate_many_not_enough_addresses(self):
+        allocator = IpAllocator(FakeBlockTable(), '192.168.2.0/29', reserved_count=5)
+
+        with self.assertRaises(Exception):
+            allocator.allocate_many(3)
+        # Nothing is left claimed after a failed bulk claim.
+        self.assertEqual(allocator.allocate_many(2), ['192.168.2.5/32', '192.168.2.6/32'])
+
+    def test_release_many(self):
+        table = FakeBlockTable()
+        allocator = IpAllocator(table, '192.168.2.0/24', reserved_count=5)
+        allocated = allocator.allocate_many(10)
+        table.update_item = MagicMock(side_effect=table.update_item)
+
+        allocator.release_many(allocated[:5] + ['192.168.2.1/32', '10.0.0.1/32'])
+
+        self.assertEqual(table.update_item.call_count, 1)
+        self.assertEqual(allocator.allocate_many(5), allocated[:5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,51 +1,328 @@
-import os
-import helpers
+import tempfile
+import threading
 import time
-import json
+import uuid
+import zipfile
+import helpers
+import metrics
+
+
+def get_command_wait_timeout(context):
+    # Leave some of the invocation's remaining time for reporting once the servers have been checked.
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        return max(0, min(helpers.COMMAND_WAIT_TIMEOUT_SECONDS, context.get_remaining_time_in_millis() / 1000 - 10))
+    return helpers.COMMAND_WAIT_TIMEOUT_SECONDS
+
+
+def get_claim_seconds(context):
+    # A config claim lasts until the invocation would time out, so the claim of one that died can be taken over as
+    # soon as it can't be finishing any more.
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        return context.get_remaining_time_in_millis() / 1000
+    return helpers.CONFIG_CLAIM_TIMEOUT_SECONDS
+
+
+def update_environments(server_map, config_files_map, peer_changes, context):
+    # Applies the peer changes to the configs, stores the ones that changed and brings every server whose config
+    # isn't confirmed applied up to date. Everything is keyed by config target, see helpers.get_server_map. Returns
+    # the command state of every target and the targets whose config couldn't be stored. A server that fails to
+    # apply its config isn't a failure here: its config is stored, so it is retried on the environment's own schedule
+    # instead of replaying the records.
+    #
+    # Every environment is mutated and persisted on its own, so a slow parameter write only holds up its own
+    # environment. The servers are then sent a single command, and each environment's result is recorded as soon as
+    # its server reports back.
+    recorder = metrics.get_current()
+    with recorder.timer('Fetch'):
+        environment_states = helpers.forget_replaced_servers(
+            helpers.get_environment_states(list(config_files_map)), server_map
+        )
+    deferred_envs = helpers.get_deferred_environments(environment_states)
+    # Editing a config is pure CPU work, so environments take turns; running them at once wouldn't be any faster but
+    # would hold every parsed config in memory at the same time.
+    mutate_lock = threading.Lock()
+    sequences = {}
+    command_states = helpers.get_command_states(server_map, list(config_files_map))
+
+    def persist_environment(env):
+        config_file = config_files_map[env]
+        # Other invocations may store the same config at the same time, e.g. stream shards processed in parallel or a
+        # reconcile. A write that loses the race applies its peer changes again to the config the winner stored. One
+        # that finds the config claimed waits for the claim to be finished without using up an attempt, for up to half
+        # of the time left so the rest is enough to store the config and wait for its server.
+        attempt = 0
+        wait_until = time.time() + get_claim_seconds(context) / 2
+        while True:
+            with mutate_lock, recorder.timer('Mutate', env):
+                dirty_config_files_map = helpers.get_dirty_config_files({env: config_file}, peer_changes)
+                apply_config_files_map = helpers.get_config_files_to_apply(
+                    {env: config_file}, dirty_config_files_map, environment_states
+                )
+                # The server applies just these peer changes when it is up to date, instead of the whole config.
+                config_deltas = {k: helpers.get_config_delta(config_file, v) for k, v in dirty_config_files_map.items()}
+            read_hash = helpers.get_config_hash(config_file)
+            # A stored config whose delta was never published, e.g. because publishing failed after the write, gets an
+            # empty one, so its servers don't mistake the previous delta for the stored config.
+            published_hash = environment_states.get(env, {}).get('PublishedHash')
+            if env in apply_config_files_map and env not in config_deltas and published_hash != read_hash:
+                config_deltas[env] = []
+            if env not in config_deltas:
+                break
+            config_hash = helpers.get_config_hash(apply_config_files_map[env])
+            try:
+                sequence = helpers.claim_config_hash(env, read_hash, config_hash, get_claim_seconds(context))
+                break
+            except helpers.ConfigClaimedError as e:
+                delay = min(max(e.pending_until - time.time(), 0), helpers.CONFIG_CLAIM_POLL_SECONDS)
+                if time.time() + delay > wait_until:
+                    raise Exception(f"gave up waiting for another writer to store the {env} config")
+                print(f'persist_environment: {env} is being stored by another writer, waiting for it')
+            except helpers.ConfigConflictError:
+                attempt += 1
+                if attempt == helpers.CONFIG_WRITE_MAX_ATTEMPTS:
+                    raise Exception(f"gave up storing the {env} config after {attempt} conflicting writes")
+                print(f'persist_environment: {env} was changed by another writer, retrying against its config')
+                delay = helpers.get_conflict_delay(attempt - 1)
+            recorder.increment('ConfigConflicts', 1, 'Count', env)
+            time.sleep(delay)
+            # The other writer may have stored its config and published its delta since.
+            environment_states[env] = helpers.forget_replaced_servers(helpers.get_environment_states([env]), server_map)[env]
+            config_file = helpers.read_config_file(env)
+        peer_count, config_bytes = helpers.get_config_sizes({env: dirty_config_files_map.get(env, config_file)})[env]
+        recorder.put('PeerCount', peer_count, 'Count', env)
+        recorder.put('ConfigBytes', config_bytes, 'Bytes', env)
+        if env not in apply_config_files_map:
+            print(f'persist_environment: {env} is unchanged, skipping')
+            return None
+        config_str = apply_config_files_map[env]
+        config_hash = helpers.get_config_hash(config_str)
+        if 'Sequence' in environment_states.get(env, {}):
+            sequences[env] = environment_states[env]['Sequence']
+
+        if env in config_deltas:
+            with recorder.timer('Persist', env):
+                if env in dirty_config_files_map:
+                    _, update_failures = helpers.update_config_file_parameters(dirty_config_files_map)
+                    if env in update_failures:
+                        helpers.release_config_claim(env, read_hash, config_hash, sequence)
+                        raise update_failures[env]
+                # The delta is published before the claim is finished, so deltas go out in the order of their
+                # sequence numbers.
+                _, delta_failures = helpers.publish_config_deltas(
+                    config_deltas, {env: sequence}, {env: (read_hash, config_hash)}
+                )
+                helpers.complete_config_claim(env, sequence, None if env in delta_failures else config_hash)
+                if env in delta_failures:
+                    raise delta_failures[env]
+                sequences[env] = sequence
+
+        if env in deferred_envs:
+            print(f'persist_environment: {env} has a failing server, deferring until its retry time')
+            recorder.increment('EnvironmentsDeferred')
+            command_states[env]['status'] = 'Deferred'
+            return None
+        # Only the hash is kept so the configs can be freed while the other environments are still being persisted.
+        return config_hash
+
+    persisted, failures = helpers.run_for_each_environment(persist_environment, list(config_files_map))
+    config_hashes = {env: config_hash for env, config_hash in persisted.items() if config_hash is not None}
+    if len(config_hashes) == 0:
+        return command_states, failures
+
+    with recorder.timer('Send'):
+        instance_id_map, send_failures = helpers.send_commands({env: command_states[env] for env in config_hashes})
+    recorded = set()
+
+    def record_results(instances):
+        instances = {env: instance for env, instance in instances.items() if env not in recorded}
+        if len(instances) == 0:
+            return
+        recorded.update(instances)
+        command_states.update(instances)
+        applied_hashes = helpers.get_applied_config_hashes(instances, config_hashes, sequences)
+        if len(applied_hashes) > 0:
+            helpers.record_config_hashes(
+                applied_hashes, 'AppliedHash', {env: instances[env]['instance_id'] for env in applied_hashes}
+            )
+        # A command that succeeded but left the server at some other config, e.g. one stored since, didn't apply ours.
+        apply_results = {
+            env: env not in send_failures and instance['status'] == 'Success'
+            and applied_hashes.get(env) == config_hashes[env]
+            for env, instance in instances.items()
+        }
+        helpers.record_apply_results(environment_states, apply_results)
+        for env, succeeded in apply_results.items():
+            recorder.increment('EnvironmentsUpdated' if succeeded else 'EnvironmentsFailed')
+            if 'elapsed_seconds' in instances[env]:
+                recorder.put('ApplyTime', instances[env]['elapsed_seconds'] * 1000, 'Milliseconds', env)
+            print(f"update_environments: {env} {'applied' if succeeded else 'failed to apply'} its config ({instances[env]['status']})")
+
+    sent = {env: instance for env, instance in instance_id_map.items() if env not in send_failures}
+    if len(sent) > 0:
+        with recorder.timer('Wait'):
+            sent = helpers.check_status_of_commands(sent, get_command_wait_timeout(context), on_complete=record_results)
+        record_results(sent)
+    record_results({env: command_states[env] for env in send_failures})
+    return command_states, failures
+
+
+def record_propagation_latency(records, command_states):
+    # From the moment a record was written to the client table to the moment its server confirmed the change.
+    recorder = metrics.get_current()
+    oldest_record_times = helpers.get_oldest_record_times(records)
+    for target, state in command_states.items():
+        created_at = oldest_record_times.get(helpers.get_target_environment(target))
+        if created_at is not None and state.get('status') == 'Success' and state.get('completed_at') is not None:
+            recorder.put('PropagationLatency', max(0, state['completed_at'] - created_at) * 1000, 'Milliseconds', target)
 
 
 def handle_stream_updates(event, context):
-    print(event)
-    for record in event['Records']:
-        try:
-
-            environment_map = json.loads(os.getenv('ENVIRONMENT_MAP'))
-            environment_names_only = list(environment_map)
-            config_files_map = helpers.get_config_files(environment_names_only)
-            old_image = record['dynamodb'].get('OldImage', {})
-            new_image = record['dynamodb'].get('NewImage', {})
-
-            removed_envs, added_envs = helpers.compare_environments(old_image, new_image)
-            for r in removed_envs:
-                if r in config_files_map:
-                    config_files_map[r] = helpers.remove_peer_section(config_files_map[r], old_image)
-                else:
-                    print(f'Environment {r} not found in config_files_map')
-            for a in added_envs:
-                if a in config_files_map:
-                    config_files_map[a] = helpers.add_peer_section(config_files_map[a], new_image)
-                else:
-                    print(f'Environment {a} not found in config_files_map')
-
-            if len(removed_envs) == 0 and len(added_envs) == 0:
-                # This only happens when the environments haven't changed but the key has. This means it can't be a
-                # new client.
-                config_files_map = helpers.update_public_key(old_image, new_image, config_files_map)
-
-            helpers.update_config_file_parameters(config_files_map)
-            environment_map = helpers.send_commands(config_files_map, environment_map)
-            # Need to sleep here because there is a small delay in when a command can be found after execution
-            time.sleep(2)
-            environment_map = helpers.check_status_of_commands(environment_map)
-
-            failed_updates = [environment_map[k] for k, v in environment_map.items() if v["status"] != "Success"]
-            successful_updates = [environment_map[k] for k, v in environment_map.items() if v["status"] == "Success"]
-
-            print(f'\n\nThe following instance updates failed:\n{failed_updates}')
-            print(f'\n\nThe following instance updates succeeded:\n{successful_updates}')
-
-        except Exception as e:
-            raise e
+    recorder = metrics.start('handle_stream_updates')
+    records = event['Records']
+    print(f"handle_stream_updates: {helpers.summarize_records(records)}")
+    started = time.perf_counter()
+    try:
+        environment_map = helpers.get_environment_map()
+        server_map = helpers.get_server_map(environment_map)
+        # Fold the whole batch into one net change per environment so every config is read, written and applied once.
+        peer_changes, poison_records = helpers.coalesce_stream_records(records)
+        for env in peer_changes:
+            if env not in environment_map:
+                print(f'Environment {env} not found in the registry')
+        peer_changes = helpers.place_peer_changes(peer_changes, environment_map)
+
+        # Only targets whose peer set actually changes are read and written, and only configs the servers haven't
+        # confirmed applying are sent a command.
+        affected_targets = [target for target in server_map if len(peer_changes.get(target, {})) > 0]
+        with recorder.timer('Fetch'):
+            config_files_map, failures = helpers.get_config_files(affected_targets)
+        command_states, update_failures = update_environments(server_map, config_files_map, peer_changes, context)
+        failures.update(update_failures)
+        record_propagation_latency(records, command_states)
+
+        # Only the records touching an environment that failed are reported back and retried; the stream checkpoints
+        # the rest, so one bad environment or record doesn't replay the whole batch.
+        failed_records = helpers.get_failed_records(records, helpers.get_failed_environments(failures), poison_records)
+        if len(failed_records) > 0:
+            print(f"handle_stream_updates: {len(failed_records)} records failed: {', '.join(f'{k} ({v})' for k, v in failures.items())}")
+        recorder.increment('RecordsFailed', len(failed_records))
+        failed_ids = {id(r) for r in failed_records}
+        succeeded_records = [r for r in records if id(r) not in failed_ids]
+
+        helpers.materialize_client_configs(succeeded_records, environment_map)
+        # Removed clients' ips are only handed out again once their peers are gone from every server.
+        helpers.release_client_ips(succeeded_records)
+        helpers.sync_public_key_guards(succeeded_records)
+        # Anything else raises and fails the whole invocation, which makes the stream bisect the batch to isolate the
+        # record.
+        return helpers.get_batch_item_failures(failed_records)
+    finally:
+        recorder.increment('RecordsProcessed', len(records))
+        recorder.increment('BatchTime', (time.perf_counter() - started) * 1000, 'Milliseconds')
+        recorder.flush()
+
+
+def reconcile(event, context):
+    # Rebuilds every server's peer set from the client table and applies only what differs from the stored configs,
+    # so records the stream handler missed or failed on don't leave servers drifted for good. It also rebalances the
+    # environments whose servers changed: every peer the hash ring now places on another server is added there and
+    # removed from the server it was on, which only touches the peers that moved.
+    recorder = metrics.start('reconcile')
+    environment_map = helpers.get_environment_map()
+    server_map = helpers.get_server_map(environment_map)
+    print(f"reconcile: Reconciling {len(server_map)} servers in {len(environment_map)} environments...")
+    clients = helpers.scan_clients()
+    with recorder.timer('Fetch'):
+        config_files_map, failures = helpers.get_config_files(list(server_map))
+    desired_peers = {target: {} for target in server_map}
+    desired_peers.update(helpers.place_peer_changes(helpers.get_desired_peers(clients, environment_map), environment_map))
+    peer_changes = helpers.get_reconcile_changes(config_files_map, desired_peers)
+    for target, changes in peer_changes.items():
+        removed = len([k for k, v in changes.items() if v is None])
+        print(f'reconcile: {target} has drifted, {len(changes) - removed} peers to add or update and {removed} to remove')
+
+    command_states, update_failures = update_environments(server_map, config_files_map, peer_changes, context)
+    failures.update(update_failures)
+    # Clients whose peer was added to a server point their config at that server, which is what moves them over
+    # after a rebalance.
+    added_public_keys = {
+        public_key for target, changes in peer_changes.items() if target not in failures
+        for public_key, client_ip in changes.items() if client_ip is not None
+    }
+    moved_clients = {
+        c['ClientIP']['S']: c for c in clients
+        if c.get('PublicKey', {}).get('S', '') in added_public_keys and 'ClientIP' in c
+    }
+    helpers.write_client_configs(moved_clients, environment_map)
+    recorder.increment('DriftedEnvironments', len(peer_changes))
+    recorder.flush()
+    if len(failures) > 0:
+        raise Exception(f"failed to reconcile environments: {', '.join(f'{k} ({v})' for k, v in failures.items())}")
+    return {
+        'clients': len(clients),
+        'drifted_environments': sorted(peer_changes),
+        'updated_environments': sorted(k for k, v in command_states.items() if v.get('status') == 'Success'),
+        'rematerialized_clients': len(moved_clients),
+    }
+
+
+def revoke_clients(event, context):
+    # Takes clients' access away with one config edit and one apply per environment however many clients are revoked,
+    # and only then deletes them from the client table. The REMOVE records that produces find the peers already gone
+    # from the configs, so the stream handler only returns the clients' ips to the pool and drops their key guards.
+    recorder = metrics.start('revoke_clients')
+    started_at = time.time()
+    client_ips = list(event.get('client_ips', []))
+    missing = []
+    for public_key in event.get('public_keys', []):
+        client_ip = helpers.get_client_ip_by_public_key(public_key)
+        if client_ip is None:
+            missing.append(public_key)
+        else:
+            client_ips.append(client_ip)
+    clients = helpers.get_clients_from_dynamodb(client_ips)
+    missing.extend(client_ip for client_ip in dict.fromkeys(client_ips) if client_ip not in clients)
+
+    environment_map = helpers.get_environment_map()
+    server_map = helpers.get_server_map(environment_map)
+    peer_changes = helpers.place_peer_changes(helpers.get_revocation_changes(clients.values()), environment_map)
+    with recorder.timer('Fetch'):
+        config_files_map, failures = helpers.get_config_files([target for target in server_map if target in peer_changes])
+    command_states, update_failures = update_environments(server_map, config_files_map, peer_changes, context)
+    failures.update(update_failures)
+
+    # A client stays in the table while any of its environments still has its peer, otherwise reconcile would bring
+    # the peer back everywhere else.
+    failed_envs = helpers.get_failed_environments(failures)
+    failed = {k: v for k, v in clients.items() if len(set(v.get('Environments', [])) & set(failed_envs)) > 0}
+    revoked = [k for k in clients if k not in failed]
+    helpers.delete_items_from_dynamodb(revoked)
+
+    enforced = {}
+    for env in config_files_map:
+        if command_states[env].get('status') == 'Success' and 'completed_at' in command_states[env]:
+            enforced[env] = round(command_states[env]['completed_at'] - started_at, 3)
+            recorder.put('RevocationLatency', enforced[env] * 1000, 'Milliseconds', env)
+    recorder.increment('ClientsRevoked', len(revoked))
+    recorder.flush()
+    return {
+        'revoked': revoked,
+        'missing': missing,
+        'failed': {k: f"could not update {', '.join(sorted(set(v.get('Environments', [])) & set(failed_envs)))}" for k, v in failed.items()},
+        # Seconds from the request to each server confirming the revocation. Servers missing here have the new config
+        # stored and pick it up on their next successful apply.
+        'enforced_seconds': enforced,
+        'pending_environments': sorted(
+            env for env in config_files_map if command_states[env].get('status') not in ('', 'Success') and env not in failures
+        ),
+    }
+
+
+def remove_client(event, context):
+    # Revokes a single client by its client ip or public key.
+    if 'client_ip' in event:
+        return revoke_clients({'client_ips': [event['client_ip']]}, context)
+    return revoke_clients({'public_keys': [event['public_key']]}, context)
 
 
 def add_new_client(event, context):
@@ -53,35 +330,177 @@ def add_new_client(event, context):
     public_key_exists = helpers.does_public_key_exist_already(event['public_key'])
     if public_key_exists:
         return "Public Key already exists. Please update your Client instead of adding a new one."
-    taken_client_ips = helpers.get_all_taken_client_ips()
-    client_ip = helpers.get_available_ip(taken_client_ips)
-    helpers.add_item_to_dynamodb(client_ip, event['public_key'], event['environments'])
+    client_ip = helpers.get_available_ip()
+    try:
+        helpers.add_item_to_dynamodb(client_ip, event['public_key'], event['environments'])
+    except helpers.PublicKeyExistsError:
+        helpers.get_ip_allocator().release(client_ip)
+        return "Public Key already exists. Please update your Client instead of adding a new one."
+    except Exception:
+        helpers.get_ip_allocator().release(client_ip)
+        raise
     return get_client_config_file({'client_ip': client_ip}, {})
 
 
+def add_new_clients(event, context):
+    # Onboards many clients at once: keys are validated up front, addresses are claimed in one pass and the clients
+    # are written through a batch writer, so the stream handler sees them in a few batches instead of one by one.
+    environment_map = helpers.get_environment_map()
+    rejected = []
+    clients = []
+    seen_public_keys = set()
+    for client in event['clients']:
+        public_key = client.get('public_key', '')
+        environments = client.get('environments', [])
+        unknown_envs = [env for env in environments if env not in environment_map]
+        if not helpers.is_valid_public_key(public_key):
+            rejected.append({'public_key': public_key, 'reason': 'not a valid WireGuard public key'})
+        elif public_key in seen_public_keys:
+            rejected.append({'public_key': public_key, 'reason': 'duplicate public key in this request'})
+        elif len(unknown_envs) > 0:
+            rejected.append({'public_key': public_key, 'reason': f'unknown environments {unknown_envs}'})
+        elif helpers.does_public_key_exist_already(public_key):
+            rejected.append({'public_key': public_key, 'reason': 'public key already exists'})
+        else:
+            seen_public_keys.add(public_key)
+            clients.append({'public_key': public_key, 'environments': environments})
+    if len(clients) == 0:
+        return {'added': [], 'rejected': rejected}
+
+    client_ips = helpers.get_ip_allocator().allocate_many(len(clients), helpers.get_all_taken_client_ips)
+    for client, client_ip in zip(clients, client_ips):
+        client['client_ip'] = client_ip
+    try:
+        taken = helpers.claim_public_key_guards({c['public_key']: c['client_ip'] for c in clients})
+    except Exception:
+        helpers.get_ip_allocator().release_many(client_ips)
+        raise
+    if len(taken) > 0:
+        # Keys claimed by a concurrent add since they were checked.
+        rejected.extend({'public_key': k, 'reason': 'public key already exists'} for k in taken)
+        helpers.get_ip_allocator().release_many([c['client_ip'] for c in clients if c['public_key'] in taken])
+        clients = [c for c in clients if c['public_key'] not in taken]
+    helpers.add_items_to_dynamodb(clients)
+    return {'added': clients, 'rejected': rejected}
+
+
+def load_client_config(client_ip, item):
+    # Returns the client's config, etag and version from its pre-rendered config item, or renders it when there is
+    # no item yet. The config is rendered again against the registry either way, which is cheap next to the read the
+    # item saves: a server that got a new endpoint or public key since the item was written leaves it out of date,
+    # so it is stored again and pollers see its etag and version move.
+    if item is not None and 'PublicKey' in item:
+        public_key, environments = item['PublicKey'], item['Environments']
+    else:
+        # Clients that were only just added may not have been rendered by the stream handler yet, and older items
+        # don't keep the client's key and environments.
+        client_item = helpers.get_client_from_dynamodb(client_ip)
+        public_key, environments = client_item.get('PublicKey', ''), list(client_item.get('Environments') or [])
+    environment_map = helpers.get_environment_map()
+    config_file = helpers.render_client_config(client_ip, public_key, environments, environment_map)
+    etag = helpers.get_config_hash(config_file)
+    if item is None:
+        return config_file, etag, 0
+    if item['ETag'] == etag and 'PublicKey' in item:
+        return item['Config'], item['ETag'], int(item['Version'])
+    print(f'load_client_config: The stored config of {client_ip} is out of date, storing it again')
+    image = helpers.serialize_item({'PublicKey': public_key, 'Environments': environments})
+    helpers.write_client_configs({client_ip: image}, environment_map)
+    # The write bumps the version, unless someone else stored the same config first and bumped it already.
+    return config_file, etag, int(item['Version']) + 1
+
+
 def get_client_config_file(event, context):
     client_ip = event['client_ip']
-    config_file = f'''\
-[Interface]
-PrivateKey = ReplaceWithYourPrivateKey
-Address = {client_ip}
-    '''
-
-    environment_map = json.loads(os.getenv('ENVIRONMENT_MAP'))
-
-    client_item = helpers.get_client_from_dynamodb(client_ip)
-    for env in client_item.get('Environments'):
-        config_file += f'''\
-    
-[Peer]
-PublicKey = {environment_map[env]['public_key']}
-AllowedIPs = {environment_map[env]['vpc_cidr']}
-Endpoint = {environment_map[env]['wireguard_endpoint']}
-PersistentKeepalive = 90
-        '''
-    print(config_file)
+    try:
+        # The stream handler keeps a pre-rendered config per client, so this is normally a single keyed read.
+        config_file, etag, version = load_client_config(client_ip, helpers.get_materialized_client_config(client_ip))
+    except helpers.ClientNotFoundError:
+        return f"No client with client ip {client_ip} was found."
+
+    # Pollers send back the etag they already have and only get the config again when it changed.
+    if 'if_none_match' in event:
+        response = {'client_ip': client_ip, 'etag': etag, 'version': version, 'not_modified': event['if_none_match'] == etag}
+        if not response['not_modified']:
+            response['config_file'] = config_file
+        return response
+    print(f'get_client_config_file: Returning the config of {client_ip} ({len(config_file)} bytes, etag {etag})')
     return config_file
 
 
+def collect_peer_liveness(event, context):
+    # Gathers every server's peer handshakes and byte counters, keeps them per environment, and takes away the peers
+    # that haven't had a handshake for PEER_EXPIRY_DAYS. Expired peers go through the same update path as revocations,
+    # and the clients then lose the expired environments in the client table, or are deleted when none are left, so
+    # reconcile doesn't bring the peers back. With dry_run the idle peers are only reported.
+    recorder = metrics.start('collect_peer_liveness')
+    dry_run = event.get('dry_run', False)
+    max_idle_seconds = int(event.get('expiry_days', helpers.PEER_EXPIRY_DAYS)) * 86400
+    environment_map = helpers.get_environment_map()
+    server_map = helpers.get_server_map(environment_map)
+    with recorder.timer('Collect'):
+        dumps, failures = helpers.collect_peer_dumps(server_map, get_command_wait_timeout(context))
+    now = int(time.time())
+    liveness, liveness_failures = helpers.update_peer_liveness(dumps, now)
+    failures.update(liveness_failures)
+    for env, peers in liveness.items():
+        recorder.put('PeersCollected', len(peers), 'Count', env)
+
+    report = {'collected': sorted(liveness), 'expired_peers': {}, 'reclaimed_bytes': {}, 'updated_clients': [], 'deleted_clients': []}
+    if max_idle_seconds > 0:
+        clients = helpers.scan_clients()
+        peer_changes, expirations = helpers.get_expiry_changes(clients, liveness, now, max_idle_seconds)
+        for env in peer_changes:
+            report['expired_peers'][env] = len(peer_changes[env])
+            report['reclaimed_bytes'][env] = sum(
+                helpers.get_peer_section_size(expiration['public_key'], client_ip)
+                for client_ip, expiration in expirations.items() if env in expiration['expired']
+            )
+        print(f"collect_peer_liveness: {sum(report['expired_peers'].values())} idle peers in {len(peer_changes)} environments")
+        if not dry_run and len(peer_changes) > 0:
+            placed_changes = helpers.place_peer_changes(peer_changes, environment_map)
+            with recorder.timer('Fetch'):
+                config_files_map, fetch_failures = helpers.get_config_files([t for t in server_map if t in placed_changes])
+            failures.update(fetch_failures)
+            _, update_failures = update_environments(server_map, config_files_map, placed_changes, context)
+            failures.update(update_failures)
+            failed_envs = helpers.get_failed_environments(failures)
+            report['updated_clients'], report['deleted_clients'], _ = helpers.expire_client_environments(expirations, failed_envs)
+            # Environments whose config couldn't be stored keep their peers until the next run.
+            for env in [env for env in peer_changes if env in failed_envs]:
+                report['expired_peers'].pop(env)
+                report['reclaimed_bytes'].pop(env)
+            for env, count in report['expired_peers'].items():
+                recorder.increment('PeersExpired', count, 'Count', env)
+                recorder.increment('ReclaimedBytes', report['reclaimed_bytes'][env], 'Bytes', env)
+    recorder.flush()
+    report['dry_run'] = dry_run
+    report['failed'] = {env: str(e) for env, e in failures.items()}
+    return report
+
+
+def export_client_configs(event, context):
+    # Exports the configs of the given clients, or of every client, as one zip archive behind a presigned url. The
+    # archive is written to disk a chunk of clients at a time so memory doesn't grow with the number of clients.
+    client_ips = event.get('client_ips') or [c['ClientIP']['S'] for c in helpers.scan_clients()]
+    missing = []
+    with tempfile.TemporaryFile() as archive:
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for i in range(0, len(client_ips), 100):
+                chunk = client_ips[i:i + 100]
+                items = helpers.get_materialized_client_configs(chunk)
+                for client_ip in chunk:
+                    try:
+                        config_file, _, _ = load_client_config(client_ip, items.get(client_ip))
+                    except helpers.ClientNotFoundError:
+                        missing.append(client_ip)
+                        continue
+                    zip_file.writestr(f"{client_ip.split('/')[0].replace(':', '-')}.conf", config_file)
+        archive.seek(0)
+        key = f"exports/client-configs-{uuid.uuid4()}.zip"
+        url = helpers.upload_client_config_archive(archive, key)
+    return {'exported': len(client_ips) - len(missing), 'missing': missing, 'key': key, 'url': url}
+
+
 if __name__ == '__main__':
     handle_stream_updates({}, {})
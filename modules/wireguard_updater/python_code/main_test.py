@@ -0,0 +1,708 @@
+import base64
+import copy
+import json
+import threading
+import time
+import unittest
+import zipfile
+import helpers
+import main
+from unittest.mock import MagicMock, patch
+
+
+ENVIRONMENT_MAP = {
+    'dev': {'public_key': 'dev_server_key', 'vpc_cidr': '10.50.0.0/16', 'wireguard_endpoint': '203.0.113.10:64731', 'instance_id': 'i-1'},
+}
+
+
+@patch('helpers.get_environment_map', return_value=ENVIRONMENT_MAP)
+class TestGetClientConfigFile(unittest.TestCase):
+    CONFIG = helpers.render_client_config('192.168.2.5/32', 'key1', ['dev'], ENVIRONMENT_MAP)
+    ITEM = {'Config': CONFIG, 'ETag': helpers.get_config_hash(CONFIG), 'PublicKey': 'key1', 'Environments': ['dev'], 'Version': 3}
+
+    @patch('helpers.write_client_configs')
+    @patch('helpers.get_client_from_dynamodb')
+    @patch('helpers.get_materialized_client_config', return_value=ITEM)
+    def test_get_client_config_file_materialized(self, mock_get_materialized_client_config, mock_get_client_from_dynamodb, mock_write_client_configs, mock_get_environment_map):
+        result = main.get_client_config_file({'client_ip': '192.168.2.5/32'}, {})
+
+        self.assertEqual(result, self.CONFIG)
+        mock_get_client_from_dynamodb.assert_not_called()
+        mock_write_client_configs.assert_not_called()
+
+    @patch('helpers.write_client_configs')
+    @patch('helpers.get_materialized_client_config', return_value=ITEM)
+    def test_get_client_config_file_server_changed(self, mock_get_materialized_client_config, mock_write_client_configs, mock_get_environment_map):
+        # The server got a new endpoint since the config was stored, which no client record brought along.
+        environment_map = {'dev': dict(ENVIRONMENT_MAP['dev'], wireguard_endpoint='203.0.113.20:64731')}
+        mock_get_environment_map.return_value = environment_map
+
+        result = main.get_client_config_file({'client_ip': '192.168.2.5/32', 'if_none_match': self.ITEM['ETag']}, {})
+
+        config = helpers.render_client_config('192.168.2.5/32', 'key1', ['dev'], environment_map)
+        self.assertEqual(result, {'client_ip': '192.168.2.5/32', 'etag': helpers.get_config_hash(config), 'version': 4, 'not_modified': False, 'config_file': config})
+        mock_write_client_configs.assert_called_once_with(
+            {'192.168.2.5/32': {'PublicKey': {'S': 'key1'}, 'Environments': {'L': [{'S': 'dev'}]}}}, environment_map
+        )
+
+    @patch('helpers.write_client_configs')
+    @patch('helpers.get_client_from_dynamodb')
+    @patch('helpers.get_materialized_client_config')
+    def test_get_client_config_file_older_item(self, mock_get_materialized_client_config, mock_get_client_from_dynamodb, mock_write_client_configs, mock_get_environment_map):
+        # Items stored before the client's key and environments were kept with the config.
+        mock_get_materialized_client_config.return_value = {'Config': self.CONFIG, 'ETag': self.ITEM['ETag'], 'Version': 3}
+        mock_get_client_from_dynamodb.return_value = {'ClientIP': '192.168.2.5/32', 'PublicKey': 'key1', 'Environments': ['dev']}
+
+        result = main.get_client_config_file({'client_ip': '192.168.2.5/32'}, {})
+
+        self.assertEqual(result, self.CONFIG)
+        mock_write_client_configs.assert_called_once()
+
+    @patch('helpers.get_client_from_dynamodb')
+    @patch('helpers.get_materialized_client_config', return_value=None)
+    def test_get_client_config_file_not_materialized_yet(self, mock_get_materialized_client_config, mock_get_client_from_dynamodb, mock_get_environment_map):
+        mock_get_client_from_dynamodb.return_value = {'ClientIP': '192.168.2.5/32', 'PublicKey': 'key1', 'Environments': ['dev']}
+
+        result = main.get_client_config_file({'client_ip': '192.168.2.5/32'}, {})
+
+        self.assertEqual(result, helpers.render_client_config('192.168.2.5/32', 'key1', ['dev'], ENVIRONMENT_MAP))
+
+    @patch('helpers.get_client_from_dynamodb', side_effect=helpers.ClientNotFoundError("missing"))
+    @patch('helpers.get_materialized_client_config', return_value=None)
+    def test_get_client_config_file_missing_client(self, mock_get_materialized_client_config, mock_get_client_from_dynamodb, mock_get_environment_map):
+        result = main.get_client_config_file({'client_ip': '192.168.2.5/32'}, {})
+
+        self.assertEqual(result, "No client with client ip 192.168.2.5/32 was found.")
+
+    @patch('helpers.get_materialized_client_config', return_value=ITEM)
+    def test_get_client_config_file_not_modified(self, mock_get_materialized_client_config, mock_get_environment_map):
+        result = main.get_client_config_file({'client_ip': '192.168.2.5/32', 'if_none_match': self.ITEM['ETag']}, {})
+
+        self.assertEqual(result, {'client_ip': '192.168.2.5/32', 'etag': self.ITEM['ETag'], 'version': 3, 'not_modified': True})
+
+    @patch('helpers.get_materialized_client_config', return_value=ITEM)
+    def test_get_client_config_file_modified(self, mock_get_materialized_client_config, mock_get_environment_map):
+        result = main.get_client_config_file({'client_ip': '192.168.2.5/32', 'if_none_match': 'etag1'}, {})
+
+        self.assertEqual(result, {'client_ip': '192.168.2.5/32', 'etag': self.ITEM['ETag'], 'version': 3, 'not_modified': False, 'config_file': self.CONFIG})
+
+
+@patch('helpers.get_environment_map', return_value=ENVIRONMENT_MAP)
+@patch('helpers.complete_config_claim')
+@patch('helpers.claim_config_hash', return_value=4)
+@patch('helpers.sync_public_key_guards')
+@patch('helpers.release_client_ips')
+@patch('helpers.materialize_client_configs')
+@patch('helpers.record_config_hashes')
+@patch('helpers.check_status_of_commands')
+@patch('helpers.send_commands')
+@patch('helpers.update_config_file_parameters')
+@patch('helpers.get_environment_states')
+@patch('helpers.get_config_files')
+class TestHandleStreamUpdates(unittest.TestCase):
+    EVENT = {'Records': [{'eventName': 'INSERT', 'dynamodb': {'NewImage': {
+        'ClientIP': {'S': '192.168.2.5/32'}, 'PublicKey': {'S': 'client_key'}, 'Environments': {'L': [{'S': 'dev'}]}
+    }}}]}
+    APPLIED_CONFIG = '[Interface]\nAddress = 192.168.2.1/32\n\n[Peer]\nPublicKey = client_key\nAllowedIPs = 192.168.2.5/32'
+
+    def test_handle_stream_updates_reapplies_unconfirmed_config(self, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        # Arrange: a retried batch whose config was already written but never confirmed by the server.
+        mock_get_config_files.return_value = ({'dev': self.APPLIED_CONFIG}, {})
+        mock_get_environment_states.return_value = {'dev': {'DesiredHash': helpers.get_config_hash(self.APPLIED_CONFIG), 'PublishedHash': helpers.get_config_hash(self.APPLIED_CONFIG)}}
+        mock_send_commands.return_value = (ENVIRONMENT_MAP, {})
+        mock_check_status_of_commands.return_value = {'dev': dict(ENVIRONMENT_MAP['dev'], status='Success', applied_hash='hash1')}
+
+        # Act
+        main.handle_stream_updates(self.EVENT, {})
+
+        # Assert
+        mock_update_config_file_parameters.assert_not_called()
+        mock_send_commands.assert_called_once_with({'dev': {'instance_id': 'i-1', 'command_id': '', 'status': ''}})
+        mock_record_config_hashes.assert_called_once_with({'dev': 'hash1'}, 'AppliedHash', {'dev': 'i-1'})
+        # The registry's metadata is shared, the command state lives apart from it.
+        self.assertNotIn('status', ENVIRONMENT_MAP['dev'])
+
+    @patch('helpers.publish_config_deltas')
+    def test_handle_stream_updates_publishes_delta(self, mock_publish_config_deltas, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        # Arrange: the new client's peer isn't in the config yet.
+        seed_config = '[Interface]\nAddress = 192.168.2.1/32'
+        mock_get_config_files.return_value = ({'dev': seed_config}, {})
+        mock_get_environment_states.return_value = {'dev': {'Sequence': 3}}
+        mock_update_config_file_parameters.return_value = ({'dev': 2}, {})
+        mock_publish_config_deltas.return_value = ({'dev': 4}, {})
+        mock_send_commands.return_value = (ENVIRONMENT_MAP, {})
+        mock_check_status_of_commands.return_value = {'dev': dict(ENVIRONMENT_MAP['dev'], status='Success', applied_sequence='4')}
+
+        # Act
+        main.handle_stream_updates(self.EVENT, {})
+
+        # Assert
+        mock_publish_config_deltas.assert_called_once_with(
+            {'dev': ['add client_key 192.168.2.5/32']}, {'dev': 4},
+            {'dev': (helpers.get_config_hash(seed_config), helpers.get_config_hash(self.APPLIED_CONFIG))}
+        )
+        mock_record_config_hashes.assert_called_with({'dev': helpers.get_config_hash(self.APPLIED_CONFIG)}, 'AppliedHash', {'dev': 'i-1'})
+
+    @patch('builtins.print')
+    def test_handle_stream_updates_emits_metrics(self, mock_print, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        event = {'Records': [dict(self.EVENT['Records'][0], dynamodb=dict(self.EVENT['Records'][0]['dynamodb'], ApproximateCreationDateTime=1700000000))]}
+        mock_get_config_files.return_value = ({'dev': self.APPLIED_CONFIG}, {})
+        mock_get_environment_states.return_value = {'dev': {'DesiredHash': helpers.get_config_hash(self.APPLIED_CONFIG), 'PublishedHash': helpers.get_config_hash(self.APPLIED_CONFIG)}}
+        mock_send_commands.return_value = (ENVIRONMENT_MAP, {})
+        mock_check_status_of_commands.return_value = {'dev': dict(ENVIRONMENT_MAP['dev'], status='Success', applied_hash=helpers.get_config_hash(self.APPLIED_CONFIG), completed_at=1700000001.5)}
+
+        main.handle_stream_updates(event, {})
+
+        logged = [c.args[0] for c in mock_print.call_args_list if c.args]
+        self.assertFalse(any('client_key' in str(line) for line in logged))
+        documents = [json.loads(line) for line in logged if isinstance(line, str) and line.startswith('{"_aws"')]
+        [environment_document] = [d for d in documents if d.get('Environment') == 'dev']
+        self.assertEqual(environment_document['PropagationLatency'], 1500)
+        self.assertEqual(environment_document['PeerCount'], 1)
+        self.assertIn('MutateTime', environment_document)
+        [function_document] = [d for d in documents if 'Environment' not in d]
+        self.assertEqual(function_document['RecordsProcessed'], 1)
+        self.assertEqual(function_document['EnvironmentsUpdated'], 1)
+        for phase in ['Fetch', 'Send', 'Wait']:
+            self.assertIn(f'{phase}Time', function_document)
+
+    @patch('helpers.publish_config_deltas')
+    def test_handle_stream_updates_reports_failed_records(self, mock_publish_config_deltas, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, mock_materialize_client_configs, mock_release_client_ips, *mocks):
+        # Arrange: the config can't be stored, and the second record is missing its public key.
+        poison_record = {'eventName': 'MODIFY', 'dynamodb': {'SequenceNumber': '200', 'NewImage': {'ClientIP': {'S': '192.168.2.6/32'}}}}
+        record = dict(self.EVENT['Records'][0], dynamodb=dict(self.EVENT['Records'][0]['dynamodb'], SequenceNumber='100'))
+        mock_get_config_files.return_value = ({'dev': '[Interface]\nAddress = 192.168.2.1/32'}, {})
+        mock_get_environment_states.return_value = {'dev': {}}
+        mock_update_config_file_parameters.return_value = ({}, {'dev': Exception('throttled')})
+        mock_publish_config_deltas.return_value = ({}, {})
+
+        # Act
+        result = main.handle_stream_updates({'Records': [record, poison_record]}, {})
+
+        # Assert
+        self.assertEqual(result, {'batchItemFailures': [{'itemIdentifier': '100'}, {'itemIdentifier': '200'}]})
+        mock_send_commands.assert_not_called()
+        mock_release_client_ips.assert_called_once_with([])
+
+    @patch('helpers.record_apply_results')
+    @patch('helpers.publish_config_deltas')
+    def test_handle_stream_updates_defers_failing_server(self, mock_publish_config_deltas, mock_record_apply_results, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        # Arrange: the server failed recently, so the new config is stored but not sent.
+        mock_get_config_files.return_value = ({'dev': '[Interface]\nAddress = 192.168.2.1/32'}, {})
+        mock_get_environment_states.return_value = {'dev': {'FailureCount': 2, 'RetryAfter': 2 ** 40}}
+        mock_update_config_file_parameters.return_value = ({'dev': 2}, {})
+        mock_publish_config_deltas.return_value = ({'dev': 4}, {})
+
+        # Act
+        result = main.handle_stream_updates(self.EVENT, {})
+
+        # Assert
+        self.assertEqual(result, {'batchItemFailures': []})
+        mock_update_config_file_parameters.assert_called_once()
+        mock_send_commands.assert_not_called()
+        mock_record_apply_results.assert_not_called()
+
+    @patch('helpers.record_apply_results')
+    def test_handle_stream_updates_records_failed_apply(self, mock_record_apply_results, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        # Arrange: the config is stored but the server doesn't apply it; the record still succeeds.
+        mock_get_config_files.return_value = ({'dev': self.APPLIED_CONFIG}, {})
+        mock_get_environment_states.return_value = {'dev': {'DesiredHash': helpers.get_config_hash(self.APPLIED_CONFIG), 'PublishedHash': helpers.get_config_hash(self.APPLIED_CONFIG)}}
+        mock_send_commands.return_value = (ENVIRONMENT_MAP, {})
+        mock_check_status_of_commands.return_value = {'dev': dict(ENVIRONMENT_MAP['dev'], status='TimedOut')}
+
+        # Act
+        result = main.handle_stream_updates(self.EVENT, {})
+
+        # Assert
+        self.assertEqual(result, {'batchItemFailures': []})
+        mock_record_apply_results.assert_called_once_with(mock_get_environment_states.return_value, {'dev': False})
+
+    @patch('helpers.record_apply_results')
+    def test_handle_stream_updates_needs_the_expected_hash(self, mock_record_apply_results, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        # Arrange: the command succeeds, but the server is left at some other config.
+        applied_hash = helpers.get_config_hash(self.APPLIED_CONFIG)
+        mock_get_config_files.return_value = ({'dev': self.APPLIED_CONFIG}, {})
+        mock_get_environment_states.return_value = {'dev': {'DesiredHash': applied_hash, 'PublishedHash': applied_hash}}
+        mock_send_commands.return_value = (ENVIRONMENT_MAP, {})
+        mock_check_status_of_commands.return_value = {'dev': dict(ENVIRONMENT_MAP['dev'], status='Success', applied_hash='other_hash')}
+
+        # Act
+        main.handle_stream_updates(self.EVENT, {})
+
+        # Assert
+        mock_record_config_hashes.assert_called_once_with({'dev': 'other_hash'}, 'AppliedHash', {'dev': 'i-1'})
+        mock_record_apply_results.assert_called_once_with(mock_get_environment_states.return_value, {'dev': False})
+
+    @patch('helpers.publish_config_deltas')
+    def test_handle_stream_updates_republishes_missing_delta(self, mock_publish_config_deltas, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        # Arrange: the config was stored by a retried batch whose delta couldn't be published.
+        applied_hash = helpers.get_config_hash(self.APPLIED_CONFIG)
+        mock_get_config_files.return_value = ({'dev': self.APPLIED_CONFIG}, {})
+        mock_get_environment_states.return_value = {'dev': {'DesiredHash': applied_hash, 'PublishedHash': 'previous_hash'}}
+        mock_publish_config_deltas.return_value = ({'dev': 4}, {})
+        mock_send_commands.return_value = (ENVIRONMENT_MAP, {})
+        mock_check_status_of_commands.return_value = {'dev': dict(ENVIRONMENT_MAP['dev'], status='Success', applied_hash=applied_hash)}
+
+        # Act
+        main.handle_stream_updates(self.EVENT, {})
+
+        # Assert: the config isn't stored again, but an empty delta for it is published before it is applied.
+        mock_update_config_file_parameters.assert_not_called()
+        mock_publish_config_deltas.assert_called_once_with({'dev': []}, {'dev': 4}, {'dev': (applied_hash, applied_hash)})
+        mock_send_commands.assert_called_once()
+
+    def test_handle_stream_updates_skips_applied_config(self, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        mock_get_config_files.return_value = ({'dev': self.APPLIED_CONFIG}, {})
+        mock_get_environment_states.return_value = {'dev': {'AppliedHash': helpers.get_config_hash(self.APPLIED_CONFIG)}}
+
+        main.handle_stream_updates(self.EVENT, {})
+
+        mock_update_config_file_parameters.assert_not_called()
+        mock_send_commands.assert_not_called()
+        mock_record_config_hashes.assert_not_called()
+
+    def test_handle_stream_updates_resends_to_a_replaced_server(self, mock_get_config_files, mock_get_environment_states, mock_update_config_file_parameters, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, *mocks):
+        # The config was applied by a server the registry has replaced since, without this container seeing it happen.
+        mock_get_config_files.return_value = ({'dev': self.APPLIED_CONFIG}, {})
+        applied_hash = helpers.get_config_hash(self.APPLIED_CONFIG)
+        mock_get_environment_states.return_value = {'dev': {'AppliedHash': applied_hash, 'AppliedInstanceId': 'i-old', 'PublishedHash': applied_hash}}
+        mock_send_commands.return_value = (ENVIRONMENT_MAP, {})
+        mock_check_status_of_commands.return_value = {'dev': dict(ENVIRONMENT_MAP['dev'], status='Success', applied_hash=applied_hash)}
+
+        main.handle_stream_updates(self.EVENT, {})
+
+        mock_update_config_file_parameters.assert_not_called()
+        mock_send_commands.assert_called_once_with({'dev': {'instance_id': 'i-1', 'command_id': '', 'status': ''}})
+        mock_record_config_hashes.assert_called_once_with({'dev': applied_hash}, 'AppliedHash', {'dev': 'i-1'})
+
+
+@patch('helpers.get_environment_map', return_value=ENVIRONMENT_MAP)
+@patch('helpers.write_client_configs')
+@patch('main.update_environments')
+@patch('helpers.get_config_files')
+@patch('helpers.scan_clients')
+class TestReconcile(unittest.TestCase):
+    def test_reconcile_applies_only_the_drift(self, mock_scan_clients, mock_get_config_files, mock_update_environments, mock_write_client_configs, mock_get_environment_map):
+        # Arrange: the stream handler never removed a deleted client and never added a new one.
+        mock_scan_clients.return_value = [
+            {'ClientIP': {'S': '192.168.2.5/32'}, 'PublicKey': {'S': 'key1'}, 'Environments': {'L': [{'S': 'dev'}]}},
+            {'ClientIP': {'S': '192.168.2.6/32'}, 'PublicKey': {'S': 'key2'}, 'Environments': {'L': [{'S': 'dev'}]}},
+        ]
+        config_files_map = {'dev': '[Interface]\nAddress = 192.168.2.1/32\n\n[Peer]\nPublicKey = key1\nAllowedIPs = 192.168.2.5/32\n\n[Peer]\nPublicKey = deleted\nAllowedIPs = 192.168.2.7/32'}
+        mock_get_config_files.return_value = (config_files_map, {})
+        mock_update_environments.return_value = ({'dev': dict(ENVIRONMENT_MAP['dev'], status='Success')}, {})
+
+        # Act
+        result = main.reconcile({}, {})
+
+        # Assert
+        mock_update_environments.assert_called_once_with(ENVIRONMENT_MAP, config_files_map, {'dev': {'deleted': None, 'key2': '192.168.2.6/32'}}, {})
+        self.assertEqual(result, {'clients': 2, 'drifted_environments': ['dev'], 'updated_environments': ['dev'], 'rematerialized_clients': 1})
+        mock_write_client_configs.assert_called_once_with({'192.168.2.6/32': mock_scan_clients.return_value[1]}, ENVIRONMENT_MAP)
+
+    def test_reconcile_rebalances_a_new_server(self, mock_scan_clients, mock_get_config_files, mock_update_environments, mock_write_client_configs, mock_get_environment_map):
+        # Arrange: dev had servers a and b and gets a third, c, which takes over some of their peers.
+        servers = [
+            {'server_id': s, 'instance_id': f'i-{s}', 'public_key': f'{s}_key', 'wireguard_endpoint': f'{s}.example.com:64731'}
+            for s in ['a', 'b', 'c']
+        ]
+        environment_map = {'dev': {'public_key': '', 'wireguard_endpoint': '', 'vpc_cidr': '10.50.0.0/16', 'instance_id': '', 'servers': servers}}
+        mock_get_environment_map.return_value = environment_map
+        public_keys = [f'key{i}' for i in range(30)]
+        mock_scan_clients.return_value = [
+            {'ClientIP': {'S': f'192.168.2.{i + 5}/32'}, 'PublicKey': {'S': k}, 'Environments': {'L': [{'S': 'dev'}]}}
+            for i, k in enumerate(public_keys)
+        ]
+        old_ring = helpers.HashRing(['a', 'b'])
+        config_files_map = {'dev/c': '[Interface]\nAddress = 192.168.2.1/32'}
+        for server_id in ['a', 'b']:
+            config_files_map[f'dev/{server_id}'] = '\n\n'.join(['[Interface]\nAddress = 192.168.2.1/32'] + [
+                f'[Peer]\nPublicKey = {k}\nAllowedIPs = 192.168.2.{i + 5}/32'
+                for i, k in enumerate(public_keys) if old_ring.get_server(k) == server_id
+            ])
+        mock_get_config_files.return_value = (config_files_map, {})
+        mock_update_environments.return_value = ({}, {})
+
+        # Act
+        main.reconcile({}, {})
+
+        # Assert: the peers now placed on c move there from a and b, and only their clients are rendered again.
+        new_ring = helpers.HashRing(['a', 'b', 'c'])
+        moved = [k for k in public_keys if new_ring.get_server(k) == 'c']
+        self.assertGreater(len(moved), 0)
+        peer_changes = mock_update_environments.call_args.args[2]
+        self.assertEqual(peer_changes['dev/c'], {k: f'192.168.2.{public_keys.index(k) + 5}/32' for k in moved})
+        self.assertEqual(
+            sorted(k for server_id in ['a', 'b'] for k in peer_changes.get(f'dev/{server_id}', {})), sorted(moved)
+        )
+        self.assertTrue(all(v is None for server_id in ['a', 'b'] for v in peer_changes.get(f'dev/{server_id}', {}).values()))
+        self.assertEqual(len(mock_write_client_configs.call_args.args[0]), len(moved))
+
+    def test_reconcile_failures(self, mock_scan_clients, mock_get_config_files, mock_update_environments, mock_write_client_configs, mock_get_environment_map):
+        mock_scan_clients.return_value = []
+        mock_get_config_files.return_value = ({}, {'dev': Exception('SSM Error')})
+        mock_update_environments.return_value = (ENVIRONMENT_MAP, {})
+
+        with self.assertRaises(Exception):
+            main.reconcile({}, {})
+
+
+VALID_KEYS = [base64.b64encode(bytes([i]) * 32).decode('ascii') for i in range(4)]
+
+
+@patch('helpers.get_environment_map', return_value=ENVIRONMENT_MAP)
+@patch('helpers.add_items_to_dynamodb')
+@patch('helpers.claim_public_key_guards', return_value=[])
+@patch('helpers.get_ip_allocator')
+@patch('helpers.does_public_key_exist_already', side_effect=lambda public_key: public_key == VALID_KEYS[3])
+class TestAddNewClients(unittest.TestCase):
+    def test_add_new_clients(self, mock_does_public_key_exist_already, mock_get_ip_allocator, mock_claim_public_key_guards, mock_add_items_to_dynamodb, mock_get_environment_map):
+        # Arrange
+        mock_allocator = mock_get_ip_allocator.return_value
+        mock_allocator.allocate_many.return_value = ['192.168.2.5/32', '192.168.2.6/32']
+        event = {'clients': [
+            {'public_key': VALID_KEYS[0], 'environments': ['dev']},
+            {'public_key': VALID_KEYS[1], 'environments': ['dev']},
+            {'public_key': VALID_KEYS[1], 'environments': ['dev']},
+            {'public_key': VALID_KEYS[2], 'environments': ['nope']},
+            {'public_key': VALID_KEYS[3], 'environments': ['dev']},
+            {'public_key': 'key1', 'environments': ['dev']},
+        ]}
+
+        # Act
+        result = main.add_new_clients(event, {})
+
+        # Assert
+        mock_allocator.allocate_many.assert_called_once_with(2, helpers.get_all_taken_client_ips)
+        self.assertEqual([c['client_ip'] for c in result['added']], ['192.168.2.5/32', '192.168.2.6/32'])
+        self.assertEqual([r['public_key'] for r in result['rejected']], [VALID_KEYS[1], VALID_KEYS[2], VALID_KEYS[3], 'key1'])
+        mock_add_items_to_dynamodb.assert_called_once_with(result['added'])
+
+    def test_add_new_clients_key_taken_concurrently(self, mock_does_public_key_exist_already, mock_get_ip_allocator, mock_claim_public_key_guards, mock_add_items_to_dynamodb, mock_get_environment_map):
+        mock_allocator = mock_get_ip_allocator.return_value
+        mock_allocator.allocate_many.return_value = ['192.168.2.5/32', '192.168.2.6/32']
+        mock_claim_public_key_guards.return_value = [VALID_KEYS[1]]
+
+        result = main.add_new_clients({'clients': [{'public_key': k, 'environments': ['dev']} for k in VALID_KEYS[:2]]}, {})
+
+        mock_allocator.release_many.assert_called_once_with(['192.168.2.6/32'])
+        self.assertEqual([c['public_key'] for c in result['added']], [VALID_KEYS[0]])
+        self.assertEqual(result['rejected'], [{'public_key': VALID_KEYS[1], 'reason': 'public key already exists'}])
+
+
+@patch('helpers.get_environment_map', return_value=ENVIRONMENT_MAP)
+class TestExportClientConfigs(unittest.TestCase):
+    @patch('helpers.upload_client_config_archive')
+    @patch('helpers.get_client_from_dynamodb')
+    @patch('helpers.get_materialized_client_configs')
+    def test_export_client_configs(self, mock_get_materialized_client_configs, mock_get_client_from_dynamodb, mock_upload_client_config_archive, mock_get_environment_map):
+        # Arrange: one pre-rendered config, one client that still has to be rendered and one that doesn't exist.
+        config = helpers.render_client_config('192.168.2.5/32', 'key1', ['dev'], ENVIRONMENT_MAP)
+        mock_get_materialized_client_configs.return_value = {'192.168.2.5/32': {
+            'Config': config, 'ETag': helpers.get_config_hash(config), 'PublicKey': 'key1', 'Environments': ['dev'], 'Version': 1
+        }}
+
+        def get_client_from_dynamodb(client_ip):
+            if client_ip != '192.168.2.6/32':
+                raise helpers.ClientNotFoundError(client_ip)
+            return {'ClientIP': client_ip, 'PublicKey': 'key2', 'Environments': ['dev']}
+
+        mock_get_client_from_dynamodb.side_effect = get_client_from_dynamodb
+        archives = {}
+
+        def upload_client_config_archive(archive, key):
+            with zipfile.ZipFile(archive) as zip_file:
+                archives[key] = {name: zip_file.read(name).decode('utf-8') for name in zip_file.namelist()}
+            return 'https://example.com/export.zip'
+
+        mock_upload_client_config_archive.side_effect = upload_client_config_archive
+
+        # Act
+        result = main.export_client_configs({'client_ips': ['192.168.2.5/32', '192.168.2.6/32', '192.168.2.7/32']}, {})
+
+        # Assert
+        self.assertEqual(result['exported'], 2)
+        self.assertEqual(result['missing'], ['192.168.2.7/32'])
+        self.assertEqual(result['url'], 'https://example.com/export.zip')
+        self.assertEqual(archives[result['key']], {
+            '192.168.2.5.conf': config,
+            '192.168.2.6.conf': helpers.render_client_config('192.168.2.6/32', 'key2', ['dev'], ENVIRONMENT_MAP),
+        })
+
+
+@patch('helpers.get_environment_map')
+@patch('helpers.delete_items_from_dynamodb')
+@patch('main.update_environments')
+@patch('helpers.get_config_files')
+@patch('helpers.get_clients_from_dynamodb')
+@patch('helpers.get_client_ip_by_public_key')
+class TestRevokeClients(unittest.TestCase):
+    ENVIRONMENT_MAP = dict(ENVIRONMENT_MAP, prod=dict(ENVIRONMENT_MAP['dev'], instance_id='i-2'))
+    CLIENTS = {
+        '192.168.2.5/32': {'ClientIP': '192.168.2.5/32', 'PublicKey': 'key1', 'Environments': ['dev']},
+        '192.168.2.6/32': {'ClientIP': '192.168.2.6/32', 'PublicKey': 'key2', 'Environments': ['dev', 'prod']},
+        '192.168.2.7/32': {'ClientIP': '192.168.2.7/32', 'PublicKey': 'key3', 'Environments': ['prod']},
+    }
+
+    def test_revoke_clients_edits_each_environment_once(self, mock_get_client_ip_by_public_key, mock_get_clients_from_dynamodb, mock_get_config_files, mock_update_environments, mock_delete_items_from_dynamodb, mock_get_environment_map):
+        # Arrange
+        mock_get_environment_map.return_value = copy.deepcopy(self.ENVIRONMENT_MAP)
+        mock_get_client_ip_by_public_key.side_effect = lambda k: {'key3': '192.168.2.7/32'}.get(k)
+        mock_get_clients_from_dynamodb.return_value = self.CLIENTS
+        mock_get_config_files.return_value = ({'dev': 'dev_config', 'prod': 'prod_config'}, {})
+        environment_map = copy.deepcopy(self.ENVIRONMENT_MAP)
+        environment_map['dev'].update(status='Success', completed_at=time.time() + 2)
+        environment_map['prod'].update(status='TimedOut')
+        mock_update_environments.return_value = (environment_map, {})
+
+        # Act
+        result = main.revoke_clients({'client_ips': ['192.168.2.5/32', '192.168.2.6/32', '192.168.2.9/32'], 'public_keys': ['key3', 'key4']}, {})
+
+        # Assert
+        mock_get_clients_from_dynamodb.assert_called_once_with(['192.168.2.5/32', '192.168.2.6/32', '192.168.2.9/32', '192.168.2.7/32'])
+        self.assertEqual(mock_update_environments.call_count, 1)
+        self.assertEqual(mock_update_environments.call_args.args[2], {'dev': {'key1': None, 'key2': None}, 'prod': {'key2': None, 'key3': None}})
+        mock_delete_items_from_dynamodb.assert_called_once_with(['192.168.2.5/32', '192.168.2.6/32', '192.168.2.7/32'])
+        self.assertEqual(result['missing'], ['key4', '192.168.2.9/32'])
+        self.assertEqual(list(result['enforced_seconds']), ['dev'])
+        self.assertGreater(result['enforced_seconds']['dev'], 0)
+        self.assertEqual(result['pending_environments'], ['prod'])
+
+    def test_revoke_clients_keeps_clients_of_failed_environments(self, mock_get_client_ip_by_public_key, mock_get_clients_from_dynamodb, mock_get_config_files, mock_update_environments, mock_delete_items_from_dynamodb, mock_get_environment_map):
+        mock_get_environment_map.return_value = copy.deepcopy(self.ENVIRONMENT_MAP)
+        mock_get_clients_from_dynamodb.return_value = self.CLIENTS
+        mock_get_config_files.return_value = ({'dev': 'dev_config'}, {'prod': Exception('throttled')})
+        mock_update_environments.return_value = (copy.deepcopy(self.ENVIRONMENT_MAP), {})
+
+        result = main.revoke_clients({'client_ips': list(self.CLIENTS)}, {})
+
+        mock_delete_items_from_dynamodb.assert_called_once_with(['192.168.2.5/32'])
+        self.assertEqual(result['failed'], {'192.168.2.6/32': 'could not update prod', '192.168.2.7/32': 'could not update prod'})
+
+    @patch('main.revoke_clients')
+    def test_remove_client(self, mock_revoke_clients, *mocks):
+        main.remove_client({'public_key': 'key1'}, {})
+
+        mock_revoke_clients.assert_called_once_with({'public_keys': ['key1']}, {})
+
+
+@patch('helpers.complete_config_claim')
+@patch('helpers.release_config_claim')
+@patch('helpers.claim_config_hash', return_value=4)
+@patch('helpers.record_apply_results')
+@patch('helpers.record_config_hashes')
+@patch('helpers.check_status_of_commands')
+@patch('helpers.send_commands')
+@patch('helpers.publish_config_deltas')
+@patch('helpers.update_config_file_parameters')
+@patch('helpers.get_environment_states')
+class TestUpdateEnvironments(unittest.TestCase):
+    SEED_CONFIG = '[Interface]\nAddress = 192.168.2.1/32'
+
+    def test_environments_are_pipelined(self, mock_get_environment_states, mock_update_config_file_parameters, mock_publish_config_deltas, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, mock_record_apply_results, mock_claim_config_hash, mock_release_config_claim, mock_complete_config_claim):
+        # Arrange: the slow environment's config is only stored once the fast one's is, which never happens if the
+        # environments are persisted one after the other starting with the slow one. The slow server also only
+        # finishes once the fast one's result was recorded.
+        environment_map = {'slow': dict(ENVIRONMENT_MAP['dev'], instance_id='i-2'), 'fast': dict(ENVIRONMENT_MAP['dev'], instance_id='i-1')}
+        fast_persisted = threading.Event()
+        mock_get_environment_states.return_value = {}
+
+        def update_config_file_parameters(config_files_map):
+            if 'slow' in config_files_map and not fast_persisted.wait(5):
+                return {}, {'slow': Exception('fast environment never persisted')}
+            if 'fast' in config_files_map:
+                fast_persisted.set()
+            return {k: 1 for k in config_files_map}, {}
+
+        def check_status_of_commands(instance_id_map, timeout, on_complete):
+            on_complete({'fast': dict(instance_id_map['fast'], status='Success', applied_sequence='4')})
+            self.assertEqual(mock_record_apply_results.call_args.args[1], {'fast': True})
+            on_complete({'slow': dict(instance_id_map['slow'], status='Success', applied_sequence='4')})
+            return instance_id_map
+
+        mock_update_config_file_parameters.side_effect = update_config_file_parameters
+        mock_publish_config_deltas.side_effect = lambda m, sequences, hashes: (sequences, {})
+        mock_send_commands.side_effect = lambda m: (m, {})
+        mock_check_status_of_commands.side_effect = check_status_of_commands
+        peer_changes = {env: {'client_key': '192.168.2.5/32'} for env in environment_map}
+
+        # Act
+        result, failures = main.update_environments(environment_map, {env: self.SEED_CONFIG for env in environment_map}, peer_changes, {})
+
+        # Assert
+        self.assertEqual(failures, {})
+        self.assertEqual({k: v['status'] for k, v in result.items()}, {'fast': 'Success', 'slow': 'Success'})
+        mock_send_commands.assert_called_once()
+        self.assertEqual(mock_record_apply_results.call_count, 2)
+        self.assertEqual(sorted(c.args[0] for c in mock_complete_config_claim.call_args_list), ['fast', 'slow'])
+
+    def test_persist_failure_only_fails_its_environment(self, mock_get_environment_states, mock_update_config_file_parameters, mock_publish_config_deltas, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, mock_record_apply_results, mock_claim_config_hash, mock_release_config_claim, mock_complete_config_claim):
+        environment_map = {'dev': dict(ENVIRONMENT_MAP['dev']), 'prod': dict(ENVIRONMENT_MAP['dev'], instance_id='i-2')}
+        error = Exception('throttled')
+        mock_get_environment_states.return_value = {}
+        mock_update_config_file_parameters.side_effect = lambda m: ({}, {'prod': error}) if 'prod' in m else ({k: 1 for k in m}, {})
+        mock_publish_config_deltas.side_effect = lambda m, sequences, hashes: (sequences, {})
+        mock_send_commands.side_effect = lambda m: (m, {})
+        mock_check_status_of_commands.side_effect = lambda m, timeout, on_complete: {k: dict(v, status='Success') for k, v in m.items()}
+        peer_changes = {env: {'client_key': '192.168.2.5/32'} for env in environment_map}
+
+        result, failures = main.update_environments(environment_map, {env: self.SEED_CONFIG for env in environment_map}, peer_changes, {})
+
+        self.assertEqual(failures, {'prod': error})
+        mock_send_commands.assert_called_once()
+        self.assertEqual(result['dev']['status'], 'Success')
+        # The failed write hands its claim back so the next writer doesn't wait for it to go stale.
+        mock_release_config_claim.assert_called_once_with(
+            'prod', helpers.get_config_hash(self.SEED_CONFIG), mock_claim_config_hash.call_args.args[2], 4
+        )
+        mock_complete_config_claim.assert_called_once_with('dev', 4, mock_claim_config_hash.call_args.args[2])
+
+    @patch('helpers.get_conflict_delay', return_value=0)
+    @patch('helpers.read_config_file')
+    def test_conflicting_write_is_applied_to_the_fresh_config(self, mock_read_config_file, mock_get_conflict_delay, mock_get_environment_states, mock_update_config_file_parameters, mock_publish_config_deltas, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, mock_record_apply_results, mock_claim_config_hash, mock_release_config_claim, mock_complete_config_claim):
+        # Arrange: another writer stored a config with its own client while this one was editing the seed config.
+        fresh_config = self.SEED_CONFIG + '\n\n[Peer]\nPublicKey = other_key\nAllowedIPs = 192.168.2.6/32'
+        mock_read_config_file.return_value = fresh_config
+        mock_claim_config_hash.side_effect = [helpers.ConfigConflictError('changed'), 4]
+        mock_get_environment_states.side_effect = [{'dev': {}}, {'dev': {'PublishedHash': helpers.get_config_hash(fresh_config)}}]
+        mock_update_config_file_parameters.side_effect = lambda m: ({k: 1 for k in m}, {})
+        mock_publish_config_deltas.side_effect = lambda m, sequences, hashes: (sequences, {})
+        mock_send_commands.side_effect = lambda m: (m, {})
+        mock_check_status_of_commands.side_effect = lambda m, timeout, on_complete: {k: dict(v, status='Success') for k, v in m.items()}
+
+        # Act
+        result, failures = main.update_environments(
+            {'dev': ENVIRONMENT_MAP['dev']}, {'dev': self.SEED_CONFIG}, {'dev': {'client_key': '192.168.2.5/32'}}, {}
+        )
+
+        # Assert: both clients' peers are stored and the delta starts from the other writer's config.
+        self.assertEqual(failures, {})
+        stored = mock_update_config_file_parameters.call_args.args[0]['dev']
+        self.assertIn('other_key', stored)
+        self.assertIn('client_key', stored)
+        self.assertEqual(mock_claim_config_hash.call_args_list[1].args, ('dev', helpers.get_config_hash(fresh_config), helpers.get_config_hash(stored), helpers.CONFIG_CLAIM_TIMEOUT_SECONDS))
+        mock_publish_config_deltas.assert_called_once_with(
+            {'dev': ['add client_key 192.168.2.5/32']}, {'dev': 4},
+            {'dev': (helpers.get_config_hash(fresh_config), helpers.get_config_hash(stored))}
+        )
+        # The state is read again along with the config, so the retry sees the other writer's published delta.
+        mock_get_environment_states.assert_called_with(['dev'])
+        self.assertEqual(mock_get_environment_states.call_count, 2)
+
+    @patch('helpers.get_conflict_delay', return_value=0)
+    @patch('helpers.read_config_file', return_value=SEED_CONFIG)
+    def test_gives_up_after_repeated_conflicts(self, mock_read_config_file, mock_get_conflict_delay, mock_get_environment_states, mock_update_config_file_parameters, mock_publish_config_deltas, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, mock_record_apply_results, mock_claim_config_hash, mock_release_config_claim, mock_complete_config_claim):
+        mock_claim_config_hash.side_effect = helpers.ConfigConflictError('changed')
+        mock_get_environment_states.return_value = {'dev': {}}
+
+        result, failures = main.update_environments(
+            {'dev': ENVIRONMENT_MAP['dev']}, {'dev': self.SEED_CONFIG}, {'dev': {'client_key': '192.168.2.5/32'}}, {}
+        )
+
+        self.assertEqual(list(failures), ['dev'])
+        self.assertEqual(mock_claim_config_hash.call_count, helpers.CONFIG_WRITE_MAX_ATTEMPTS)
+        mock_update_config_file_parameters.assert_not_called()
+
+    @patch('time.sleep')
+    @patch('helpers.read_config_file', return_value=SEED_CONFIG)
+    def test_waits_for_a_claimed_config_without_using_up_attempts(self, mock_read_config_file, mock_sleep, mock_get_environment_states, mock_update_config_file_parameters, mock_publish_config_deltas, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, mock_record_apply_results, mock_claim_config_hash, mock_release_config_claim, mock_complete_config_claim):
+        # Arrange: another writer holds the claim for longer than the attempts would last.
+        claimed = helpers.ConfigClaimedError('claimed', int(time.time()) + 60)
+        mock_claim_config_hash.side_effect = [claimed] * (helpers.CONFIG_WRITE_MAX_ATTEMPTS + 1) + [4]
+        mock_get_environment_states.return_value = {'dev': {}}
+        mock_update_config_file_parameters.side_effect = lambda m: ({k: 1 for k in m}, {})
+        mock_publish_config_deltas.side_effect = lambda m, sequences, hashes: (sequences, {})
+        mock_send_commands.side_effect = lambda m: (m, {})
+        mock_check_status_of_commands.side_effect = lambda m, timeout, on_complete: {k: dict(v, status='Success') for k, v in m.items()}
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 300000
+
+        # Act
+        result, failures = main.update_environments(
+            {'dev': ENVIRONMENT_MAP['dev']}, {'dev': self.SEED_CONFIG}, {'dev': {'client_key': '192.168.2.5/32'}}, context
+        )
+
+        # Assert: the claim is polled, and this writer's own claim only lasts as long as its invocation has left.
+        self.assertEqual(failures, {})
+        mock_sleep.assert_called_with(helpers.CONFIG_CLAIM_POLL_SECONDS)
+        self.assertEqual(mock_claim_config_hash.call_args.args[3], 300)
+        mock_complete_config_claim.assert_called_once()
+
+    @patch('time.sleep')
+    @patch('helpers.read_config_file', return_value=SEED_CONFIG)
+    def test_gives_up_waiting_when_the_claim_outlasts_the_invocation(self, mock_read_config_file, mock_sleep, mock_get_environment_states, mock_update_config_file_parameters, mock_publish_config_deltas, mock_send_commands, mock_check_status_of_commands, mock_record_config_hashes, mock_record_apply_results, mock_claim_config_hash, mock_release_config_claim, mock_complete_config_claim):
+        mock_claim_config_hash.side_effect = helpers.ConfigClaimedError('claimed', int(time.time()) + 600)
+        mock_get_environment_states.return_value = {'dev': {}}
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 1000
+
+        result, failures = main.update_environments(
+            {'dev': ENVIRONMENT_MAP['dev']}, {'dev': self.SEED_CONFIG}, {'dev': {'client_key': '192.168.2.5/32'}}, context
+        )
+
+        self.assertIn('gave up waiting', str(failures['dev']))
+        mock_sleep.assert_not_called()
+        mock_update_config_file_parameters.assert_not_called()
+
+
+
+@patch('helpers.get_environment_map', return_value=ENVIRONMENT_MAP)
+@patch('helpers.expire_client_environments', return_value=(['192.168.2.5/32'], ['192.168.2.6/32'], []))
+@patch('main.update_environments')
+@patch('helpers.get_config_files')
+@patch('helpers.scan_clients')
+@patch('helpers.update_peer_liveness')
+@patch('helpers.collect_peer_dumps')
+class TestCollectPeerLiveness(unittest.TestCase):
+    CLIENTS = [
+        {'ClientIP': {'S': '192.168.2.5/32'}, 'PublicKey': {'S': 'key1'}, 'Environments': {'L': [{'S': 'dev'}, {'S': 'prod'}]}},
+        {'ClientIP': {'S': '192.168.2.6/32'}, 'PublicKey': {'S': 'key2'}, 'Environments': {'L': [{'S': 'dev'}]}},
+        {'ClientIP': {'S': '192.168.2.7/32'}, 'PublicKey': {'S': 'key3'}, 'Environments': {'L': [{'S': 'dev'}]}},
+    ]
+
+    def arrange(self, mock_collect_peer_dumps, mock_update_peer_liveness, mock_scan_clients):
+        now = int(time.time())
+        mock_collect_peer_dumps.return_value = ({'dev': {}}, {'prod': Exception('Failed')})
+        mock_update_peer_liveness.return_value = ({'dev': {
+            'key1': (now - 200 * 86400, 0, 0, 0),
+            'key2': (now - 200 * 86400, now - 100 * 86400, 0, 0),
+            'key3': (now - 200 * 86400, now - 86400, 0, 0),
+        }}, {})
+        mock_scan_clients.return_value = self.CLIENTS
+
+    def test_expires_idle_peers(self, mock_collect_peer_dumps, mock_update_peer_liveness, mock_scan_clients, mock_get_config_files, mock_update_environments, mock_expire_client_environments, mock_get_environment_map):
+        self.arrange(mock_collect_peer_dumps, mock_update_peer_liveness, mock_scan_clients)
+        mock_get_config_files.return_value = ({'dev': 'dev_config'}, {})
+        mock_update_environments.return_value = ({}, {})
+
+        result = main.collect_peer_liveness({}, {})
+
+        mock_update_environments.assert_called_once_with(ENVIRONMENT_MAP, {'dev': 'dev_config'}, {'dev': {'key1': None, 'key2': None}}, {})
+        self.assertEqual(mock_expire_client_environments.call_args.args[0]['192.168.2.5/32']['expired'], ['dev'])
+        self.assertEqual(result['expired_peers'], {'dev': 2})
+        self.assertEqual(result['reclaimed_bytes'], {'dev': helpers.get_peer_section_size('key1', '192.168.2.5/32') * 2})
+        self.assertEqual(result['updated_clients'], ['192.168.2.5/32'])
+        self.assertEqual(result['deleted_clients'], ['192.168.2.6/32'])
+        self.assertEqual(result['failed'], {'prod': 'Failed'})
+
+    def test_dry_run_only_reports(self, mock_collect_peer_dumps, mock_update_peer_liveness, mock_scan_clients, mock_get_config_files, mock_update_environments, mock_expire_client_environments, mock_get_environment_map):
+        self.arrange(mock_collect_peer_dumps, mock_update_peer_liveness, mock_scan_clients)
+
+        result = main.collect_peer_liveness({'dry_run': True, 'expiry_days': 50}, {})
+
+        mock_update_environments.assert_not_called()
+        mock_expire_client_environments.assert_not_called()
+        self.assertEqual(result['expired_peers'], {'dev': 2})
+        self.assertTrue(result['dry_run'])
+
+    def test_zero_expiry_days_only_collects(self, mock_collect_peer_dumps, mock_update_peer_liveness, mock_scan_clients, mock_get_config_files, mock_update_environments, mock_expire_client_environments, mock_get_environment_map):
+        self.arrange(mock_collect_peer_dumps, mock_update_peer_liveness, mock_scan_clients)
+
+        result = main.collect_peer_liveness({'expiry_days': 0}, {})
+
+        mock_scan_clients.assert_not_called()
+        self.assertEqual(result['collected'], ['dev'])
+        self.assertEqual(result['expired_peers'], {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'WireguardUpdater')
+# CloudWatch accepts at most this many values per metric in one embedded metric format document.
+MAX_VALUES_PER_METRIC = 100
+# Error codes the AWS APIs the updater calls use when they throttle a request.
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyUpdates',
+    'RequestLimitExceeded',
+    'ProvisionedThroughputExceededException',
+}
+
+
+class MetricsLogger:
+    # Collects the metrics of one invocation and prints them as CloudWatch embedded metric format documents, which
+    # CloudWatch turns into metrics straight from the log line without any PutMetricData calls. Metrics are recorded
+    # per function and, when an environment is given, per function and environment. Handlers record from many
+    # threads at once, so every update takes the lock.
+
+    def __init__(self, function_name='', namespace=NAMESPACE):
+        self.function_name = function_name
+        self.namespace = namespace
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def put(self, name, value, unit='Count', environment=None):
+        # Keeps every value, e.g. one propagation latency per record.
+        with self.lock:
+            self.metrics.setdefault(environment, {}).setdefault(name, (unit, []))[1].append(value)
+
+    def increment(self, name, value=1, unit='Count', environment=None):
+        # Adds up into a single value, e.g. the calls made over the whole invocation.
+        with self.lock:
+            values = self.metrics.setdefault(environment, {}).setdefault(name, (unit, [0]))[1]
+            values[0] += value
+
+    @contextlib.contextmanager
+    def timer(self, phase, environment=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.increment(f'{phase}Time', (time.perf_counter() - started) * 1000, 'Milliseconds', environment)
+
+    def get_documents(self, timestamp=None):
+        timestamp = int((timestamp or time.time()) * 1000)
+        documents = []
+        with self.lock:
+            metrics = {k: dict(v) for k, v in self.metrics.items()}
+        for environment, values in metrics.items():
+            dimensions = {'Function': self.function_name}
+            if environment is not None:
+                dimensions['Environment'] = environment
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [list(dimensions)],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in sorted(values.items())],
+                    }],
+                },
+                **dimensions,
+            }
+            for name, (_, samples) in values.items():
+                samples = samples[-MAX_VALUES_PER_METRIC:]
+                document[name] = samples[0] if len(samples) == 1 else samples
+            documents.append(document)
+        return documents
+
+    def flush(self):
+        for document in self.get_documents():
+            print(json.dumps(document))
+        with self.lock:
+            self.metrics = {}
+
+
+# The AWS clients outlive invocations, so their hooks record into whichever logger the running handler started.
+current = MetricsLogger()
+
+
+def start(function_name):
+    global current
+    current = MetricsLogger(function_name)
+    return current
+
+
+def get_current():
+    return current
+
+
+def instrument_client(client, prefix):
+    # Counts every call the client makes, the retries botocore made for it and the attempts that were throttled.
+
+    def after_call(parsed=None, **kwargs):
+        get_current().increment(f'{prefix}Calls')
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries > 0:
+            get_current().increment(f'{prefix}Retries', retries)
+
+    def needs_retry(response=None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            get_current().increment(f'{prefix}Throttles')
+        # Returning None leaves the decision to botocore's own retry handler.
+        return None
+
+    service = client.meta.service_model.service_id.hyphenize()
+    client.meta.events.register(f'after-call.{service}', after_call)
+    client.meta.events.register_first(f'needs-retry.{service}', needs_retry)
+    return client
@@ -0,0 +1,95 @@
+import unittest
+import boto3
+from unittest.mock import MagicMock
+from botocore.stub import Stubber
+import metrics
+from metrics import MetricsLogger
+
+
+class TestMetricsLogger(unittest.TestCase):
+    def test_get_documents_per_environment(self):
+        recorder = MetricsLogger('handle_stream_updates', 'Test')
+        recorder.increment('RecordsProcessed', 3)
+        recorder.increment('RecordsProcessed', 2)
+        recorder.put('PropagationLatency', 1200, 'Milliseconds', 'dev')
+        recorder.put('PropagationLatency', 800, 'Milliseconds', 'dev')
+
+        documents = recorder.get_documents(timestamp=1700000000)
+
+        self.assertEqual(documents, [
+            {
+                '_aws': {
+                    'Timestamp': 1700000000000,
+                    'CloudWatchMetrics': [{
+                        'Namespace': 'Test',
+                        'Dimensions': [['Function']],
+                        'Metrics': [{'Name': 'RecordsProcessed', 'Unit': 'Count'}],
+                    }],
+                },
+                'Function': 'handle_stream_updates',
+                'RecordsProcessed': 5,
+            },
+            {
+                '_aws': {
+                    'Timestamp': 1700000000000,
+                    'CloudWatchMetrics': [{
+                        'Namespace': 'Test',
+                        'Dimensions': [['Function', 'Environment']],
+                        'Metrics': [{'Name': 'PropagationLatency', 'Unit': 'Milliseconds'}],
+                    }],
+                },
+                'Function': 'handle_stream_updates',
+                'Environment': 'dev',
+                'PropagationLatency': [1200, 800],
+            },
+        ])
+
+    def test_timer_adds_up(self):
+        recorder = MetricsLogger('reconcile')
+        with recorder.timer('Wait'):
+            pass
+        with recorder.timer('Wait'):
+            pass
+
+        [document] = recorder.get_documents()
+
+        self.assertEqual(document['_aws']['CloudWatchMetrics'][0]['Metrics'], [{'Name': 'WaitTime', 'Unit': 'Milliseconds'}])
+        self.assertIsInstance(document['WaitTime'], float)
+
+    def test_flush_resets(self):
+        recorder = MetricsLogger('reconcile')
+        recorder.increment('DriftedEnvironments')
+
+        recorder.flush()
+
+        self.assertEqual(recorder.get_documents(), [])
+
+
+class TestInstrumentClient(unittest.TestCase):
+    def test_counts_calls_and_throttles(self):
+        client = boto3.client('ssm', 'us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+        metrics.instrument_client(client, 'Ssm')
+        recorder = metrics.start('handle_stream_updates')
+        stubber = Stubber(client)
+        stubber.add_response('put_parameter', {'Version': 2})
+        stubber.add_client_error('put_parameter', 'ThrottlingException')
+        stubber.activate()
+
+        client.put_parameter(Name='/dev/wireguard/config_file', Value='config', Type='SecureString', Overwrite=True)
+        with self.assertRaises(client.exceptions.ClientError):
+            client.put_parameter(Name='/dev/wireguard/config_file', Value='config', Type='SecureString', Overwrite=True)
+
+        # The stubber answers before botocore's retry handler runs, so the throttled attempt is replayed by hand.
+        client.meta.events.emit(
+            'needs-retry.ssm.PutParameter',
+            response=(MagicMock(status_code=400, headers={}), {'Error': {'Code': 'ThrottlingException'}}),
+            endpoint=None, operation=None, attempts=1, caught_exception=None, request_dict={'context': {}}
+        )
+
+        [document] = recorder.get_documents()
+        self.assertEqual(document['SsmCalls'], 2)
+        self.assertEqual(document['SsmThrottles'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import base64
+import binascii
+import gzip
+import struct
+from botocore.exceptions import ClientError
+
+# What a server reports about its peers: `wg show wg0 dump` without its first line, which is the interface's and
+# holds the private key, cut down to the public key, latest handshake and transfer rx and tx columns.
+DUMP_COMMAND = "sudo wg show wg0 dump | awk 'NR > 1 {print $1, $5, $6, $7}'"
+# Every peer is stored as its raw public key, when it was first seen, its latest handshake (both unix seconds) and
+# its rx and tx byte counters, 56 bytes a peer before compression.
+PEER_RECORD = struct.Struct('<32sIIQQ')
+
+
+def parse_peer_dump(output):
+    # Returns public key -> (latest handshake, rx bytes, tx bytes) from DUMP_COMMAND's output. A peer that never
+    # completed a handshake reports 0.
+    peers = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        try:
+            peers[fields[0]] = (int(fields[1]), int(fields[2]), int(fields[3]))
+        except ValueError:
+            print(f"parse_peer_dump: Skipping malformed line '{line}'")
+    return peers
+
+
+def merge_peer_liveness(previous, dump, now):
+    # The new liveness of an environment from its last one and the server's current dump. Handshakes only ever move
+    # forward, so a replaced or restarted server doesn't make its peers look idle for longer than they are. Peers no
+    # longer on the server are dropped.
+    liveness = {}
+    for public_key, (latest_handshake, rx_bytes, tx_bytes) in dump.items():
+        first_seen, last_handshake, _, _ = previous.get(public_key, (now, 0, 0, 0))
+        liveness[public_key] = (first_seen, max(last_handshake, latest_handshake), rx_bytes, tx_bytes)
+    return liveness
+
+
+def get_idle_peers(liveness, now, max_idle_seconds):
+    # Peers without a handshake in max_idle_seconds. A peer that never had one counts from when it was first seen.
+    cutoff = now - max_idle_seconds
+    return sorted(k for k, (first_seen, last_handshake, _, _) in liveness.items() if max(first_seen, last_handshake) < cutoff)
+
+
+def pack_peer_liveness(liveness):
+    records = []
+    for public_key, values in sorted(liveness.items()):
+        try:
+            raw_key = base64.b64decode(public_key, validate=True)
+        except (binascii.Error, ValueError):
+            continue
+        if len(raw_key) == 32:
+            records.append(PEER_RECORD.pack(raw_key, *values))
+    # mtime is fixed so the same liveness always compresses to the same bytes.
+    return gzip.compress(b''.join(records), mtime=0)
+
+
+def unpack_peer_liveness(data):
+    liveness = {}
+    for raw_key, *values in PEER_RECORD.iter_unpack(gzip.decompress(data)):
+        liveness[base64.b64encode(raw_key).decode('ascii')] = tuple(values)
+    return liveness
+
+
+class PeerLivenessStore:
+    # Keeps each environment's peer liveness as one packed object in the liveness bucket, next to the command output
+    # the servers upload their dumps to.
+
+    def __init__(self, s3_client, bucket, output_prefix='output'):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.output_prefix = output_prefix
+
+    @staticmethod
+    def get_object_key(env):
+        return f'liveness/{env}.bin.gz'
+
+    def read(self, env):
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket, Key=self.get_object_key(env))['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise e
+            return {}
+        return unpack_peer_liveness(body)
+
+    def write(self, env, liveness):
+        data = pack_peer_liveness(liveness)
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.get_object_key(env), Body=data, ContentType='application/gzip')
+        return len(data)
+
+    def read_command_output(self, command_id, instance_id):
+        # SSM uploads the output under <prefix>/<command id>/<instance id>/, in a folder named after the plugin.
+        prefix = f'{self.output_prefix}/{command_id}/{instance_id}/'
+        response = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=prefix)
+        keys = [o['Key'] for o in response.get('Contents', []) if o['Key'].endswith('/stdout')]
+        if len(keys) == 0:
+            return ''
+        return self.s3_client.get_object(Bucket=self.bucket, Key=keys[0])['Body'].read().decode('utf-8')
@@ -0,0 +1,107 @@
+import base64
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+import peer_liveness
+
+KEY1 = base64.b64encode(b'\x01' * 32).decode('ascii')
+KEY2 = base64.b64encode(b'\x02' * 32).decode('ascii')
+# What `wg show wg0 dump` prints: the interface first, then one tab separated line per peer.
+WG_DUMP = (
+    'server_private_key\tserver_public_key\t64731\toff\n'
+    f'{KEY1}\t(none)\t198.51.100.7:51820\t192.168.2.5/32\t1700000000\t1024\t2048\t0\n'
+    f'{KEY2}\t(none)\t(none)\t192.168.2.6/32\t0\t0\t0\t0\n'
+)
+
+
+class TestPeerDump(unittest.TestCase):
+    def test_dump_command_leaves_out_the_interface(self):
+        with tempfile.TemporaryDirectory() as root:
+            for name, body in {'sudo': 'exec "$@"\n', 'wg': f"printf '{WG_DUMP}'\n"}.items():
+                path = os.path.join(root, name)
+                with open(path, 'w') as f:
+                    f.write('#!/bin/bash\n' + body)
+                os.chmod(path, 0o755)
+            result = subprocess.run(
+                ['bash', '-c', peer_liveness.DUMP_COMMAND],
+                env=dict(os.environ, PATH=f"{root}:{os.environ['PATH']}"),
+                capture_output=True,
+                text=True,
+            )
+
+        self.assertNotIn('server_private_key', result.stdout)
+        self.assertEqual(peer_liveness.parse_peer_dump(result.stdout), {KEY1: (1700000000, 1024, 2048), KEY2: (0, 0, 0)})
+
+    def test_parse_skips_malformed_lines(self):
+        self.assertEqual(peer_liveness.parse_peer_dump(f'{KEY1} 5 6 7\ngarbage\n{KEY2} x 1 2\n'), {KEY1: (5, 6, 7)})
+
+
+class TestPeerLiveness(unittest.TestCase):
+    def test_merge_keeps_first_seen_and_latest_handshake(self):
+        previous = {KEY1: (100, 500, 10, 20), 'gone': (100, 0, 0, 0)}
+
+        # The server was replaced, so KEY1's handshake and counters start over.
+        liveness = peer_liveness.merge_peer_liveness(previous, {KEY1: (0, 0, 0), KEY2: (0, 0, 0)}, 1000)
+
+        self.assertEqual(liveness, {KEY1: (100, 500, 0, 0), KEY2: (1000, 0, 0, 0)})
+
+    def test_idle_peers(self):
+        liveness = {KEY1: (100, 500, 0, 0), KEY2: (900, 0, 0, 0), 'never': (100, 0, 0, 0)}
+
+        self.assertEqual(peer_liveness.get_idle_peers(liveness, 1000, 600), ['never'])
+        self.assertEqual(peer_liveness.get_idle_peers(liveness, 1000, 50), sorted([KEY1, KEY2, 'never']))
+
+    def test_pack_round_trip(self):
+        liveness = {KEY1: (100, 1700000000, 2 ** 40, 3), KEY2: (200, 0, 0, 0)}
+
+        data = peer_liveness.pack_peer_liveness(liveness)
+
+        self.assertEqual(peer_liveness.unpack_peer_liveness(data), liveness)
+        self.assertEqual(data, peer_liveness.pack_peer_liveness(dict(reversed(list(liveness.items())))))
+
+    def test_pack_is_compact(self):
+        liveness = {base64.b64encode(os.urandom(32)).decode('ascii'): (1700000000, 1700000000 + i, i, i) for i in range(1000)}
+
+        self.assertLess(len(peer_liveness.pack_peer_liveness(liveness)), 1000 * peer_liveness.PEER_RECORD.size)
+
+
+class TestPeerLivenessStore(unittest.TestCase):
+    def test_read_missing_environment(self):
+        s3_client = MagicMock()
+        s3_client.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey', 'Message': ''}}, 'GetObject')
+
+        self.assertEqual(peer_liveness.PeerLivenessStore(s3_client, 'bucket').read('dev'), {})
+
+    def test_write_and_read(self):
+        s3_client = MagicMock()
+        store = peer_liveness.PeerLivenessStore(s3_client, 'bucket')
+
+        size = store.write('dev', {KEY1: (1, 2, 3, 4)})
+        body = s3_client.put_object.call_args.kwargs['Body']
+        s3_client.get_object.return_value = {'Body': io.BytesIO(body)}
+
+        self.assertEqual(size, len(body))
+        self.assertEqual(s3_client.put_object.call_args.kwargs['Key'], 'liveness/dev.bin.gz')
+        self.assertEqual(store.read('dev'), {KEY1: (1, 2, 3, 4)})
+
+    def test_read_command_output(self):
+        s3_client = MagicMock()
+        s3_client.list_objects_v2.return_value = {'Contents': [
+            {'Key': 'output/cmd/i-1/awsrunShellScript/0.awsrunShellScript/stderr'},
+            {'Key': 'output/cmd/i-1/awsrunShellScript/0.awsrunShellScript/stdout'},
+        ]}
+        s3_client.get_object.return_value = {'Body': io.BytesIO(b'dump')}
+
+        output = peer_liveness.PeerLivenessStore(s3_client, 'bucket').read_command_output('cmd', 'i-1')
+
+        self.assertEqual(output, 'dump')
+        s3_client.list_objects_v2.assert_called_once_with(Bucket='bucket', Prefix='output/cmd/i-1/')
+        s3_client.get_object.assert_called_once_with(Bucket='bucket', Key='output/cmd/i-1/awsrunShellScript/0.awsrunShellScript/stdout')
+
+
+if __name__ == '__main__':
+    unittest.main()
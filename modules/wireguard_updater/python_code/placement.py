@@ -0,0 +1,29 @@
+import bisect
+import hashlib
+
+# Points every server gets on the ring. More points spread the peers more evenly over the servers.
+VIRTUAL_NODES = 64
+
+
+def get_ring_position(value):
+    return int.from_bytes(hashlib.sha256(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    # Places peers on an environment's servers by consistent hashing. Every server owns the arcs of the ring that end
+    # at its points, and a peer goes to the server owning the point its public key hashes to. Adding or removing a
+    # server only moves the peers on the arcs it takes over or gives up, about 1/N of them, and leaves the rest where
+    # they are.
+
+    def __init__(self, server_ids, virtual_nodes=VIRTUAL_NODES):
+        if len(server_ids) == 0:
+            raise Exception("a hash ring needs at least one server")
+        points = sorted(
+            (get_ring_position(f'{server_id}#{i}'), server_id) for server_id in server_ids for i in range(virtual_nodes)
+        )
+        self.positions = [position for position, _ in points]
+        self.server_ids = [server_id for _, server_id in points]
+
+    def get_server(self, key):
+        index = bisect.bisect(self.positions, get_ring_position(key)) % len(self.positions)
+        return self.server_ids[index]
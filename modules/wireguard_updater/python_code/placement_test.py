@@ -0,0 +1,48 @@
+import base64
+import random
+import unittest
+from placement import HashRing
+
+PUBLIC_KEYS = [base64.b64encode(random.Random(i).randbytes(32)).decode('ascii') for i in range(3000)]
+
+
+class TestHashRing(unittest.TestCase):
+    def test_placement_is_stable(self):
+        ring, shuffled_ring = HashRing(['a', 'b', 'c']), HashRing(['c', 'a', 'b'])
+
+        self.assertEqual([ring.get_server(k) for k in PUBLIC_KEYS], [shuffled_ring.get_server(k) for k in PUBLIC_KEYS])
+
+    def test_spreads_peers_over_servers(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {}
+        for public_key in PUBLIC_KEYS:
+            server_id = ring.get_server(public_key)
+            counts[server_id] = counts.get(server_id, 0) + 1
+
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        self.assertTrue(all(600 < count < 1400 for count in counts.values()), counts)
+
+    def test_adding_a_server_only_moves_peers_to_it(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+
+        moved = [k for k in PUBLIC_KEYS if before.get_server(k) != after.get_server(k)]
+
+        self.assertTrue(all(after.get_server(k) == 'd' for k in moved))
+        self.assertLess(len(moved), len(PUBLIC_KEYS) / 3)
+
+    def test_removing_a_server_only_moves_its_peers(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'c'])
+
+        moved = [k for k in PUBLIC_KEYS if before.get_server(k) != after.get_server(k)]
+
+        self.assertEqual(moved, [k for k in PUBLIC_KEYS if before.get_server(k) == 'b'])
+
+    def test_needs_a_server(self):
+        with self.assertRaises(Exception):
+            HashRing([])
+
+
+if __name__ == '__main__':
+    unittest.main()
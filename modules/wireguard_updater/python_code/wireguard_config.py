@@ -0,0 +1,91 @@
+class WireGuardConfig:
+    # A parsed wg-quick config. The [Interface] section is kept as an ordered list of (key, value) pairs and the
+    # peers are indexed by public key, so adding, removing and rekeying a peer doesn't rescan the config.
+
+    def __init__(self, interface=None, peers=None):
+        self.interface = interface if interface is not None else []
+        self.peers = peers if peers is not None else {}
+
+    @classmethod
+    def parse(cls, config_str):
+        config = cls()
+        sections = []
+        section = None
+        for line in config_str.splitlines():
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                section = (line[1:-1].strip().lower(), [])
+                sections.append(section)
+                continue
+            key, _, value = line.partition('=')
+            if section is None:
+                raise Exception(f"config line '{line}' is not inside a section")
+            section[1].append((key.strip(), value.strip()))
+
+        for name, entries in sections:
+            if name == 'interface':
+                config.interface.extend(entries)
+            elif name == 'peer':
+                public_key = next((v for k, v in entries if k == 'PublicKey'), '')
+                config.peers[public_key] = [(k, v) for k, v in entries if k != 'PublicKey']
+            else:
+                raise Exception(f"unknown config section [{name}]")
+        return config
+
+    def __contains__(self, public_key):
+        return public_key in self.peers
+
+    def __len__(self):
+        return len(self.peers)
+
+    def get_allowed_ips(self, public_key):
+        return ', '.join(v for k, v in self.peers.get(public_key, []) if k == 'AllowedIPs')
+
+    def add_peer(self, public_key, allowed_ips):
+        if public_key in self.peers:
+            return False
+        self.peers[public_key] = [('AllowedIPs', allowed_ips)]
+        return True
+
+    def set_peer(self, public_key, allowed_ips):
+        # Adds the peer, or replaces its AllowedIPs while keeping any other settings it has.
+        if public_key not in self.peers:
+            return self.add_peer(public_key, allowed_ips)
+        if self.get_allowed_ips(public_key) == allowed_ips:
+            return False
+        entries = [(k, v) for k, v in self.peers[public_key] if k != 'AllowedIPs']
+        self.peers[public_key] = [('AllowedIPs', allowed_ips)] + entries
+        return True
+
+    def remove_peer(self, public_key):
+        return self.peers.pop(public_key, None) is not None
+
+    def rekey_peer(self, old_public_key, new_public_key):
+        if old_public_key not in self.peers or old_public_key == new_public_key:
+            return False
+        self.peers[new_public_key] = self.peers.pop(old_public_key)
+        return True
+
+    def diff(self, other):
+        # The ordered peer operations that turn this config's peer set into other's. Removals come first so an
+        # address that moves between peers is never claimed twice.
+        removed = [('remove', public_key, '') for public_key in self.peers if public_key not in other.peers]
+        added = [
+            ('add', public_key, other.get_allowed_ips(public_key))
+            for public_key in other.peers
+            if public_key not in self.peers or self.get_allowed_ips(public_key) != other.get_allowed_ips(public_key)
+        ]
+        return removed + added
+
+    def serialize(self):
+        sections = []
+        if len(self.interface) > 0:
+            sections.append('\n'.join(['[Interface]'] + [f'{k} = {v}' for k, v in self.interface]))
+        for public_key, entries in self.peers.items():
+            sections.append('\n'.join(['[Peer]', f'PublicKey = {public_key}'] + [f'{k} = {v}' for k, v in entries]))
+        return '\n\n'.join(sections)
+
+    def __str__(self):
+        return self.serialize()
@@ -0,0 +1,128 @@
+import unittest
+from wireguard_config import WireGuardConfig
+
+
+CONFIG = """
+[Interface]
+Address = 192.168.2.2/32
+ListenPort = 51820
+PrivateKey = server_private_key
+
+[Peer]
+PublicKey = key1
+AllowedIPs = 192.168.2.5/32
+
+[Peer]
+# comment lines are dropped
+AllowedIPs = 192.168.2.6/32
+PublicKey = key2
+PersistentKeepalive = 25
+"""
+
+
+class TestParse(unittest.TestCase):
+    def test_parse(self):
+        config = WireGuardConfig.parse(CONFIG)
+
+        self.assertEqual(config.interface, [('Address', '192.168.2.2/32'), ('ListenPort', '51820'), ('PrivateKey', 'server_private_key')])
+        self.assertEqual(list(config.peers), ['key1', 'key2'])
+        self.assertEqual(config.peers['key2'], [('AllowedIPs', '192.168.2.6/32'), ('PersistentKeepalive', '25')])
+        self.assertEqual(config.get_allowed_ips('key1'), '192.168.2.5/32')
+
+    def test_parse_values_containing_equals(self):
+        config = WireGuardConfig.parse('[Peer]\nPublicKey = abc=\nAllowedIPs = 10.0.0.1/32')
+
+        self.assertIn('abc=', config)
+
+    def test_parse_unknown_section(self):
+        with self.assertRaises(Exception):
+            WireGuardConfig.parse('[Unknown]\nKey = value')
+
+    def test_parse_line_outside_section(self):
+        with self.assertRaises(Exception):
+            WireGuardConfig.parse('Key = value')
+
+    def test_serialize_is_canonical(self):
+        config = WireGuardConfig.parse(CONFIG)
+
+        self.assertEqual(config.serialize(), """[Interface]
+Address = 192.168.2.2/32
+ListenPort = 51820
+PrivateKey = server_private_key
+
+[Peer]
+PublicKey = key1
+AllowedIPs = 192.168.2.5/32
+
+[Peer]
+PublicKey = key2
+AllowedIPs = 192.168.2.6/32
+PersistentKeepalive = 25""")
+        self.assertEqual(WireGuardConfig.parse(config.serialize()).serialize(), config.serialize())
+
+
+class TestPeers(unittest.TestCase):
+    def test_add_peer(self):
+        config = WireGuardConfig.parse(CONFIG)
+
+        self.assertTrue(config.add_peer('key3', '192.168.2.7/32'))
+        self.assertFalse(config.add_peer('key1', '192.168.2.8/32'))
+        self.assertEqual(list(config.peers), ['key1', 'key2', 'key3'])
+        self.assertEqual(config.get_allowed_ips('key1'), '192.168.2.5/32')
+
+    def test_set_peer(self):
+        config = WireGuardConfig.parse(CONFIG)
+
+        self.assertFalse(config.set_peer('key2', '192.168.2.6/32'))
+        self.assertTrue(config.set_peer('key2', '192.168.2.9/32'))
+        self.assertEqual(config.peers['key2'], [('AllowedIPs', '192.168.2.9/32'), ('PersistentKeepalive', '25')])
+        self.assertTrue(config.set_peer('key3', '192.168.2.7/32'))
+        self.assertEqual(len(config), 3)
+
+    def test_remove_peer(self):
+        config = WireGuardConfig.parse(CONFIG)
+
+        self.assertTrue(config.remove_peer('key1'))
+        self.assertFalse(config.remove_peer('key1'))
+        self.assertNotIn('key1', config)
+        self.assertEqual(list(config.peers), ['key2'])
+
+    def test_rekey_peer(self):
+        config = WireGuardConfig.parse(CONFIG)
+
+        self.assertTrue(config.rekey_peer('key1', 'new_key'))
+        self.assertFalse(config.rekey_peer('missing_key', 'other_key'))
+        self.assertNotIn('key1', config)
+        self.assertEqual(config.get_allowed_ips('new_key'), '192.168.2.5/32')
+
+    def test_many_peers(self):
+        config = WireGuardConfig.parse('[Interface]\nAddress = 192.168.2.2/32')
+        for i in range(5000):
+            config.add_peer(f'key{i}', f'10.0.{i // 256}.{i % 256}/32')
+
+        config = WireGuardConfig.parse(config.serialize())
+        config.remove_peer('key2500')
+
+        self.assertEqual(len(config), 4999)
+        self.assertNotIn('key2500', config)
+
+
+class TestDiff(unittest.TestCase):
+    def test_diff(self):
+        old = WireGuardConfig.parse(CONFIG)
+        new = WireGuardConfig.parse(CONFIG)
+        new.rekey_peer('key1', 'key3')
+        new.set_peer('key2', '192.168.2.7/32, 10.0.0.0/24')
+
+        self.assertEqual(old.diff(new), [
+            ('remove', 'key1', ''),
+            ('add', 'key2', '192.168.2.7/32, 10.0.0.0/24'),
+            ('add', 'key3', '192.168.2.5/32'),
+        ])
+
+    def test_diff_unchanged(self):
+        self.assertEqual(WireGuardConfig.parse(CONFIG).diff(WireGuardConfig.parse(CONFIG)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# Only created when the server configs are stored as objects instead of SSM parameters.
+resource "aws_s3_bucket" "wireguard_config" {
+  count         = var.config_store == "s3" ? 1 : 0
+  bucket_prefix = "wireguard-config-"
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+resource "aws_s3_bucket_server_side_encryption_configuration" "wireguard_config" {
+  count  = var.config_store == "s3" ? 1 : 0
+  bucket = aws_s3_bucket.wireguard_config[0].id
+
+  rule {
+    apply_server_side_encryption_by_default {
+      sse_algorithm     = "aws:kms"
+      kms_master_key_id = var.config_kms_key_id != "" ? var.config_kms_key_id : null
+    }
+    bucket_key_enabled = true
+  }
+}
+
+resource "aws_s3_bucket_public_access_block" "wireguard_config" {
+  count  = var.config_store == "s3" ? 1 : 0
+  bucket = aws_s3_bucket.wireguard_config[0].id
+
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+# config_kms_key_id may also be an alias, the policies need the key's arn.
+data "aws_kms_key" "wireguard_config" {
+  count  = var.config_store == "s3" && var.config_kms_key_id != "" ? 1 : 0
+  key_id = var.config_kms_key_id
+}
+
+locals {
+  config_bucket_name = var.config_store == "s3" ? aws_s3_bucket.wireguard_config[0].id : ""
+  config_bucket_arn  = var.config_store == "s3" ? aws_s3_bucket.wireguard_config[0].arn : ""
+  config_kms_key_arn = var.config_store == "s3" && var.config_kms_key_id != "" ? data.aws_kms_key.wireguard_config[0].arn : ""
+}
+
+# Client config exports are only kept long enough to be downloaded through their presigned url.
+resource "aws_s3_bucket" "client_config_exports" {
+  bucket_prefix = "wireguard-client-exports-"
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+resource "aws_s3_bucket_server_side_encryption_configuration" "client_config_exports" {
+  bucket = aws_s3_bucket.client_config_exports.id
+
+  rule {
+    apply_server_side_encryption_by_default {
+      sse_algorithm = "aws:kms"
+    }
+    bucket_key_enabled = true
+  }
+}
+
+resource "aws_s3_bucket_public_access_block" "client_config_exports" {
+  bucket = aws_s3_bucket.client_config_exports.id
+
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_s3_bucket_lifecycle_configuration" "client_config_exports" {
+  bucket = aws_s3_bucket.client_config_exports.id
+
+  rule {
+    id     = "expire-exports"
+    status = "Enabled"
+
+    filter {
+      prefix = "exports/"
+    }
+
+    expiration {
+      days = 1
+    }
+  }
+}
+
+# The servers upload their peer dumps here and collect_peer_liveness keeps each environment's peer liveness here.
+resource "aws_s3_bucket" "peer_liveness" {
+  bucket_prefix = "wireguard-peer-liveness-"
+
+  tags = {
+    DeployedBy = "terraform"
+    Name       = "wireguard-updater"
+  }
+}
+
+resource "aws_s3_bucket_server_side_encryption_configuration" "peer_liveness" {
+  bucket = aws_s3_bucket.peer_liveness.id
+
+  rule {
+    apply_server_side_encryption_by_default {
+      sse_algorithm = "aws:kms"
+    }
+    bucket_key_enabled = true
+  }
+}
+
+resource "aws_s3_bucket_public_access_block" "peer_liveness" {
+  bucket = aws_s3_bucket.peer_liveness.id
+
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_s3_bucket_lifecycle_configuration" "peer_liveness" {
+  bucket = aws_s3_bucket.peer_liveness.id
+
+  # The raw dumps are only read once, by the run that asked for them.
+  rule {
+    id     = "expire-command-output"
+    status = "Enabled"
+
+    filter {
+      prefix = "output/"
+    }
+
+    expiration {
+      days = 1
+    }
+  }
+}
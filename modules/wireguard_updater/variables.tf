@@ -3,14 +3,224 @@ variable "account_id" {
 }
 
 variable "vpn_environments" {
-  # A dynamic map of environments and instance IDs
+  # A dynamic map of environments and instance IDs. An environment served by several servers lists them in servers
+  # instead of setting instance_id, public_key and wireguard_endpoint; the updater spreads its peers over them with a
+  # consistent hash ring. Every server needs a server_id made of letters, digits, '_', '.' and '-', the same one that
+  # was passed to its wireguard_vpn_server module.
   type = list(object({
     environment        = string
-    instance_id        = string
-    public_key         = string
-    wireguard_endpoint = string
+    instance_id        = optional(string, "")
+    public_key         = optional(string, "")
+    wireguard_endpoint = optional(string, "")
     vpc_cidr           = string
+    servers = optional(list(object({
+      server_id          = string
+      instance_id        = string
+      public_key         = string
+      wireguard_endpoint = string
+    })), [])
   }))
   default = []
 }
 
+variable "stream_batch_size" {
+  # Maximum number of DynamoDB stream records handed to handle_stream_updates in one invocation.
+  type    = number
+  default = 100
+}
+
+variable "stream_batching_window_in_seconds" {
+  # How long to buffer stream records before invoking handle_stream_updates.
+  type    = number
+  default = 5
+}
+
+variable "stream_parallelization_factor" {
+  # How many batches of each stream shard handle_stream_updates processes concurrently, from 1 to 10. Raise it for
+  # onboarding bursts.
+  type    = number
+  default = 1
+}
+
+variable "stream_maximum_retry_attempts" {
+  # How often a failing batch of stream records is retried before it is sent to the dead letter queue.
+  type    = number
+  default = 5
+}
+
+variable "stream_maximum_record_age_in_seconds" {
+  # Stream records older than this are sent to the dead letter queue instead of being retried. -1 keeps them until
+  # they expire from the stream.
+  type    = number
+  default = 3600
+}
+
+variable "environment_retry_base_seconds" {
+  # How long an environment whose server failed to apply its config is skipped, doubling with every failure in a row.
+  type    = number
+  default = 30
+}
+
+variable "environment_retry_max_seconds" {
+  # Upper bound on how long an environment with a failing server is skipped.
+  type    = number
+  default = 900
+}
+
+variable "ssm_max_concurrency" {
+  # Maximum number of environments whose SSM parameters and commands are handled concurrently.
+  type    = number
+  default = 10
+}
+
+variable "handle_stream_updates_timeout" {
+  # Lambda timeout in seconds for handle_stream_updates. Must leave room for the servers to apply their configs.
+  type    = number
+  default = 300
+}
+
+variable "command_wait_timeout_seconds" {
+  # Upper bound on how long handle_stream_updates waits for the servers to finish applying a config.
+  type    = number
+  default = 120
+}
+
+variable "wireguard_apply_mode" {
+  # "syncconf" hot-applies peer changes without dropping tunnels, "restart" restarts wg-quick@wg0 on every change.
+  type    = string
+  default = "syncconf"
+
+  validation {
+    condition     = contains(["syncconf", "restart"], var.wireguard_apply_mode)
+    error_message = "wireguard_apply_mode must be either \"syncconf\" or \"restart\"."
+  }
+}
+
+variable "apply_max_concurrency" {
+  # How many servers apply a config at the same time, as a number or a percentage of the servers being updated.
+  # Lower it to roll changes out in waves.
+  type    = string
+  default = "50"
+}
+
+variable "apply_max_errors" {
+  # How many servers may fail to apply a config, as a number or a percentage, before the rest aren't sent it anymore.
+  # Failing servers are retried on their own schedule, so by default every server is always tried.
+  type    = string
+  default = "100%"
+}
+
+variable "client_cidr" {
+  # Pool that client ips are allocated from. Can be IPv4 or IPv6 and should contain the WireGuard servers' addresses.
+  type    = string
+  default = "192.168.2.0/24"
+}
+
+variable "client_ip_reserved_count" {
+  # Number of addresses at the start of client_cidr that are never handed to clients, e.g. for the servers.
+  type    = number
+  default = 5
+}
+
+variable "config_store" {
+  # Where the server configs are stored. "parameter" is a Standard tier SSM parameter (about 40 peers),
+  # "advanced_parameter" an Advanced tier one (about 80 peers), "sharded_parameter" compressed shards over as many
+  # parameters as needed and "s3" a KMS encrypted object, for thousands of peers.
+  type    = string
+  default = "parameter"
+
+  validation {
+    condition     = contains(["parameter", "advanced_parameter", "sharded_parameter", "s3"], var.config_store)
+    error_message = "config_store must be one of \"parameter\", \"advanced_parameter\", \"sharded_parameter\" or \"s3\"."
+  }
+}
+
+variable "config_shard_tier" {
+  # Parameter tier of the shards when config_store is "sharded_parameter". Advanced shards hold twice as much.
+  type    = string
+  default = "Standard"
+
+  validation {
+    condition     = contains(["Standard", "Advanced"], var.config_shard_tier)
+    error_message = "config_shard_tier must be either \"Standard\" or \"Advanced\"."
+  }
+}
+
+variable "config_kms_key_id" {
+  # KMS key the config objects are encrypted with when config_store is "s3". Defaults to the aws/s3 key.
+  type    = string
+  default = ""
+}
+
+variable "reconcile_schedule_expression" {
+  # How often the reconcile lambda rebuilds the server configs from the client table.
+  type    = string
+  default = "rate(1 hour)"
+}
+
+variable "reconcile_timeout" {
+  # Lambda timeout in seconds for the reconcile lambda.
+  type    = number
+  default = 900
+}
+
+variable "reconcile_memory_size" {
+  # Memory in MB for the reconcile lambda. The whole client table is held in memory while it runs.
+  type    = number
+  default = 1024
+}
+
+variable "reconcile_scan_segments" {
+  # Number of parallel scan segments the reconcile lambda reads the client table with.
+  type    = number
+  default = 8
+}
+
+variable "revoke_clients_timeout" {
+  # Timeout of the revoke_clients lambda, which waits for every affected server to apply the revocation.
+  type    = number
+  default = 300
+}
+
+variable "add_new_clients_timeout" {
+  # Timeout of the add_new_clients lambda, which validates, claims and writes every client of a request in one run.
+  type    = number
+  default = 300
+}
+
+variable "metrics_namespace" {
+  # CloudWatch namespace of the metrics the stream handler and the reconcile lambda log in embedded metric format.
+  type    = string
+  default = "WireguardUpdater"
+}
+
+variable "export_url_expiry_seconds" {
+  # How long the presigned url returned by export_client_configs stays valid.
+  type    = number
+  default = 900
+}
+
+variable "registry_cache_ttl_seconds" {
+  # How long a lambda serves the environment registry from memory before checking the registry version again.
+  type    = number
+  default = 60
+}
+
+variable "liveness_schedule_expression" {
+  # How often the collect_peer_liveness lambda collects the servers' peer handshakes.
+  type    = string
+  default = "rate(1 day)"
+}
+
+variable "collect_peer_liveness_timeout" {
+  # Timeout of the collect_peer_liveness lambda, which waits for every server's dump and for expired peers to apply.
+  type    = number
+  default = 900
+}
+
+variable "peer_expiry_days" {
+  # Peers without a handshake for this many days are removed from the servers and their clients' environments.
+  # 0 only collects the liveness.
+  type    = number
+  default = 90
+}
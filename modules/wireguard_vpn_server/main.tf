@@ -16,6 +16,9 @@ data "aws_ami" "amazon_linux" {
 
 locals {
   config_file = "[Interface]\nAddress = ${var.wireguard_ip_address}\nListenPort = ${var.wireguard_port}\nPrivateKey = ${var.wireguard_private_key}"
+  # The config target the updater stores this server's config under, and the prefix of its resource names.
+  target = var.server_id != "" ? "${var.environment}/${var.server_id}" : var.environment
+  name   = var.server_id != "" ? "${var.environment}-${var.server_id}" : var.environment
 }
 
 resource "aws_instance" "vpn" {
@@ -37,16 +40,25 @@ resource "aws_instance" "vpn" {
     echo -e '${local.config_file}' | sudo tee /etc/wireguard/wg0.conf
     systemctl enable wg-quick@wg0
     sudo systemctl start wg-quick@wg0
-    sudo iptables -A FORWARD -i wg0 -j ACCEPT
-    sudo iptables -t nat -A POSTROUTING -o ens5 -j MASQUERADE
+    sudo iptables -C FORWARD -i wg0 -j ACCEPT 2> /dev/null || sudo iptables -A FORWARD -i wg0 -j ACCEPT
+    sudo iptables -t nat -C POSTROUTING -o ens5 -j MASQUERADE 2> /dev/null || sudo iptables -t nat -A POSTROUTING -o ens5 -j MASQUERADE
   EOT
 
   associate_public_ip_address = true
   iam_instance_profile        = aws_iam_instance_profile.wireguard_profile.name
 
-  tags = {
-    Name = "${var.environment}-wireguard-vpn"
+  # The updater's apply document reads the Environment and WireguardServer tags from the instance metadata to find the
+  # server's config.
+  metadata_options {
+    http_endpoint          = "enabled"
+    http_tokens            = "required"
+    instance_metadata_tags = "enabled"
   }
+
+  tags = merge({
+    Name        = "${local.name}-wireguard-vpn"
+    Environment = var.environment
+  }, var.server_id != "" ? { WireguardServer = var.server_id } : {})
 }
 
 resource "aws_eip" "wireguard" {
@@ -54,7 +66,7 @@ resource "aws_eip" "wireguard" {
 }
 
 resource "aws_iam_role" "wireguard_role" {
-  name               = "${var.environment}-wireguard-vpn-role"
+  name               = "${local.name}-wireguard-vpn-role"
   assume_role_policy = <<EOF
 {
   "Version": "2012-10-17",
@@ -68,7 +80,7 @@ EOF
 }
 
 resource "aws_iam_instance_profile" "wireguard_profile" {
-  name = "${var.environment}-wireguard-vpn-profile"
+  name = "${local.name}-wireguard-vpn-profile"
   role = aws_iam_role.wireguard_role.name
 }
 
@@ -78,7 +90,7 @@ resource "aws_iam_role_policy_attachment" "this" {
 }
 
 resource "aws_iam_role_policy" "wireguard_policy" {
-  name   = "${var.environment}-wireguard-kms-decrypt"
+  name   = "${local.name}-wireguard-kms-decrypt"
   role   = aws_iam_role.wireguard_role.name
   policy = <<EOF
 {
@@ -96,9 +108,59 @@ resource "aws_iam_role_policy" "wireguard_policy" {
 EOF
 }
 
+resource "aws_iam_role_policy" "wireguard_config_bucket" {
+  # Lets the server stream its config from the updater's config bucket when the updater uses the s3 config store.
+  # Listing the bucket makes a config object that wasn't written yet answer 404, so the server keeps its seed config.
+  count  = var.config_store == "s3" ? 1 : 0
+  name   = "${local.name}-wireguard-config-bucket"
+  role   = aws_iam_role.wireguard_role.name
+  policy = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3:GetObject"
+            ],
+            "Resource": "${var.config_bucket_arn}/${local.target}/*"
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3:ListBucket"
+            ],
+            "Resource": "${var.config_bucket_arn}"
+        }
+    ]
+}
+EOF
+}
+
+resource "aws_iam_role_policy" "wireguard_liveness_bucket" {
+  # Lets the SSM agent upload the output of the updater's peer dump command.
+  count  = var.enable_liveness_bucket ? 1 : 0
+  name   = "${local.name}-wireguard-liveness-bucket"
+  role   = aws_iam_role.wireguard_role.name
+  policy = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3:PutObject"
+            ],
+            "Resource": "${var.liveness_bucket_arn}/output/*"
+        }
+    ]
+}
+EOF
+}
+
 resource "aws_security_group" "vpn" {
-  name        = "${var.environment}-wireguard-vpn"
-  description = "SG for Wireguard VPN Server - ${var.environment}"
+  name        = "${local.name}-wireguard-vpn"
+  description = "SG for Wireguard VPN Server - ${local.name}"
   vpc_id      = var.vpc_id
 
   ingress {
@@ -123,12 +185,12 @@ resource "aws_security_group" "vpn" {
   }
 
   tags = {
-    Name = "${var.environment}-wireguard-vpn"
+    Name = "${local.name}-wireguard-vpn"
   }
 }
 
 resource "aws_ssm_parameter" "wireguard_config_file" {
-  name  = "/${var.environment}/wireguard/config_file"
+  name  = "/${local.target}/wireguard/config_file"
   type  = "SecureString"
   value = local.config_file
   lifecycle {
@@ -32,4 +32,35 @@ variable "region" {
 
 variable "vpc_id" {
   type = string
-}
\ No newline at end of file
+}
+
+variable "config_store" {
+  # The wireguard_updater module's config_store. The server may read the config bucket when it is "s3".
+  type    = string
+  default = "parameter"
+}
+
+variable "config_bucket_arn" {
+  # The wireguard_updater module's config_bucket_arn output, only needed when its config_store is "s3".
+  type    = string
+  default = ""
+}
+
+variable "server_id" {
+  # Set when the environment has several servers, to tell this one apart. The server then gets its own config under
+  # /<environment>/<server_id>/wireguard/ and must be listed with the same server_id in the updater's vpn_environments.
+  type    = string
+  default = ""
+}
+
+variable "liveness_bucket_arn" {
+  # The wireguard_updater module's liveness_bucket_arn output, so the updater can collect the server's peer handshakes.
+  type    = string
+  default = ""
+}
+
+variable "enable_liveness_bucket" {
+  # Whether liveness_bucket_arn is set. The bucket's arn isn't known until it is created, so it can't decide this.
+  type    = bool
+  default = false
+}